@@ -0,0 +1,206 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Times the stages of ColdBrew on synthetic structures of increasing size, with the external programs replaced by the
+# stubs of stub_tools.py, so the results measure ColdBrew itself. Each stage is run once for its wall and CPU time and
+# once more with tracemalloc for its peak memory (Python and NumPy allocations).
+# Structures with more than 9999 waters do not fit in the files of naccess and HBPLUS (see validation.check_pdb_format_limits),
+# so their SASA and HB use the native backends.
+# usage: python benchmarks/pipeline_stages.py [-sizes 100 1000 10000 100000] [-o stages.json]
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import contextlib
+import numpy as np
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from functions.structure import read_structure, encode_hybrid36
+from functions.configuration import do_setup, get_backends
+from functions.execution import run_calculations
+from functions.data_parsing import parse_raw_datafiles
+from functions.data_analysis import read_in_parsed_data, calculate_CB_prob
+from stub_tools import write_stub_tools
+
+demo_pdb = os.path.join(root_dir, 'demo', '6GPW.pdb')
+# most waters that the files of naccess and HBPLUS hold
+max_external_waters = 9999
+
+def make_synthetic_structure(n_waters_, pdb_file_, template_file_=demo_pdb, spacing_=10.0):
+    """
+    Writes a synthetic structure with a given number of waters: copies of a template structure (protein, ions, and
+    waters) on a grid, 10 A apart, in one chain with new residue numbers (residue numbers and atom serials beyond the
+    columns are written in hybrid-36). The last copy keeps only the waters needed.
+
+    Args:
+        n_waters_ (int): Number of waters.
+        pdb_file_ (str): Path of the PDB file.
+        template_file_ (str): Path of the template structure (default: the demo, 358 waters).
+        spacing_ (float): Gap between the copies (Angstrom).
+
+    Returns:
+        int: Number of atoms.
+    """
+
+    with open(template_file_, 'r') as f:
+        lines = [line.rstrip('\n').ljust(80) for line in f if line.startswith(('ATOM', 'HETATM'))]
+    xyz = np.array([[float(line[30:38]), float(line[38:46]), float(line[46:54])] for line in lines])
+    residue_numbers = np.array([int(line[22:26]) for line in lines])
+    is_water = np.array([line[17:20] == 'HOH' for line in lines])
+    n_template = int(is_water.sum())
+    n_copies = -(-n_waters_ // n_template)
+    n_side = int(np.ceil(n_copies ** (1 / 3)))
+    size = xyz.max(axis=0) - xyz.min(axis=0) + spacing_
+    residue_step = 10**int(np.ceil(np.log10(residue_numbers.max() + 1)))
+
+    n_atoms, n_written = 0, 0
+    with open(pdb_file_, 'w') as f:
+        f.write('CRYST1%9.3f%9.3f%9.3f  90.00  90.00  90.00 P 1           1\n' % tuple(size * n_side))
+        for copy in range(n_copies):
+            shift = size * np.array([copy % n_side, (copy // n_side) % n_side, copy // n_side**2])
+            for line, (x, y, z), residue_number, water in zip(lines, xyz + shift, residue_numbers, is_water):
+                if water:
+                    if n_written == n_waters_:
+                        continue
+                    n_written += 1
+                n_atoms += 1
+                f.write(line[:6] + encode_hybrid36(n_atoms, 5).rjust(5) + line[11:21] + 'A' + encode_hybrid36(copy * residue_step + residue_number, 4).rjust(4) +
+                        line[26:30] + '%8.3f%8.3f%8.3f' % (x, y, z) + line[54:80] + '\n')
+        f.write('END\n')
+    return n_atoms
+
+def measure(function_, args_, trace_memory_):
+    """
+    Runs a stage and measures it (its output is hidden).
+
+    Args:
+        function_ (function): The stage.
+        args_ (list): Arguments of the stage.
+        trace_memory_ (bool): Measure the peak memory allocated by the stage with tracemalloc (slower).
+
+    Returns:
+        tuple: Result of the stage and a dictionary of its wall time (seconds), CPU time (seconds, this process and
+        the programs it ran), and peak memory (MB, if traced).
+    """
+
+    if trace_memory_:
+        tracemalloc.start()
+    cpu_start = os.times()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = function_(*args_)
+    seconds = time.perf_counter() - start
+    cpu_end = os.times()
+    metrics = {'seconds': round(seconds, 4), 'cpu_seconds': round(sum(cpu_end[:4]) - sum(cpu_start[:4]), 4)}
+    if trace_memory_:
+        metrics['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024**2, 2)
+        tracemalloc.stop()
+    return result, metrics
+
+def benchmark_size(n_waters_, workdir_, n_workers_=1, trace_memory_=True):
+    """
+    Runs the stages of ColdBrew on a synthetic structure with stub programs.
+
+    Args:
+        n_waters_ (int): Number of waters of the structure.
+        workdir_ (str): Directory of the structure and outputs.
+        n_workers_ (int): Maximum number of external calculations run at the same time (default: 1).
+        trace_memory_ (bool): Also measure the peak memory of each stage (default: True).
+
+    Returns:
+        dict: Size of the structure, backends, and the metrics of each stage (see measure).
+    """
+
+    pdb_id = 'synthetic_' + str(n_waters_)
+    outdir = os.path.join(workdir_, pdb_id)
+    os.makedirs(outdir, exist_ok=True)
+    pdb_file = os.path.join(outdir, pdb_id + '.pdb')
+    n_atoms = make_synthetic_structure(n_waters_, pdb_file)
+    # the stub programs do not read the reflections or the map
+    mtz_file, ccp4_file = os.path.join(outdir, 'stub.mtz'), os.path.join(outdir, 'stub.ccp4')
+    for path in [mtz_file, ccp4_file]:
+        open(path, 'w').close()
+    backends = get_backends({'SASA': 'native', 'HB': 'native'} if n_waters_ > max_external_waters else None)
+
+    stages = {}
+    def run_stage(name, function, *args):
+        result, metrics = measure(function, args, False)
+        if trace_memory_:
+            metrics['peak_memory_mb'] = measure(function, args, True)[1]['peak_memory_mb']
+        stages[name] = metrics
+        print('  ' + name + ': ' + '%.3f' % metrics['seconds'] + ' s' + (', ' + '%.1f' % metrics['peak_memory_mb'] + ' MB' if trace_memory_ else ''))
+        return result
+
+    structure = run_stage('read_structure', read_structure, pdb_file)
+    run_stage('do_setup', do_setup, structure, pdb_id, outdir, backends)
+    run_stage('run_calculations', run_calculations, pdb_file, pdb_id, mtz_file, ccp4_file, outdir, n_workers_, outdir, None, backends)
+    df_features = run_stage('parse_raw_datafiles', parse_raw_datafiles, structure, pdb_id, outdir, False, backends, ccp4_file)
+    run_stage('write_parsed_datafiles', parse_raw_datafiles, structure, pdb_id, outdir, True, backends, ccp4_file)
+    run_stage('read_in_parsed_data', read_in_parsed_data, pdb_id, outdir, structure.file_extension)
+    run_stage('calculate_CB_prob', lambda: calculate_CB_prob(structure, pdb_id, outdir, df_features.copy()))
+
+    return {'n_waters': n_waters_, 'n_atoms': n_atoms, 'backends': backends, 'stages': stages}
+
+def git_commit():
+    """
+    Returns the commit of the repository (None if it is not a git repository).
+    """
+    try:
+        return subprocess.run('git rev-parse --short HEAD', shell=True, check=True, capture_output=True, text=True, cwd=root_dir).stdout.strip()
+    except subprocess.CalledProcessError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sizes', dest='sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000], help='Numbers of waters of the synthetic structures (default: 100 1000 10000 100000).')
+    parser.add_argument('-o', dest='out_file', type=str, default=None, help='Save the results as JSON (e.g., benchmarks/results/<commit>.json) to compare commits.')
+    parser.add_argument('-workdir', dest='workdir', type=str, default=None, help='Directory of the structures and outputs (default: a temporary directory, removed at the end).')
+    parser.add_argument('-nproc', dest='nproc', type=int, default=1, help='Maximum number of stub programs run at the same time (default: 1).')
+    parser.add_argument('-no_memory', dest='no_memory', action='store_true', help='Do not measure the peak memory (each stage then runs once).')
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='coldbrew_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    os.environ.update(write_stub_tools(os.path.join(workdir, 'stubs')))
+
+    results = []
+    try:
+        for n_waters in args.sizes:
+            print(str(n_waters) + ' waters:')
+            results.append(benchmark_size(n_waters, os.path.abspath(workdir), args.nproc, not args.no_memory))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'cpus': os.cpu_count(), 'results': results}
+    if args.out_file is not None:
+        with open(args.out_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('saved ' + args.out_file)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Measures the startup time of run_coldbrew.py (a new interpreter for each run) and checks it against the targets.
+# usage: python benchmarks/startup.py [-n 10] [-ccp4 /path/to/6GPW_2mFo-DFc_map.ccp4] [-o startup.json]
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+run_coldbrew = os.path.join(root_dir, 'run_coldbrew.py')
+demo_pdb = os.path.join(root_dir, 'demo', '6GPW.pdb')
+demo_mtz = os.path.join(root_dir, 'demo', '6GPW.mtz')
+
+# median wall time (seconds) each case must stay under; the validation case depends on the size of the map and has no target
+startup_targets = {
+    'help': 0.25,
+    'missing_env': 0.25,
+    'import_pipeline': None,
+    'validate': None
+}
+
+def time_command(command_, n_runs_, env_=None):
+    """
+    Runs a command several times and returns its wall times.
+
+    Args:
+        command_ (list): The command.
+        n_runs_ (int): Number of runs.
+        env_ (dict): Environment variables of the command (default: the current environment).
+
+    Returns:
+        list: Wall time of each run (seconds).
+    """
+
+    times = []
+    for i in range(n_runs_):
+        start = time.perf_counter()
+        subprocess.run(command_, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env_, cwd=root_dir)
+        times.append(time.perf_counter() - start)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='n_runs', type=int, default=10, help='Number of runs of each case (default: 10).')
+    parser.add_argument('-ccp4', dest='ccp4_file', type=str, default=None, help='CCP4 map of the demo structure, to also time the validation-only mode.')
+    parser.add_argument('-o', dest='out_file', type=str, default=None, help='Save the results as JSON.')
+    args = parser.parse_args()
+
+    # the external programs are not run, so any value of their variables will do
+    env_missing = dict((key, value) for key, value in os.environ.items() if key != 'PYMOL_EXE')
+    env_set = dict(os.environ, **dict((key, os.getenv(key, 'unused')) for key in ['PYMOL_EXE', 'PHENIX_BIN', 'NACCESS_EXE', 'HBPLUS_EXE', 'EDIASCORER_EXE', 'EDIASCORER_LICENSE']))
+    cases = {
+        'help': ([sys.executable, run_coldbrew, '-h'], None),
+        'missing_env': ([sys.executable, run_coldbrew, '-pdb', demo_pdb, '-mtz', demo_mtz, '-ccp4', 'map.ccp4', '-o', '.'], env_missing),
+        'import_pipeline': ([sys.executable, '-c', 'import functions.pipeline'], None)
+    }
+    if args.ccp4_file is not None:
+        cases['validate'] = ([sys.executable, run_coldbrew, '-pdb', demo_pdb, '-mtz', demo_mtz, '-ccp4', os.path.abspath(args.ccp4_file), '-o', tempfile.gettempdir(), '-validate'], env_set)
+
+    results = {}
+    for name, (command, env) in cases.items():
+        times = sorted(time_command(command, args.n_runs, env))
+        median = times[len(times) // 2]
+        target = startup_targets[name]
+        results[name] = {'median': round(median, 4), 'min': round(times[0], 4), 'max': round(times[-1], 4), 'target': target,
+                         'passed': target is None or median <= target}
+        print(name + ': median ' + '%.3f' % median + ' s, min ' + '%.3f' % times[0] + ' s' + ('' if target is None else ' (target ' + '%.2f' % target + ' s: ' + ('passed' if median <= target else 'FAILED') + ')'))
+
+    if args.out_file is not None:
+        with open(args.out_file, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'n_runs': args.n_runs, 'results': results}, f, indent=2)
+    if not all(result['passed'] for result in results.values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Deterministic stand-ins for the external programs (PyMOL, phenix.real_space_correlation, naccess, HBPLUS, and
+# ediascorer), used by the benchmarks to time ColdBrew without the programs. Each writes its output files in the format
+# read by data_parsing.py, with values that depend only on the water number. They are called through the wrappers
+# made by write_stub_tools, with the command lines of execution.py and configuration.add_hydrogens.
+# usage: python benchmarks/stub_tools.py <pymol|phenix|naccess|hbplus|ediascorer> <arguments of the program>
+
+import os
+import sys
+import random
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from functions.structure import decode_hybrid36
+
+def read_atom_lines(pdb_file_):
+    """
+    Returns the ATOM and HETATM records of a PDB file.
+    """
+    with open(pdb_file_, 'r') as f:
+        return [line.rstrip('\n') for line in f if line.startswith(('ATOM', 'HETATM'))]
+
+def is_water(line_):
+    return line_[17:20] == 'HOH'
+
+def water_values(water_number_):
+    """
+    Returns the random generator of a water (the same values for the same water in every run).
+    """
+    return random.Random(water_number_)
+
+def run_pymol(args_):
+    # -cq script -- -id ID -o OUTDIR: the hydrogenated structure is the renumbered structure (the waters are what is parsed)
+    pdb_id, outdir = args_[args_.index('-id') + 1], args_[args_.index('-o') + 1]
+    shutil.copyfile(os.path.join(outdir, pdb_id + '_renumber.pdb'), os.path.join(outdir, pdb_id + '_renumber_pymolH.pdb'))
+    print(' PyMOL (stub): added hydrogens')
+
+def residue_number(line_):
+    # residue numbers beyond 9999 are written in hybrid-36
+    text = line_[22:26].strip()
+    return int(text) if text.lstrip('-').isdigit() else decode_hybrid36(text, 4)
+
+def run_phenix(args_):
+    # PDB MTZ > <ID>_original.txt: one line per atom, RSCC in the third last column
+    print('Input PDB file name: ' + os.path.basename(args_[0]))
+    print('Input reflection file name: ' + os.path.basename(args_[1]))
+    print('-------------------------------------------------------------------------------')
+    n_waters = 0
+    for line in read_atom_lines(args_[0]):
+        if is_water(line):
+            n_waters += 1
+            rscc = 0.5 + 0.5 * water_values(n_waters).random()
+        else:
+            rscc = 0.9
+        print(' %s   %s %5d %5s     %6.3f  %6.2f  %6.4f   %4.2f   %4.2f' % (line[21], line[17:20], residue_number(line), line[12:16].strip(), float(line[54:60]), float(line[60:66]), rscc, 1.5, 1.5))
+
+def run_naccess(args_):
+    # RENUMBERED.pdb -w: <base>.asa (SASA in the occupancy columns), <base>.rsa and <base>.log in the current directory
+    base = os.path.splitext(os.path.basename(args_[0]))[0]
+    n_waters = 0
+    with open(base + '.asa', 'w') as f:
+        for line in read_atom_lines(args_[0]):
+            if is_water(line):
+                n_waters += 1
+                sasa = 40 * water_values(n_waters).random()
+            else:
+                sasa = 10.0
+            f.write(line[:54].ljust(54) + '%8.3f' % sasa + '  1.40\n')
+    with open(base + '.rsa', 'w') as f:
+        f.write('REM  Relative accessibilites read from external file "standard.data"\n')
+    with open(base + '.log', 'w') as f:
+        f.write('naccess (stub)\n')
+    print('naccess (stub): ' + str(n_waters) + ' waters')
+
+def run_hbplus(args_):
+    # HYDROGENATED.pdb ORIGINAL.pdb: <base>.hb2 (0 to 4 hydrogen bonds of each water with the protein) and hbdebug.dat
+    base = os.path.splitext(os.path.basename(args_[0]))[0]
+    n_waters = 0
+    n_bonds = 0
+    with open(base + '.hb2', 'w') as f:
+        f.write('HBPLUS Hydrogen Bond Calculator (stub)\n' + '\n' * 7)
+        for line in read_atom_lines(args_[0]):
+            if not (is_water(line) and line[12:16].strip() == 'O'):
+                continue
+            n_waters += 1
+            values = water_values(n_waters)
+            for i in range(values.randint(0, 4)):
+                n_bonds += 1
+                partner, kind = ('A%04d-GLY N  ' % (i + 1), 'MH') if values.random() < 0.5 else ('A%04d-SER OG ' % (i + 1), 'SH')
+                f.write('%s A%04d-HOH O   %4.2f %s  -2 -1.00  -1.0 -1.00  -1.0  -1.0 %5d\n' % (partner, n_waters, 2.6 + values.random() / 2, kind, n_bonds))
+    with open('hbdebug.dat', 'w') as f:
+        f.write('hbplus (stub)\n')
+    print('hbplus (stub): ' + str(n_bonds) + ' hydrogen bonds')
+
+def run_ediascorer(args_):
+    # --license L --target RENUMBERED.pdb --outputfolder OUTDIR --densitymap MAP: <base>atomscores.csv
+    target, outdir = args_[args_.index('--target') + 1], args_[args_.index('--outputfolder') + 1]
+    base = os.path.splitext(os.path.basename(target))[0]
+    n_waters = 0
+    with open(os.path.join(outdir, base + 'atomscores.csv'), 'w') as f:
+        f.write('Structure specifier,Atom name,Infile id,Substructure name,Substructure id,Chain,Element,EDIA,EDIA fault analysis,B factor,Occupancy\n')
+        for i, line in enumerate(read_atom_lines(target)):
+            if is_water(line):
+                n_waters += 1
+                specifier, edia = 'w', 1.2 * water_values(n_waters).random()
+            else:
+                specifier, edia = 'r', 0.9
+            f.write(','.join([specifier, line[12:16].strip(), str(i + 1), line[17:20].strip(), line[22:26].strip(), line[21], line[76:78].strip(), '%.2f' % edia, '0', line[60:66].strip(), line[54:60].strip()]) + '\n')
+    print('ediascorer (stub): ' + str(n_waters) + ' waters')
+
+def write_stub_tools(stub_dir_):
+    """
+    Writes executable wrappers of the stub programs and returns the environment variables that point ColdBrew to them.
+
+    Args:
+        stub_dir_ (str): Directory of the wrappers (created if missing).
+
+    Returns:
+        dict: PYMOL_EXE, PHENIX_BIN, NACCESS_EXE, HBPLUS_EXE, EDIASCORER_EXE, and EDIASCORER_LICENSE.
+    """
+
+    phenix_bin = os.path.join(stub_dir_, 'phenix_bin')
+    os.makedirs(phenix_bin, exist_ok=True)
+    paths = {
+        'pymol': os.path.join(stub_dir_, 'pymol'),
+        'phenix': os.path.join(phenix_bin, 'phenix.real_space_correlation'),
+        'naccess': os.path.join(stub_dir_, 'naccess'),
+        'hbplus': os.path.join(stub_dir_, 'hbplus'),
+        'ediascorer': os.path.join(stub_dir_, 'ediascorer')
+    }
+    for tool, path in paths.items():
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "' + sys.executable + '" "' + os.path.abspath(__file__) + '" ' + tool + ' "$@"\n')
+        os.chmod(path, 0o755)
+    return {'PYMOL_EXE': paths['pymol'], 'PHENIX_BIN': phenix_bin, 'NACCESS_EXE': paths['naccess'], 'HBPLUS_EXE': paths['hbplus'],
+            'EDIASCORER_EXE': paths['ediascorer'], 'EDIASCORER_LICENSE': 'stub'}
+
+# stub of each program
+stub_tools = {'pymol': run_pymol, 'phenix': run_phenix, 'naccess': run_naccess, 'hbplus': run_hbplus, 'ediascorer': run_ediascorer}
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in stub_tools:
+        sys.exit('usage: stub_tools.py <' + '|'.join(stub_tools) + '> <arguments of the program>')
+    stub_tools[sys.argv[1]](sys.argv[2:])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Library entry point: scores the waters of a structure in the calling process and returns the results DataFrame.
+# Every input is an argument (no global state and no current directory), so threads and processes can call it at once:
+#
+#     from functions.api import score_waters
+#     df = score_waters('6GPW.pdb', '6GPW_2mFo-DFc.ccp4')
+#     df = score_waters(structure, density_map)                # a Structure and a DensityMap held in memory
+#     df = score_waters(structure, mtz_file_='6GPW.mtz')       # the 2mFo-DFc map is calculated from the MTZ file
+
+import os
+import shutil
+import tempfile
+from functions.structure import Structure, load_structure
+from functions.ccp4 import load_ccp4_map
+from functions.configuration import feature_backends, get_backends, required_env_variables, uses_external_programs, get_pdb_id, do_setup
+from functions.validation import check_pdb_format_limits
+
+# backends of score_waters: every feature is calculated in this process unless another backend is given
+native_backends = dict((feature, 'native') for feature in feature_backends)
+
+def score_waters(structure_, density_map_=None, mtz_file_=None, backends_=None, resolution_=None, map_columns_=None, pdb_id_=None, n_workers_=1, report_=None,
+                 verbose_=False):
+    """
+    Scores the waters of one structure and returns the results, without writing any output file or, unless verbose_
+    is set, printing progress messages (the messages of other threads, e.g., of the command-line pipeline, are kept).
+    With the native backends (the default), everything is calculated in memory. If an external program is used, the
+    structure, the map, and the outputs of the program are written to a private temporary directory, which is
+    removed before returning. The inputs are not changed, so one structure or map can be scored by several threads.
+
+    Args:
+        structure_ (Structure or str): The structure, or the path to a PDB or mmCIF file.
+        density_map_ (DensityMap or str): The 2mFo-DFc map, or the path to a CCP4 map file (default: None, the map is
+            calculated from mtz_file_; see maps.calculate_map).
+        mtz_file_ (str): Path to the MTZ file; needed if density_map_ is None or RSCC is calculated with phenix (default: None).
+        backends_ (dict): Backend of each feature, e.g., {'SASA': 'naccess'} (see configuration.get_backends; default: native).
+        resolution_ (float): Resolution of the map for the native RSCC and EDIA backends (default: estimated from the grid of the map).
+        map_columns_ (list): Labels of the amplitude and phase of the map coefficients in the MTZ file, used if
+            density_map_ is None (default: None, found in the file, or the map is phased by the model).
+        pdb_id_ (str): Identifier of the structure, used in the results and the file names of external programs
+            (default: the name of the structure file, or 'structure').
+        n_workers_ (int): Maximum number of external programs run at the same time, and threads of the native SASA
+            calculation (default: 1).
+        report_ (RunReport): Report that records each stage and external command (default: None).
+        verbose_ (bool): Print the progress messages of the calculations (default: False).
+
+    Outputs:
+        Raises a ValueError if no map is given and no MTZ file either, or if phenix is used without an MTZ file, and an
+        EnvironmentError if an environment variable of an external program is not set.
+
+    Returns:
+        pandas.DataFrame: The results, with the columns of <ID>_ColdBrew_results.csv (see data_analysis.results_frame).
+    """
+
+    from functions.data_parsing import parse_raw_datafiles
+    from functions.data_analysis import predict_CB_prob, results_frame
+    from functions.instrumentation import instrument, quiet_progress
+
+    backends = get_backends(dict(native_backends, **(backends_ or {})))
+    if pdb_id_ is None:
+        pdb_id_ = get_pdb_id(structure_) if isinstance(structure_, str) else 'structure'
+    missing = [var for var in required_env_variables(backends) if not os.getenv(var)]
+    if missing:
+        raise EnvironmentError('Required environment variables are not set: ' + ', '.join(missing) + '. See github page for instructions.')
+    if density_map_ is None and mtz_file_ is None:
+        raise ValueError('Give a map or the MTZ file to calculate it from.')
+    if backends['RSCC'] == 'phenix' and mtz_file_ is None:
+        raise ValueError('phenix calculates RSCC from the MTZ file; give the MTZ file or use the native RSCC backend.')
+
+    with quiet_progress(not verbose_):
+        with instrument(report_, 'read_structure'):
+            structure = load_structure(structure_)
+        check_pdb_format_limits(structure, pdb_id_, backends)
+
+        if density_map_ is None:
+            from functions.maps import calculate_map
+            with instrument(report_, 'calculate_map'):
+                density_map, map_info = calculate_map(mtz_file_, structure, map_columns_)
+        else:
+            with instrument(report_, 'read_map'):
+                density_map, map_info = load_ccp4_map(density_map_), {}
+
+        if not uses_external_programs(backends):
+            df_out = parse_raw_datafiles(structure, pdb_id_, None, backends_=backends, ccp4_file_=density_map, resolution_=resolution_, report_=report_, n_workers_=n_workers_)
+        else:
+            df_out = run_external_programs(structure, structure_, pdb_id_, density_map, density_map_, map_info, mtz_file_, backends, resolution_, n_workers_, report_)
+
+    with instrument(report_, 'predict', n_waters=len(df_out.index)):
+        df_out['ColdBrew_probability'] = predict_CB_prob(df_out)
+    return results_frame(structure, df_out)
+
+def run_external_programs(structure_, structure_input_, pdb_id_, density_map_, density_map_input_, map_info_, mtz_file_, backends_, resolution_, n_workers_, report_):
+    """
+    Calculates the features of score_waters in a private temporary directory, which the external programs read their
+    inputs from and write their outputs (and, for naccess and HBPLUS, their working files) into.
+
+    Returns:
+        pandas.DataFrame: The per-water features (see data_parsing.parse_raw_datafiles).
+    """
+
+    from functions.ccp4 import write_ccp4_map
+    from functions.execution import run_calculations
+    from functions.data_parsing import parse_raw_datafiles
+
+    outdir = tempfile.mkdtemp(prefix='coldbrew_')
+    try:
+        # the programs read files, so a structure or a map held in memory is written first
+        if isinstance(structure_input_, Structure):
+            pdb_file = outdir + '/' + pdb_id_ + structure_.file_extension
+            structure_.write(pdb_file)
+        else:
+            pdb_file = os.path.abspath(structure_input_)
+        if isinstance(density_map_input_, str):
+            ccp4_file = os.path.abspath(density_map_input_)
+        else:
+            ccp4_file = outdir + '/' + pdb_id_ + '_2mFo-DFc.ccp4'
+            write_ccp4_map(density_map_, ccp4_file, map_info_.get('space_group_number', 1))
+        mtz_file = os.path.abspath(mtz_file_) if mtz_file_ is not None else None
+
+        do_setup(structure_, pdb_id_, outdir, backends_)
+        run_calculations(pdb_file, pdb_id_, mtz_file, ccp4_file, outdir, n_workers_=n_workers_, backends_=backends_, report_=report_)
+        return parse_raw_datafiles(structure_, pdb_id_, outdir, backends_=backends_, ccp4_file_=density_map_, resolution_=resolution_, report_=report_, n_workers_=n_workers_)
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
@@ -0,0 +1,229 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import csv
+import time
+import shutil
+import tempfile
+import argparse
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functions.validation import check_argument_files
+
+manifest_columns = ['id', 'pdb', 'mtz', 'ccp4']
+
+def read_manifest(manifest_file_):
+    """
+    Reads a manifest of structures to score in batch mode.
+    The manifest is a CSV or TSV file with the columns id, pdb, mtz, and ccp4 (a header line with these names is optional).
+    The ccp4 column may be empty, so the map is calculated from the MTZ file (see maps.calculate_map).
+    Relative paths are taken relative to the directory of the manifest.
+
+    Args:
+        manifest_file_ (str): Path to the manifest file.
+
+    Outputs:
+        Raises a ValueError if a line does not have four columns or if an ID is used more than once.
+
+    Returns:
+        list: A list of dictionaries with the keys id, pdb, mtz, and ccp4 (one per structure; ccp4 is None if empty).
+    """
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file_))
+    with open(manifest_file_, 'r', newline='') as f:
+        lines = [line for line in f if line.strip() and not line.startswith('#')]
+    delimiter = '\t' if manifest_file_.endswith('.tsv') or (lines and '\t' in lines[0]) else ','
+
+    entries = []
+    for i, row in enumerate(csv.reader(lines, delimiter=delimiter)):
+        row = [col.strip() for col in row]
+        if i == 0 and [col.lower() for col in row] == manifest_columns:
+            continue
+        if len(row) != len(manifest_columns):
+            raise ValueError('Invalid line in manifest ' + manifest_file_ + ': ' + delimiter.join(row) + '. Expected the columns ' + ', '.join(manifest_columns) + '.')
+        entry = dict(zip(manifest_columns, row))
+        for key in ['pdb', 'mtz', 'ccp4']:
+            entry[key] = os.path.join(manifest_dir, entry[key]) if entry[key] else None
+        entries.append(entry)
+
+    IDs = [entry['id'] for entry in entries]
+    duplicates = sorted(set(ID for ID in IDs if IDs.count(ID) > 1))
+    if duplicates:
+        raise ValueError('Duplicate IDs in manifest ' + manifest_file_ + ': ' + ', '.join(duplicates))
+    return entries
+
+def run_manifest_entry(entry_, outdir_, n_workers_=None, write_parsed_=False, cache_=None, backends_=None, openmetrics_=False, resolution_=None, site_=None, dataset_=None,
+                       scratch_=None, keep_intermediates_=None, map_columns_=None):
+    """
+    Runs the pipeline for one structure of a manifest and captures any failure.
+    The structure gets its own output directory (<outdir>/<ID>) and its own scratch directory for the
+    external programs that write into the current directory, so several entries can run at the same time.
+    Everything the pipeline prints is saved to <outdir>/<ID>/<ID>_ColdBrew.log.
+
+    Args:
+        entry_ (dict): Manifest entry with the keys id, pdb, mtz, and ccp4.
+        outdir_ (str): Output directory of the batch.
+        n_workers_ (int): Maximum number of calculations run at the same time for this structure.
+        write_parsed_ (bool): Also save the parsed data of each metric as PDB files (default: False).
+        cache_ (StageCache): Cache of stage outputs shared by all structures (default: None).
+        backends_ (dict): Backend of each feature (see configuration.get_backends; default: external programs).
+        openmetrics_ (bool): Also save the run report as OpenMetrics text (default: False).
+        resolution_ (float): Resolution of the map for the native RSCC and EDIA backends (default: estimated from the grid).
+        site_ (dict): Site to score (see pipeline.run_pipeline; default: None, all waters).
+        dataset_ (str): Directory of a Parquet dataset to add the results to (default: None).
+        scratch_ (str): Directory for the scratch workspace of the run (see pipeline.run_pipeline; default: None).
+        keep_intermediates_ (str): With a workspace, when to keep the intermediate files: 'none', 'failure', or 'all' (default: None).
+        map_columns_ (list): Labels of the map coefficients in the MTZ file, used if the entry has no CCP4 map (default: None).
+
+    Returns:
+        dict: Summary of the run with the keys id, status ('done' or 'failed'), error, and seconds.
+    """
+
+    from functions.pipeline import run_pipeline
+
+    start = time.time()
+    outdir_entry = os.path.join(outdir_, entry_['id'])
+    os.makedirs(outdir_entry, exist_ok=True)
+    error = ''
+    with open(os.path.join(outdir_entry, entry_['id'] + '_ColdBrew.log'), 'w') as log:
+        with contextlib.redirect_stdout(log):
+            # a workspace has its own working directory for the external programs
+            use_workspace = scratch_ is not None or keep_intermediates_ is not None
+            scratch_dir = None if use_workspace else tempfile.mkdtemp(prefix='scratch_', dir=outdir_entry)
+            try:
+                check_argument_files(argparse.Namespace(pdb_file=entry_['pdb'], ccp4_file=entry_['ccp4'], mtz_file=entry_['mtz'], outdir=outdir_entry))
+                run_pipeline(entry_['pdb'], entry_['id'], entry_['mtz'], entry_['ccp4'], outdir_entry, n_workers_=n_workers_, workdir_=scratch_dir, write_parsed_=write_parsed_,
+                             cache_=cache_, backends_=backends_, resolution_=resolution_, openmetrics_=openmetrics_, site_=site_, dataset_=dataset_,
+                             scratch_=scratch_, keep_intermediates_=keep_intermediates_, map_columns_=map_columns_)
+            except Exception as e:
+                traceback.print_exc(file=log)
+                error = type(e).__name__ + ': ' + str(e)
+            finally:
+                if scratch_dir is not None:
+                    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return {'id': entry_['id'], 'status': 'failed' if error else 'done', 'error': error, 'seconds': round(time.time() - start, 2)}
+
+def run_isolated_entry(entry_, outdir_, options_):
+    """
+    Runs one manifest entry in a process of its own (see run_entries), so a process that dies fails only this entry.
+
+    Returns:
+        dict: Summary of the run (see run_manifest_entry).
+    """
+    from concurrent.futures.process import BrokenProcessPool
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(run_manifest_entry, entry_, outdir_, **options_).result()
+        except BrokenProcessPool:
+            return {'id': entry_['id'], 'status': 'failed', 'error': 'BrokenProcessPool: the process running the entry died (e.g., killed when out of memory)', 'seconds': None}
+
+def run_entries(entries_, outdir_, n_procs_=1, **options_):
+    """
+    Runs manifest entries on a pool of processes (see run_manifest_entry) and prints the status of each as it ends.
+    An error outside the pipeline (e.g., a summary that cannot be returned) fails only its entry. If a worker process
+    dies (e.g., killed when out of memory), the pool breaks and stops its other processes, without telling which entry
+    killed it; the unfinished entries are then run again, n_procs_ at a time, each in a process of its own (see
+    run_isolated_entry), so only the entry whose process dies again fails.
+
+    Args:
+        entries_ (list): Manifest entries (see read_manifest).
+        outdir_ (str): Output directory of the batch.
+        n_procs_ (int): Number of entries run at the same time (default: 1).
+        options_: Other arguments of run_manifest_entry.
+
+    Returns:
+        dict: Summary of the run of each entry (see run_manifest_entry), by ID.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    summaries = {}
+    def record(ID, run_summary):
+        try:
+            summary = run_summary()
+        except BrokenProcessPool:
+            return
+        except Exception as e:
+            summary = {'id': ID, 'status': 'failed', 'error': type(e).__name__ + ': ' + str(e), 'seconds': None}
+        summaries[ID] = summary
+        print(str(len(summaries)) + '/' + str(len(entries_)) + ' ' + ID + ': ' + summary['status'] + (' (' + summary['error'] + ')' if summary['error'] else ''))
+
+    with ProcessPoolExecutor(max_workers=max(1, n_procs_)) as executor:
+        futures = dict( (executor.submit(run_manifest_entry, entry, outdir_, **options_), entry['id']) for entry in entries_ )
+        for future in as_completed(futures):
+            record(futures[future], future.result)
+
+    remaining = [entry for entry in entries_ if entry['id'] not in summaries]
+    if remaining:
+        print('a worker process died, running the ' + str(len(remaining)) + ' unfinished entries again, each in a process of its own...')
+        with ThreadPoolExecutor(max_workers=max(1, n_procs_)) as executor:
+            futures = dict( (executor.submit(run_isolated_entry, entry, outdir_, options_), entry['id']) for entry in remaining )
+            for future in as_completed(futures):
+                record(futures[future], future.result)
+    return summaries
+
+def run_manifest(manifest_file_, outdir_, n_procs_=1, n_workers_=None, write_parsed_=False, cache_=None, backends_=None, openmetrics_=False, dataset_=None,
+                 scratch_=None, keep_intermediates_=None, map_columns_=None):
+    """
+    Runs the pipeline for every structure of a manifest on a pool of processes.
+    A failed structure does not stop the batch; its error is recorded in the summary file.
+
+    Args:
+        manifest_file_ (str): Path to the manifest file (see read_manifest).
+        outdir_ (str): Output directory of the batch. Results of each structure are saved in <outdir>/<ID>.
+        n_procs_ (int): Number of structures run at the same time.
+        n_workers_ (int): Maximum number of calculations run at the same time for each structure.
+        write_parsed_ (bool): Also save the parsed data of each metric as PDB files (default: False).
+        cache_ (StageCache): Cache of stage outputs shared by all structures, so a rerun of the batch only repeats unfinished stages (default: None).
+        backends_ (dict): Backend of each feature (see configuration.get_backends; default: external programs).
+        openmetrics_ (bool): Also save the run report of each structure as OpenMetrics text (default: False).
+        dataset_ (str): Directory of a Parquet dataset the results of every structure are added to, one file per
+            structure, so the processes add to it at the same time (see dataset.write_structure_results; default: None).
+        scratch_ (str): Directory for the scratch workspaces of the runs, e.g., a local disk of the node (see
+            workspace.Workspace; default: None, all files are written to the output directory).
+        keep_intermediates_ (str): With workspaces, when to keep the intermediate files of a structure as
+            <ID>_intermediates.tar.gz: 'none', 'failure', or 'all' (default: None, 'failure' if scratch_ is given).
+        map_columns_ (list): Labels of the map coefficients in the MTZ files, used for the entries without a CCP4 map (default: None).
+
+    Outputs:
+        Saves a summary of all runs to <outdir>/batch_summary.csv.
+
+    Returns:
+        list: Summaries of the runs (see run_manifest_entry), in manifest order.
+    """
+
+    entries = read_manifest(manifest_file_)
+    outdir_ = os.path.abspath(outdir_)
+    print('running ' + str(len(entries)) + ' structures from ' + manifest_file_ + ' on ' + str(n_procs_) + ' processes...')
+
+    summaries = run_entries(entries, outdir_, n_procs_, n_workers_=n_workers_, write_parsed_=write_parsed_, cache_=cache_, backends_=backends_, openmetrics_=openmetrics_,
+                            dataset_=dataset_, scratch_=scratch_, keep_intermediates_=keep_intermediates_, map_columns_=map_columns_)
+
+    # save summary
+    summaries = [summaries[entry['id']] for entry in entries]
+    with open(os.path.join(outdir_, 'batch_summary.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['id', 'status', 'error', 'seconds'])
+        writer.writeheader()
+        writer.writerows(summaries)
+
+    n_failed = len([summary for summary in summaries if summary['status'] == 'failed'])
+    print(str(len(summaries) - n_failed) + ' structures done, ' + str(n_failed) + ' failed (see ' + os.path.join(outdir_, 'batch_summary.csv') + ')')
+    return summaries
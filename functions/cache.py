@@ -0,0 +1,264 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import threading
+
+# change when the outputs of a stage change for the same inputs (e.g., new setup code)
+cache_version = '1'
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+def hash_file(path_):
+    """
+    Returns the SHA-256 hash of the contents of a file.
+    Hashes are remembered for the lifetime of the process as long as the size and modification time of the file do not change.
+
+    Args:
+        path_ (str): Path to the file.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+
+    st = os.stat(path_)
+    memo_key = (os.path.abspath(path_), st.st_size, st.st_mtime_ns)
+    with _file_hashes_lock:
+        if memo_key in _file_hashes:
+            return _file_hashes[memo_key]
+
+    h = hashlib.sha256()
+    with open(path_, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    with _file_hashes_lock:
+        _file_hashes[memo_key] = h.hexdigest()
+    return h.hexdigest()
+
+def tool_fingerprint(tool_):
+    """
+    Identifies the version of an external program by the resolved path, size, and modification time of its executable.
+    The programs do not share a common way to report their version, so a reinstalled or updated executable counts as a new version.
+
+    Args:
+        tool_ (str): Executable, possibly using environment variables (e.g., '$PHENIX_BIN/phenix.real_space_correlation').
+
+    Returns:
+        str: Fingerprint of the executable ('missing:<path>' if it cannot be found).
+    """
+
+    path = os.path.expandvars(tool_)
+    path = shutil.which(path) or path
+    if not os.path.isfile(path):
+        return 'missing:' + path
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return path + ':' + str(st.st_size) + ':' + str(st.st_mtime_ns)
+
+class StageCache:
+    """
+    Local content-addressed cache for the outputs of pipeline stages (setup and external programs).
+    A stage is keyed by the hash of its input files, the fingerprints of the programs it runs, and the environment variables
+    it depends on, so a rerun (or a run of an identical structure) reuses the outputs of any stage that already finished.
+    Entries are stored in <cache_dir>/<key[:2]>/<key> and the least recently used entries are removed when the cache is larger than max_bytes.
+
+    Attributes:
+        cache_dir (str): Directory of the cache.
+        max_bytes (int): Maximum total size of the cached files.
+    """
+
+    def __init__(self, cache_dir_, max_bytes_=10 * 1024**3):
+        self.cache_dir = os.path.abspath(cache_dir_)
+        self.max_bytes = max_bytes_
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def stage_key(self, stage_name_, input_files_, tools_=(), env_vars_=(), extra_=()):
+        """
+        Computes the cache key of a stage.
+
+        Args:
+            stage_name_ (str): Name of the stage (e.g., 'SASA').
+            input_files_ (list): Paths to the input files of the stage.
+            tools_ (list): Executables run by the stage (see tool_fingerprint).
+            env_vars_ (list): Names of environment variables the outputs depend on.
+            extra_ (list): Other strings the outputs depend on (e.g., options).
+
+        Returns:
+            str: Hex digest identifying the stage and its inputs.
+        """
+
+        h = hashlib.sha256()
+        parts = ['version=' + cache_version, 'stage=' + stage_name_]
+        parts += ['input=' + hash_file(path) for path in input_files_]
+        parts += ['tool=' + tool_fingerprint(tool) for tool in tools_]
+        parts += ['env=' + var + '=' + os.getenv(var, '') for var in env_vars_]
+        parts += ['extra=' + str(value) for value in extra_]
+        h.update('\n'.join(parts).encode())
+        return h.hexdigest()
+
+    def entry_dir(self, key_):
+        """
+        Returns the directory of the cache entry for a key.
+        """
+        return os.path.join(self.cache_dir, key_[:2], key_)
+
+    def fetch(self, key_, outputs_, optional_=()):
+        """
+        Copies the outputs of a cached stage to their destination paths if the entry exists, is valid, and holds every
+        requested output that is not optional.
+
+        Args:
+            key_ (str): Cache key of the stage.
+            outputs_ (dict): Maps output names to destination paths.
+            optional_ (list): Names of outputs that may be missing from the entry (e.g., log files).
+
+        Returns:
+            bool: True if the outputs were restored from the cache.
+        """
+
+        entry = self.entry_dir(key_)
+        try:
+            with open(os.path.join(entry, 'manifest.json'), 'r') as f:
+                manifest = json.load(f)
+            for name, info in manifest['files'].items():
+                cached_file = os.path.join(entry, name)
+                if os.path.getsize(cached_file) != info['size'] or hash_file(cached_file) != info['sha256']:
+                    return False
+            if not set(manifest['required']).issubset(manifest['files']):
+                return False
+            if any(name not in manifest['files'] for name in outputs_ if name not in optional_):
+                return False
+        except (OSError, ValueError, KeyError):
+            return False
+
+        for name, path in outputs_.items():
+            if name in manifest['files']:
+                shutil.copyfile(os.path.join(entry, name), path)
+
+        # mark entry as recently used
+        os.utime(os.path.join(entry, 'manifest.json'))
+        return True
+
+    def store(self, key_, outputs_, optional_=()):
+        """
+        Stores the outputs of a stage in the cache and removes least recently used entries if the cache is too large.
+
+        Args:
+            key_ (str): Cache key of the stage.
+            outputs_ (dict): Maps output names to the paths of the files produced by the stage.
+            optional_ (list): Names of outputs that may be missing (e.g., log files).
+
+        Returns:
+            None
+        """
+
+        tmp_dir = os.path.join(self.cache_dir, 'tmp-' + uuid.uuid4().hex)
+        os.makedirs(tmp_dir)
+        manifest = {'files': {}, 'required': [name for name in outputs_ if name not in optional_]}
+        for name, path in outputs_.items():
+            if not os.path.isfile(path):
+                if name in optional_:
+                    continue
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            shutil.copyfile(path, os.path.join(tmp_dir, name))
+            manifest['files'][name] = {'size': os.path.getsize(path), 'sha256': hash_file(os.path.join(tmp_dir, name))}
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        # move entry into place (another process may have stored the same key in the meantime)
+        entry = self.entry_dir(key_)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        try:
+            if os.path.isdir(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp_dir, entry)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is not larger than max_bytes.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        entries = []
+        total_bytes = 0
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if prefix.startswith('tmp-') or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                    last_used = os.path.getmtime(os.path.join(entry, 'manifest.json'))
+                except OSError:
+                    continue
+                entries.append((last_used, size, entry))
+                total_bytes += size
+
+        for last_used, size, entry in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_bytes -= size
+
+def run_cached_stage(cache_, stage_name_, func_, input_files_, outputs_, tools_=(), env_vars_=(), extra_=(), optional_=()):
+    """
+    Runs a pipeline stage, or restores its outputs from the cache if the stage already ran with the same inputs.
+
+    Args:
+        cache_ (StageCache): The cache (None to always run the stage).
+        stage_name_ (str): Name of the stage.
+        func_ (function): Function running the stage (called without arguments).
+        input_files_ (list): Paths to the input files of the stage.
+        outputs_ (dict): Maps output names to the paths of the files produced by the stage.
+        tools_ (list): Executables run by the stage.
+        env_vars_ (list): Names of environment variables the outputs depend on.
+        extra_ (list): Other strings the outputs depend on.
+        optional_ (list): Names of outputs that may be missing.
+
+    Outputs:
+        The output files of the stage, either produced by running it or copied from the cache.
+
+    Returns:
+        bool: True if the outputs were restored from the cache, False if the stage ran.
+    """
+
+    if cache_ is None:
+        func_()
+        return False
+
+    key = cache_.stage_key(stage_name_, input_files_, tools_, env_vars_, extra_)
+    if cache_.fetch(key, outputs_, optional_):
+        print('using cached ' + stage_name_ + ' results...')
+        return True
+    func_()
+    cache_.store(key, outputs_, optional_)
+    return False
@@ -0,0 +1,443 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import threading
+import numpy as np
+
+# data type of each CCP4/MRC map mode
+map_modes = {0: 'i1', 1: 'i2', 2: 'f4', 6: 'u2'}
+header_bytes = 1024
+symmetry_record_bytes = 80
+
+# maps read by this process (see load_ccp4_map), by path, size, and modification time
+loaded_maps = {}
+loaded_maps_lock = threading.Lock()
+max_loaded_maps = 4
+
+def orthogonalization_matrix(cell_):
+    """
+    Returns the matrix converting fractional to Cartesian coordinates (PDB convention: a along x, b in the xy plane).
+
+    Args:
+        cell_ (numpy.ndarray): Unit cell a, b, c (Angstrom), alpha, beta, gamma (degrees).
+
+    Returns:
+        numpy.ndarray: 3x3 orthogonalization matrix.
+    """
+
+    a, b, c = cell_[:3]
+    alpha, beta, gamma = np.radians(cell_[3:])
+    cos_a, cos_b, cos_g, sin_g = np.cos(alpha), np.cos(beta), np.cos(gamma), np.sin(gamma)
+    volume = a * b * c * np.sqrt(1 - cos_a**2 - cos_b**2 - cos_g**2 + 2 * cos_a * cos_b * cos_g)
+    return np.array([
+        [a, b * cos_g, c * cos_b],
+        [0, b * sin_g, c * (cos_a - cos_b * cos_g) / sin_g],
+        [0, 0, volume / (a * b * sin_g)]
+    ])
+
+def parse_symmetry_operator(operator_):
+    """
+    Parses a symmetry operator of the CCP4 symmetry records (e.g., '-X+1/2,Y,-Z').
+
+    Args:
+        operator_ (str): The operator.
+
+    Outputs:
+        Raises a ValueError if the operator cannot be parsed.
+
+    Returns:
+        tuple: Rotation (3x3 numpy.ndarray) and translation (numpy.ndarray) of the operator in fractional coordinates.
+    """
+
+    rows = operator_.replace(' ', '').upper().split(',')
+    if len(rows) != 3:
+        raise ValueError('Invalid symmetry operator ' + operator_ + '.')
+    rotation = np.zeros((3, 3))
+    translation = np.zeros(3)
+    for i, row in enumerate(rows):
+        for term in row.replace('-', '+-').split('+'):
+            if not term:
+                continue
+            sign = -1 if term.startswith('-') else 1
+            term = term.lstrip('-')
+            if term in ('X', 'Y', 'Z'):
+                rotation[i, 'XYZ'.index(term)] = sign
+            else:
+                try:
+                    numerator, _, denominator = term.partition('/')
+                    translation[i] += sign * float(numerator) / float(denominator or 1)
+                except ValueError:
+                    raise ValueError('Invalid symmetry operator ' + operator_ + '.')
+    return rotation, translation
+
+def format_symmetry_operator(rotation_, translation_):
+    """
+    Formats a symmetry operator as in the CCP4 symmetry records (e.g., '-X+1/2,Y,-Z'; see parse_symmetry_operator).
+    """
+
+    rows = []
+    for i in range(3):
+        row = ''.join(('-' if rotation_[i, j] < 0 else '+') + 'XYZ'[j] for j in range(3) if round(rotation_[i, j]))
+        fraction = translation_[i] % 1
+        if fraction > 1e-6:
+            denominator = next(d for d in (2, 3, 4, 6, 8, 12) if abs(fraction * d - round(fraction * d)) < 1e-4)
+            row += '+' + str(int(round(fraction * denominator))) + '/' + str(denominator)
+        rows.append(row.lstrip('+'))
+    return ','.join(rows)
+
+def read_symmetry_operators(records_):
+    """
+    Reads the symmetry operators of the extended header of a CCP4 map (80-character records, e.g., 'X,Y,Z').
+
+    Args:
+        records_ (bytes): The extended header.
+
+    Returns:
+        list: (rotation, translation) of each operator; only the identity if the header has no valid symmetry records.
+    """
+
+    operators = []
+    for i in range(0, len(records_) - symmetry_record_bytes + 1, symmetry_record_bytes):
+        record = records_[i: i + symmetry_record_bytes].decode('ascii', errors='replace').strip()
+        # records may hold several operators separated by '*'
+        for operator in filter(None, (op.strip() for op in record.split('*'))):
+            try:
+                operators.append(parse_symmetry_operator(operator))
+            except ValueError:
+                # e.g., an MRC extended header of another type
+                return [(np.eye(3), np.zeros(3))]
+    if not any(np.array_equal(rotation, np.eye(3)) and not translation.any() for rotation, translation in operators):
+        operators.insert(0, (np.eye(3), np.zeros(3)))
+    return operators
+
+class DensityMap:
+    """
+    Electron density map on a grid of the unit cell (e.g., a 2mFo-DFc map read from a CCP4 file).
+    Values are held with the axes in x, y, z order, for the box of grid points starting at origin. The values of a
+    map read from a file are memory-mapped, so only the grid points that are used are read from the disk.
+    Grid points outside the box are taken from their symmetry mates (symmetry operators and unit cell translations).
+
+    Attributes:
+        data (numpy.ndarray): Map values of the box, indexed [x, y, z].
+        cell (numpy.ndarray): Unit cell a, b, c, alpha, beta, gamma.
+        grid (numpy.ndarray): Number of grid points along a, b, and c in the unit cell.
+        origin (numpy.ndarray): Grid index of the first point of the box along a, b, and c.
+        mean (float): Mean of the map.
+        rms (float): Standard deviation of the map (sigma).
+        symmetry (list): (rotation, translation) of each symmetry operator in fractional coordinates.
+    """
+
+    def __init__(self, data_, cell_, grid_, origin_, mean_=None, rms_=None, symmetry_=None):
+        self.data = data_
+        self.cell = np.asarray(cell_, dtype=float)
+        self.grid = np.asarray(grid_, dtype=int)
+        self.origin = np.asarray(origin_, dtype=int)
+        self.symmetry = symmetry_ if symmetry_ is not None else [(np.eye(3), np.zeros(3))]
+        if mean_ is None or not rms_:
+            mean_, rms_ = map_statistics(self.data)
+        self.mean = mean_
+        self.rms = rms_
+        self._frac = np.linalg.inv(orthogonalization_matrix(self.cell))
+        # axes covering the whole cell are periodic
+        self._periodic = np.array(self.data.shape) >= self.grid
+
+    def spacing(self):
+        """
+        Returns the distance between grid points along a, b, and c (Angstrom).
+        """
+        return self.cell[:3] / self.grid
+
+    def grid_coordinates(self, xyz_):
+        """
+        Converts Cartesian coordinates to (fractional) grid indices of the unit cell.
+
+        Args:
+            xyz_ (numpy.ndarray): (n, 3) coordinates.
+
+        Returns:
+            numpy.ndarray: (n, 3) grid coordinates.
+        """
+        return (np.asarray(xyz_, dtype=float).reshape(-1, 3) @ self._frac.T) * self.grid
+
+    def locate(self, low_, high_):
+        """
+        Finds, for each block of grid points from low to high, a symmetry operator and a unit cell translation that
+        place the whole block inside the box of the map. The identity is tried first.
+
+        Args:
+            low_ (numpy.ndarray): (n, 3) first grid index of each block.
+            high_ (numpy.ndarray): (n, 3) last grid index of each block.
+
+        Returns:
+            tuple: Index of the symmetry operator of each block (-1 if the map does not cover it) and (n, 3) shift of
+            the grid indices after the operator is applied.
+        """
+
+        shape = np.array(self.data.shape)
+        corners = np.array(list(np.ndindex(2, 2, 2)))
+        operator = np.full(len(low_), -1)
+        shift = np.zeros((len(low_), 3), dtype=np.int64)
+        for i in range(len(self.symmetry)):
+            left = np.flatnonzero(operator == -1)
+            if not len(left):
+                break
+            # the image of the block spans the images of its 8 corners
+            block_corners = np.where(corners[None, :, :], high_[left, None, :], low_[left, None, :])
+            images = self.apply_symmetry(i, block_corners.reshape(-1, 3)).reshape(len(left), 8, 3)
+            low, high = images.min(axis=1), images.max(axis=1)
+            cells = np.floor_divide(low - self.origin, self.grid)
+            inside = ((high - cells * self.grid - self.origin < shape) | self._periodic).all(axis=1)
+            operator[left[inside]] = i
+            shift[left[inside]] = -cells[inside] * self.grid - self.origin
+        return operator, shift
+
+    def apply_symmetry(self, operator_, grid_index_):
+        """
+        Applies a symmetry operator to grid indices.
+
+        Args:
+            operator_ (int): Index of the symmetry operator.
+            grid_index_ (numpy.ndarray): (n, 3) grid indices.
+
+        Returns:
+            numpy.ndarray: (n, 3) grid indices of the symmetry mates.
+        """
+
+        rotation, translation = self.symmetry[operator_]
+        frac = grid_index_ / self.grid
+        return np.rint(((frac @ rotation.T) + translation) * self.grid).astype(np.int64)
+
+    def values_at(self, grid_index_, operator_, shift_):
+        """
+        Returns the map values at grid indices, reading only these points of the box.
+
+        Args:
+            grid_index_ (numpy.ndarray): (n, 3) grid indices of the unit cell.
+            operator_ (numpy.ndarray): Symmetry operator of each point (see locate; -1 for points not covered).
+            shift_ (numpy.ndarray): (n, 3) shift of each point (see locate).
+
+        Returns:
+            numpy.ndarray: Map value at each point (NaN for points not covered).
+        """
+
+        values = np.full(len(grid_index_), np.nan)
+        for i in np.unique(operator_[operator_ >= 0]):
+            select = np.flatnonzero(operator_ == i)
+            idx = self.apply_symmetry(i, grid_index_[select]) + shift_[select]
+            idx = np.where(self._periodic, idx % self.grid, idx)
+            values[select] = self.data[idx[:, 0], idx[:, 1], idx[:, 2]]
+        return values
+
+    def interpolate(self, xyz_):
+        """
+        Returns the map values at Cartesian coordinates by trilinear interpolation between the 8 surrounding grid points.
+
+        Args:
+            xyz_ (numpy.ndarray): (n, 3) coordinates.
+
+        Returns:
+            numpy.ndarray: Map value at each point (NaN for points outside the map).
+        """
+
+        grid_xyz = self.grid_coordinates(xyz_)
+        base = np.floor(grid_xyz).astype(np.int64)
+        t = grid_xyz - base
+        operator, shift = self.locate(base, base + 1)
+
+        values = np.zeros(len(grid_xyz))
+        for corner in np.ndindex(2, 2, 2):
+            weight = np.prod(np.where(corner, t, 1 - t), axis=1)
+            values += weight * self.values_at(base + corner, operator, shift)
+        return values
+
+    def covers(self, xyz_, radius_):
+        """
+        Checks whether the map covers spheres around coordinates (including the grid points needed to interpolate).
+
+        Args:
+            xyz_ (numpy.ndarray): (n, 3) centers.
+            radius_ (float): Radius of the spheres (Angstrom).
+
+        Returns:
+            numpy.ndarray: True for the centers whose sphere is covered.
+        """
+
+        grid_xyz = self.grid_coordinates(xyz_)
+        margin = radius_ * np.linalg.norm(self._frac, axis=1) * self.grid
+        operator, shift = self.locate(np.floor(grid_xyz - margin).astype(np.int64), np.ceil(grid_xyz + margin).astype(np.int64))
+        return operator >= 0
+
+    def extract_box(self, xyz_, margin_):
+        """
+        Extracts the grid points around coordinates (the bounding box of the coordinates plus a margin) into a map held
+        in memory. Points outside the box of this map are taken from their symmetry mates (NaN if not covered).
+
+        Args:
+            xyz_ (numpy.ndarray): (n, 3) coordinates.
+            margin_ (float): Margin around the coordinates (Angstrom).
+
+        Returns:
+            DensityMap: The sub-box, with the cell, grid, mean, and sigma of this map.
+        """
+
+        grid_xyz = self.grid_coordinates(xyz_)
+        margin = margin_ * np.linalg.norm(self._frac, axis=1) * self.grid
+        low = np.floor(grid_xyz.min(axis=0) - margin).astype(np.int64)
+        high = np.ceil(grid_xyz.max(axis=0) + margin).astype(np.int64)
+        grid_index = np.array(np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(low, high)], indexing='ij')).reshape(3, -1).T
+
+        operator, shift = self.locate(low[None, :], high[None, :])
+        if operator[0] >= 0:
+            operator, shift = np.repeat(operator, len(grid_index)), np.repeat(shift, len(grid_index), axis=0)
+        else:
+            # no single symmetry mate holds the whole box, so locate each point
+            operator, shift = self.locate(grid_index, grid_index)
+        data = self.values_at(grid_index, operator, shift).astype(np.float32).reshape(high - low + 1)
+        return DensityMap(data, self.cell, self.grid, low, self.mean, self.rms)
+
+def map_statistics(data_, n_sections_=16):
+    """
+    Calculates the mean and standard deviation of a map, a few sections (along the slowest axis of the file) at a time,
+    so a memory-mapped map is not loaded at once.
+
+    Args:
+        data_ (numpy.ndarray): Map values.
+        n_sections_ (int): Number of sections read at a time (default: 16).
+
+    Returns:
+        tuple: Mean and standard deviation.
+    """
+
+    axis = int(np.argmax(np.abs(data_.strides)))
+    total, total_squares = 0.0, 0.0
+    for start in range(0, data_.shape[axis], n_sections_):
+        section = np.take(data_, np.arange(start, min(start + n_sections_, data_.shape[axis])), axis=axis).astype(float)
+        total += section.sum()
+        total_squares += (section**2).sum()
+    mean = total / data_.size
+    return float(mean), float(np.sqrt(max(total_squares / data_.size - mean**2, 0)))
+
+def read_ccp4_map(map_file_):
+    """
+    Reads a CCP4/MRC map file. The map values are memory-mapped rather than loaded, so large maps can be shared by
+    many structures or workers.
+    The axis order of the file (MAPC, MAPR, MAPS), the start of the box (NCSTART, NRSTART, NSSTART), the cell, the
+    symmetry operators (extended header), and the byte order (machine stamp) are taken from the header.
+
+    Args:
+        map_file_ (str): Path to the CCP4 map file.
+
+    Outputs:
+        Raises a ValueError if the file is not a CCP4/MRC map, uses an unsupported data mode, or is truncated.
+
+    Returns:
+        DensityMap: The map.
+    """
+
+    with open(map_file_, 'rb') as f:
+        header = f.read(header_bytes)
+        if len(header) < header_bytes or header[208:212] != b'MAP ':
+            raise ValueError(map_file_ + ' is not a CCP4/MRC map file.')
+        byte_order = '>' if header[212] == 0x11 else '<'
+        words_i = np.frombuffer(header, dtype=byte_order + 'i4')
+        n_symmetry_bytes = int(words_i[23])
+        symmetry_records = f.read(n_symmetry_bytes)
+    words_f = np.frombuffer(header, dtype=byte_order + 'f4')
+
+    n_crs = words_i[0:3]
+    mode = int(words_i[3])
+    start_crs = words_i[4:7]
+    grid = words_i[7:10]
+    cell = words_f[10:16]
+    axis_crs = words_i[16:19] - 1
+    mean, rms = float(words_f[21]), float(words_f[54])
+    if mode not in map_modes:
+        raise ValueError('Unsupported data mode ' + str(mode) + ' in map ' + map_file_ + '.')
+    if sorted(axis_crs) != [0, 1, 2]:
+        raise ValueError('Invalid axis order ' + str(list(axis_crs + 1)) + ' in map ' + map_file_ + '.')
+    dtype = np.dtype(byte_order + map_modes[mode])
+    if os.path.getsize(map_file_) < header_bytes + n_symmetry_bytes + int(np.prod(n_crs)) * dtype.itemsize:
+        raise ValueError('The map ' + map_file_ + ' is truncated.')
+
+    data = np.memmap(map_file_, dtype=dtype, mode='r', offset=header_bytes + n_symmetry_bytes, shape=tuple(n_crs[::-1]))
+    # file order is sections, rows, columns; view the axes in x, y, z order
+    xyz_of_crs = np.argsort(axis_crs)
+    data = data.transpose(2, 1, 0).transpose(xyz_of_crs)
+    origin = start_crs[xyz_of_crs]
+    return DensityMap(data, cell, grid, origin, mean, rms, read_symmetry_operators(symmetry_records))
+
+def write_ccp4_map(density_map_, map_file_, space_group_number_=1):
+    """
+    Writes a map to a CCP4 map file (mode 2, little-endian, columns along x), with its symmetry operators in the
+    extended header, so read_ccp4_map and other programs (e.g., PyMOL and Coot) read it.
+
+    Args:
+        density_map_ (DensityMap): The map.
+        map_file_ (str): Path of the map file.
+        space_group_number_ (int): Space group number of the header (default: 1).
+    """
+
+    data = np.asarray(density_map_.data, dtype='<f4')
+    records = ''.join(format_symmetry_operator(rotation, translation).ljust(symmetry_record_bytes)
+                      for rotation, translation in density_map_.symmetry).encode('ascii')
+    words_i = np.zeros(header_bytes // 4, dtype='<i4')
+    words_f = words_i.view('<f4')
+    words_i[0:3] = data.shape
+    words_i[3] = 2
+    words_i[4:7] = density_map_.origin
+    words_i[7:10] = density_map_.grid
+    words_f[10:16] = density_map_.cell
+    words_i[16:19] = [1, 2, 3]
+    words_f[19:22] = [data.min(), data.max(), density_map_.mean]
+    words_i[22] = space_group_number_
+    words_i[23] = len(records)
+    words_f[54] = density_map_.rms
+    header = bytearray(words_i.tobytes())
+    header[208:212] = b'MAP '
+    # machine stamp of little-endian IEEE numbers
+    header[212:216] = bytes([0x44, 0x41, 0, 0])
+    with open(map_file_, 'wb') as f:
+        f.write(bytes(header))
+        f.write(records)
+        # sections along z, rows along y, columns along x
+        f.write(np.ascontiguousarray(data.transpose(2, 1, 0)).tobytes())
+
+def load_ccp4_map(map_file_):
+    """
+    Reads a CCP4 map once per process (see read_ccp4_map); later calls with the same unchanged file (e.g., the input
+    checks and the density features of a run, or the models of an ensemble run by the same worker) reuse it, including
+    its mean and standard deviation, which are calculated from all grid points if the header has none.
+    The last max_loaded_maps maps are kept. A DensityMap (e.g., a map calculated in memory) is returned as it is.
+
+    Args:
+        map_file_ (str or DensityMap): Path to the CCP4 map file, or the map.
+
+    Returns:
+        DensityMap: The map.
+    """
+
+    if isinstance(map_file_, DensityMap):
+        return map_file_
+    stat = os.stat(map_file_)
+    key = (os.path.abspath(map_file_), stat.st_size, stat.st_mtime_ns)
+    with loaded_maps_lock:
+        if key not in loaded_maps:
+            loaded_maps[key] = read_ccp4_map(map_file_)
+            while len(loaded_maps) > max_loaded_maps:
+                del loaded_maps[next(iter(loaded_maps))]
+        return loaded_maps[key]
@@ -16,47 +16,189 @@
 
 
 import os
-import subprocess
-import pandas as pd
-from biopandas.pdb import PandasPdb
+from functions.instrumentation import run_command
 
-def do_setup(pdb_file_, pdb_id_, outdir_): 
+# feature: available backends (the first one is the default)
+# 'native' backends are computed in Python and do not need an external program
+feature_backends = {
+    'RSCC': ['phenix', 'native'],
+    'SASA': ['naccess', 'native'],
+    'EDIA': ['ediascorer', 'native'],
+    'HB': ['hbplus', 'native']
+}
+
+# distance (Angstrom) within which atoms can change the features of a water: the SASA neighbors (~6 A), the hydrogen
+# bond partners and the atoms placing their hydrogens (~6.5 A), and the model density of RSCC and EDIA (~5 A)
+environment_cutoff = 8.0
+
+# (feature, backend): environment variables of the external programs it runs
+backend_env_variables = {
+    ('RSCC', 'phenix'): ['PHENIX_BIN'],
+    ('RSCC', 'native'): [],
+    ('SASA', 'naccess'): ['NACCESS_EXE'],
+    ('SASA', 'native'): [],
+    ('EDIA', 'ediascorer'): ['EDIASCORER_EXE', 'EDIASCORER_LICENSE'],
+    ('EDIA', 'native'): [],
+    ('HB', 'hbplus'): ['PYMOL_EXE', 'HBPLUS_EXE'],
+    ('HB', 'native'): []
+}
+
+def get_backends(backends_=None):
+    """
+    Returns the backend used for each feature, filling in the defaults.
+
+    Args:
+        backends_ (dict): Maps feature names (e.g., 'SASA') to backend names (default: None, all defaults).
+
+    Outputs:
+        Raises a ValueError for an unknown feature or backend.
+
+    Returns:
+        dict: Backend of each feature.
+    """
+
+    backends = dict( (feature, options[0]) for feature, options in feature_backends.items() )
+    for feature, backend in (backends_ or {}).items():
+        if backend is None:
+            continue
+        if feature not in feature_backends or backend not in feature_backends[feature]:
+            raise ValueError('Invalid backend ' + str(backend) + ' for ' + feature + '. Expected one of: ' + ', '.join(feature_backends.get(feature, [])) + '.')
+        backends[feature] = backend
+    return backends
+
+def required_env_variables(backends_=None):
+    """
+    Returns the environment variables of the external programs needed for the given backends.
+
+    Args:
+        backends_ (dict): Backend of each feature (see get_backends).
+
+    Returns:
+        list: Names of the required environment variables.
+    """
+
+    required_vars = []
+    for feature, backend in get_backends(backends_).items():
+        required_vars += backend_env_variables[(feature, backend)]
+    return required_vars
+
+add_hydrogens_script = os.path.join( os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'add_hydrogens.py')
+
+def get_pdb_id(pdb_file_):
+    """
+    Gets the ID used for output files from the name of the input PDB or mmCIF file.
+
+    Args:
+        pdb_file_ (str): Path to the input PDB or mmCIF file.
+
+    Returns:
+        str: The file name without directory and extension ('.pdb', '.cif', or '.mmcif').
+    """
+    return os.path.splitext(os.path.basename(pdb_file_))[0]
+
+def uses_external_programs(backends_=None):
+    """
+    Checks whether any feature is calculated with an external program (which reads the renumbered PDB files).
+
+    Args:
+        backends_ (dict): Backend of each feature (see get_backends).
+
+    Returns:
+        bool: True if any backend is an external program.
+    """
+    return len(required_env_variables(backends_)) > 0
+
+def uses_native_density(backends_=None):
+    """
+    Checks whether the map is read by ColdBrew itself, i.e., RSCC or EDIA is calculated with the native backend.
+
+    Args:
+        backends_ (dict): Backend of each feature (see get_backends).
+
+    Returns:
+        bool: True if the RSCC or EDIA backend is native.
+    """
+    backends = get_backends(backends_)
+    return backends['RSCC'] == 'native' or backends['EDIA'] == 'native'
+
+def setup_files(structure_, pdb_id_, outdir_, backends_=None):
+    """
+    Returns the files written by do_setup.
+
+    Args:
+        structure_ (Structure): The input structure.
+        pdb_id_ (str): Identifier for the PDB file, used for output naming.
+        outdir_ (str): Directory where output files will be saved.
+        backends_ (dict): Backend of each feature (see get_backends).
+
+    Returns:
+        dict: Paths of the setup files, by name.
+    """
+
+    files = {'wats_renumber' + structure_.file_extension: outdir_ + '/wats_' + pdb_id_ + '_renumber' + structure_.file_extension}
+    if uses_external_programs(backends_):
+        files['renumber.pdb'] = outdir_ + '/' + pdb_id_ + '_renumber.pdb'
+        files['renumber_no_header.pdb'] = outdir_ + '/' + pdb_id_ + '_renumber_no_header.pdb'
+    return files
+
+def do_setup(structure_, pdb_id_, outdir_, backends_=None): 
     """
     Prepares the input PDB file for further analysis by performing the following steps:
     
     1. Renumbers water molecules in the HETATM records to ensure sequential numbering.
-    2. Saves renumbered PDB files, including one without the header.
-    3. Generates a separate PDB file containing only water molecules.
-    4. Runs an external PyMOL script to add hydrogen atoms to the structure.
+    2. Saves renumbered PDB files, including one without the header (only if an external program reads them).
+    3. Generates a separate PDB file containing only water molecules (an mmCIF file for mmCIF input).
+
+    Hydrogen atoms are added separately (see add_hydrogens) as a stage of run_calculations.
 
     Args:
-        pdb_file_ (str): Path to the input PDB file.
+        structure_ (Structure or str): The input structure, or the path to the input PDB or mmCIF file.
         pdb_id_ (str): Identifier for the PDB file, used for output naming.
         outdir_ (str): Directory where output files will be saved.
+        backends_ (dict): Backend of each feature (see get_backends; default: external programs).
 
     Returns:
         None
     """
     
-    # renumber waters
-    ppdb = PandasPdb().read_pdb(pdb_file_ )
-    df_prot = ppdb.df['ATOM']
-    df_het = ppdb.df['HETATM']
-    chains_cryo = df_prot['chain_id'].unique()
-    hets_cryo = df_het['residue_name'].unique()
-    df_het_non_HOH = df_het.loc[df_het['residue_name']!='HOH']
-    df_het_HOH = df_het.loc[ (df_het['residue_name']=='HOH') & (df_het['element_symbol']=='O') ]
-    df_het_HOH = df_het_HOH.copy()
-    df_het_HOH['residue_number'] = range(1, len(df_het_HOH) + 1)
-    df_het_HOH.loc[:, 'alt_loc'] = ''
-    ppdb.df['HETATM'] = pd.concat([df_het_non_HOH, df_het_HOH])
-    ppdb.to_pdb(path=outdir_ + '/' + pdb_id_ + '_renumber.pdb', records=['ATOM', 'HETATM', 'OTHERS'] )
-    ppdb.to_pdb(path=outdir_ + '/' + pdb_id_ + '_renumber_no_header.pdb', records=['ATOM', 'HETATM'] )
+    import numpy as np
+    from functions.structure import load_structure
+
+    # renumber waters (water hydrogens are removed and water alt locs are cleared)
+    structure_ = load_structure(structure_)
+    wat_index = structure_.water_index()
+    wat_IDs = np.arange(1, len(wat_index) + 1)
+    is_HOH = (structure_.column('record_name') == 'HETATM') & (structure_.column('residue_name') == 'HOH')
+    index_renumber = np.union1d(np.flatnonzero(~is_HOH), wat_index)
+    renumber_columns = {'residue_number': (wat_index, wat_IDs), 'alt_loc': (wat_index, ['']*len(wat_index))}
+    if uses_external_programs(backends_):
+        structure_.write_pdb(outdir_ + '/' + pdb_id_ + '_renumber.pdb', index_renumber, renumber_columns)
+        structure_.write_pdb(outdir_ + '/' + pdb_id_ + '_renumber_no_header.pdb', index_renumber, renumber_columns, others_=False)
 
     # save pdb of only water
-    df_het_HOH.loc[:, 'atom_number'] = range(1, len(df_het_HOH) + 1)
-    ppdb.df['HETATM'] = df_het_HOH
-    ppdb.to_pdb(path=outdir_ + '/wats_' + pdb_id_ + '_renumber.pdb', records=['HETATM'] )
+    renumber_columns['atom_number'] = (wat_index, wat_IDs)
+    structure_.write(outdir_ + '/wats_' + pdb_id_ + '_renumber' + structure_.file_extension, wat_index, renumber_columns, others_=False)
+
+def add_hydrogens(pdb_id_, outdir_, report_=None):
+    """
+    Runs an external PyMOL script to add hydrogen atoms to the renumbered structure. Starting PyMOL takes longer than
+    adding the hydrogens, so a PyMOL worker that stays running is used (see pymol_worker.py), unless the environment
+    variable COLDBREW_PYMOL_WORKER is 0; PyMOL is run once for the structure if the worker cannot be used.
+
+    Args:
+        pdb_id_ (str): Identifier for the PDB file, used for output naming.
+        outdir_ (str): Directory where the renumbered PDB file is stored and the output file will be saved.
+        report_ (RunReport): Report of the run, which records the PyMOL command (default: None).
+
+    Outputs:
+        Saves the hydrogenated PDB file (<ID>_renumber_pymolH.pdb) in the output directory.
+
+    Returns:
+        None
+    """
 
-    # add hydrogens
-    subprocess.run('$PYMOL_EXE -cq ' + os.path.join( os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'add_hydrogens.py') + ' -- -id ' + pdb_id_ + ' -o ' + outdir_ + ' > ' + outdir_ + '/pymol_HB_add.log', shell=True, check=True)
+    if os.environ.get('COLDBREW_PYMOL_WORKER', '1') != '0':
+        from functions.pymol_worker import add_hydrogens_with_worker
+        if add_hydrogens_with_worker(pdb_id_, outdir_, outdir_ + '/pymol_HB_add.log', report_):
+            return
+    run_command('$PYMOL_EXE -cq ' + add_hydrogens_script + ' -- -id ' + pdb_id_ + ' -o ' + outdir_ + ' > ' + outdir_ + '/pymol_HB_add.log', report_, 'H_add')
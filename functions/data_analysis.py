@@ -16,53 +16,143 @@
 
 
 import os
+import hashlib
+import threading
+import numpy as np
 import pandas as pd
-from biopandas.pdb import PandasPdb
-import joblib
+from functions.forest import load_forest
+from functions.instrumentation import instrument
+from functions.structure import read_structure, load_structure, get_water_frame
+
+# feature column: suffix of the parsed data file (see data_parsing.write_parsed_datafiles)
+parsed_file_suffixes = {
+    'RSCC': 'RSCC_original',
+    'B_norm': 'Bnorm',
+    'SASA': 'SASA',
+    'EDIA': 'EDIA',
+    'HB_M': 'HB_pymolH_M',
+    'HB_S': 'HB_pymolH_S'
+}
+
+# features of the model, in the order it was trained on
+feature_cols = ['RSCC', 'B_norm', 'SASA', 'HB', 'EDIA']
+model_file = os.path.join( (os.path.dirname(os.path.abspath(__file__))) , '..', 'model', 'model.joblib')
+# the model compiled into NumPy arrays (see forest.py and scripts/export_model.py), used for inference
+forest_file = os.path.join( (os.path.dirname(os.path.abspath(__file__))) , '..', 'model', 'model_forest.npz')
+
+# the model is loaded once per process (see load_model)
+loaded_model = {}
+model_lock = threading.Lock()
+
+def load_model():
+    """
+    Loads the ColdBrew model, once per process; later calls (e.g., the structures of a batch or the requests of a
+    scoring service) reuse it. The compiled model (model_forest.npz) is used, which gives the same probabilities as the
+    scikit-learn model without loading scikit-learn; the scikit-learn model is the fallback if it is missing.
 
-def read_in_parsed_data(pdb_id__, outdir__):
+    Returns:
+        CompiledForest or sklearn.ensemble.RandomForestClassifier: The pre-trained model.
     """
-    Reads parsed data from renumbered water molecules and extracts relevant metrics.
 
-    This function:
-    1. Loads the renumbered water molecule PDB file.
-    2. Extracts water residue numbers.
-    3. Iterates over a set of predefined metrics, reading corresponding parsed PDB files.
-    4. Constructs a DataFrame containing the extracted data.
+    with model_lock:
+        if 'model' not in loaded_model:
+            if os.path.isfile(forest_file):
+                loaded_model['model'] = load_forest(forest_file)
+            else:
+                import joblib
+                loaded_model['model'] = joblib.load(model_file)
+        return loaded_model['model']
+
+def model_version():
+    """
+    Returns the version of the ColdBrew model: the first 12 hexadecimal digits of the SHA-256 of its file (the compiled
+    model, or the scikit-learn model if it is missing), recorded with the results so those of different models can be
+    told apart.
+    """
+    with model_lock:
+        if 'version' not in loaded_model:
+            with open(forest_file if os.path.isfile(forest_file) else model_file, 'rb') as f:
+                loaded_model['version'] = hashlib.sha256(f.read()).hexdigest()[:12]
+        return loaded_model['version']
+
+def predict_CB_prob(df_features_):
+    """
+    Applies the ColdBrew model to per-water features.
+    The probability is -1 for waters with EDIA = -1 (or the native RSCC = -1), which the map does not cover.
+
+    Args:
+        df_features_ (pd.DataFrame): Features of the waters (see feature_cols).
+
+    Returns:
+        numpy.ndarray: ColdBrew probability of each water.
+    """
+
+    X_ = df_features_[feature_cols] # Features
+    y_pred_proba = load_model().predict_proba(X_)[::,1]
+    y_pred_proba[((X_['EDIA'] == -1) | (X_['RSCC'] == -1)).values] = -1
+    return y_pred_proba
+
+def build_feature_frame(pdb_id__, df_wat_, df_features_):
+    """
+    Assembles the per-water metrics into the DataFrame used by the model.
 
     Args:
         pdb_id__ (str): Identifier for the PDB file.
-        outdir__ (str): Directory where parsed data files are stored.
+        df_wat_ (pd.DataFrame): DataFrame of the renumbered water molecules (see structure.get_water_frame).
+        df_features_ (pd.DataFrame): Per-water metrics (RSCC, B_norm, SASA, EDIA, HB_M, HB_S), indexed by renumbered water ID.
+            Missing metrics are filled with 'M'.
 
     Returns:
         pd.DataFrame: A DataFrame containing water residue IDs, chains, and various computed metrics.
     """
 
-    # load renumbered PDB file
-    ppdb = PandasPdb().read_pdb( outdir__ + '/wats_' + pdb_id__ + '_renumber.pdb' )
-    df_wat = ppdb.df['HETATM']
-    n_wats = len(df_wat.index)
-    list_wat_ID = list(df_wat['residue_number'])
-
-    # read in parsed data for each metric
-    metrics = ['RSCC_original', 'Bnorm', 'SASA', 'EDIA', 'HB_pymolH_M', 'HB_pymolH_S', 'HB_pymolH_wat']
+    n_wats = len(df_wat_.index)
+    list_wat_ID = list(df_wat_['residue_number'])
     dict_metric_to_list = {}
-    for metric in metrics:
-        parsed_metric_file = outdir__ + '/parsed_data_files/wats_' + pdb_id__ + '_renumber_' + metric + '.pdb'
-        if os.path.isfile(parsed_metric_file):
-            ppdb = PandasPdb().read_pdb( parsed_metric_file )
-            df_wat = ppdb.df['HETATM']
-            dict_metric_to_list[metric] = list(df_wat['b_factor'])
+    for metric in parsed_file_suffixes:
+        if metric in df_features_.columns:
+            dict_metric_to_list[metric] = list(df_features_.loc[list_wat_ID, metric])
         else:
             dict_metric_to_list[metric] = ['M']*n_wats
 
     # create df with results
-    df_out_cur = pd.DataFrame( {'pdb':[pdb_id__]*n_wats, 'wat_ID':list_wat_ID, 'chain':list(df_wat['chain_id']), 'RSCC':dict_metric_to_list['RSCC_original'], 'B_norm':dict_metric_to_list['Bnorm'], 'SASA':dict_metric_to_list['SASA'], 'EDIA':dict_metric_to_list['EDIA'], 'HB_M': dict_metric_to_list['HB_pymolH_M'], 'HB_S':dict_metric_to_list['HB_pymolH_S'] }  )
+    df_out_cur = pd.DataFrame( {'pdb':[pdb_id__]*n_wats, 'wat_ID':list_wat_ID, 'chain':list(df_wat_['chain_id']), 'RSCC':dict_metric_to_list['RSCC'], 'B_norm':dict_metric_to_list['B_norm'], 'SASA':dict_metric_to_list['SASA'], 'EDIA':dict_metric_to_list['EDIA'], 'HB_M': dict_metric_to_list['HB_M'], 'HB_S':dict_metric_to_list['HB_S'] }  )
     df_out_cur['HB'] = df_out_cur['HB_M'] + df_out_cur['HB_S']
 
     return df_out_cur
 
-def calculate_CB_prob(pdb_file_, pdb_id_, outdir_, df_out_cur):
+def read_in_parsed_data(pdb_id__, outdir__, extension__='.pdb'):
+    """
+    Reads parsed data previously exported to 'parsed_data_files' (see data_parsing.write_parsed_datafiles)
+    and extracts relevant metrics.
+
+    This function:
+    1. Loads the renumbered water molecule PDB file.
+    2. Iterates over a set of predefined metrics, reading corresponding parsed PDB files.
+    3. Constructs a DataFrame containing the extracted data.
+
+    Args:
+        pdb_id__ (str): Identifier for the PDB file.
+        outdir__ (str): Directory where parsed data files are stored.
+        extension__ (str): Extension of the structure files ('.pdb', or '.cif' for mmCIF input) (default: '.pdb').
+
+    Returns:
+        pd.DataFrame: A DataFrame containing water residue IDs, chains, and various computed metrics.
+    """
+
+    # load renumbered PDB file
+    df_wat = get_water_frame(read_structure( outdir__ + '/wats_' + pdb_id__ + '_renumber' + extension__ ))
+
+    # read in parsed data for each metric
+    df_features = pd.DataFrame(index=df_wat['residue_number'].values)
+    for metric, suffix in parsed_file_suffixes.items():
+        parsed_metric_file = outdir__ + '/parsed_data_files/wats_' + pdb_id__ + '_renumber_' + suffix + extension__
+        if os.path.isfile(parsed_metric_file):
+            df_features[metric] = read_structure( parsed_metric_file ).column('b_factor')
+
+    return build_feature_frame(pdb_id__, df_wat, df_features)
+
+def calculate_CB_prob(structure_, pdb_id_, outdir_, df_out_cur, report_=None, wat_index_=None, dataset_=None, backends_=None):
     """
     Calculates ColdBrew probabilities for water molecules using a pre-trained model.
 
@@ -70,57 +160,96 @@ def calculate_CB_prob(pdb_file_, pdb_id_, outdir_, df_out_cur):
     1. Loads the ColdBrew model from a pre-specified directory.
     2. Applies the model to compute probabilities based on selected features.
     3. Assigns probabilities to water molecules and modifies output data accordingly.
-    4. Saves updated probability values into new PDB files.
+    4. Saves updated probability values into new PDB files (mmCIF files for mmCIF input).
     5. Saves results for all metrics to csv file.
+    6. Optionally adds the results to a Parquet dataset (see dataset.write_structure_results).
 
     Args:
-        pdb_file_ (str): Path to the original PDB file.
+        structure_ (Structure or str): The input structure, or the path to the original PDB file.
         pdb_id_ (str): Identifier for the PDB structure.
         outdir_ (str): Directory where processed files are stored.
         df_out_cur (pd.DataFrame): DataFrame containing extracted metrics for water molecules.
+        report_ (RunReport): Report of the run, which records the prediction and the saving of the results (default: None).
+        wat_index_ (numpy.ndarray): Indices of the scored water oxygens, e.g., the waters of a site (default: all waters).
+        dataset_ (str): Directory of a Parquet dataset of results to add the results to (default: None).
+        backends_ (dict): Backend of each feature, recorded in the dataset (default: None).
 
     Returns:
-        None
+        pandas.DataFrame: The results as saved in the CSV file.
     """
     
     print('calculating ColdBrew probabilities...')
-    model = joblib.load( os.path.join( (os.path.dirname(os.path.abspath(__file__))) , '..', 'model', 'model.joblib') )
 
-    #apply the model on the df
-    feature_cols = ['RSCC', 'B_norm', 'SASA', 'HB', 'EDIA']
-    X_ = df_out_cur[feature_cols] # Features
-    y_pred_proba = model.predict_proba(X_)[::,1]
-    
-    df_out_cur['ColdBrew_probability'] = y_pred_proba
-            
-    #if EDIA = -1, then set CB prob also to -1
-    df_out_cur.loc[df_out_cur['EDIA'] == -1, 'ColdBrew_probability'] = -1
+    #apply the model on the df (CB prob is -1 if EDIA = -1 or the native RSCC = -1, i.e., the map does not cover the water)
+    with instrument(report_, 'predict', n_waters=len(df_out_cur.index)):
+        df_out_cur['ColdBrew_probability'] = predict_CB_prob(df_out_cur)
             
     #save the results to pdb
     print('saving results')
+    with instrument(report_, 'write_results'):
+        df_results = write_results(structure_, pdb_id_, outdir_, df_out_cur, wat_index_)
+
+    if dataset_ is not None:
+        from functions.dataset import write_structure_results
+        with instrument(report_, 'write_dataset'):
+            print('adding the results to ' + dataset_ + '...')
+            write_structure_results(dataset_, pdb_id_, df_results, model_version(), backends_)
+    return df_results
+
+def write_results(structure_, pdb_id_, outdir_, df_out_cur, wat_index_=None):
+    """
+    Saves the ColdBrew probabilities (see calculate_CB_prob): the waters and the structure with the probabilities in the
+    B-factor column, and the results CSV file.
+
+    Args:
+        structure_ (Structure or str): The input structure, or the path to the original PDB file.
+        pdb_id_ (str): Identifier for the PDB structure.
+        outdir_ (str): Directory where processed files are stored.
+        df_out_cur (pd.DataFrame): DataFrame containing extracted metrics and ColdBrew probabilities for water molecules.
+        wat_index_ (numpy.ndarray): Indices of the scored water oxygens (default: all waters). Only these waters are
+            written, with the renumbered water IDs of df_out_cur.
+
+    Returns:
+        pandas.DataFrame: The results as saved in the CSV file.
+    """
+
+    structure_ = load_structure(structure_)
+    wat_index = structure_.water_index() if wat_index_ is None else wat_index_
+    assert len(wat_index) == len(df_out_cur.index), pdb_id_ + ' ' + str(len(wat_index)) + ' ' + str(len(df_out_cur.index))
+    wat_IDs = np.arange(1, len(wat_index) + 1) if wat_index_ is None else df_out_cur['wat_ID'].values
+    CB_prob = df_out_cur['ColdBrew_probability'].values
+
     #wat pdb
-    ppdb = PandasPdb().read_pdb( outdir_ + '/wats_' + pdb_id_ + '_renumber.pdb' )
-    df_wat = ppdb.df['HETATM']
-    assert len(df_wat.index) == len(df_out_cur.index)
-    df_wat = df_wat.copy()
-    df_wat['b_factor'] = df_out_cur['ColdBrew_probability'].values
-    ppdb.df['HETATM'] = df_wat
-    ppdb.to_pdb(path=outdir_ + '/wats_' + pdb_id_ + '_renumber_ColdBrew_probability.pdb')
+    wat_columns = {'atom_number': (wat_index, wat_IDs), 'residue_number': (wat_index, wat_IDs), 'alt_loc': (wat_index, ['']*len(wat_index)), 'b_factor': (wat_index, CB_prob)}
+    structure_.write(outdir_ + '/wats_' + pdb_id_ + '_renumber_ColdBrew_probability' + structure_.file_extension, wat_index, wat_columns, others_=False)
 
     #raw pdb
-    ppdb = PandasPdb().read_pdb( pdb_file_ )
-    df_het = ppdb.df['HETATM']
-    df_wat = df_het.loc[ (df_het['residue_name']=='HOH') & (df_het['atom_name']=='O')   ]
-    df_het_other = df_het.loc[df_het['residue_name']!='HOH']
-    
-    assert len(df_wat.index) == len(df_out_cur.index), pdb_ID + ' ' + str(len(df_wat.index)) + ' ' + str(len(df_out_cur.index))
-    df_wat = df_wat.copy()
-    df_wat['b_factor'] = df_out_cur['ColdBrew_probability'].values
-    ppdb.df['HETATM'] = pd.concat([df_wat,df_het_other])
-    ppdb.to_pdb(path=outdir_ + '/' + pdb_id_ + '_ColdBrew_probability.pdb', records=['ATOM', 'HETATM'])
+    is_HOH = (structure_.column('record_name') == 'HETATM') & (structure_.column('residue_name') == 'HOH')
+    index_out = np.union1d(np.flatnonzero(~is_HOH), wat_index)
+    structure_.write(outdir_ + '/' + pdb_id_ + '_ColdBrew_probability' + structure_.file_extension, index_out, {'b_factor': (wat_index, CB_prob)}, others_=False)
 
     #save results to csv file
-    df_out_cur.rename(columns={'wat_ID':'wat_ID_renumbered'}, inplace=True)
-    df_out_cur['wat_ID'] = list(df_wat['residue_number'])
-    df_out_cur = df_out_cur.reindex(columns=['wat_ID', 'wat_ID_renumbered', 'chain', 'RSCC', 'B_norm', 'SASA', 'EDIA', 'HB', 'ColdBrew_probability'])
+    df_out_cur = results_frame(structure_, df_out_cur, wat_index)
     df_out_cur.to_csv(outdir_ + '/' + pdb_id_ + '_ColdBrew_results.csv')
+    return df_out_cur
+
+def results_frame(structure_, df_out_cur, wat_index_=None):
+    """
+    Returns the results of the scored waters as saved in the results CSV file: the water IDs and insertion codes of the
+    input structure, the renumbered water IDs, the chains, the features, and the ColdBrew probabilities.
+
+    Args:
+        structure_ (Structure): The input structure.
+        df_out_cur (pd.DataFrame): DataFrame containing extracted metrics and ColdBrew probabilities for water molecules
+            (renamed in place: its wat_ID column becomes wat_ID_renumbered).
+        wat_index_ (numpy.ndarray): Indices of the scored water oxygens (default: all waters).
+
+    Returns:
+        pandas.DataFrame: The results.
+    """
+
+    wat_index = structure_.water_index() if wat_index_ is None else wat_index_
+    df_out_cur.rename(columns={'wat_ID':'wat_ID_renumbered'}, inplace=True)
+    df_out_cur['wat_ID'] = list(structure_.column('residue_number')[wat_index])
+    df_out_cur['insertion'] = list(structure_.column('insertion')[wat_index])
+    return df_out_cur.reindex(columns=['wat_ID', 'insertion', 'wat_ID_renumbered', 'chain', 'RSCC', 'B_norm', 'SASA', 'EDIA', 'HB', 'ColdBrew_probability'])
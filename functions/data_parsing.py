@@ -16,30 +16,63 @@
 
 
 import os
-import subprocess
+import numpy as np
 import pandas as pd
-from biopandas.pdb import PandasPdb
+from functions.structure import load_structure, get_water_frame
 from functions.validation import *
+from functions.configuration import get_backends, uses_native_density
+from functions.sasa import calculate_water_SASA, round_like_naccess
+from functions.hbonds import count_water_HB
+from functions.ccp4 import load_ccp4_map
+from functions.density import calculate_water_RSCC, calculate_water_EDIA
+from functions.data_analysis import build_feature_frame, parsed_file_suffixes
+from functions.instrumentation import instrument, run_command, progress
+from functions.scheduling import default_n_workers
+
+# fixed columns of the lines of an HBPLUS .hb2 file (after its header lines): the donor and the acceptor (chain,
+# 4-digit residue number, insertion code or '-', residue name, and atom name) and the type of the bond (e.g., HS).
+# The renumbered water IDs fit the 4-digit residue number because check_pdb_format_limits allows at most 9999 waters.
+hb2_header_lines = 8
+hb2_donor_columns = slice(0, 14)
+hb2_acceptor_columns = slice(14, 28)
+hb2_type_columns = slice(33, 35)
+hb2_residue_columns = slice(0, 9)
+hb2_residue_number_columns = slice(1, 5)
+hb2_residue_name_columns = slice(6, 9)
+
+def round_to_pdb_precision(values_):
+    """
+    Rounds values to the two decimals of the B-factor column of a PDB file.
+    The features were stored in (and the model was trained on) that column, so the in-memory values are rounded the same way.
+
+    Args:
+        values_ (iterable): Values to round.
+
+    Returns:
+        list: The rounded values as floats.
+    """
+    return [float('%.2f' % value) for value in values_]
 
-def read_in_RSCC(pdb_id__, outdir__, rscc_raw_datafile_):
+def select_waters(df_wat_, waters_=None):
+    """
+    Returns the renumbered water IDs of the given rows of the water DataFrame (all waters if waters_ is None).
     """
-    Reads in RSCC values from a raw data file and assigns them to water molecules in a PDB file.
+    if waters_ is None:
+        return df_wat_['residue_number'].values
+    return df_wat_['residue_number'].values[waters_]
+
+def read_in_RSCC(df_wat_, rscc_raw_datafile_):
+    """
+    Reads in RSCC values from a raw data file and assigns them to water molecules.
 
     Args:
-        pdb_id__ (str): Identifier for the PDB structure.
-        outdir__ (str): Directory where the processed PDB files are stored.
+        df_wat_ (pandas.DataFrame): DataFrame of the renumbered water molecules (see structure.get_water_frame).
         rscc_raw_datafile_ (str): Path to the raw RSCC data file.
 
-    Outputs:
-        Saves a new PDB file with updated RSCC values assigned to water molecules.
     Returns:
-        None
+        pandas.Series: RSCC value of each water molecule, indexed by renumbered water ID.
     """
 
-    # load renumbered water pdb
-    ppdb = PandasPdb().read_pdb( outdir__ + '/wats_' + pdb_id__ + '_renumber.pdb' )
-    df_wat = ppdb.df['HETATM']
-
     # open the file and get RSCC values for all water molecules
     f = open( rscc_raw_datafile_, 'r' ).readlines()
     RSCC_values = []
@@ -51,12 +84,29 @@ def read_in_RSCC(pdb_id__, outdir__, rscc_raw_datafile_):
             RSCC_values.append(RSCC)
 
     # make sure the number of RSCC values is correct
-    assert len(df_wat['b_factor'])==len(RSCC_values), print('RSCC error', len(df_wat['b_factor']), len(RSCC_values))
+    assert len(df_wat_.index)==len(RSCC_values), print('RSCC error', len(df_wat_.index), len(RSCC_values))
+
+    return pd.Series(round_to_pdb_precision(RSCC_values), index=df_wat_['residue_number'].values, name='RSCC')
+
+
+def calc_RSCC_native(structure__, df_wat_, density_map_, resolution_=None, waters_=None):
+    """
+    Calculates RSCC-like values of water molecules from the map with the built-in density backend (see density.calculate_water_RSCC).
+
+    Args:
+        structure__ (Structure): The input structure.
+        df_wat_ (pandas.DataFrame): DataFrame of the renumbered water molecules.
+        density_map_ (DensityMap): The electron density map.
+        resolution_ (float): Resolution of the map (default: estimated from the grid).
+        waters_ (numpy.ndarray): Positions (rows of df_wat_) of the waters to calculate (default: None, all waters).
+
+    Returns:
+        pandas.Series: RSCC value of each water molecule, indexed by renumbered water ID.
+    """
 
-    # save results
-    df_wat['b_factor'] = RSCC_values
-    ppdb.df['HETATM'] = df_wat
-    ppdb.to_pdb(path=outdir__ + '/parsed_data_files/wats_' + pdb_id__ + '_renumber_RSCC_original.pdb', records=['HETATM'])
+    progress('calculating RSCC (native)...')
+    RSCC = calculate_water_RSCC(structure__, density_map_, resolution_, waters_=waters_)
+    return pd.Series(round_to_pdb_precision(RSCC), index=select_waters(df_wat_, waters_), name='RSCC')
 
 
 #def calc_avg_stdev(df_, col_code):
@@ -76,179 +126,217 @@ def calc_avg_stdev_bfactor(df_):
     """
     return [df_['b_factor'].mean(), df_['b_factor'].std()]
 
-def read_in_B_norm(pdb_file__, pdb_id__, outdir__):
+def read_in_B_norm(structure__, df_wat_):
     """
-    Reads in a PDB file, normalizes the B-factor values of water molecules,
-    and saves the updated PDB file.
+    Normalizes the B-factor values of water molecules by the B-factors of the protein atoms.
 
     Args:
-        pdb_file__ (str): Path to the protein PDB file.
-        pdb_id__ (str): Identifier for the PDB structure (used for file naming).
-        outdir__ (str): Directory where the processed PDB files are stored.
+        structure__ (Structure): The input structure.
+        df_wat_ (pandas.DataFrame): DataFrame of the renumbered water molecules.
 
-    Outputs:
-        Saves a new PDB file with normalized B-factor values (Bnorm) for water molecules.
     Returns:
-        None
+        pandas.Series: Normalized B-factor (Bnorm) of each water molecule, indexed by renumbered water ID.
     """
     
-    # load renumbered water pdb
-    ppdb = PandasPdb().read_pdb( pdb_file__ )
-    df_prot = ppdb.df['ATOM']
-
     # calculate average and standard deviation of protein b factor
+    df_prot = pd.DataFrame({'b_factor': structure__.column('b_factor')[structure__.protein_index()]})
     B_avg_stdev_protein = calc_avg_stdev_bfactor(df_prot)
 
-    #calculate normalized b factor and save
-    ppdb = PandasPdb().read_pdb( outdir__ + '/wats_' + pdb_id__ + '_renumber.pdb' )
-    df_wat = ppdb.df['HETATM']
-    df_wat['b_factor'] = ( df_wat['b_factor'] - B_avg_stdev_protein[0] ) / B_avg_stdev_protein[1]
-    ppdb.df['HETATM'] = df_wat
-    ppdb.to_pdb(path=outdir__ + '/parsed_data_files/wats_' + pdb_id__ + '_renumber_Bnorm.pdb', records=['HETATM'])
+    #calculate normalized b factor
+    B_norm = ( df_wat_['b_factor'] - B_avg_stdev_protein[0] ) / B_avg_stdev_protein[1]
+    return pd.Series(round_to_pdb_precision(B_norm), index=df_wat_['residue_number'].values, name='B_norm')
 
-def read_in_SASA(pdb_id__, outdir__, SASA_raw_datafile_pdb_):
+def read_in_SASA(df_wat_, SASA_raw_datafile_):
     """
-    Reads in a PDB file with SASA (solvent-accessible surface area) data,
-    copies the occupancy values to the B-factor column, and saves the updated PDB file.
+    Reads in SASA (solvent-accessible surface area) values of water molecules from the naccess .asa file.
 
     Args:
-        pdb_id__ (str): Identifier for the PDB structure (used for file naming).
-        outdir__ (str): Directory where the processed PDB files are stored.
-        SASA_raw_datafile_pdb_ (str): Path to the PDB file containing SASA data.
+        df_wat_ (pandas.DataFrame): DataFrame of the renumbered water molecules.
+        SASA_raw_datafile_ (str): Path to the .asa file written by naccess for the renumbered structure.
 
-    Outputs:
-        Saves a new PDB file with SASA values copied to the B-factor column for water molecules.
     Returns:
-        None
+        pandas.Series: SASA value of each water molecule, indexed by renumbered water ID.
     """
 
-    # load pdb from naccess, reformat, and save
-    ppdb = PandasPdb().read_pdb( SASA_raw_datafile_pdb_ )
-    df_wat = ppdb.df['HETATM']
-    df_wat['b_factor'] = df_wat['occupancy'] #naccess writes the value as occupancy, but for consistency, copy that to B factor
-    ppdb.df['HETATM'] = df_wat
-    ppdb.to_pdb(path=outdir__ + '/parsed_data_files/wats_' + pdb_id__ + '_renumber_SASA.pdb', records=['HETATM'])
+    # naccess writes the value in the occupancy columns of a PDB-like file
+    dict_wat_ID_to_SASA = {}
+    for line in open(SASA_raw_datafile_, 'r'):
+        if line.startswith('HETATM') and line[17:20] == 'HOH':
+            dict_wat_ID_to_SASA[int(line[22:26])] = float(line[54:60])
+
+    # make sure every water has a SASA value
+    assert len(df_wat_.index) == len(dict_wat_ID_to_SASA), print('SASA error', len(df_wat_.index), len(dict_wat_ID_to_SASA))
 
-def read_in_EDIA(pdb_id__, outdir__, edia_raw_datafile_):
+    SASA = df_wat_['residue_number'].map(dict_wat_ID_to_SASA)
+    return pd.Series(round_to_pdb_precision(SASA), index=df_wat_['residue_number'].values, name='SASA')
+
+def calc_SASA_native(structure__, df_wat_, n_workers_=1, waters_=None):
     """
-    Reads in EDIA values from a CSV file, assigns them to water molecules in a PDB file,
-    and saves the updated PDB file.
+    Calculates SASA (solvent-accessible surface area) values of water molecules with the built-in engine (see sasa.calculate_water_SASA).
 
     Args:
-        pdb_id__ (str): Identifier for the PDB structure (used for file naming).
-        outdir__ (str): Directory where the processed PDB files are stored.
-        edia_raw_datafile_ (str): Path to the raw EDIA data file in CSV format.
+        structure__ (Structure): The input structure.
+        df_wat_ (pandas.DataFrame): DataFrame of the renumbered water molecules.
+        n_workers_ (int): Number of threads used for the calculation (default: 1).
+        waters_ (numpy.ndarray): Positions (rows of df_wat_) of the waters to calculate (default: None, all waters).
 
-    Outputs:
-        Saves a new PDB file with EDIA values assigned to the B-factor column of water molecules.
     Returns:
-        None
+        pandas.Series: SASA value of each water molecule, indexed by renumbered water ID.
+    """
+
+    progress('calculating SASA (native)...')
+    SASA = calculate_water_SASA(structure__, n_workers_=n_workers_, waters_=waters_)
+
+    # match the precision of the values read from naccess
+    return pd.Series(round_to_pdb_precision(round_like_naccess(SASA)), index=select_waters(df_wat_, waters_), name='SASA')
+
+def read_in_EDIA(df_wat_, edia_raw_datafile_):
     """
+    Reads in EDIA values from a CSV file and assigns them to water molecules.
 
-    # load renumbered water pdb
-    ppdb = PandasPdb().read_pdb( outdir__ + '/wats_' + pdb_id__ + '_renumber.pdb' )
-    df_wat = ppdb.df['HETATM']
+    Args:
+        df_wat_ (pandas.DataFrame): DataFrame of the renumbered water molecules.
+        edia_raw_datafile_ (str): Path to the raw EDIA data file in CSV format.
+
+    Returns:
+        pandas.Series: EDIA value of each water molecule, indexed by renumbered water ID.
+    """
 
     # read in EDIA data
     df_temp = pd.read_csv(edia_raw_datafile_)
     df_edia_wat = df_temp.loc[ (df_temp['Structure specifier']=='w') & (df_temp['Substructure name']=='HOH') ]
 
     # make sure the number of EDIA values is correct
-    assert len(df_wat['b_factor']) == len(df_edia_wat['EDIA'])
+    assert len(df_wat_.index) == len(df_edia_wat['EDIA'])
 
-    # save results
-    df_wat['b_factor'] = list(df_edia_wat['EDIA'])
-    ppdb.df['HETATM'] = df_wat
-    ppdb.to_pdb(path=outdir__ + '/parsed_data_files/wats_' + pdb_id__ + '_renumber_EDIA.pdb', records=['HETATM'])
+    return pd.Series(round_to_pdb_precision(df_edia_wat['EDIA']), index=df_wat_['residue_number'].values, name='EDIA')
 
-def read_in_HB(pdb_id__, outdir__, HB_raw_datafile_):
+def calc_EDIA_native(structure__, df_wat_, density_map_, resolution_=None, waters_=None):
     """
-    Reads in hydrogen bond (HB) information from a raw data file, assigns the number of hydrogen bonds 
-    to water molecules in a PDB file based on their interactions with proteins (main chain, side chain) 
-    and other water molecules, and saves the updated PDB files.
+    Calculates EDIA-like values of water molecules from the map with the built-in density backend (see density.calculate_water_EDIA).
 
     Args:
-        pdb_id__ (str): Identifier for the PDB structure (used for file naming).
-        outdir__ (str): Directory where the processed PDB files are stored.
+        structure__ (Structure): The input structure.
+        df_wat_ (pandas.DataFrame): DataFrame of the renumbered water molecules.
+        density_map_ (DensityMap): The electron density map.
+        resolution_ (float): Resolution of the map (default: estimated from the grid).
+        waters_ (numpy.ndarray): Positions (rows of df_wat_) of the waters to calculate (default: None, all waters).
+
+    Returns:
+        pandas.Series: EDIA value of each water molecule (-1 if the map does not cover it), indexed by renumbered water ID.
+    """
+
+    progress('calculating EDIA (native)...')
+    EDIA = calculate_water_EDIA(structure__, density_map_, resolution_, waters_=waters_)
+    return pd.Series(round_to_pdb_precision(EDIA), index=select_waters(df_wat_, waters_), name='EDIA')
+
+def read_in_HB(df_wat_, HB_raw_datafile_):
+    """
+    Reads in hydrogen bond (HB) information from a raw data file and counts the number of hydrogen bonds 
+    of each water molecule with the protein main chain and side chains.
+
+    Args:
+        df_wat_ (pandas.DataFrame): DataFrame of the renumbered water molecules.
         HB_raw_datafile_ (str): Path to the raw hydrogen bond data file.
 
-    Outputs:
-        Saves new PDB files with updated B-factor values corresponding to the number of hydrogen bonds 
-        for water molecules interacting with protein.
     Returns:
-        None
+        pandas.DataFrame: Number of hydrogen bonds to the main chain (HB_M) and side chains (HB_S) of each water molecule,
+        indexed by renumbered water ID.
     """
     
-    # load renumbered water pdb
-    ppdb = PandasPdb().read_pdb( outdir__ + '/wats_' + pdb_id__ + '_renumber.pdb' )
-    df_wat = ppdb.df['HETATM']
-    n_wats = len(df_wat.index)
-
     # read in parse HB data 
     dict_wat_ID_to_n_HB_M = {} #HB to main chain protein
     dict_wat_ID_to_n_HB_S = {} #HB to side chain protein
-    for i in range(1, n_wats+1):
-        dict_wat_ID_to_n_HB_M[i] = 0
-        dict_wat_ID_to_n_HB_S[i] = 0
-
-    water_partner_pairs = []
-
-    f = open(HB_raw_datafile_, 'r')
-    for line in f:
-        if 'HOH' in line:
-            spline = line.split()    
-            if len(spline)==13:
-                HB_type = spline[5].upper()
-                if 'HOH' in spline[0]: 
-                    wat_num = int(spline[0][1:5])
-                    ID_wat = spline[0] 
-                    ID_part = spline[2] 
-                    if (ID_wat, ID_part) not in water_partner_pairs:
-                        if HB_type in ['HM','MH']:
-                            dict_wat_ID_to_n_HB_M[wat_num] = dict_wat_ID_to_n_HB_M[wat_num] + 1
-                        elif HB_type in ['HS','SH']:
-                            dict_wat_ID_to_n_HB_S[wat_num] = dict_wat_ID_to_n_HB_S[wat_num] + 1
-                        water_partner_pairs.append((ID_wat, ID_part))
-                if 'HOH' in spline[2]: 
-                    wat_num = int(spline[2][1:5])
-                    ID_wat = spline[2] 
-                    ID_part = spline[0] 
-                    if (ID_wat, ID_part) not in water_partner_pairs:
-                        if HB_type in ['HM','MH']:
-                            dict_wat_ID_to_n_HB_M[wat_num] = dict_wat_ID_to_n_HB_M[wat_num] + 1
-                        elif HB_type in ['HS','SH']:
-                            dict_wat_ID_to_n_HB_S[wat_num] = dict_wat_ID_to_n_HB_S[wat_num] + 1
-                        water_partner_pairs.append((ID_wat, ID_part))
-    # save results
-    # main chain (M)
-    ppdb = PandasPdb().read_pdb( outdir__ + '/wats_' + pdb_id__ + '_renumber.pdb' )
-    df_wat = ppdb.df['HETATM']
-    df_wat['b_factor'] = df_wat['residue_number'].map(dict_wat_ID_to_n_HB_M)
-    ppdb.df['HETATM'] = df_wat
-    ppdb.to_pdb(path=outdir__ + '/parsed_data_files/wats_' + pdb_id__ + '_renumber_HB_pymolH_M.pdb', records=['HETATM'])
-
-    # side chain (S)
-    ppdb = PandasPdb().read_pdb( outdir__ + '/wats_' + pdb_id__ + '_renumber.pdb' )
-    df_wat = ppdb.df['HETATM']
-    df_wat['b_factor'] = df_wat['residue_number'].map(dict_wat_ID_to_n_HB_S)
-    ppdb.df['HETATM'] = df_wat
-    ppdb.to_pdb(path=outdir__ + '/parsed_data_files/wats_' + pdb_id__ + '_renumber_HB_pymolH_S.pdb', records=['HETATM'])
-
-
-def parse_raw_datafiles(pdb_file_, pdb_id_, outdir_):
+    for wat_num in df_wat_['residue_number']:
+        dict_wat_ID_to_n_HB_M[wat_num] = 0
+        dict_wat_ID_to_n_HB_S[wat_num] = 0
+
+    water_partner_pairs = set()
+
+    with open(HB_raw_datafile_, 'r') as f:
+        lines = f.readlines()[hb2_header_lines:]
+    for line in lines:
+        donor, acceptor = line[hb2_donor_columns], line[hb2_acceptor_columns]
+        HB_type = line[hb2_type_columns].upper()
+        # a bond between two waters counts for both
+        for water, partner in [(donor, acceptor), (acceptor, donor)]:
+            if water[hb2_residue_name_columns] != 'HOH':
+                continue
+            wat_num = int(water[hb2_residue_number_columns])
+            ID_wat = water[hb2_residue_columns]
+            ID_part = partner[hb2_residue_columns]
+            if (ID_wat, ID_part) not in water_partner_pairs:
+                if HB_type in ['HM','MH']:
+                    dict_wat_ID_to_n_HB_M[wat_num] = dict_wat_ID_to_n_HB_M[wat_num] + 1
+                elif HB_type in ['HS','SH']:
+                    dict_wat_ID_to_n_HB_S[wat_num] = dict_wat_ID_to_n_HB_S[wat_num] + 1
+                water_partner_pairs.add((ID_wat, ID_part))
+
+    wat_IDs = df_wat_['residue_number'].values
+    return pd.DataFrame({'HB_M': [float(dict_wat_ID_to_n_HB_M[i]) for i in wat_IDs], 'HB_S': [float(dict_wat_ID_to_n_HB_S[i]) for i in wat_IDs]}, index=wat_IDs)
+
+def calc_HB_native(structure__, df_wat_, waters_=None):
     """
-    Parses raw data files for a given PDB ID, validates their existence, and processes them into parsed data files.
+    Counts the hydrogen bonds of each water molecule with the protein main chain and side chains with the built-in
+    counter (see hbonds.count_water_HB), without adding hydrogens. Hydrogen bonds donated by waters are scored by
+    distance, so the counts approximate those of HBPLUS (see hbonds.max_DA_water).
 
     Args:
-        pdb_file_ (str): Path to the PDB file.
-        pdb_id_ (str): Identifier for the PDB structure (used for file naming).
-        outdir_ (str): Directory where the parsed data files will be saved.
+        structure__ (Structure): The input structure.
+        df_wat_ (pandas.DataFrame): DataFrame of the renumbered water molecules.
+        waters_ (numpy.ndarray): Positions (rows of df_wat_) of the waters to count (default: None, all waters).
+
+    Returns:
+        pandas.DataFrame: Number of hydrogen bonds to the main chain (HB_M) and side chains (HB_S) of each water molecule,
+        indexed by renumbered water ID.
+    """
+
+    progress('calculating HB (native)...')
+    n_HB_M, n_HB_S = count_water_HB(structure__, waters_=waters_)
+    return pd.DataFrame({'HB_M': n_HB_M.astype(float), 'HB_S': n_HB_S.astype(float)}, index=select_waters(df_wat_, waters_))
+
+def write_parsed_datafiles(pdb_id__, outdir__, structure__, df_features_):
+    """
+    Saves the parsed per-water metrics as PDB files (mmCIF files for mmCIF input) with the value of each metric in the B-factor column (debug export).
+
+    Args:
+        pdb_id__ (str): Identifier for the PDB structure (used for file naming).
+        outdir__ (str): Directory where the parsed data files will be saved (in 'parsed_data_files').
+        structure__ (Structure): The input structure.
+        df_features_ (pandas.DataFrame): Per-water metrics, indexed by renumbered water ID.
 
     Outputs:
-        Saves parsed data files in the specified output directory.
+        Saves one structure file per metric in the 'parsed_data_files' directory.
     Returns:
         None
     """
+
+    run_command('mkdir -p ' + outdir__ + '/parsed_data_files')
+    wat_index = structure__.water_index()
+    wat_IDs = np.arange(1, len(wat_index) + 1)
+    for metric, suffix in parsed_file_suffixes.items():
+        columns = {'atom_number': (wat_index, wat_IDs), 'residue_number': (wat_index, wat_IDs), 'alt_loc': (wat_index, ['']*len(wat_index)), 'b_factor': (wat_index, df_features_.loc[wat_IDs, metric].values)}
+        structure__.write(outdir__ + '/parsed_data_files/wats_' + pdb_id__ + '_renumber_' + suffix + structure__.file_extension, wat_index, columns, others_=False)
+
+def parse_raw_datafiles(structure_, pdb_id_, outdir_, write_parsed_=False, backends_=None, ccp4_file_=None, resolution_=None, report_=None, n_workers_=1):
+    """
+    Parses raw data files for a given PDB ID, validates their existence, and assembles the per-water features.
+    Features with a native backend are calculated here instead of being read from a raw data file.
+
+    Args:
+        structure_ (Structure or str): The input structure, or the path to the input PDB file.
+        pdb_id_ (str): Identifier for the PDB structure (used for file naming).
+        outdir_ (str): Directory where the raw data files are stored (not used if every feature has a native backend).
+        write_parsed_ (bool): Also save the parsed data of each metric as PDB files in 'parsed_data_files' (default: False).
+        backends_ (dict): Backend of each feature (see configuration.get_backends; default: external programs).
+        ccp4_file_ (str or DensityMap): Path to the CCP4 map, or the map (needed by the native RSCC and EDIA backends).
+        resolution_ (float): Resolution of the map for the native RSCC and EDIA backends (default: estimated from the grid).
+        report_ (RunReport): Report of the run, which records the parsing (or native calculation) of each feature (default: None).
+        n_workers_ (int): Number of threads of the native SASA calculation (default: 1; None: scheduling.default_n_workers()).
+
+    Returns:
+        pandas.DataFrame: A DataFrame containing water residue IDs, chains, and the computed metrics (see build_feature_frame).
+    """
     
     dict_file_suffixes = {
 	'EDIA': '_renumberatomscores.csv',
@@ -256,19 +344,46 @@ def parse_raw_datafiles(pdb_file_, pdb_id_, outdir_):
 	'HB': '_renumber_pymolH.hb2',
 	'SASA': '_renumber_no_header.asa'
     }
+    backends = get_backends(backends_)
+    for feature, backend in backends.items():
+        if backend == 'native':
+            del dict_file_suffixes[feature]
+    if n_workers_ is None:
+        n_workers_ = default_n_workers()
+
+    # check raw datafiles (none if every feature has a native backend)
+    if dict_file_suffixes:
+        check_raw_datafiles(pdb_id_, outdir_, dict_file_suffixes)
+
+    progress('parsing raw datafiles...')
+
+    # get renumbered waters
+    structure_ = load_structure(structure_)
+    df_wat = get_water_frame(structure_)
+
+    # read the map once for the native density backends
+    density_map = None
+    if uses_native_density(backends):
+        with instrument(report_, 'read_map'):
+            density_map = load_ccp4_map(ccp4_file_)
+
+    # parse the datafiles (or calculate the features with a native backend)
+    raw_datafile = outdir_ + '/raw_data_files/' + pdb_id_ if dict_file_suffixes else None
+    parsers = {
+        'RSCC': (lambda: calc_RSCC_native(structure_, df_wat, density_map, resolution_)) if backends['RSCC'] == 'native' else (lambda: read_in_RSCC(df_wat, raw_datafile + dict_file_suffixes['RSCC'])),
+        'B_norm': lambda: read_in_B_norm(structure_, df_wat),
+        'SASA': (lambda: calc_SASA_native(structure_, df_wat, n_workers_)) if backends['SASA'] == 'native' else (lambda: read_in_SASA(df_wat, raw_datafile + dict_file_suffixes['SASA'])),
+        'EDIA': (lambda: calc_EDIA_native(structure_, df_wat, density_map, resolution_)) if backends['EDIA'] == 'native' else (lambda: read_in_EDIA(df_wat, raw_datafile + dict_file_suffixes['EDIA'])),
+        'HB': (lambda: calc_HB_native(structure_, df_wat)) if backends['HB'] == 'native' else (lambda: read_in_HB(df_wat, raw_datafile + dict_file_suffixes['HB']))
+    }
+    features = []
+    for feature, parser in parsers.items():
+        with instrument(report_, 'parse_' + feature, backend=backends.get(feature), n_waters=len(df_wat)):
+            features.append(parser())
+    df_features = pd.concat(features, axis=1)
+
+    if write_parsed_:
+        with instrument(report_, 'write_parsed'):
+            write_parsed_datafiles(pdb_id_, outdir_, structure_, df_features)
 
-    # check raw datafiles and copy SASA result to pdb file
-    check_raw_datafiles(pdb_id_, outdir_, dict_file_suffixes)
-    SASA_raw_datafile = outdir_ + '/raw_data_files/' + pdb_id_ + dict_file_suffixes['SASA']
-    SASA_raw_datafile_pdb = outdir_ + '/raw_data_files/' + pdb_id_ + '_renumber_asa.pdb'
-    subprocess.run('cp ' + SASA_raw_datafile + ' ' + SASA_raw_datafile_pdb, shell=True, check=True)
-
-    print('parsing raw datafiles...')
-
-    # parse the datafiles
-    subprocess.run('mkdir -p ' + outdir_ + '/parsed_data_files', shell=True, check=True)
-    read_in_RSCC(pdb_id_, outdir_, outdir_ + '/raw_data_files/' + pdb_id_ + dict_file_suffixes['RSCC'])
-    read_in_B_norm(pdb_file_, pdb_id_, outdir_)
-    read_in_SASA(pdb_id_, outdir_, SASA_raw_datafile_pdb)
-    read_in_EDIA(pdb_id_, outdir_, outdir_ + '/raw_data_files/' + pdb_id_ + dict_file_suffixes['EDIA'])
-    read_in_HB(pdb_id_, outdir_, outdir_ + '/raw_data_files/' + pdb_id_ + dict_file_suffixes['HB'])
+    return build_feature_frame(pdb_id_, df_wat, df_features)
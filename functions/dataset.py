@@ -0,0 +1,215 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Parquet dataset of ColdBrew results (needs pyarrow, which is only imported here): one file per structure, in
+# Hive-style partitions by ID group, e.g., <dataset>/id_group=GP/6GPW.<run_id>.parquet. Queries read only the
+# partitions and row groups that can match (by ID and by the range of ColdBrew probabilities of each row group).
+
+import os
+import re
+import time
+import uuid
+from functions.store import normalize_pdb_id
+
+# columns of the dataset and their types (pyarrow type names), in file order
+dataset_columns = [
+    ('pdb_id', 'string'),
+    ('wat_ID', 'int32'),
+    ('insertion', 'string'),
+    ('wat_ID_renumbered', 'int32'),
+    ('chain', 'string'),
+    ('RSCC', 'float64'),
+    ('B_norm', 'float64'),
+    ('SASA', 'float64'),
+    ('EDIA', 'float64'),
+    ('HB', 'float64'),
+    ('ColdBrew_probability', 'float64'),
+    ('model_version', 'string'),
+    ('backends', 'string'),
+    ('run_id', 'string'),
+    ('run_time', 'timestamp')
+]
+# rows per row group; the statistics of each row group let queries by probability skip the others
+row_group_size = 4096
+
+def import_pyarrow():
+    """
+    Imports pyarrow, which the dataset needs (e.g., pip install pyarrow).
+
+    Outputs:
+        Raises an ImportError with the name of the missing package if pyarrow is not installed.
+
+    Returns:
+        tuple: The pyarrow, pyarrow.parquet, and pyarrow.dataset modules.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.dataset
+    except ImportError as e:
+        raise ImportError('The results dataset needs pyarrow (pip install pyarrow): ' + str(e))
+    return pyarrow, pyarrow.parquet, pyarrow.dataset
+
+def dataset_schema():
+    """
+    Returns the pyarrow schema of the dataset (see dataset_columns).
+    """
+    pa = import_pyarrow()[0]
+    types = {'string': pa.string(), 'int32': pa.int32(), 'float64': pa.float64(), 'timestamp': pa.timestamp('ms', tz='UTC')}
+    return pa.schema([(name, types[type_name]) for name, type_name in dataset_columns])
+
+def id_group(pdb_id_):
+    """
+    Returns the partition of a structure: the middle two characters of a PDB ID (as in the divided layout of the PDB
+    archive, e.g., GP for 6GPW), so the partitions stay few and of similar size. Other IDs use their first two
+    characters.
+    """
+    key = re.sub(r'[^0-9A-Z]', '_', normalize_pdb_id(pdb_id_))
+    return key[1:3] if len(key) == 4 else key[:2].ljust(2, '_')
+
+def write_structure_results(dataset_dir_, pdb_id_, df_results_, model_version_=None, backends_=None, run_time_=None):
+    """
+    Adds the results of one structure to the dataset, replacing its earlier results (a structure is stored as a whole,
+    as in store.ResultStore). The file is written under a temporary name and renamed, so readers and other processes
+    writing to the dataset never see a partial file.
+
+    Args:
+        dataset_dir_ (str): Directory of the dataset (created if missing).
+        pdb_id_ (str): Identifier of the structure.
+        df_results_ (pandas.DataFrame): Results of the structure, with the columns of the results CSV (see store.result_columns).
+        model_version_ (str): Version of the ColdBrew model (see data_analysis.model_version; default: None).
+        backends_ (dict): Backend of each feature (default: None).
+        run_time_ (float): Time of the run, in seconds since the epoch (default: now).
+
+    Returns:
+        str: Path of the written file.
+    """
+
+    import pandas as pd
+    pa, pq, ds = import_pyarrow()
+
+    key = normalize_pdb_id(pdb_id_)
+    n_waters = len(df_results_.index)
+    df = pd.DataFrame({'pdb_id': [key] * n_waters})
+    for name, type_name in dataset_columns:
+        if name in df_results_.columns:
+            df[name] = df_results_[name].values
+    df['model_version'] = model_version_
+    df['backends'] = ','.join(feature + '=' + backend for feature, backend in sorted(backends_.items())) if backends_ else None
+    run_id = uuid.uuid4().hex[:12]
+    df['run_id'] = run_id
+    df['run_time'] = pd.Timestamp(round((time.time() if run_time_ is None else run_time_) * 1000), unit='ms', tz='UTC')
+    table = pa.Table.from_pandas(df, schema=dataset_schema(), preserve_index=False)
+
+    partition_dir = os.path.join(dataset_dir_, 'id_group=' + id_group(key))
+    os.makedirs(partition_dir, exist_ok=True)
+    file_stem = re.sub(r'[^0-9A-Za-z_-]', '_', key)
+    file_name = file_stem + '.' + run_id + '.parquet'
+    previous_files = [name for name in os.listdir(partition_dir) if re.fullmatch(re.escape(file_stem) + r'\.[0-9a-f]{12}\.parquet', name)]
+    temp_file = os.path.join(partition_dir, '.' + file_name + '.tmp')
+    pq.write_table(table, temp_file, row_group_size=row_group_size, compression='zstd')
+    os.replace(temp_file, os.path.join(partition_dir, file_name))
+    for name in previous_files:
+        os.remove(os.path.join(partition_dir, name))
+    return os.path.join(partition_dir, file_name)
+
+def latest_runs(dataset_, condition_=None):
+    """
+    Returns the run of each structure whose results are current: its latest run (by time), as the results of a
+    structure written again are in a new file until the dataset is compacted.
+    """
+    df = dataset_.to_table(columns=['pdb_id', 'run_id', 'run_time'], filter=condition_).to_pandas().drop_duplicates()
+    return df.sort_values(['run_time', 'run_id']).drop_duplicates('pdb_id', keep='last')['run_id'].tolist()
+
+def open_dataset(dataset_dir_):
+    """
+    Opens the dataset with pyarrow.dataset (the id_group partitions as strings; temporary files are left out). The
+    schema is given, so the columns missing from files written by earlier versions (e.g., insertion) are null.
+    """
+    pa, pq, ds = import_pyarrow()
+    partitioning = ds.partitioning(pa.schema([('id_group', pa.string())]), flavor='hive')
+    return ds.dataset(dataset_dir_, format='parquet', partitioning=partitioning, ignore_prefixes=['.', '_'],
+                      schema=dataset_schema().append(pa.field('id_group', pa.string())))
+
+def read_results(dataset_dir_, pdb_ids_=None, min_probability_=None, max_probability_=None, columns_=None):
+    """
+    Reads the current results (see latest_runs) from the dataset. The filters are pushed down to the files: only the
+    partitions of the given IDs are listed, and row groups whose probabilities are all outside the range are skipped
+    (the rows of compacted files are sorted by probability, see compact_dataset).
+
+    Args:
+        dataset_dir_ (str): Directory of the dataset.
+        pdb_ids_ (list): IDs of the structures to read (default: all structures).
+        min_probability_ (float): Only the waters with at least this ColdBrew probability (default: no minimum).
+        max_probability_ (float): Only the waters with at most this ColdBrew probability (default: no maximum).
+        columns_ (list): Columns to read (default: all columns, see dataset_columns).
+
+    Returns:
+        pandas.DataFrame: The waters, one row each.
+    """
+
+    pa, pq, ds = import_pyarrow()
+
+    dataset = open_dataset(dataset_dir_)
+    id_condition = None
+    if pdb_ids_:
+        keys = [normalize_pdb_id(pdb_id) for pdb_id in pdb_ids_]
+        id_condition = ds.field('id_group').isin(sorted(set(id_group(key) for key in keys))) & ds.field('pdb_id').isin(keys)
+    condition = ds.field('run_id').isin(latest_runs(dataset, id_condition))
+    for expression in [id_condition,
+                       None if min_probability_ is None else ds.field('ColdBrew_probability') >= min_probability_,
+                       None if max_probability_ is None else ds.field('ColdBrew_probability') <= max_probability_]:
+        if expression is not None:
+            condition = condition & expression
+    table = dataset.to_table(columns=columns_ or [name for name, type_name in dataset_columns], filter=condition)
+    return table.to_pandas()
+
+def compact_dataset(dataset_dir_):
+    """
+    Merges the files of each partition into one file, keeping the current results of each structure (see latest_runs),
+    with the rows sorted by ColdBrew probability so queries by probability read few row groups. Many small files (one
+    per structure) make queries slow, so compact the dataset after adding many structures. Do not add to the dataset
+    while it is compacted.
+
+    Args:
+        dataset_dir_ (str): Directory of the dataset.
+
+    Returns:
+        tuple: Numbers of files before and after.
+    """
+
+    pa, pq, ds = import_pyarrow()
+
+    n_before, n_after = 0, 0
+    for partition in sorted(os.listdir(dataset_dir_)):
+        partition_dir = os.path.join(dataset_dir_, partition)
+        files = sorted(name for name in os.listdir(partition_dir) if name.endswith('.parquet') and not name.startswith('.')) if os.path.isdir(partition_dir) else []
+        n_before += len(files)
+        if len(files) <= 1:
+            n_after += len(files)
+            continue
+        dataset = ds.dataset([os.path.join(partition_dir, name) for name in files], format='parquet', schema=dataset_schema())
+        table = dataset.to_table(filter=ds.field('run_id').isin(latest_runs(dataset)))
+        table = table.sort_by([('ColdBrew_probability', 'ascending'), ('pdb_id', 'ascending'), ('wat_ID_renumbered', 'ascending')])
+        file_name = 'part.' + uuid.uuid4().hex[:12] + '.parquet'
+        temp_file = os.path.join(partition_dir, '.' + file_name + '.tmp')
+        pq.write_table(table, temp_file, row_group_size=row_group_size, compression='zstd')
+        os.replace(temp_file, os.path.join(partition_dir, file_name))
+        for name in files:
+            os.remove(os.path.join(partition_dir, name))
+        n_after += 1
+    return n_before, n_after
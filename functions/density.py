@@ -0,0 +1,222 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functions.spatial import CellList
+
+# number of electrons of each element (model density); other elements count as carbon
+atomic_numbers = {'H': 1, 'D': 1, 'C': 6, 'N': 7, 'O': 8, 'NA': 11, 'MG': 12, 'P': 15, 'S': 16, 'CL': 17, 'K': 19, 'CA': 20,
+                  'MN': 25, 'FE': 26, 'CO': 27, 'NI': 28, 'CU': 29, 'ZN': 30, 'SE': 34, 'BR': 35, 'I': 53}
+# distance beyond which atoms do not add to the model density
+model_density_cutoff = 3.0
+# density (in sigma) above which EDIA does not give more support
+EDIA_max_z = 1.2
+sample_spacing = 0.4
+
+def estimate_resolution(density_map_):
+    """
+    Estimates the resolution of a map from its grid, assuming the usual sampling of three grid points per resolution element.
+
+    Args:
+        density_map_ (DensityMap): The map.
+
+    Returns:
+        float: Estimated resolution (Angstrom).
+    """
+    return 3 * float(density_map_.spacing().max())
+
+def RSCC_radius(resolution_):
+    """
+    Returns the radius of the sphere around a water in which the observed and model densities are correlated.
+    """
+    return min(max(0.8 * resolution_, 1.0), 2.0)
+
+def EDIA_radius(resolution_):
+    """
+    Returns the radius of the EDIA sphere of a water oxygen (density support is scored up to twice this radius).
+    """
+    return min(max(0.7 * resolution_, 0.9), 1.6)
+
+def sphere_offsets(radius_, spacing_=sample_spacing):
+    """
+    Returns the points of a cubic lattice within a sphere around the origin.
+
+    Args:
+        radius_ (float): Radius of the sphere.
+        spacing_ (float): Distance between lattice points.
+
+    Returns:
+        numpy.ndarray: (n, 3) offsets.
+    """
+
+    r = np.arange(-np.floor(radius_ / spacing_), np.floor(radius_ / spacing_) + 1) * spacing_
+    offsets = np.array(np.meshgrid(r, r, r, indexing='ij')).reshape(3, -1).T
+    return offsets[np.linalg.norm(offsets, axis=1) <= radius_]
+
+def get_density_atoms(structure_):
+    """
+    Returns the atoms of the model density: all atoms except hydrogens (first alternate locations are not preferred;
+    each atom contributes with its occupancy).
+
+    Args:
+        structure_ (Structure): The structure.
+
+    Returns:
+        numpy.ndarray: Indices of the atoms.
+    """
+    return np.flatnonzero(~np.isin(structure_.column('element_symbol'), ['H', 'D']))
+
+def run_water_chunks(n_waters_, calc_chunk_, n_workers_=1, chunk_size_=64):
+    """
+    Runs a per-water calculation in chunks of waters, optionally on a pool of threads.
+
+    Args:
+        n_waters_ (int): Number of waters.
+        calc_chunk_ (function): Function of (start, stop) returning the values of the waters start to stop - 1.
+        n_workers_ (int): Number of threads (default: 1).
+        chunk_size_ (int): Number of waters per chunk (default: 64).
+
+    Returns:
+        numpy.ndarray: Values of all waters.
+    """
+
+    bounds = [(start, min(start + chunk_size_, n_waters_)) for start in range(0, n_waters_, chunk_size_)]
+    if n_workers_ > 1:
+        with ThreadPoolExecutor(max_workers=n_workers_) as executor:
+            chunks = list(executor.map(lambda b: calc_chunk_(*b), bounds))
+    else:
+        chunks = [calc_chunk_(*b) for b in bounds]
+    return np.concatenate(chunks) if chunks else np.zeros(0)
+
+def water_map_coverage(structure_, density_map_, resolution_=None):
+    """
+    Checks which waters the map covers, i.e., the map (or a symmetry mate of it) holds the points used to score their
+    EDIA (twice the EDIA radius around the water oxygen, which also holds the RSCC sphere).
+
+    Args:
+        structure_ (Structure): The structure.
+        density_map_ (DensityMap): The map.
+        resolution_ (float): Resolution of the map (default: estimated from the grid).
+
+    Returns:
+        numpy.ndarray: True for the covered waters (in the order of structure_.water_index()).
+    """
+
+    if resolution_ is None:
+        resolution_ = estimate_resolution(density_map_)
+    radius = max(2 * EDIA_radius(resolution_), RSCC_radius(resolution_))
+    return density_map_.covers(structure_.coords(structure_.water_index()), radius)
+
+def calculate_water_RSCC(structure_, density_map_, resolution_=None, n_workers_=1, waters_=None):
+    """
+    Calculates an RSCC-like real-space correlation of every water: the correlation between the map and a model density
+    at the points within RSCC_radius of the water oxygen. The model density is a sum of Gaussian atoms (number of electrons,
+    occupancy, and B-factor, blurred by 4 * resolution^2 for the resolution of the map), as phenix.real_space_correlation
+    correlates the 2mFo-DFc map with the Fc map.
+
+    Args:
+        structure_ (Structure): The structure.
+        density_map_ (DensityMap): The map (e.g., 2mFo-DFc).
+        resolution_ (float): Resolution of the map (default: estimated from the grid).
+        n_workers_ (int): Number of threads (default: 1).
+        waters_ (numpy.ndarray): Positions (in the order of structure_.water_index()) of the waters to score (default: None, all waters).
+
+    Returns:
+        numpy.ndarray: RSCC of each water (in the order of structure_.water_index(), or of waters_); -1 if the map does not cover the water.
+    """
+
+    if resolution_ is None:
+        resolution_ = estimate_resolution(density_map_)
+    wat_index = structure_.water_index()
+    if waters_ is not None:
+        wat_index = wat_index[waters_]
+    wat_xyz = structure_.coords(wat_index)
+    atom_index = get_density_atoms(structure_)
+    atoms = CellList(structure_.coords(atom_index), model_density_cutoff)
+    electrons = np.array([atomic_numbers.get(element, 6) for element in structure_.column('element_symbol')[atom_index]], dtype=float)
+    weights = electrons * structure_.column('occupancy')[atom_index]
+    B_eff = structure_.column('b_factor')[atom_index] + 4 * resolution_**2
+    offsets = sphere_offsets(RSCC_radius(resolution_))
+
+    def calc_chunk(start, stop):
+        points = (wat_xyz[start:stop, None, :] + offsets[None, :, :]).reshape(-1, 3)
+        observed = density_map_.interpolate(points).reshape(stop - start, -1)
+
+        pair_point, pair_atom, dist = atoms.query_pairs(points, model_density_cutoff, sort_=False)
+        B = B_eff[pair_atom]
+        gaussians = weights[pair_atom] * (4 * np.pi / B)**1.5 * np.exp(-4 * np.pi**2 * dist**2 / B)
+        model = np.bincount(pair_point, gaussians, minlength=len(points)).reshape(stop - start, -1)
+
+        observed = observed - observed.mean(axis=1, keepdims=True)
+        model = model - model.mean(axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            RSCC = (observed * model).sum(axis=1) / np.sqrt((observed**2).sum(axis=1) * (model**2).sum(axis=1))
+        return np.where(np.isnan(RSCC), -1, RSCC)
+
+    return run_water_chunks(len(wat_xyz), calc_chunk, n_workers_)
+
+def calculate_water_EDIA(structure_, density_map_, resolution_=None, n_workers_=1, waters_=None):
+    """
+    Calculates an EDIA-like electron density support of every water. As in EDIA, the density (in sigma, capped at 1.2)
+    at the points around the water oxygen is weighted by a function of the distance: positive within the EDIA radius r
+    (1 - d^2 / 2r^2) and negative between r and 2r (-(2 - d/r)^2 / 2), where density is not explained by another atom
+    within r. The sum is divided by the sum of the positive weights.
+
+    Args:
+        structure_ (Structure): The structure.
+        density_map_ (DensityMap): The map (e.g., 2mFo-DFc).
+        resolution_ (float): Resolution of the map (default: estimated from the grid).
+        n_workers_ (int): Number of threads (default: 1).
+        waters_ (numpy.ndarray): Positions (in the order of structure_.water_index()) of the waters to score (default: None, all waters).
+
+    Returns:
+        numpy.ndarray: EDIA of each water (in the order of structure_.water_index(), or of waters_); -1 if the map does not
+        cover the water, as ediascorer does.
+    """
+
+    if resolution_ is None:
+        resolution_ = estimate_resolution(density_map_)
+    wat_index = structure_.water_index()
+    if waters_ is not None:
+        wat_index = wat_index[waters_]
+    wat_xyz = structure_.coords(wat_index)
+    atom_index = get_density_atoms(structure_)
+    radius = EDIA_radius(resolution_)
+    atoms = CellList(structure_.coords(atom_index), radius)
+    wat_atom_pos = np.searchsorted(atom_index, wat_index)
+
+    offsets = sphere_offsets(2 * radius)
+    dist = np.linalg.norm(offsets, axis=1)
+    weights = np.where(dist <= radius, 1 - 0.5 * (dist / radius)**2, -0.5 * (2 - dist / radius)**2)
+    positive_sum = weights[weights > 0].sum()
+
+    def calc_chunk(start, stop):
+        points = (wat_xyz[start:stop, None, :] + offsets[None, :, :]).reshape(-1, 3)
+        z = np.clip((density_map_.interpolate(points) - density_map_.mean) / density_map_.rms, 0, EDIA_max_z).reshape(stop - start, -1)
+
+        # points of the negative shell that are within r of another atom do not count
+        pair_point, pair_atom, pair_dist = atoms.query_pairs(points, radius, sort_=False)
+        is_other = pair_atom != np.repeat(wat_atom_pos[start:stop], len(offsets))[pair_point]
+        explained = np.zeros(len(points), dtype=bool)
+        explained[pair_point[is_other]] = True
+        point_weights = np.where(explained.reshape(stop - start, -1) & (weights < 0), 0, weights)
+
+        EDIA = np.maximum((z * point_weights).sum(axis=1) / positive_sum, 0)
+        return np.where(np.isnan(EDIA), -1, EDIA)
+
+    return run_water_chunks(len(wat_xyz), calc_chunk, n_workers_)
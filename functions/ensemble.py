@@ -0,0 +1,162 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import csv
+from functions.structure import read_models
+from functions.batch import run_entries
+
+def write_models(pdb_file_, pdb_id_, mtz_file_, ccp4_file_, outdir_):
+    """
+    Splits an ensemble into one structure file per model: <outdir>/<ID>_model_<N>/<ID>_model_<N>.pdb (.cif for mmCIF
+    input), with the header of the ensemble (e.g., the cell). The ensemble is read once.
+
+    Args:
+        pdb_file_ (str): Path to the PDB or mmCIF file of the ensemble.
+        pdb_id_ (str): Identifier of the ensemble.
+        mtz_file_ (str): Path to the MTZ file (shared by all models).
+        ccp4_file_ (str): Path to the CCP4 map (shared by all models; None to calculate a map for each model).
+        outdir_ (str): Output directory of the ensemble.
+
+    Returns:
+        list: One entry per model with the keys id, pdb, mtz, ccp4 (see batch.run_manifest_entry) and model (model number).
+    """
+
+    entries = []
+    for model, structure in read_models(pdb_file_):
+        model_id = pdb_id_ + '_model_' + str(model)
+        os.makedirs(os.path.join(outdir_, model_id), exist_ok=True)
+        model_file = os.path.join(outdir_, model_id, model_id + structure.file_extension)
+        structure.write(model_file)
+        entries.append({'id': model_id, 'pdb': model_file, 'mtz': mtz_file_, 'ccp4': ccp4_file_, 'model': model})
+    return entries
+
+def summarize_ensemble(pdb_id_, outdir_, entries_):
+    """
+    Collects the ColdBrew probabilities of the models of an ensemble. Waters are the same water in every model if they
+    have the same chain and residue number (the models of an ensemble keep the residue numbers of their waters); the
+    alternate conformations of a water are told apart by their order in the model (conformer 1, 2, ...).
+    Probabilities of -1 (waters the map does not cover) are left out of the statistics.
+
+    Args:
+        pdb_id_ (str): Identifier of the ensemble.
+        outdir_ (str): Output directory of the ensemble.
+        entries_ (list): Models whose results are saved (see write_models).
+
+    Outputs:
+        Saves <ID>_ensemble_probabilities.csv (the probability of each water in each model, blank if the model does not
+        have the water) and <ID>_ensemble_summary.csv (per water: the number of models with the water and with a
+        probability, and the mean, standard deviation, minimum, median, and maximum of its probabilities).
+
+    Returns:
+        pandas.DataFrame: The summary.
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    probabilities = []
+    for entry in entries_:
+        df = pd.read_csv(os.path.join(outdir_, entry['id'], entry['id'] + '_ColdBrew_results.csv'), index_col=0)
+        df['conformer'] = df.groupby(['chain', 'wat_ID']).cumcount() + 1
+        df = df.set_index(['chain', 'wat_ID', 'conformer'])
+        probabilities.append(df['ColdBrew_probability'].rename('model_' + str(entry['model'])))
+    df_prob = pd.concat(probabilities, axis=1, sort=False)
+    df_prob.index.names = ['chain', 'wat_ID', 'conformer']
+    df_prob.to_csv(os.path.join(outdir_, pdb_id_ + '_ensemble_probabilities.csv'))
+
+    scored = df_prob.where(df_prob >= 0)
+    df_summary = pd.DataFrame({
+        'n_models': df_prob.notna().sum(axis=1),
+        'n_scored': scored.notna().sum(axis=1),
+        'mean': scored.mean(axis=1),
+        'std': scored.std(axis=1),
+        'min': scored.min(axis=1),
+        'median': scored.median(axis=1),
+        'max': scored.max(axis=1)
+    }, index=df_prob.index)
+    df_summary.to_csv(os.path.join(outdir_, pdb_id_ + '_ensemble_summary.csv'))
+    print('saved the probabilities of ' + str(len(df_summary.index)) + ' waters in ' + str(len(entries_)) + ' models (mean standard deviation across models: ' +
+          str(round(float(np.nanmean(df_summary['std'].values)), 3) if df_summary['std'].notna().any() else 'NA') + ')')
+    return df_summary
+
+def run_ensemble(pdb_file_, pdb_id_, mtz_file_, ccp4_file_, outdir_, n_procs_=1, n_workers_=None, write_parsed_=False, cache_=None, backends_=None,
+                 openmetrics_=False, resolution_=None, site_=None, dataset_=None,
+                 scratch_=None, keep_intermediates_=None, map_columns_=None):
+    """
+    Scores every model of an ensemble (e.g., an NMR or refinement ensemble, or the snapshots of a simulation with
+    crystallographic waters) against the same reflections and map. The ensemble is read and split once (see
+    write_models), and the models run as a batch on a pool of processes, each in its own output directory (see
+    batch.run_manifest_entry). The model and the map are loaded before the pool starts, so the worker processes
+    share them (where processes are forked) and keep them for all the models they run. A failed model (or a model whose
+    process died) does not stop the others (see batch.run_entries).
+
+    Args:
+        pdb_file_ (str): Path to the PDB or mmCIF file of the ensemble.
+        pdb_id_ (str): Identifier of the ensemble.
+        mtz_file_ (str): Path to the MTZ file.
+        ccp4_file_ (str): Path to the CCP4 map (None to calculate the 2mFo-DFc map of each model, phased by the model,
+            from the MTZ file; see maps.calculate_map).
+        outdir_ (str): Output directory of the ensemble.
+        n_procs_ (int): Number of models run at the same time (default: 1).
+        n_workers_ (int): Maximum number of calculations run at the same time for each model.
+        write_parsed_ (bool): Also save the parsed data of each metric as PDB files (default: False).
+        cache_ (StageCache): Cache of stage outputs shared by all models (default: None).
+        backends_ (dict): Backend of each feature (see configuration.get_backends; default: external programs).
+        openmetrics_ (bool): Also save the run report of each model as OpenMetrics text (default: False).
+        resolution_ (float): Resolution of the map for the native RSCC and EDIA backends (default: estimated from the grid).
+        site_ (dict): Site to score in each model (see pipeline.run_pipeline; default: None, all waters).
+        dataset_ (str): Directory of a Parquet dataset to add the results of each model to, as <ID>_model_<N> (default: None).
+        scratch_ (str): Directory for the scratch workspaces of the models (see batch.run_manifest; default: None).
+        keep_intermediates_ (str): With workspaces, when to keep the intermediate files of a model: 'none', 'failure', or 'all' (default: None).
+        map_columns_ (list): Labels of the map coefficients in the MTZ file, used if ccp4_file_ is None (default: None).
+
+    Outputs:
+        Saves the results of each model in <outdir>/<ID>_model_<N>, the status of each model in <ID>_ensemble_runs.csv,
+        and the probabilities of the waters across the models (see summarize_ensemble).
+
+    Returns:
+        list: Summaries of the runs of the models (see batch.run_manifest_entry), in model order.
+    """
+
+    from functions.ccp4 import load_ccp4_map
+    from functions.data_analysis import load_model
+
+    outdir_ = os.path.abspath(outdir_)
+    if ccp4_file_ is not None:
+        ccp4_file_ = os.path.abspath(ccp4_file_)
+    entries = write_models(pdb_file_, pdb_id_, os.path.abspath(mtz_file_), ccp4_file_, outdir_)
+    print('running ' + str(len(entries)) + ' models of ' + pdb_id_ + ' on ' + str(n_procs_) + ' processes...')
+    load_model()
+    if ccp4_file_ is not None:
+        load_ccp4_map(ccp4_file_)
+
+    summaries = run_entries(entries, outdir_, n_procs_, n_workers_=n_workers_, write_parsed_=write_parsed_, cache_=cache_, backends_=backends_, openmetrics_=openmetrics_,
+                            resolution_=resolution_, site_=site_, dataset_=dataset_, scratch_=scratch_, keep_intermediates_=keep_intermediates_, map_columns_=map_columns_)
+
+    # save the status of each model
+    summaries = [dict(summaries[entry['id']], model=entry['model']) for entry in entries]
+    with open(os.path.join(outdir_, pdb_id_ + '_ensemble_runs.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['id', 'model', 'status', 'error', 'seconds'])
+        writer.writeheader()
+        writer.writerows(summaries)
+
+    done = [entry for entry, summary in zip(entries, summaries) if summary['status'] == 'done']
+    print(str(len(done)) + ' models done, ' + str(len(entries) - len(done)) + ' failed (see ' + os.path.join(outdir_, pdb_id_ + '_ensemble_runs.csv') + ')')
+    if done:
+        summarize_ensemble(pdb_id_, outdir_, done)
+    return summaries
@@ -16,7 +16,20 @@
 
 import os
 import sys
-import subprocess
+import shutil
+import tempfile
+from functions.configuration import add_hydrogens, add_hydrogens_script, get_backends
+from functions.cache import run_cached_stage
+from functions.scheduling import run_stage_graph
+from functions.instrumentation import instrument, run_command, progress
+
+# feature: stages of run_calculations that calculate it
+feature_stages = {
+    'RSCC': ['RSCC', 'RSCC_edit'],
+    'SASA': ['SASA'],
+    'EDIA': ['EDIA'],
+    'HB': ['H_add', 'HB']
+}
 
 def edit_RSCC(pdb_id__, outdir__):
     """
@@ -36,14 +49,17 @@ def edit_RSCC(pdb_id__, outdir__):
     fout = open(outdir__ + '/raw_data_files/' + pdb_id__ + '_original_edited.txt','w')
     for line in f:
         if 'HOH' in line and ('H1' in line or 'H2' in line):
-            print('Delete:', line.replace('\n', ''))
+            progress('Delete:', line.replace('\n', ''))
         else:
             fout.write(line)
     fout.close()
 
-def run_calculations(pdb_file_, pdb_id_, mtz_file_, ccp4_file_, outdir_):
+def run_calculations(pdb_file_, pdb_id_, mtz_file_, ccp4_file_, outdir_, n_workers_=None, workdir_=None, cache_=None, backends_=None, report_=None, features_=None):
     """                                                                                                                                                                                                            
     Runs various calculations (RSCC, SASA, EDIA, HB) on the given PDB and related files, and saves the raw output data in a specified directory.
+    The calculations are independent of each other, so they are run as a stage graph where each stage starts as soon as its
+    inputs are ready (RSCC, SASA, and EDIA only need the setup outputs; HB only needs the PyMOL-hydrogenated file).
+    Features with a native backend are not run here; they are calculated when the raw data files are parsed.
 
     Args:                                                                                                                                                                                                         
         pdb_file_ (str): Path to the PDB file for the structure.                                                                                                                                                   
@@ -51,6 +67,14 @@ def run_calculations(pdb_file_, pdb_id_, mtz_file_, ccp4_file_, outdir_):
         mtz_file_ (str): Path to the MTZ file containing reflection data.                                                                                                                                           
         ccp4_file_ (str): Path to the CCP4 file containing the electron density map.                                                                                                                               
         outdir_ (str): Directory to store the raw data files generated during calculations.                                                                                                                         
+        n_workers_ (int): Maximum number of calculations run at the same time (default: number of CPUs, up to 4).
+        workdir_ (str): Working directory for naccess and HBPLUS, which write their output files into the
+            current directory (default: a private directory in the output directory, removed afterwards), so runs do not
+            depend on or write into the current directory of the process.
+        cache_ (StageCache): Cache of stage outputs; stages that already ran with the same inputs and programs are skipped (default: None).
+        backends_ (dict): Backend of each feature (see configuration.get_backends; default: external programs).
+        report_ (RunReport): Report of the run, which records each stage and external command (default: None).
+        features_ (list): Features to calculate (default: None, all features).
                                                                                                                                                                                                                   
     Outputs:                                                                                                                                                                                                        
         Saves various raw data files in the 'raw_data_files' directory.                                                                                                                                           
@@ -58,27 +82,93 @@ def run_calculations(pdb_file_, pdb_id_, mtz_file_, ccp4_file_, outdir_):
         None                                                                                                                                                                                                        
     """
     
-    print('running calculations...')
-    subprocess.run('mkdir -p ' + outdir_ + '/raw_data_files', shell=True, check=True)
+    progress('running calculations...')
+    run_command('mkdir -p ' + outdir_ + '/raw_data_files')
+    private_workdir = workdir_ is None
+    if private_workdir:
+        workdir_ = tempfile.mkdtemp(prefix='workdir_', dir=outdir_)
+
+    raw = outdir_ + '/raw_data_files/' + pdb_id_
 
     # RSCC
-    print('calculating RSCC...')
-    subprocess.run('$PHENIX_BIN/phenix.real_space_correlation ' + pdb_file_ + ' ' + mtz_file_ + ' > ' + outdir_ + '/raw_data_files/' + pdb_id_ + '_original.txt', shell=True, check=True)
-    edit_RSCC(pdb_id_, outdir_)
+    def calc_RSCC():
+        progress('calculating RSCC...')
+        run_command('$PHENIX_BIN/phenix.real_space_correlation ' + pdb_file_ + ' ' + mtz_file_ + ' > ' + raw + '_original.txt', report_, 'RSCC')
 
     # SASA
-    print('calculating SASA...')
-    subprocess.run('$NACCESS_EXE ' + outdir_ + '/' + pdb_id_ + '_renumber_no_header.pdb -w > ' + outdir_ + '/raw_data_files/naccess.log', shell=True, check=True)
-    subprocess.run('mv ' + pdb_id_ + '_renumber_no_header.asa ' + outdir_ + '/raw_data_files', shell=True, check=True)
-    subprocess.run('mv ' + pdb_id_ + '_renumber_no_header.rsa ' + outdir_ + '/raw_data_files', shell=True, check=True)
-    subprocess.run('mv ' + pdb_id_ + '_renumber_no_header.log ' + outdir_ + '/raw_data_files', shell=True, check=True)
+    def calc_SASA():
+        progress('calculating SASA...')
+        run_command('$NACCESS_EXE ' + outdir_ + '/' + pdb_id_ + '_renumber_no_header.pdb -w > ' + outdir_ + '/raw_data_files/naccess.log', report_, 'SASA', workdir_)
+        run_command('mv ' + pdb_id_ + '_renumber_no_header.asa ' + outdir_ + '/raw_data_files', report_, 'SASA', workdir_)
+        run_command('mv ' + pdb_id_ + '_renumber_no_header.rsa ' + outdir_ + '/raw_data_files', report_, 'SASA', workdir_)
+        run_command('mv ' + pdb_id_ + '_renumber_no_header.log ' + outdir_ + '/raw_data_files', report_, 'SASA', workdir_)
 
     # EDIA
-    print('calculating EDIA...')
-    subprocess.run('$EDIASCORER_EXE --license $EDIASCORER_LICENSE --target ' + outdir_ + '/' + pdb_id_ + '_renumber.pdb --outputfolder ' + outdir_ + '/raw_data_files --densitymap ' + ccp4_file_ + ' > ' + outdir_ + '/raw_data_files/EDIAscorer.log 2>&1', shell=True, check=True)
+    def calc_EDIA():
+        progress('calculating EDIA...')
+        run_command('$EDIASCORER_EXE --license $EDIASCORER_LICENSE --target ' + outdir_ + '/' + pdb_id_ + '_renumber.pdb --outputfolder ' + outdir_ + '/raw_data_files --densitymap ' + ccp4_file_ + ' > ' + outdir_ + '/raw_data_files/EDIAscorer.log 2>&1', report_, 'EDIA')
 
     # HB
-    print('calculating HB...')
-    subprocess.run('$HBPLUS_EXE ' + outdir_ + '/' + pdb_id_ + '_renumber_pymolH.pdb ' + pdb_file_ + ' > ' + outdir_ + '/raw_data_files/hbplus.log', shell=True, check=True)
-    subprocess.run('mv ' + pdb_id_ + '_renumber_pymolH.hb2 ' + outdir_ + '/raw_data_files', shell=True, check=True)
-    subprocess.run('mv hbdebug.dat ' + outdir_ + '/raw_data_files', shell=True, check=True)
+    def calc_H():
+        progress('adding hydrogens...')
+        add_hydrogens(pdb_id_, outdir_, report_)
+
+    def calc_HB():
+        progress('calculating HB...')
+        run_command('$HBPLUS_EXE ' + outdir_ + '/' + pdb_id_ + '_renumber_pymolH.pdb ' + pdb_file_ + ' > ' + outdir_ + '/raw_data_files/hbplus.log', report_, 'HB', workdir_)
+        run_command('mv ' + pdb_id_ + '_renumber_pymolH.hb2 ' + outdir_ + '/raw_data_files', report_, 'HB', workdir_)
+        run_command('mv hbdebug.dat ' + outdir_ + '/raw_data_files', report_, 'HB', workdir_)
+
+    # run each calculation through the cache (inputs, programs, and outputs of each stage)
+    def cached_RSCC():
+        with instrument(report_, 'RSCC') as record:
+            record['cached'] = run_cached_stage(cache_, 'RSCC', calc_RSCC, [pdb_file_, mtz_file_], {'rscc.txt': raw + '_original.txt'},
+                                           tools_=['$PHENIX_BIN/phenix.real_space_correlation'], env_vars_=['PHENIX_BIN'])
+
+    def cached_SASA():
+        with instrument(report_, 'SASA') as record:
+            record['cached'] = run_cached_stage(cache_, 'SASA', calc_SASA, [outdir_ + '/' + pdb_id_ + '_renumber_no_header.pdb'],
+                                           {'naccess.asa': raw + '_renumber_no_header.asa', 'naccess.rsa': raw + '_renumber_no_header.rsa', 'naccess_run.log': raw + '_renumber_no_header.log', 'naccess.log': outdir_ + '/raw_data_files/naccess.log'},
+                                           tools_=['$NACCESS_EXE'], env_vars_=['NACCESS_EXE'], optional_=['naccess_run.log', 'naccess.log'])
+
+    def cached_EDIA():
+        with instrument(report_, 'EDIA') as record:
+            record['cached'] = run_cached_stage(cache_, 'EDIA', calc_EDIA, [outdir_ + '/' + pdb_id_ + '_renumber.pdb', ccp4_file_],
+                                           {'atomscores.csv': raw + '_renumberatomscores.csv', 'structurescores.csv': raw + '_renumberstructurescores.csv', 'EDIA.pdb': raw + '_renumberEDIA.pdb', 'EDIAscorer.log': outdir_ + '/raw_data_files/EDIAscorer.log'},
+                                           tools_=['$EDIASCORER_EXE'], env_vars_=['EDIASCORER_EXE'], optional_=['structurescores.csv', 'EDIA.pdb', 'EDIAscorer.log'])
+
+    def cached_H():
+        with instrument(report_, 'H_add') as record:
+            record['cached'] = run_cached_stage(cache_, 'H_add', calc_H, [outdir_ + '/' + pdb_id_ + '_renumber.pdb', add_hydrogens_script],
+                                           {'pymolH.pdb': outdir_ + '/' + pdb_id_ + '_renumber_pymolH.pdb', 'pymol_HB_add.log': outdir_ + '/pymol_HB_add.log'},
+                                           tools_=['$PYMOL_EXE'], env_vars_=['PYMOL_EXE'], optional_=['pymol_HB_add.log'])
+
+    def cached_HB():
+        with instrument(report_, 'HB') as record:
+            record['cached'] = run_cached_stage(cache_, 'HB', calc_HB, [outdir_ + '/' + pdb_id_ + '_renumber_pymolH.pdb', pdb_file_],
+                                           {'hbplus.hb2': raw + '_renumber_pymolH.hb2', 'hbdebug.dat': outdir_ + '/raw_data_files/hbdebug.dat', 'hbplus.log': outdir_ + '/raw_data_files/hbplus.log'},
+                                           tools_=['$HBPLUS_EXE'], env_vars_=['HBPLUS_EXE'], optional_=['hbdebug.dat', 'hbplus.log'])
+
+    def edited_RSCC():
+        with instrument(report_, 'RSCC_edit'):
+            edit_RSCC(pdb_id_, outdir_)
+
+    # stage name: (function, stages it depends on)
+    stages = {
+        'RSCC': (cached_RSCC, []),
+        'RSCC_edit': (edited_RSCC, ['RSCC']),
+        'SASA': (cached_SASA, []),
+        'EDIA': (cached_EDIA, []),
+        'H_add': (cached_H, []),
+        'HB': (cached_HB, ['H_add'])
+    }
+    backends = get_backends(backends_)
+    for feature, stage_names in feature_stages.items():
+        if backends[feature] == 'native' or (features_ is not None and feature not in features_):
+            for stage_name in stage_names:
+                del stages[stage_name]
+    try:
+        run_stage_graph(stages, n_workers_)
+    finally:
+        if private_workdir:
+            shutil.rmtree(workdir_, ignore_errors=True)
@@ -0,0 +1,152 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import numpy as np
+
+class CompiledForest:
+    """
+    A random forest classifier flattened into NumPy arrays (the nodes of all trees one after the other), evaluated
+    for all samples and trees at once. It gives the same probabilities as sklearn's RandomForestClassifier.predict_proba,
+    bit for bit: the samples are compared as float32 with the float64 thresholds (x <= threshold goes left), the leaf
+    values are normalized per tree, and the trees are summed in the order of the forest and divided by their number.
+
+    Attributes:
+        feature_names (numpy.ndarray): Names of the features, in the order of the columns of X.
+        feature (numpy.ndarray): Feature tested at each node (-2 for leaves, as in sklearn).
+        threshold (numpy.ndarray): Threshold of each node.
+        left (numpy.ndarray): Index of the left child of each node (the node itself for leaves).
+        right (numpy.ndarray): Index of the right child of each node (the node itself for leaves).
+        proba (numpy.ndarray): (n_nodes, n_classes) class probabilities of each node (normalized leaf values).
+        roots (numpy.ndarray): Index of the root node of each tree.
+        max_depth (int): Depth of the deepest tree.
+    """
+
+    def __init__(self, feature_names_, feature_, threshold_, left_, right_, proba_, roots_, max_depth_):
+        self.feature_names = np.asarray(feature_names_, dtype=str)
+        self.feature = feature_
+        self.threshold = threshold_
+        self.left = left_
+        self.right = right_
+        self.proba = proba_
+        self.roots = roots_
+        self.max_depth = int(max_depth_)
+
+        # traversal tables indexed by twice the node index, so that adding 1 (going right) selects the right child
+        self._children = np.stack([left_, right_], axis=1).ravel().astype(np.intp) * 2
+        self._feature = np.repeat(np.maximum(feature_, 0), 2).astype(np.intp)
+        self._threshold = np.repeat(threshold_, 2)
+
+    def predict_proba(self, X_, chunk_size_=1024):
+        """
+        Returns the class probabilities of samples.
+
+        Args:
+            X_ (pandas.DataFrame or numpy.ndarray): Features of the samples (a DataFrame is reordered by feature_names).
+            chunk_size_ (int): Number of samples evaluated at a time (default: 1024).
+
+        Returns:
+            numpy.ndarray: (n_samples, n_classes) probabilities.
+        """
+
+        if hasattr(X_, 'columns'):
+            X_ = X_[list(self.feature_names)].values
+        # float32 like sklearn, compared as float64 with the thresholds (exact)
+        X_ = np.asarray(X_, dtype=np.float32).T.astype(np.float64)
+        n_samples = X_.shape[1]
+        out = np.zeros((n_samples, self.proba.shape[1]))
+        for start in range(0, n_samples, chunk_size_):
+            X = X_[:, start: start + chunk_size_]
+            n = X.shape[1]
+            X_flat = X.ravel()
+            feature_offset = self._feature * n
+            sample = np.arange(n)
+            # walk all trees (rows) for all samples (columns) down one level at a time (leaves point to themselves)
+            node = np.repeat(2 * self.roots.astype(np.intp)[:, np.newaxis], n, axis=1)
+            for depth in range(self.max_depth):
+                node += X_flat[feature_offset[node] + sample] > self._threshold[node]
+                node = self._children[node]
+            leaf_proba = self.proba[node // 2]
+            chunk = out[start: start + n]
+            for tree in range(len(self.roots)):
+                chunk += leaf_proba[tree]
+        out /= len(self.roots)
+        return out
+
+def compile_forest(model_):
+    """
+    Flattens the trees of a fitted sklearn RandomForestClassifier (one output) into a CompiledForest.
+
+    Args:
+        model_ (sklearn.ensemble.RandomForestClassifier): The fitted forest.
+
+    Returns:
+        CompiledForest: The compiled forest.
+    """
+
+    feature, threshold, left, right, proba, roots = [], [], [], [], [], []
+    n_nodes = 0
+    for estimator in model_.estimators_:
+        tree = estimator.tree_
+        node = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+        value = tree.value[:, 0, :model_.n_classes_].copy()
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        value /= normalizer
+
+        roots.append(n_nodes)
+        feature.append(tree.feature)
+        threshold.append(tree.threshold)
+        left.append(np.where(is_leaf, node, tree.children_left) + n_nodes)
+        right.append(np.where(is_leaf, node, tree.children_right) + n_nodes)
+        proba.append(value)
+        n_nodes += tree.node_count
+
+    feature_names = getattr(model_, 'feature_names_in_', np.arange(model_.n_features_in_).astype(str))
+    max_depth = max(estimator.tree_.max_depth for estimator in model_.estimators_)
+    return CompiledForest(feature_names, np.concatenate(feature).astype(np.int32), np.concatenate(threshold), np.concatenate(left).astype(np.int32),
+                          np.concatenate(right).astype(np.int32), np.concatenate(proba), np.array(roots, dtype=np.int32), max_depth)
+
+def save_forest(forest_, forest_file_):
+    """
+    Saves a CompiledForest to a NumPy .npz file.
+
+    Args:
+        forest_ (CompiledForest): The forest.
+        forest_file_ (str): Path of the .npz file.
+
+    Returns:
+        None
+    """
+
+    np.savez_compressed(forest_file_, feature_names=forest_.feature_names, feature=forest_.feature, threshold=forest_.threshold, left=forest_.left,
+                        right=forest_.right, proba=forest_.proba, roots=forest_.roots, max_depth=forest_.max_depth)
+
+def load_forest(forest_file_):
+    """
+    Loads a CompiledForest saved with save_forest.
+
+    Args:
+        forest_file_ (str): Path of the .npz file.
+
+    Returns:
+        CompiledForest: The forest.
+    """
+
+    with np.load(forest_file_) as arrays:
+        return CompiledForest(arrays['feature_names'], arrays['feature'], arrays['threshold'], arrays['left'], arrays['right'], arrays['proba'],
+                              arrays['roots'], arrays['max_depth'])
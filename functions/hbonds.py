@@ -0,0 +1,259 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import numpy as np
+from functions.spatial import CellList
+
+# geometric criteria of HBPLUS (default settings)
+max_DA = 3.9
+max_HA = 2.5
+min_angle = 90.0
+# donors whose hydrogen is not placed (rotatable or alternate location)
+max_DA_rotatable = 3.5
+# water donors without explicit hydrogens; the hydrogens added by PyMOL have no preferred orientation, so water donors
+# are scored by distance only. This is an approximation: the cutoff was fitted to the mean HBPLUS count of the 6GPW
+# demo (the HBPLUS rule for unplaced hydrogens, max_DA_rotatable, overcounts it by half), so the demo does not validate
+# it independently; with it, 285 of 358 demo waters get the HBPLUS count. The criteria themselves are checked with the
+# water hydrogens added by PyMOL (scripts/compare_backends.py -check: 358 of 358 main-chain, 356 of 358 side-chain counts)
+max_DA_water = 2.8
+
+main_chain_atoms = ['N', 'CA', 'C', 'O', 'OXT']
+
+# donors with one hydrogen in the plane of two bonded atoms (on the bisector)
+sp2_donors_one_H = {
+    ('ARG', 'NE'): ('CD', 'CZ'),
+    ('TRP', 'NE1'): ('CD1', 'CE2'),
+    ('HIS', 'ND1'): ('CG', 'CE1'),
+    ('HIS', 'NE2'): ('CD2', 'CE1')
+}
+# donors with two hydrogens in the plane of the bonded atom and its neighbor
+sp2_donors_two_H = {
+    ('ARG', 'NH1'): ('CZ', 'NE'),
+    ('ARG', 'NH2'): ('CZ', 'NE'),
+    ('ASN', 'ND2'): ('CG', 'OD1'),
+    ('GLN', 'NE2'): ('CD', 'OE1')
+}
+rotatable_donors = [('LYS', 'NZ'), ('SER', 'OG'), ('THR', 'OG1'), ('TYR', 'OH'), ('CYS', 'SG')]
+
+# acceptor: antecedent (bonded atom used for the angle criteria); None matches any residue
+acceptor_antecedents = {
+    (None, 'O'): 'C',
+    (None, 'OXT'): 'C',
+    ('ASP', 'OD1'): 'CG',
+    ('ASP', 'OD2'): 'CG',
+    ('ASN', 'OD1'): 'CG',
+    ('GLU', 'OE1'): 'CD',
+    ('GLU', 'OE2'): 'CD',
+    ('GLN', 'OE1'): 'CD',
+    ('HIS', 'ND1'): 'CG',
+    ('HIS', 'NE2'): 'CD2',
+    ('SER', 'OG'): 'CB',
+    ('THR', 'OG1'): 'CB',
+    ('TYR', 'OH'): 'CZ',
+    ('MET', 'SD'): 'CG'
+}
+
+def unit_vectors(v_):
+    return v_ / np.linalg.norm(v_, axis=-1, keepdims=True)
+
+def angles(a_, b_, c_):
+    """
+    Returns the angles a-b-c in degrees (row-wise for arrays of points).
+    """
+    cos = (unit_vectors(a_ - b_) * unit_vectors(c_ - b_)).sum(axis=-1)
+    return np.degrees(np.arccos(np.clip(cos, -1, 1)))
+
+class ProteinTopology:
+    """
+    Residues and atom names of the protein atoms (ATOM records) of a structure, used to find bonded atoms by name.
+    Atoms with alternate locations are looked up as the first alternate location, as HBPLUS does.
+
+    Attributes:
+        index (numpy.ndarray): Indices of the protein atoms.
+        residue (numpy.ndarray): Residue number (0 to n_residues - 1, in file order) of each protein atom.
+    """
+
+    def __init__(self, structure_):
+        self.structure = structure_
+        self.index = structure_.protein_index()
+        residue_keys = np.char.add(np.char.add(structure_.column('chain_id')[self.index], '|'),
+                                   np.char.add(structure_.column('residue_number')[self.index].astype(str), structure_.column('insertion')[self.index]))
+        new_residue = np.ones(len(self.index), dtype=bool)
+        new_residue[1:] = residue_keys[1:] != residue_keys[:-1]
+        self.residue = np.cumsum(new_residue) - 1
+
+        self._atoms = {}
+        for residue, name, atom in zip(self.residue, structure_.column('atom_name')[self.index], self.index):
+            self._atoms.setdefault((residue, name), atom)
+
+    def find(self, residue_, name_):
+        """
+        Returns the index of an atom in a residue (-1 if it does not exist).
+        """
+        return self._atoms.get((residue_, name_), -1)
+
+def get_donor_hydrogens(structure_, topology_):
+    """
+    Places the hydrogens of the protein donors whose hydrogen positions are fixed by the geometry of the residue:
+    main-chain N (bisector of C(i-1)-N-CA) and sp2 side-chain nitrogens, with N-H bonds of 1 Angstrom.
+    Donors with rotatable hydrogens (Lys, Ser, Thr, Tyr, Cys, N-termini), alternate locations other than the first one,
+    or missing bonded atoms get no hydrogens.
+
+    Args:
+        structure_ (Structure): The structure.
+        topology_ (ProteinTopology): Protein topology of the structure.
+
+    Returns:
+        tuple: (donor indices, hydrogen coordinates as an (n, 2, 3) array with NaN for missing hydrogens).
+    """
+
+    atom_names = structure_.column('atom_name')
+    residue_names = structure_.column('residue_name')
+    alt_locs = structure_.column('alt_loc')
+    xyz = structure_.coords()
+
+    donors = []
+    hydrogens = []
+    for residue, atom in zip(topology_.residue, topology_.index):
+        name = atom_names[atom]
+        key = (residue_names[atom], name)
+        if name == 'N':
+            if residue_names[atom] == 'PRO':
+                continue
+        elif key not in sp2_donors_one_H and key not in sp2_donors_two_H and key not in rotatable_donors:
+            continue
+        donors.append(atom)
+        H = np.full((2, 3), np.nan)
+        if alt_locs[atom] in ['', 'A']:
+            if name == 'N':
+                C = topology_.find(residue - 1, 'C')
+                CA = topology_.find(residue, 'CA')
+                # N-terminus or chain break: rotatable NH3+
+                if C >= 0 and CA >= 0 and np.linalg.norm(xyz[atom] - xyz[C]) < 2.0:
+                    H[0] = xyz[atom] + unit_vectors(unit_vectors(xyz[atom] - xyz[C]) + unit_vectors(xyz[atom] - xyz[CA]))
+            elif key in sp2_donors_one_H:
+                A, B = [topology_.find(residue, bonded) for bonded in sp2_donors_one_H[key]]
+                if A >= 0 and B >= 0:
+                    H[0] = xyz[atom] + unit_vectors(unit_vectors(xyz[atom] - xyz[A]) + unit_vectors(xyz[atom] - xyz[B]))
+            elif key in sp2_donors_two_H:
+                Y, Z = [topology_.find(residue, bonded) for bonded in sp2_donors_two_H[key]]
+                if Y >= 0 and Z >= 0:
+                    # 120 degrees from the bond to Y, in the plane of Y and Z
+                    e1 = unit_vectors(xyz[atom] - xyz[Y])
+                    e2 = xyz[Z] - xyz[Y]
+                    e2 = unit_vectors(e2 - (e2 @ e1) * e1)
+                    H[0] = xyz[atom] + 0.5 * e1 + np.sqrt(3) / 2 * e2
+                    H[1] = xyz[atom] + 0.5 * e1 - np.sqrt(3) / 2 * e2
+        hydrogens.append(H)
+
+    return np.array(donors, dtype=int), np.array(hydrogens).reshape(-1, 2, 3)
+
+def get_acceptors(structure_, topology_):
+    """
+    Finds the protein acceptors and their antecedents.
+
+    Args:
+        structure_ (Structure): The structure.
+        topology_ (ProteinTopology): Protein topology of the structure.
+
+    Returns:
+        tuple: (acceptor indices, antecedent indices).
+    """
+
+    atom_names = structure_.column('atom_name')
+    residue_names = structure_.column('residue_name')
+    acceptors = []
+    antecedents = []
+    for residue, atom in zip(topology_.residue, topology_.index):
+        name = atom_names[atom]
+        antecedent = acceptor_antecedents.get((None, name), acceptor_antecedents.get((residue_names[atom], name)))
+        if antecedent is None:
+            continue
+        AA = topology_.find(residue, antecedent)
+        if AA >= 0:
+            acceptors.append(atom)
+            antecedents.append(AA)
+    return np.array(acceptors, dtype=int), np.array(antecedents, dtype=int)
+
+def count_water_HB(structure_, water_hydrogens_=None, waters_=None):
+    """
+    Counts the hydrogen bonds of every water with the protein main chain and side chains, with the geometric criteria of HBPLUS.
+    Partners within max_DA of each water are found with a cell list. Protein donors need an H...O(water) distance of at most
+    max_HA and a D-H...O angle of at least 90 degrees (or D...O within max_DA_rotatable if their hydrogen is not fixed).
+    Water donors need acceptor angles (antecedent-acceptor...O and, with hydrogens, antecedent-acceptor...H) of at least 90 degrees.
+    As in read_in_HB, a residue is counted once per water, as main chain or side chain by its first bonded atom.
+
+    Args:
+        structure_ (Structure): The structure.
+        water_hydrogens_ (numpy.ndarray): Hydrogens of the waters as an (n_waters, 2, 3) array, in the order of
+            structure_.water_index() (default: None, water donors are scored by the D...A distance, max_DA_water, which
+            approximates the HBPLUS counts).
+        waters_ (numpy.ndarray): Positions (in the order of structure_.water_index()) of the waters to count (default: None, all waters).
+
+    Returns:
+        tuple: Number of hydrogen bonds of each water (in the order of structure_.water_index(), or of waters_) to the main chain and to the side chains.
+    """
+
+    wat_index = structure_.water_index()
+    if waters_ is not None:
+        wat_index = wat_index[waters_]
+        if water_hydrogens_ is not None:
+            water_hydrogens_ = np.asarray(water_hydrogens_)[waters_]
+    wat_xyz = structure_.coords(wat_index)
+    xyz = structure_.coords()
+    topology = ProteinTopology(structure_)
+
+    # protein donors (water is the acceptor)
+    donors, donor_H = get_donor_hydrogens(structure_, topology)
+    pair_wat, pair_donor, dist = CellList(xyz[donors], max_DA).query_pairs(wat_xyz, max_DA)
+    H = donor_H[pair_donor]
+    W = wat_xyz[pair_wat][:, None, :]
+    with np.errstate(invalid='ignore'):
+        fixed = (np.linalg.norm(H - W, axis=2) <= max_HA) & (angles(xyz[donors[pair_donor]][:, None, :], H, W) >= min_angle)
+    rotatable = np.isnan(H[:, 0, 0])
+    is_HB = np.where(rotatable, dist <= max_DA_rotatable, fixed.any(axis=1))
+    HB_wat = [pair_wat[is_HB]]
+    HB_atom = [donors[pair_donor[is_HB]]]
+
+    # protein acceptors (water is the donor)
+    acceptors, antecedents = get_acceptors(structure_, topology)
+    pair_wat, pair_acc, dist = CellList(xyz[acceptors], max_DA).query_pairs(wat_xyz, max_DA)
+    A = xyz[acceptors[pair_acc]]
+    AA = xyz[antecedents[pair_acc]]
+    is_HB = angles(wat_xyz[pair_wat], A, AA) >= min_angle
+    if water_hydrogens_ is None:
+        is_HB &= dist <= max_DA_water
+    else:
+        H = np.asarray(water_hydrogens_)[pair_wat]
+        with np.errstate(invalid='ignore'):
+            is_HB &= ((np.linalg.norm(H - A[:, None, :], axis=2) <= max_HA) & (angles(wat_xyz[pair_wat][:, None, :], H, A[:, None, :]) >= min_angle) &
+                      (angles(H, A[:, None, :], AA[:, None, :]) >= min_angle)).any(axis=1)
+    HB_wat.append(pair_wat[is_HB])
+    HB_atom.append(acceptors[pair_acc[is_HB]])
+
+    # count each (water, residue) once, by the first atom of the residue
+    HB_wat = np.concatenate(HB_wat)
+    HB_atom = np.concatenate(HB_atom)
+    residue_of_atom = np.full(len(structure_), -1)
+    residue_of_atom[topology.index] = topology.residue
+    order = np.lexsort((HB_atom, HB_wat))
+    HB_wat, HB_atom = HB_wat[order], HB_atom[order]
+    pairs, first = np.unique(np.column_stack([HB_wat, residue_of_atom[HB_atom]]), axis=0, return_index=True)
+    is_main_chain = np.isin(structure_.column('atom_name')[HB_atom[first]], main_chain_atoms)
+    n_HB_M = np.bincount(pairs[is_main_chain, 0], minlength=len(wat_index))
+    n_HB_S = np.bincount(pairs[~is_main_chain, 0], minlength=len(wat_index))
+    return n_HB_M, n_HB_S
@@ -0,0 +1,306 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+from functions.spatial import CellList
+from functions.structure import read_structure, get_water_frame
+from functions.configuration import get_backends, environment_cutoff
+from functions.execution import run_calculations
+from functions.instrumentation import instrument, file_fingerprint
+from functions.scheduling import default_n_workers
+from functions.ccp4 import load_ccp4_map
+from functions.data_parsing import (read_in_RSCC, read_in_B_norm, read_in_SASA, read_in_EDIA, read_in_HB,
+                                    calc_RSCC_native, calc_SASA_native, calc_EDIA_native, calc_HB_native)
+
+# waters of the new structure are matched to the previous waters of the same chain within this distance (Angstrom)
+match_distance = 1.0
+# an atom has changed if it moved more than this (Angstrom), or its B-factor or occupancy changed more than these
+move_tolerance = 0.05
+b_factor_tolerance = 1.0
+occupancy_tolerance = 0.01
+
+# feature: input files (besides the structure) its values depend on
+feature_input_files = {
+    'RSCC': ['mtz_file', 'ccp4_file'],
+    'SASA': [],
+    'EDIA': ['ccp4_file'],
+    'HB': []
+}
+
+def load_previous_run(previous_dir_):
+    """
+    Loads the outputs of a previous run: its run report (<ID>_run_report.json, see instrumentation.RunReport), its
+    structure (the input recorded in the report), and its results (<ID>_ColdBrew_results.csv).
+
+    Args:
+        previous_dir_ (str): Output directory of the previous run.
+
+    Outputs:
+        Raises a FileNotFoundError if the directory has no finished run, and a ValueError if the structure of the
+        previous run was changed since (e.g., overwritten by the next refinement cycle).
+
+    Returns:
+        tuple: The report (dict), the structure (Structure), and the results (pandas.DataFrame indexed by renumbered water ID).
+    """
+
+    reports = []
+    for report_file in sorted(glob.glob(os.path.join(previous_dir_, '*_run_report.json'))):
+        with open(report_file, 'r') as f:
+            report = json.load(f)
+        if report.get('status') == 'done':
+            reports.append(report)
+    if len(reports) != 1:
+        raise FileNotFoundError(previous_dir_ + ' has ' + str(len(reports)) + ' finished runs (<ID>_run_report.json); give the output directory of one finished run.')
+    report = reports[0]
+
+    recorded = report['info'].get('input_files', {}).get('pdb_file')
+    if recorded is None or file_fingerprint(recorded['path']) != recorded:
+        raise ValueError('the structure of the previous run (' + str(recorded['path'] if recorded else report['info'].get('pdb_file')) +
+                         ') is missing or was changed since that run; keep the structure of each cycle to rescore incrementally.')
+    structure = read_structure(recorded['path'])
+    results = pd.read_csv(os.path.join(previous_dir_, report['id'] + '_ColdBrew_results.csv'), index_col=0).set_index('wat_ID_renumbered')
+    if len(results.index) != len(structure.water_index()):
+        raise ValueError('the results of the previous run have ' + str(len(results.index)) + ' waters, its structure ' + str(len(structure.water_index())) + '.')
+    return report, structure, results
+
+def match_waters(previous_structure_, structure_, match_distance_=match_distance):
+    """
+    Matches the waters of a structure to the waters of the previous structure by position and chain (not by residue
+    number, which may change when waters are added or deleted): each water is paired with the closest unpaired previous
+    water of the same chain within match_distance_.
+
+    Args:
+        previous_structure_ (Structure): The previous structure.
+        structure_ (Structure): The new structure.
+        match_distance_ (float): Largest distance between matched waters (Angstrom).
+
+    Returns:
+        numpy.ndarray: Position of the matched previous water (in the order of previous_structure_.water_index()) of
+        each water (in the order of structure_.water_index()); -1 for new waters.
+    """
+
+    previous_index, index = previous_structure_.water_index(), structure_.water_index()
+    pair_new, pair_old, dist = CellList(previous_structure_.coords(previous_index), match_distance_).query_pairs(structure_.coords(index), match_distance_)
+    same_chain = structure_.column('chain_id')[index][pair_new] == previous_structure_.column('chain_id')[previous_index][pair_old]
+    pair_new, pair_old, dist = pair_new[same_chain], pair_old[same_chain], dist[same_chain]
+
+    # closest pairs first
+    matched = np.full(len(index), -1)
+    taken = np.zeros(len(previous_index), dtype=bool)
+    for i in np.argsort(dist, kind='stable'):
+        if matched[pair_new[i]] == -1 and not taken[pair_old[i]]:
+            matched[pair_new[i]] = pair_old[i]
+            taken[pair_old[i]] = True
+    return matched
+
+def atom_keys(structure_, index_):
+    """
+    Returns the identity of atoms (record, chain, residue number, insertion code, residue name, atom name, alternate location).
+    """
+    columns = ['record_name', 'chain_id', 'residue_number', 'insertion', 'residue_name', 'atom_name', 'alt_loc']
+    return list(zip(*[structure_.column(column)[index_] for column in columns]))
+
+def atoms_differ(previous_structure_, previous_index_, structure_, index_):
+    """
+    Compares pairs of atoms of two structures: True where the atom moved more than move_tolerance, or its B-factor,
+    occupancy, or element changed.
+    """
+    moved = np.linalg.norm(structure_.coords(index_) - previous_structure_.coords(previous_index_), axis=1) > move_tolerance
+    b_factor = np.abs(structure_.column('b_factor')[index_] - previous_structure_.column('b_factor')[previous_index_]) > b_factor_tolerance
+    occupancy = np.abs(structure_.column('occupancy')[index_] - previous_structure_.column('occupancy')[previous_index_]) > occupancy_tolerance
+    element = structure_.column('element_symbol')[index_] != previous_structure_.column('element_symbol')[previous_index_]
+    return moved | b_factor | occupancy | element
+
+def find_changes(previous_structure_, structure_, matched_):
+    """
+    Finds the atoms that changed between two structures: other atoms are matched by their identity (see atom_keys)
+    and waters by position (see match_waters). Added, deleted, moved, and modified atoms are changes; both the old
+    and the new position of a changed atom count.
+
+    Args:
+        previous_structure_ (Structure): The previous structure.
+        structure_ (Structure): The new structure.
+        matched_ (numpy.ndarray): Matched previous water of each water (see match_waters).
+
+    Returns:
+        numpy.ndarray: (n, 3) positions of the changes.
+    """
+
+    def non_water(structure):
+        # water hydrogens are not read by any feature (see configuration.do_setup)
+        return np.flatnonzero(structure.column('residue_name') != 'HOH')
+
+    previous_index, index = non_water(previous_structure_), non_water(structure_)
+    previous_keys, keys = atom_keys(previous_structure_, previous_index), atom_keys(structure_, index)
+    # duplicate identities cannot be matched, so such atoms count as changed
+    previous_position = {}
+    duplicates = set()
+    for i, key in enumerate(previous_keys):
+        if key in previous_position:
+            duplicates.add(key)
+        previous_position[key] = i
+    pair_new, pair_old = [], []
+    for i, key in enumerate(keys):
+        if key in previous_position and key not in duplicates:
+            pair_new.append(i)
+            pair_old.append(previous_position.pop(key))
+            duplicates.add(key)
+    pair_new, pair_old = np.array(pair_new, dtype=int), np.array(pair_old, dtype=int)
+    changed = atoms_differ(previous_structure_, previous_index[pair_old], structure_, index[pair_new])
+    is_new_kept = np.zeros(len(index), dtype=bool)
+    is_new_kept[pair_new[~changed]] = True
+    is_old_kept = np.zeros(len(previous_index), dtype=bool)
+    is_old_kept[pair_old[~changed]] = True
+
+    # waters
+    previous_wat, wat = previous_structure_.water_index(), structure_.water_index()
+    is_matched = matched_ >= 0
+    wat_changed = np.ones(len(wat), dtype=bool)
+    wat_changed[is_matched] = atoms_differ(previous_structure_, previous_wat[matched_[is_matched]], structure_, wat[is_matched])
+    is_old_wat_kept = np.zeros(len(previous_wat), dtype=bool)
+    is_old_wat_kept[matched_[is_matched & ~wat_changed]] = True
+
+    return np.concatenate([structure_.coords(index[~is_new_kept]), previous_structure_.coords(previous_index[~is_old_kept]),
+                           structure_.coords(wat[wat_changed]), previous_structure_.coords(previous_wat[~is_old_wat_kept])]).reshape(-1, 3)
+
+def find_affected_waters(structure_, matched_, changes_, cutoff_=environment_cutoff):
+    """
+    Returns the waters whose features may have changed: new waters and waters within cutoff_ of a change (by default,
+    configuration.environment_cutoff, which covers the range of every feature).
+
+    Args:
+        structure_ (Structure): The new structure.
+        matched_ (numpy.ndarray): Matched previous water of each water (see match_waters).
+        changes_ (numpy.ndarray): Positions of the changes (see find_changes).
+        cutoff_ (float): Distance from a change within which waters are affected (Angstrom).
+
+    Returns:
+        numpy.ndarray: True for the affected waters (in the order of structure_.water_index()).
+    """
+    near_change = CellList(changes_, cutoff_).count_within(structure_.coords(structure_.water_index()), cutoff_) > 0
+    return near_change | (matched_ < 0)
+
+def rescore_incrementally(structure_, pdb_id_, pdb_file_, mtz_file_, ccp4_file_, outdir_, previous_dir_, n_workers_=None, workdir_=None,
+                          cache_=None, backends_=None, resolution_=None, report_=None, cutoff_=environment_cutoff):
+    """
+    Calculates the features of a structure from the outputs of a previous run (e.g., the previous refinement cycle):
+    only the waters whose environment changed (see find_affected_waters) are recalculated, and the features of the
+    other waters are taken from the previous results. B_norm depends on all protein B-factors, so it is always
+    recalculated. A feature is recalculated for all waters if its backend or its input files (the map and reflections
+    for RSCC and EDIA) differ from the previous run. Native backends recalculate only the affected waters; the external
+    programs run on the whole structure, so if any water is affected, the feature of all waters is taken from the new run.
+
+    Args:
+        structure_ (Structure): The new structure.
+        pdb_id_ (str): Identifier of the structure.
+        pdb_file_ (str): Path to the structure file.
+        mtz_file_ (str): Path to the MTZ file.
+        ccp4_file_ (str): Path to the CCP4 map.
+        outdir_ (str): Output directory (its setup files must exist).
+        previous_dir_ (str): Output directory of the previous run.
+        n_workers_ (int): Maximum number of external calculations run at the same time, and threads of the native SASA
+            calculation (default: scheduling.default_n_workers()).
+        workdir_ (str): Working directory of the external programs (default: a private directory in the output directory).
+        cache_ (StageCache): Cache of stage outputs (default: None).
+        backends_ (dict): Backend of each feature (see configuration.get_backends; default: external programs).
+        resolution_ (float): Resolution of the map for the native RSCC and EDIA backends (default: estimated from the grid).
+        report_ (RunReport): Report of the run, which records the comparison and the recalculated waters (default: None).
+        cutoff_ (float): Waters within this distance of a changed atom are recalculated (default: environment_cutoff).
+
+    Returns:
+        pandas.DataFrame: The features of all waters, as parse_raw_datafiles returns them (without HB_M and HB_S).
+    """
+
+    backends = get_backends(backends_)
+    if n_workers_ is None:
+        n_workers_ = default_n_workers()
+    df_wat = get_water_frame(structure_)
+    n_waters = len(df_wat.index)
+
+    # compare the structure with the previous one
+    with instrument(report_, 'compare_previous') as record:
+        previous_report, previous_structure, previous_results = load_previous_run(previous_dir_)
+        matched = match_waters(previous_structure, structure_)
+        changes = find_changes(previous_structure, structure_, matched)
+        affected = find_affected_waters(structure_, matched, changes, cutoff_)
+        record.update({'n_changed_atoms': len(changes), 'n_affected_waters': int(affected.sum())})
+    print('matched ' + str(int((matched >= 0).sum())) + ' of ' + str(n_waters) + ' waters to ' + previous_report['id'] + ' (' + str(len(previous_results.index)) +
+          ' waters), ' + str(int(affected.sum())) + ' waters to recalculate...')
+
+    # waters to recalculate for each feature
+    previous_info = previous_report['info']
+    inputs = {'mtz_file': mtz_file_, 'ccp4_file': ccp4_file_}
+    recalculate = {}
+    for feature, input_names in feature_input_files.items():
+        same_inputs = all(previous_info.get('input_files', {}).get(name) == file_fingerprint(inputs[name]) for name in input_names)
+        same_resolution = not input_names or previous_info.get('resolution') == resolution_
+        if previous_info['backends'].get(feature) != backends[feature] or not same_inputs or not same_resolution:
+            recalculate[feature] = np.ones(n_waters, dtype=bool)
+        elif backends[feature] != 'native' and affected.any():
+            recalculate[feature] = np.ones(n_waters, dtype=bool)
+        else:
+            recalculate[feature] = affected
+
+    # run the external programs whose values are needed
+    external = [feature for feature in recalculate if backends[feature] != 'native' and recalculate[feature].any()]
+    if external:
+        run_calculations(pdb_file_, pdb_id_, mtz_file_, ccp4_file_, outdir_, n_workers_, workdir_, cache_, backends, report_, external)
+    density_map = None
+    if any(backends[feature] == 'native' and recalculate[feature].any() for feature in ['RSCC', 'EDIA']):
+        with instrument(report_, 'read_map'):
+            density_map = load_ccp4_map(ccp4_file_)
+
+    # values of the given waters (rows of df_wat) of each feature
+    raw_datafile = outdir_ + '/raw_data_files/' + pdb_id_
+    calculators = {
+        'RSCC': (lambda waters: calc_RSCC_native(structure_, df_wat, density_map, resolution_, waters).values) if backends['RSCC'] == 'native' else
+                (lambda waters: read_in_RSCC(df_wat, raw_datafile + '_original_edited.txt').values[waters]),
+        'SASA': (lambda waters: calc_SASA_native(structure_, df_wat, n_workers_, waters).values) if backends['SASA'] == 'native' else
+                (lambda waters: read_in_SASA(df_wat, raw_datafile + '_renumber_no_header.asa').values[waters]),
+        'EDIA': (lambda waters: calc_EDIA_native(structure_, df_wat, density_map, resolution_, waters).values) if backends['EDIA'] == 'native' else
+                (lambda waters: read_in_EDIA(df_wat, raw_datafile + '_renumberatomscores.csv').values[waters]),
+        'HB': (lambda waters: calc_HB_native(structure_, df_wat, waters).sum(axis=1).values) if backends['HB'] == 'native' else
+              (lambda waters: read_in_HB(df_wat, raw_datafile + '_renumber_pymolH.hb2').sum(axis=1).values[waters])
+    }
+
+    # previous values of the matched waters, recalculated values of the others
+    previous_IDs = matched + 1
+    df_out = pd.DataFrame({'pdb': [pdb_id_]*n_waters, 'wat_ID': list(df_wat['residue_number']), 'chain': list(df_wat['chain_id'])})
+    with instrument(report_, 'parse_B_norm', n_waters=n_waters):
+        df_out['B_norm'] = read_in_B_norm(structure_, df_wat).values
+    n_recalculated = {'B_norm': n_waters}
+    for feature, calculator in calculators.items():
+        waters = np.flatnonzero(recalculate[feature])
+        values = np.zeros(n_waters)
+        with instrument(report_, 'parse_' + feature, backend=backends[feature], n_waters=len(waters)):
+            kept = np.flatnonzero(~recalculate[feature])
+            values[kept] = previous_results.loc[previous_IDs[kept], feature].values.astype(float)
+            if len(waters):
+                values[waters] = calculator(waters)
+        df_out[feature] = values
+        n_recalculated[feature] = len(waters)
+    df_out = df_out[['pdb', 'wat_ID', 'chain', 'RSCC', 'B_norm', 'SASA', 'EDIA', 'HB']]
+
+    if report_ is not None:
+        report_.info['incremental'] = {'previous_dir': os.path.abspath(previous_dir_), 'previous_id': previous_report['id'], 'n_matched_waters': int((matched >= 0).sum()),
+                                       'n_new_waters': int((matched < 0).sum()), 'n_deleted_waters': len(previous_results.index) - int((matched >= 0).sum()),
+                                       'n_changed_atoms': len(changes), 'cutoff': cutoff_, 'n_recalculated': n_recalculated}
+    return df_out
@@ -0,0 +1,264 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import time
+import resource
+import threading
+import subprocess
+import contextlib
+import contextvars
+
+def read_thread_io():
+    """
+    Returns the bytes read and written so far by the calling thread (Linux /proc/thread-self/io: rchar and wchar,
+    which include cached reads and writes), or None where it is not available.
+    """
+    try:
+        with open('/proc/thread-self/io', 'r') as f:
+            counters = dict(line.split(':') for line in f if ':' in line)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def file_fingerprint(path_):
+    """
+    Returns the path, size, and modification time of a file (None if it does not exist), recorded in the run report to
+    tell later runs whether an input changed (see incremental.py).
+    """
+    if path_ is None or not os.path.isfile(path_):
+        return None
+    stat = os.stat(path_)
+    return {'path': os.path.abspath(path_), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+class RunReport:
+    """
+    Machine-readable record of one ColdBrew run: the structure, and the wall time, CPU time, bytes read and written,
+    and external commands of each stage. Stages may run in different threads (see scheduling.run_stage_graph).
+
+    Attributes:
+        pdb_id (str): Identifier of the structure.
+        info (dict): Facts about the run (e.g., input files, backends, and the numbers of atoms and waters).
+        stages (dict): Record of each stage, in the order the stages started.
+    """
+
+    def __init__(self, pdb_id_, info_=None):
+        self.pdb_id = pdb_id_
+        self.info = dict(info_ or {})
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, stage_name_, **info_):
+        """
+        Records a stage: its wall time, the CPU time of the thread running it, the bytes that thread read and wrote
+        (the external commands of the stage are recorded by run_command), and its status ('running', then 'done' or
+        'failed'). Values set on the yielded record (e.g., counts) are saved with it.
+        """
+        record = dict(info_)
+        record['start'] = round(time.perf_counter() - self._start, 4)
+        record['status'] = 'running'
+        record['commands'] = []
+        with self._lock:
+            self.stages[stage_name_] = record
+        start, cpu_start, io_start = time.perf_counter(), time.thread_time(), read_thread_io()
+        try:
+            yield record
+            record['status'] = 'done'
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            io_end = read_thread_io()
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            record['cpu_seconds'] = round(time.thread_time() - cpu_start, 4)
+            if io_start is not None and io_end is not None:
+                record['read_bytes'], record['write_bytes'] = io_end[0] - io_start[0], io_end[1] - io_start[1]
+
+    def add_command(self, stage_name_, command_record_):
+        with self._lock:
+            self.stages.setdefault(stage_name_, {'commands': []})['commands'].append(command_record_)
+
+    def as_dict(self, status_='done', error_=''):
+        """
+        Returns the report as a dictionary (see save).
+        """
+        self_usage, children_usage = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self._lock:
+            stages = [dict(record, name=name) for name, record in self.stages.items()]
+        for record in stages:
+            commands = record['commands']
+            record['child_cpu_seconds'] = round(sum(command['cpu_seconds'] for command in commands), 4)
+            record['child_max_rss_mb'] = max([command['max_rss_mb'] for command in commands], default=0.0)
+        return {
+            'id': self.pdb_id,
+            'status': status_,
+            'error': error_,
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self._started)),
+            'seconds': round(time.perf_counter() - self._start, 4),
+            'info': self.info,
+            'stages': stages,
+            # the whole process so far (in batch mode, the worker process, which may have run other structures)
+            'process': {'cpu_seconds': round(self_usage.ru_utime + self_usage.ru_stime, 4), 'max_rss_mb': round(self_usage.ru_maxrss / 1024, 2),
+                        'children_cpu_seconds': round(children_usage.ru_utime + children_usage.ru_stime, 4),
+                        'children_max_rss_mb': round(children_usage.ru_maxrss / 1024, 2)}
+        }
+
+    def save(self, report_file_, status_='done', error_='', metrics_file_=None):
+        """
+        Saves the report as JSON, and optionally as OpenMetrics text (see write_openmetrics).
+
+        Args:
+            report_file_ (str): Path of the JSON file (<ID>_run_report.json).
+            status_ (str): 'done' or 'failed'.
+            error_ (str): Error of a failed run.
+            metrics_file_ (str): Path of the OpenMetrics file (default: None, not written).
+
+        Returns:
+            dict: The report.
+        """
+
+        report = self.as_dict(status_, error_)
+        with open(report_file_, 'w') as f:
+            json.dump(report, f, indent=2)
+        if metrics_file_ is not None:
+            write_openmetrics(report, metrics_file_)
+        return report
+
+# whether the progress messages of the current context are printed (see quiet_progress); a context variable, so
+# silencing one call (e.g., a library call) does not silence the calls running in other threads
+progress_enabled = contextvars.ContextVar('progress_enabled', default=True)
+
+def progress(*message_):
+    """
+    Prints a progress message (like print) unless the messages of the current context are silenced (see quiet_progress).
+    """
+    if progress_enabled.get():
+        print(*message_)
+
+@contextlib.contextmanager
+def quiet_progress(quiet_=True):
+    """
+    Silences the progress messages printed in this context (and the stages it starts; see scheduling.run_stage_graph).
+    """
+    token = progress_enabled.set(not quiet_)
+    try:
+        yield
+    finally:
+        progress_enabled.reset(token)
+
+@contextlib.contextmanager
+def instrument(report_, stage_name_, **info_):
+    """
+    Records a stage in a run report (see RunReport.stage); without a report (None), only yields an unused record.
+    """
+    if report_ is None:
+        yield dict(info_)
+        return
+    with report_.stage(stage_name_, **info_) as record:
+        yield record
+
+def run_command(command_, report_=None, stage_name_=None, cwd_=None):
+    """
+    Runs a shell command (like subprocess.run with shell=True and check=True) and records it in a run report: its
+    wall time, and the CPU time, peak resident memory, and block input/output of the command and the programs it ran.
+
+    Args:
+        command_ (str): The shell command.
+        report_ (RunReport): Report of the run (default: None, the command is only run).
+        stage_name_ (str): Stage the command belongs to.
+        cwd_ (str): Working directory of the command (default: current directory).
+
+    Outputs:
+        Raises a subprocess.CalledProcessError if the command fails.
+
+    Returns:
+        None
+    """
+
+    if report_ is None:
+        subprocess.run(command_, shell=True, check=True, cwd=cwd_)
+        return
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command_, shell=True, cwd=cwd_)
+    # wait4 gives the resources of this command alone, even when other stages run commands at the same time
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    report_.add_command(stage_name_, {
+        'command': command_,
+        'returncode': process.returncode,
+        'seconds': round(time.perf_counter() - start, 4),
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 4),
+        # the command starts as a copy of this process, so its peak is at least the memory ColdBrew used at that time
+        'max_rss_mb': round(usage.ru_maxrss / 1024, 2),
+        # blocks of 512 bytes read from and written to disk (reads served from the page cache are not counted)
+        'read_bytes': usage.ru_inblock * 512,
+        'write_bytes': usage.ru_oublock * 512
+    })
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command_)
+
+def openmetrics_labels(labels_):
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in labels_.items()) + '}'
+
+def write_openmetrics(report_, metrics_file_):
+    """
+    Writes a run report (see RunReport.as_dict) as OpenMetrics text, one gauge family per measure with the ID and
+    stage as labels, e.g., to be collected by a Prometheus node exporter textfile collector.
+
+    Args:
+        report_ (dict): The report.
+        metrics_file_ (str): Path of the text file.
+
+    Returns:
+        None
+    """
+
+    run_labels = {'id': report_['id']}
+    families = [
+        ('coldbrew_run_seconds', 'seconds', 'Wall time of the run.', [(dict(run_labels, status=report_['status']), report_['seconds'])]),
+        ('coldbrew_run_atoms', None, 'Number of atoms of the structure.', [(run_labels, report_['info'].get('n_atoms'))]),
+        ('coldbrew_run_waters', None, 'Number of waters of the structure.', [(run_labels, report_['info'].get('n_waters'))])
+    ]
+    stage_measures = [
+        ('coldbrew_stage_seconds', 'seconds', 'Wall time of the stage.', 'seconds', 1),
+        ('coldbrew_stage_cpu_seconds', 'seconds', 'CPU time of the thread running the stage.', 'cpu_seconds', 1),
+        ('coldbrew_stage_child_cpu_seconds', 'seconds', 'CPU time of the external commands of the stage.', 'child_cpu_seconds', 1),
+        ('coldbrew_stage_child_max_rss_bytes', 'bytes', 'Peak resident memory of the external commands of the stage.', 'child_max_rss_mb', 1024**2),
+        ('coldbrew_stage_read_bytes', 'bytes', 'Bytes read by the thread running the stage.', 'read_bytes', 1),
+        ('coldbrew_stage_write_bytes', 'bytes', 'Bytes written by the thread running the stage.', 'write_bytes', 1)
+    ]
+    for name, unit, help_text, key, scale in stage_measures:
+        samples = [(dict(run_labels, stage=record['name']), record[key] * scale) for record in report_['stages'] if record.get(key) is not None]
+        families.append((name, unit, help_text, samples))
+
+    with open(metrics_file_, 'w') as f:
+        for name, unit, help_text, samples in families:
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                continue
+            f.write('# TYPE ' + name + ' gauge\n')
+            if unit is not None:
+                f.write('# UNIT ' + name + ' ' + unit + '\n')
+            f.write('# HELP ' + name + ' ' + help_text + '\n')
+            for labels, value in samples:
+                f.write(name + openmetrics_labels(labels) + ' ' + repr(float(value)) + '\n')
+        f.write('# EOF\n')
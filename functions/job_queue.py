@@ -0,0 +1,457 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Work queue of structure jobs in an SQLite file on shared storage, so workers on several nodes run one batch (e.g.,
+# a rescoring of the PDB). A worker leases a job, renews the lease while the job runs (heartbeat), and records its
+# outcome; the jobs of a worker that stops (e.g., a failed node) are queued again when their lease expires.
+
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import sqlite3
+import threading
+import contextlib
+
+# seconds a lease lasts without a heartbeat; workers renew it every lease_seconds / heartbeats_per_lease seconds
+default_lease_seconds = 120
+heartbeats_per_lease = 4
+# seconds an idle worker waits before looking for queued jobs again, while other workers run jobs
+idle_seconds = 5
+# runs of a job (leases, including those of stopped workers) before it is failed for good
+default_max_attempts = 3
+job_statuses = ['queued', 'running', 'done', 'failed']
+# directory of the output directory in which each attempt runs (<outdir>/.attempts/<lease>/<ID>) until it is published
+attempts_dirname = '.attempts'
+
+queue_schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    pdb TEXT NOT NULL,
+    mtz TEXT NOT NULL,
+    ccp4 TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease TEXT,
+    lease_expires REAL,
+    heartbeat REAL,
+    added REAL,
+    started REAL,
+    finished REAL,
+    seconds REAL,
+    failed_stage TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, added);
+CREATE TABLE IF NOT EXISTS attempts (
+    lease TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    worker TEXT,
+    started REAL,
+    finished REAL,
+    status TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS attempts_id ON attempts (id, started);
+CREATE TABLE IF NOT EXISTS stages (
+    lease TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT,
+    start REAL,
+    seconds REAL,
+    cached INTEGER,
+    PRIMARY KEY (lease, stage)
+) WITHOUT ROWID;
+'''
+
+def worker_name():
+    """
+    Returns the name of this worker process (host and process ID), recorded with the jobs it leases.
+    """
+    return socket.gethostname() + ':' + str(os.getpid())
+
+class JobQueue:
+    """
+    SQLite work queue of structure jobs (the entries of a manifest, see batch.read_manifest). Jobs are 'queued',
+    'running' (leased by a worker until lease_expires), 'done', or 'failed'. Each lease is one attempt; a failed attempt,
+    or one whose worker stopped renewing its lease, is queued again until the job has max_attempts attempts. The stages
+    of each attempt and the error of a failed one are recorded from its run report.
+
+    Leases are taken in IMMEDIATE transactions, so two workers never lease the same job. The database uses the rollback
+    journal rather than WAL, which needs shared memory on one host, so the file can be on a shared file system with
+    working POSIX locks (e.g., NFSv4 or Lustre) and used from several nodes. Lease times are compared across nodes, so
+    their clocks should agree to well within the lease time.
+
+    Attributes:
+        db_file (str): Path of the SQLite database.
+        lease_seconds (float): Time a lease lasts without a heartbeat.
+        max_attempts (int): Attempts of a job before it fails for good.
+    """
+
+    def __init__(self, db_file_, lease_seconds_=default_lease_seconds, max_attempts_=default_max_attempts):
+        self.db_file = db_file_
+        self.lease_seconds = lease_seconds_
+        self.max_attempts = max_attempts_
+        # transactions are begun explicitly (see transaction)
+        self._connection = sqlite3.connect(db_file_, timeout=60, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=DELETE')
+        self._connection.executescript(queue_schema)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args_):
+        self.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Runs statements in one transaction that holds the write lock from its start (BEGIN IMMEDIATE).
+        """
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._connection
+            self._connection.execute('COMMIT')
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+
+    def add_jobs(self, entries_, requeue_=False):
+        """
+        Adds jobs to the queue. Jobs already in the queue (by ID) are kept as they are, unless requeue_ is set.
+
+        Args:
+            entries_ (list): Manifest entries with the keys id, pdb, mtz, and ccp4 (see batch.read_manifest).
+            requeue_ (bool): Queue the jobs already in the queue again, with their new files and no attempts (default: False).
+
+        Returns:
+            int: Number of jobs added or queued again.
+        """
+
+        now = time.time()
+        n_added = 0
+        with self.transaction() as connection:
+            for entry in entries_:
+                values = (entry['pdb'], entry['mtz'], entry['ccp4'], now, entry['id'])
+                if requeue_ and connection.execute('SELECT 1 FROM jobs WHERE id = ?', (entry['id'],)).fetchone() is not None:
+                    connection.execute("UPDATE jobs SET pdb = ?, mtz = ?, ccp4 = ?, added = ?, status = 'queued', attempts = 0, worker = NULL, lease = NULL, "
+                                       'lease_expires = NULL, failed_stage = NULL, error = NULL WHERE id = ?', values)
+                    n_added += 1
+                else:
+                    n_added += connection.execute("INSERT OR IGNORE INTO jobs (pdb, mtz, ccp4, added, id, status) VALUES (?, ?, ?, ?, ?, 'queued')", values).rowcount
+        return n_added
+
+    def requeue_failed(self):
+        """
+        Queues the failed jobs again, with no attempts (e.g., after fixing an input or a program).
+
+        Returns:
+            int: Number of jobs queued again.
+        """
+        with self.transaction() as connection:
+            return connection.execute("UPDATE jobs SET status = 'queued', attempts = 0, failed_stage = NULL, error = NULL WHERE status = 'failed'").rowcount
+
+    def expire_leases(self, connection_, now_):
+        """
+        Queues again the running jobs whose lease expired (their worker stopped), or fails them if they have no attempts
+        left. Runs in the transaction of the caller.
+
+        Returns:
+            list: IDs of the jobs whose lease expired.
+        """
+
+        expired = connection_.execute("SELECT id, attempts, worker, lease FROM jobs WHERE status = 'running' AND lease_expires < ?", (now_,)).fetchall()
+        for job_id, attempts, worker, lease in expired:
+            error = 'lease expired (worker ' + str(worker) + ' stopped renewing it)'
+            status = 'failed' if attempts >= self.max_attempts else 'queued'
+            connection_.execute('UPDATE jobs SET status = ?, lease = NULL, lease_expires = NULL, finished = ?, error = ? WHERE id = ?', (status, now_, error, job_id))
+            connection_.execute("UPDATE attempts SET status = 'expired', finished = ?, error = ? WHERE lease = ?", (now_, error, lease))
+        return [job_id for job_id, attempts, worker, lease in expired]
+
+    def lease(self, worker_=None):
+        """
+        Leases the oldest queued job (jobs that were not tried yet first), after queuing again the jobs of stopped workers (see expire_leases).
+
+        Args:
+            worker_ (str): Name of the worker (default: host and process ID, see worker_name).
+
+        Returns:
+            dict: The job, with the keys id, pdb, mtz, ccp4 (a manifest entry), attempt, and lease (the token of the lease);
+            None if no job is queued.
+        """
+
+        worker_ = worker_ or worker_name()
+        now = time.time()
+        with self.transaction() as connection:
+            self.expire_leases(connection, now)
+            row = connection.execute("SELECT id, pdb, mtz, ccp4, attempts FROM jobs WHERE status = 'queued' ORDER BY attempts, added, id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            job = {'id': row[0], 'pdb': row[1], 'mtz': row[2], 'ccp4': row[3], 'attempt': row[4] + 1, 'lease': uuid.uuid4().hex}
+            connection.execute("UPDATE jobs SET status = 'running', attempts = ?, worker = ?, lease = ?, lease_expires = ?, heartbeat = ?, started = ?, finished = NULL "
+                               'WHERE id = ?', (job['attempt'], worker_, job['lease'], now + self.lease_seconds, now, now, job['id']))
+            connection.execute("INSERT INTO attempts (lease, id, attempt, worker, started, status) VALUES (?, ?, ?, ?, ?, 'running')", (job['lease'], job['id'], job['attempt'], worker_, now))
+        return job
+
+    def heartbeat(self, job_id_, lease_):
+        """
+        Renews the lease of a running job.
+
+        Returns:
+            bool: True if the lease is still held; False if it expired and the job was queued again (or leased by another worker).
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            return connection.execute("UPDATE jobs SET lease_expires = ?, heartbeat = ? WHERE id = ? AND lease = ? AND status = 'running'",
+                                      (now + self.lease_seconds, now, job_id_, lease_)).rowcount == 1
+
+    def complete(self, job_, summary_, stages_=(), publish_=None):
+        """
+        Records the outcome of a job. A failed job is queued again if it has attempts left. Nothing is recorded if the
+        lease was lost (the job was queued again after the lease expired), so a job finished twice is counted once.
+
+        Args:
+            job_ (dict): The job (see lease).
+            summary_ (dict): Summary of the run (see batch.run_manifest_entry: status, error, and seconds).
+            stages_ (list): Stages of the run (the stages of its run report, with the keys name, status, start, seconds, and cached).
+            publish_ (callable): Called if the outcome is recorded, before it is committed (e.g., to move the outputs of
+                the attempt to the output directory, see publish_attempt); other workers wait for it (default: None).
+
+        Returns:
+            bool: True if the outcome was recorded.
+        """
+
+        now = time.time()
+        failed = summary_['status'] != 'done'
+        failed_stages = [stage['name'] for stage in stages_ if stage.get('status') == 'failed']
+        failed_stage = failed_stages[-1] if failed and failed_stages else None
+        if not failed:
+            status = 'done'
+        else:
+            status = 'failed' if job_['attempt'] >= self.max_attempts else 'queued'
+        with self.transaction() as connection:
+            if connection.execute("SELECT 1 FROM jobs WHERE id = ? AND lease = ? AND status = 'running'", (job_['id'], job_['lease'])).fetchone() is None:
+                return False
+            if publish_ is not None:
+                publish_()
+            connection.execute('UPDATE jobs SET status = ?, lease = NULL, lease_expires = NULL, finished = ?, seconds = ?, failed_stage = ?, error = ? WHERE id = ?',
+                               (status, now, summary_.get('seconds'), failed_stage, summary_.get('error') or None, job_['id']))
+            connection.execute('UPDATE attempts SET status = ?, finished = ?, error = ? WHERE lease = ?', (summary_['status'], now, summary_.get('error') or None, job_['lease']))
+            connection.executemany('INSERT OR REPLACE INTO stages (lease, stage, status, start, seconds, cached) VALUES (?, ?, ?, ?, ?, ?)',
+                                   [(job_['lease'], stage['name'], stage.get('status'), stage.get('start'), stage.get('seconds'),
+                                     None if stage.get('cached') is None else int(bool(stage['cached']))) for stage in stages_])
+        return True
+
+    def counts(self):
+        """
+        Returns the number of jobs of each status (see job_statuses), after queuing again the jobs of stopped workers.
+        """
+        with self.transaction() as connection:
+            self.expire_leases(connection, time.time())
+            counts = dict(connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return dict((status, counts.get(status, 0)) for status in job_statuses)
+
+    def jobs(self, status_=None):
+        """
+        Returns the jobs (all, or those of one status) as dictionaries with the columns of the jobs table, in the order they were added.
+        """
+        cursor = self._connection.execute('SELECT * FROM jobs' + (' WHERE status = ?' if status_ else '') + ' ORDER BY added, id', (status_,) if status_ else ())
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def attempts(self, job_id_):
+        """
+        Returns the attempts of a job as dictionaries with the keys lease, attempt, worker, started, finished, status, and
+        error, in the order they started.
+        """
+        columns = ['lease', 'attempt', 'worker', 'started', 'finished', 'status', 'error']
+        rows = self._connection.execute('SELECT ' + ', '.join(columns) + ' FROM attempts WHERE id = ? ORDER BY started', (job_id_,)).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def attempt_status(self, lease_):
+        """
+        Returns the status of an attempt (by its lease): 'running', 'expired', or the status of its run; None if unknown.
+        """
+        row = self._connection.execute('SELECT status FROM attempts WHERE lease = ?', (lease_,)).fetchone()
+        return row[0] if row else None
+
+    def stages(self, lease_):
+        """
+        Returns the recorded stages of an attempt (by its lease, see attempts) as (stage, status, seconds, cached), in the order they started.
+        """
+        return self._connection.execute('SELECT stage, status, seconds, cached FROM stages WHERE lease = ? ORDER BY start', (lease_,)).fetchall()
+
+def keep_lease(queue_file_, job_, lease_seconds_, stop_, lost_):
+    """
+    Renews the lease of a job every lease_seconds_ / heartbeats_per_lease seconds until stop_ is set (run in a thread
+    of the worker, with its own connection). Sets lost_ if the lease expired meanwhile.
+    """
+    with JobQueue(queue_file_, lease_seconds_) as queue:
+        while not stop_.wait(lease_seconds_ / heartbeats_per_lease):
+            try:
+                if not queue.heartbeat(job_['id'], job_['lease']):
+                    lost_.set()
+                    return
+            except sqlite3.OperationalError as e:
+                # e.g., the shared file system is briefly unavailable; the next heartbeat tries again
+                print('could not renew the lease of ' + job_['id'] + ' (' + str(e) + ')...')
+
+def publish_attempt(attempt_dir_, outdir_, pdb_id_):
+    """
+    Replaces the outputs of a structure (<outdir>/<ID>) with those of an attempt (<attempt_dir>/<ID>). Both are on the
+    same file system, so each is moved by renaming; the previous outputs are moved into the attempt directory, which
+    the caller removes.
+    """
+    outdir_entry = os.path.join(outdir_, pdb_id_)
+    if os.path.isdir(outdir_entry):
+        os.rename(outdir_entry, os.path.join(attempt_dir_, pdb_id_ + '_previous'))
+    os.rename(os.path.join(attempt_dir_, pdb_id_), outdir_entry)
+
+def remove_stale_attempts(queue_, outdir_):
+    """
+    Removes the directories of the attempts that are no longer running (those of workers that stopped) from <outdir>/.attempts.
+    """
+    attempts_dir = os.path.join(outdir_, attempts_dirname)
+    for lease in os.listdir(attempts_dir) if os.path.isdir(attempts_dir) else []:
+        if queue_.attempt_status(lease) != 'running':
+            shutil.rmtree(os.path.join(attempts_dir, lease), ignore_errors=True)
+
+def read_report_stages(outdir_, pdb_id_):
+    """
+    Returns the stages recorded in the run report of a structure (<outdir>/<ID>/<ID>_run_report.json); none if the run
+    stopped before the report was written.
+    """
+    report_file = os.path.join(outdir_, pdb_id_, pdb_id_ + '_run_report.json')
+    if not os.path.isfile(report_file):
+        return []
+    with open(report_file, 'r') as f:
+        return json.load(f).get('stages', [])
+
+def run_queue_worker(queue_file_, outdir_, n_workers_=None, write_parsed_=False, cache_=None, backends_=None, openmetrics_=False, dataset_=None,
+                     scratch_=None, keep_intermediates_=None, map_columns_=None, lease_seconds_=default_lease_seconds, max_attempts_=default_max_attempts):
+    """
+    Runs jobs of the queue one after the other until none is queued or running, as in batch mode (see
+    batch.run_manifest_entry: results in <outdir>/<ID>). While other workers run jobs, the worker waits, so it takes
+    over the jobs of a worker that stops once their lease expires. Each attempt runs in a directory of its own
+    (<outdir>/.attempts/<lease>), which is moved to <outdir>/<ID> when its outcome is recorded, so an attempt whose
+    lease expired while it was still running never writes to the outputs (or the recorded stages) of another attempt.
+    The directories of attempts whose worker stopped are removed when the worker exits.
+
+    Args:
+        queue_file_ (str): Path of the queue database (see JobQueue).
+        outdir_ (str): Output directory of the batch.
+        lease_seconds_ (float): Time a lease lasts without a heartbeat (default: 120).
+        max_attempts_ (int): Attempts of a job before it fails for good (default: 3).
+        The other arguments are those of batch.run_manifest_entry.
+
+    Returns:
+        dict: Number of jobs this worker finished ('done'), failed ('failed'), and lost to another worker ('lost').
+    """
+
+    from functions.batch import run_manifest_entry
+
+    worker = worker_name()
+    counts = {'done': 0, 'failed': 0, 'lost': 0}
+    with JobQueue(queue_file_, lease_seconds_, max_attempts_) as queue:
+        while True:
+            job = queue.lease(worker)
+            if job is None:
+                if queue.counts()['running'] == 0:
+                    remove_stale_attempts(queue, outdir_)
+                    break
+                time.sleep(min(idle_seconds, lease_seconds_ / heartbeats_per_lease))
+                continue
+
+            print(worker + ': running ' + job['id'] + ' (attempt ' + str(job['attempt']) + ')...')
+            stop, lost = threading.Event(), threading.Event()
+            heartbeat = threading.Thread(target=keep_lease, args=(queue_file_, job, lease_seconds_, stop, lost), daemon=True)
+            heartbeat.start()
+            attempt_dir = os.path.join(outdir_, attempts_dirname, job['lease'])
+            try:
+                summary = run_manifest_entry(job, attempt_dir, n_workers_=n_workers_, write_parsed_=write_parsed_, cache_=cache_, backends_=backends_, openmetrics_=openmetrics_,
+                                             dataset_=dataset_, scratch_=scratch_, keep_intermediates_=keep_intermediates_, map_columns_=map_columns_)
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            try:
+                recorded = not lost.is_set() and queue.complete(job, summary, read_report_stages(attempt_dir, job['id']),
+                                                                lambda: publish_attempt(attempt_dir, outdir_, job['id']))
+            finally:
+                shutil.rmtree(attempt_dir, ignore_errors=True)
+            if not recorded:
+                print(worker + ': lost the lease of ' + job['id'] + ', which was queued again...')
+                counts['lost'] += 1
+                continue
+            counts[summary['status']] += 1
+            print(worker + ': ' + job['id'] + ' ' + summary['status'] + (' (' + summary['error'] + ')' if summary['error'] else ''))
+    return counts
+
+def run_queue(queue_file_, outdir_, n_procs_=1, n_workers_=None, write_parsed_=False, cache_=None, backends_=None, openmetrics_=False, dataset_=None,
+              scratch_=None, keep_intermediates_=None, map_columns_=None, lease_seconds_=default_lease_seconds, max_attempts_=default_max_attempts):
+    """
+    Runs n_procs_ queue workers on this node (see run_queue_worker) until the queue is empty. Several nodes may run
+    workers on the same queue at the same time.
+
+    Args:
+        queue_file_ (str): Path of the queue database (see JobQueue).
+        outdir_ (str): Output directory of the batch (the same for every node). Results of each structure are saved in <outdir>/<ID>.
+        n_procs_ (int): Number of workers (structures run at the same time) on this node.
+        The other arguments are those of run_queue_worker.
+
+    Returns:
+        dict: Number of jobs of each status in the queue at the end (see JobQueue.counts).
+    """
+
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    outdir_ = os.path.abspath(outdir_)
+    with JobQueue(queue_file_, lease_seconds_, max_attempts_) as queue:
+        counts = queue.counts()
+    print('running the ' + str(counts['queued']) + ' queued jobs of ' + queue_file_ + ' on ' + str(n_procs_) + ' workers...')
+
+    # each worker runs in a process pool of its own, so a worker process that dies (e.g., killed when out of memory)
+    # stops only that worker; its job is queued again when its lease expires, and a new worker takes its place
+    def run_worker():
+        while True:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                try:
+                    return executor.submit(run_queue_worker, queue_file_, outdir_, n_workers_=n_workers_, write_parsed_=write_parsed_, cache_=cache_, backends_=backends_,
+                                           openmetrics_=openmetrics_, dataset_=dataset_, scratch_=scratch_, keep_intermediates_=keep_intermediates_,
+                                           map_columns_=map_columns_, lease_seconds_=lease_seconds_, max_attempts_=max_attempts_).result()
+                except BrokenProcessPool:
+                    print('a worker process died, starting a new worker (its job is queued again when its lease expires)...')
+                except Exception as e:
+                    print('a queue worker stopped: ' + type(e).__name__ + ': ' + str(e))
+                    return
+
+    with ThreadPoolExecutor(max_workers=max(1, n_procs_)) as executor:
+        for future in [executor.submit(run_worker) for i in range(max(1, n_procs_))]:
+            future.result()
+
+    with JobQueue(queue_file_, lease_seconds_, max_attempts_) as queue:
+        counts = queue.counts()
+    print(', '.join(str(n) + ' ' + status for status, n in counts.items()) + ' (see python scripts/coldbrew_queue.py -queue ' + queue_file_ + ' -status)')
+    return counts
@@ -0,0 +1,596 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Electron density maps calculated from the reflections of an MTZ file with NumPy FFTs, instead of a map made
+# beforehand with phenix.maps: either from map coefficients of the file (e.g., 2FOFCWT/PH2FOFCWT), or a 2mFo-DFc map
+# phased by the model (structure factors of the model and a flat bulk solvent, scaled to Fobs, with sigmaA weights).
+
+from fractions import Fraction
+import numpy as np
+from functions.ccp4 import DensityMap, orthogonalization_matrix
+from functions.density import atomic_numbers
+from functions.mtz import read_mtz
+
+# Cromer-Mann coefficients of the X-ray scattering factors (a1-a4, b1-b4, c; International Tables for
+# Crystallography, Vol. C, Table 6.1.1.4); other elements are scaled from carbon by their number of electrons
+scattering_factors = {
+    'H': ([0.489918, 0.262003, 0.196767, 0.049879], [20.6593, 7.74039, 49.5519, 2.20159], 0.001305),
+    'C': ([2.31, 1.02, 1.5886, 0.865], [20.8439, 10.2075, 0.5687, 51.6512], 0.2156),
+    'N': ([12.2126, 3.1322, 2.0125, 1.1663], [0.0057, 9.8933, 28.9975, 0.5826], -11.529),
+    'O': ([3.0485, 2.2868, 1.5463, 0.867], [13.2771, 5.7011, 0.3239, 32.9089], 0.2508),
+    'NA': ([4.7626, 3.1736, 1.2674, 1.1128], [3.285, 8.8422, 0.3136, 129.424], 0.676),
+    'MG': ([5.4204, 2.1735, 1.2269, 2.3073], [2.8275, 79.2611, 0.3808, 7.1937], 0.8584),
+    'P': ([6.4345, 4.1791, 1.78, 1.4908], [1.9067, 27.157, 0.526, 68.1645], 1.1149),
+    'S': ([6.9053, 5.2034, 1.4379, 1.5863], [1.4679, 22.2151, 0.2536, 56.172], 0.8669),
+    'CL': ([11.4604, 7.1962, 6.2556, 1.6455], [0.0104, 1.1662, 18.5194, 47.7784], -9.5574),
+    'K': ([8.2186, 7.4398, 1.0519, 0.8659], [12.7949, 0.7748, 213.187, 41.6841], 1.4228),
+    'CA': ([8.6266, 7.3873, 1.5899, 1.0211], [10.4421, 0.6599, 85.7484, 178.437], 1.3751),
+    'MN': ([11.2819, 7.3573, 3.0193, 2.2441], [5.3409, 0.3432, 17.8674, 83.7543], 1.0896),
+    'FE': ([11.7695, 7.3573, 3.5222, 2.3045], [4.7611, 0.3072, 15.3535, 76.8805], 1.0369),
+    'ZN': ([14.0743, 7.0318, 5.1652, 2.41], [3.2655, 0.2333, 10.3163, 58.7097], 1.3041),
+    'SE': ([17.0006, 5.8196, 3.9731, 4.3543], [2.4098, 0.2726, 15.2372, 43.8163], 2.8409)
+}
+scattering_factors['D'] = scattering_factors['H']
+# van der Waals radii of the bulk solvent mask (Angstrom); other elements use the default
+vdw_radii = {'H': 1.2, 'D': 1.2, 'C': 1.7, 'N': 1.55, 'O': 1.52, 'S': 1.8, 'P': 1.8}
+default_vdw_radius = 1.8
+# flat bulk solvent mask: probe radius and shrink radius (Angstrom)
+solvent_radius = 1.1
+shrink_radius = 0.9
+# grid step of the map and of the model density, as fractions of the resolution (the map grid is that of phenix.maps)
+map_grid_factor = 1 / 3
+model_grid_factor = 1 / 4
+# atoms add to the model density up to this distance (Angstrom)
+model_density_radius = 5.0
+# map coefficients looked for in the MTZ file (amplitude and phase), in order
+map_coefficient_columns = [('2FOFCWT', 'PH2FOFCWT'), ('FWT', 'PHWT'), ('2FOFCWT_no_fill', 'PH2FOFCWT_no_fill')]
+
+def smooth_size(n_, multiple_):
+    """
+    Returns the smallest grid size of at least n_ that is a multiple of multiple_ and has no prime factor above 5 (fast FFTs).
+    """
+    n = int(np.ceil(n_ / multiple_)) * multiple_
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += multiple_
+
+def fft_grid(cell_, d_min_, symmetry_, step_factor_=map_grid_factor):
+    """
+    Returns a grid of the unit cell for maps of a resolution: a step of at most step_factor_ times the resolution along
+    each axis, sizes that are multiples of the translations of the symmetry operators (so symmetry mates fall on grid
+    points), equal sizes along axes exchanged by the operators, and small prime factors.
+
+    Args:
+        cell_ (numpy.ndarray): Unit cell.
+        d_min_ (float): Resolution (Angstrom).
+        symmetry_ (list): (rotation, translation) of each symmetry operator.
+        step_factor_ (float): Grid step as a fraction of the resolution (default: map_grid_factor).
+
+    Returns:
+        numpy.ndarray: Number of grid points along a, b, and c.
+    """
+
+    n = np.ceil(np.asarray(cell_[:3], dtype=float) / (d_min_ * step_factor_)).astype(int)
+    multiple = np.ones(3, dtype=int)
+    linked = np.eye(3, dtype=bool)
+    for rotation, translation in symmetry_:
+        for i in range(3):
+            multiple[i] = np.lcm(multiple[i], Fraction(float(translation[i])).limit_denominator(12).denominator)
+        linked |= rotation != 0
+    for _ in range(2):
+        linked = (linked.astype(int) @ linked.astype(int)) > 0
+    grid = np.zeros(3, dtype=int)
+    for i in range(3):
+        if not grid[i]:
+            axes = np.flatnonzero(linked[i])
+            grid[axes] = smooth_size(n[axes].max(), int(np.lcm.reduce(multiple[axes])))
+    return grid
+
+def reflection_symmetry(hkl_, symmetry_):
+    """
+    Returns, for each reflection, its statistical weight epsilon (number of symmetry operators, of the point group and
+    the centering, leaving it unchanged), whether it is centric (an operator maps it to its Friedel mate), and whether it
+    is systematically absent.
+    """
+
+    epsilon = np.zeros(len(hkl_), dtype=int)
+    centric = np.zeros(len(hkl_), dtype=bool)
+    absent = np.zeros(len(hkl_), dtype=bool)
+    for rotation, translation in symmetry_:
+        image = hkl_ @ np.rint(rotation).astype(np.int64)
+        same = (image == hkl_).all(axis=1)
+        epsilon += same
+        phase = hkl_ @ translation
+        absent |= same & (np.abs(phase - np.rint(phase)) > 1e-3)
+        centric |= (image == -hkl_).all(axis=1)
+    return epsilon, centric, absent
+
+def grid_structure_factors(grid_values_, cell_, hkl_, symmetry_=None):
+    """
+    Returns the structure factors of values on a grid of the unit cell (e.g., a density) at Miller indices,
+    F(h) = integral of rho(x) exp(2 pi i h.x) over the cell, by one FFT of the grid. With symmetry operators, the values
+    are those of one asymmetric copy, and F(h) sums the structure factors of the images of h under the operators,
+    exp(2 pi i h.t) F(h R).
+
+    Args:
+        grid_values_ (numpy.ndarray): Values on the grid, indexed [a, b, c].
+        cell_ (numpy.ndarray): Unit cell.
+        hkl_ (numpy.ndarray): (n, 3) Miller indices.
+        symmetry_ (list): (rotation, translation) of each symmetry operator (default: None, the values of the whole cell).
+
+    Returns:
+        numpy.ndarray: Complex structure factors.
+    """
+
+    n = np.array(grid_values_.shape)
+    volume = abs(np.linalg.det(orthogonalization_matrix(cell_)))
+    transform = np.fft.rfftn(grid_values_) * (volume / n.prod())
+    values = np.zeros(len(hkl_), dtype=complex)
+    for rotation, translation in symmetry_ or [(np.eye(3), np.zeros(3))]:
+        image = hkl_ @ np.rint(rotation).astype(np.int64)
+        # the FFT holds l >= 0; F(-h) is the complex conjugate of F(h)
+        negative = image[:, 2] < 0
+        index = np.where(negative[:, None], -image, image) % n
+        image_values = transform[index[:, 0], index[:, 1], index[:, 2]]
+        values += np.exp(2j * np.pi * (hkl_ @ translation)) * np.where(negative, image_values, np.conj(image_values))
+    return values
+
+def sphere_offsets(grid_, orthogonal_, radius_):
+    """
+    Returns the grid offsets that can lie within radius_ of a point (relative to the grid point below it), their
+    Cartesian vectors, and the margin (grid points along a, b, c) they reach beyond the cell. Atoms are spread onto a
+    grid padded by the margin, so the grid point of an offset is a sum of flat indices (see fold_padded).
+    """
+
+    fractional = np.linalg.inv(orthogonal_)
+    margin = np.ceil(radius_ * np.linalg.norm(fractional, axis=1) * grid_).astype(int) + 1
+    offsets = np.array(np.meshgrid(*[np.arange(-m + 1, m + 1) for m in margin], indexing='ij')).reshape(3, -1).T
+    offset_xyz = (offsets / grid_) @ orthogonal_.T
+    # the point lies within one grid cell of the grid point below it
+    cell_diagonal = np.linalg.norm(orthogonal_ @ (1 / np.asarray(grid_, dtype=float)))
+    keep = np.linalg.norm(offset_xyz, axis=1) <= radius_ + cell_diagonal
+    return offsets[keep], offset_xyz[keep], margin
+
+def padded_flat_indices(points_, offsets_, padded_shape_, margin_):
+    """
+    Returns the flat indices, in the padded grid, of the grid points below points_ (k, 3) plus offsets_ (m, 3), as a (k, m) array.
+    """
+    strides = np.array([padded_shape_[1] * padded_shape_[2], padded_shape_[2], 1])
+    return ((points_ + margin_) @ strides)[:, None] + (offsets_ @ strides)[None, :]
+
+def fold_padded(padded_, grid_, margin_):
+    """
+    Folds a grid padded by margin_ on each side back into the unit cell by periodicity (adding the values, or combining
+    booleans with or).
+    """
+    folded = padded_
+    for axis, (n, m) in enumerate(zip(grid_, margin_)):
+        core = np.take(folded, np.arange(m, n + m), axis=axis).copy()
+        low = np.take(folded, np.arange(m), axis=axis)
+        high = np.take(folded, np.arange(n + m, n + 2 * m), axis=axis)
+        index = [slice(None)] * 3
+        index[axis] = slice(n - m, n)
+        core[tuple(index)] += low
+        index[axis] = slice(0, m)
+        core[tuple(index)] += high
+        folded = core
+    return folded
+
+def atom_arrays(structure_):
+    """
+    Returns the coordinates, scattering factor coefficients (a: (n, 5), b: (n, 5), with c as a fifth Gaussian of width 0),
+    B-factors, and occupancies of the atoms of a structure.
+    """
+
+    elements = np.char.upper(np.char.strip(structure_.column('element_symbol').astype(str)))
+    a, b = np.zeros((len(elements), 5)), np.zeros((len(elements), 5))
+    for element in np.unique(elements):
+        select = elements == element
+        if element in scattering_factors:
+            coefficients_a, coefficients_b, c = scattering_factors[element]
+            scale = 1.0
+        else:
+            (coefficients_a, coefficients_b, c), scale = scattering_factors['C'], atomic_numbers.get(element, 6) / 6
+        a[select] = np.array(coefficients_a + [c]) * scale
+        b[select] = coefficients_b + [0.0]
+    return structure_.coords(), a, b, structure_.column('b_factor').astype(float), structure_.column('occupancy').astype(float), elements
+
+def model_density(structure_, cell_, grid_, b_extra_):
+    """
+    Calculates the electron density of the atoms of a structure (no symmetry mates) on a grid of the unit cell, as sums of
+    Gaussians (see scattering_factors) blurred by an extra B-factor b_extra_, so the grid samples them finely enough; the
+    structure factors of the density are sharpened back by exp(b_extra_ s^2 / 4) (see model_structure_factors).
+
+    Returns:
+        numpy.ndarray: The density, indexed [a, b, c].
+    """
+
+    orthogonal = orthogonalization_matrix(cell_)
+    xyz, a, b, b_factor, occupancy, elements = atom_arrays(structure_)
+    widths = b + b_factor[:, None] + b_extra_
+    weights = a * occupancy[:, None] * (4 * np.pi / widths)**1.5
+    grid_xyz = (xyz @ np.linalg.inv(orthogonal).T) * grid_
+    below = np.floor(grid_xyz).astype(np.int64)
+    # position of each atom relative to the grid point below it (wrapped into the cell)
+    atom_xyz = ((grid_xyz - below) / grid_) @ orthogonal.T
+    below %= grid_
+    radius_max = model_density_radius
+    offsets, offset_xyz, margin = sphere_offsets(grid_, orthogonal, radius_max)
+    padded_shape = tuple(np.asarray(grid_) + 2 * margin)
+    density = np.zeros(int(np.prod(padded_shape)))
+
+    # atoms with similar B-factors together, so each chunk uses the offsets within its widest Gaussian
+    order = np.argsort(widths.max(axis=1))
+    offset_norm2 = (offset_xyz**2).sum(axis=1)
+    start = 0
+    while start < len(order):
+        radius = min(np.sqrt(10 * widths[order[min(start + 255, len(order) - 1)]].max() / (4 * np.pi**2)), radius_max)
+        near = np.sqrt(offset_norm2) <= radius + np.linalg.norm(orthogonal @ (1 / np.asarray(grid_, dtype=float)))
+        chunk = order[start: start + max(1, min(256, 2000000 // int(near.sum())))]
+        start += len(chunk)
+        # |offset - atom|^2 without (k, m, 3) arrays
+        dist2 = offset_norm2[near][None, :] - 2 * atom_xyz[chunk] @ offset_xyz[near].T + (atom_xyz[chunk]**2).sum(axis=1)[:, None]
+        values = np.zeros(dist2.shape)
+        for term in range(5):
+            values += weights[chunk, term][:, None] * np.exp(-4 * np.pi**2 * dist2 / widths[chunk, term][:, None])
+        values[dist2 > radius**2] = 0
+        flat = padded_flat_indices(below[chunk], offsets[near], padded_shape, margin)
+        density += np.bincount(flat.ravel(), values.ravel(), minlength=len(density))
+    return fold_padded(density.reshape(padded_shape), grid_, margin)
+
+def symmetry_mates(structure_, cell_, symmetry_):
+    """
+    Returns the fractional coordinates of the atoms of a structure and of their symmetry mates (operators in order), and
+    the element of each.
+    """
+    fractional = structure_.coords() @ np.linalg.inv(orthogonalization_matrix(cell_)).T
+    elements = np.char.upper(np.char.strip(structure_.column('element_symbol').astype(str)))
+    return np.concatenate([fractional @ rotation.T + translation for rotation, translation in symmetry_]), np.tile(elements, len(symmetry_))
+
+def solvent_mask(structure_, cell_, grid_, symmetry_):
+    """
+    Calculates the flat bulk solvent mask on a grid of the unit cell: grid points farther than the van der Waals radius
+    plus the probe radius (solvent_radius) from every atom and symmetry mate are solvent, and the solvent region then
+    grows by shrink_radius.
+
+    Returns:
+        numpy.ndarray: 1 for solvent and 0 for the macromolecule, indexed [a, b, c].
+    """
+
+    orthogonal = orthogonalization_matrix(cell_)
+    fractional = np.linalg.inv(orthogonal)
+    frac_xyz, elements = symmetry_mates(structure_, cell_, symmetry_)
+    radii = np.array([vdw_radii.get(element, default_vdw_radius) for element in elements]) + solvent_radius
+    grid_xyz = frac_xyz * grid_
+    below = np.floor(grid_xyz).astype(np.int64)
+    atom_xyz = ((grid_xyz - below) / grid_) @ orthogonal.T
+    below %= grid_
+    offsets, offset_xyz, margin = sphere_offsets(grid_, orthogonal, radii.max())
+    padded_shape = tuple(np.asarray(grid_) + 2 * margin)
+    macromolecule = np.zeros(int(np.prod(padded_shape)), dtype=bool)
+
+    offset_norm2 = (offset_xyz**2).sum(axis=1)
+    chunk_size = max(1, 2000000 // len(offsets))
+    for start in range(0, len(grid_xyz), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        dist2 = offset_norm2[None, :] - 2 * atom_xyz[chunk] @ offset_xyz.T + (atom_xyz[chunk]**2).sum(axis=1)[:, None]
+        inside = dist2 <= radii[chunk][:, None]**2
+        macromolecule[padded_flat_indices(below[chunk], offsets, padded_shape, margin)[inside]] = True
+
+    macromolecule = fold_padded(macromolecule.reshape(padded_shape), grid_, margin)
+    solvent = ~macromolecule
+    extent = np.ceil(shrink_radius * np.linalg.norm(fractional, axis=1) * grid_).astype(int)
+    grown = solvent.copy()
+    for shift in np.ndindex(*(2 * extent + 1)):
+        shift = np.array(shift) - extent
+        if shift.any() and ((shift / grid_ @ orthogonal.T)**2).sum() <= shrink_radius**2:
+            grown |= np.roll(solvent, tuple(shift), axis=(0, 1, 2))
+    return grown.astype(float)
+
+def model_structure_factors(structure_, cell_, symmetry_, hkl_, d_min_):
+    """
+    Calculates the structure factors of a structure (Fcalc, with all symmetry mates) and of its bulk solvent mask (Fmask)
+    at Miller indices, by FFTs of the model density and the mask. The density of the atoms without their symmetry mates
+    is transformed once; the structure factor of a reflection sums those of its images under the symmetry operators,
+    Fcalc(h) = sum over operators of exp(2 pi i h.t) Fatoms(h R).
+
+    Args:
+        structure_ (Structure): The structure.
+        cell_ (numpy.ndarray): Unit cell.
+        symmetry_ (list): (rotation, translation) of each symmetry operator.
+        hkl_ (numpy.ndarray): (n, 3) Miller indices.
+        d_min_ (float): Resolution of the reflections.
+
+    Returns:
+        tuple: Complex Fcalc and Fmask.
+    """
+
+    grid = fft_grid(cell_, d_min_, symmetry_, model_grid_factor)
+    step = (np.asarray(cell_[:3], dtype=float) / grid).max()
+    # blur the sharpest Gaussians to a width of about one grid step, and sharpen the structure factors back
+    b_extra = max(0.0, 8 * np.pi**2 * step**2 - np.min(structure_.column('b_factor').astype(float), initial=0))
+    s2 = 1 / np.maximum(d_spacing(cell_, hkl_), 1e-6)**2
+    f_calc = grid_structure_factors(model_density(structure_, cell_, grid, b_extra), cell_, hkl_, symmetry_)
+    f_calc *= np.exp(b_extra * s2 / 4)
+    f_mask = grid_structure_factors(solvent_mask(structure_, cell_, grid, symmetry_), cell_, hkl_)
+    return f_calc, f_mask
+
+def d_spacing(cell_, hkl_):
+    """
+    Returns the resolution (d-spacing, Angstrom) of Miller indices.
+    """
+    s = hkl_ @ np.linalg.inv(orthogonalization_matrix(cell_))
+    return 1 / np.sqrt(np.maximum((s**2).sum(axis=1), 1e-12))
+
+def scale_model(f_obs_, f_calc_, f_mask_, s2_):
+    """
+    Scales the model to the observed amplitudes, Fmodel = k exp(-B s^2 / 4) (Fcalc + k_sol exp(-B_sol s^2 / 4) Fmask),
+    with the bulk solvent parameters k_sol and B_sol searched on a grid and k and B fitted for each by least squares of
+    log(Fobs / |Fmodel|); the parameters with the lowest R-factor are kept.
+
+    Returns:
+        tuple: Complex Fmodel and the parameters (dict with k, B, k_sol, B_sol, and R).
+    """
+
+    best = None
+    for k_sol in [0.0, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5]:
+        for b_sol in ([0.0] if k_sol == 0 else [20.0, 30.0, 40.0, 50.0, 60.0, 80.0]):
+            f_model = f_calc_ + k_sol * np.exp(-b_sol * s2_ / 4) * f_mask_
+            amplitude = np.abs(f_model)
+            use = (amplitude > 0) & (f_obs_ > 0)
+            slope, intercept = np.polyfit(s2_[use], np.log(f_obs_[use] / amplitude[use]), 1)
+            k, b = np.exp(intercept), -4 * slope
+            r = np.abs(f_obs_ - k * np.exp(-b * s2_ / 4) * amplitude).sum() / f_obs_.sum()
+            if best is None or r < best[0]:
+                best = (r, k, b, k_sol, b_sol)
+    r, k, b, k_sol, b_sol = best
+    f_model = k * np.exp(-b * s2_ / 4) * (f_calc_ + k_sol * np.exp(-b_sol * s2_ / 4) * f_mask_)
+    return f_model, {'k': float(k), 'B': float(b), 'k_sol': k_sol, 'B_sol': b_sol, 'R': round(float(r), 4)}
+
+def log_i0(x_):
+    """
+    Returns the logarithm of the modified Bessel function I0, without overflow for large arguments.
+    """
+    x = np.asarray(x_, dtype=float)
+    large = x > 50
+    values = np.empty_like(x)
+    values[~large] = np.log(np.i0(x[~large]))
+    values[large] = x[large] - 0.5 * np.log(2 * np.pi * x[large]) + np.log1p(1 / (8 * x[large]) + 9 / (128 * x[large]**2))
+    return values
+
+def bessel_ratio(x_):
+    """
+    Returns I1(x) / I0(x) (the figure of merit of acentric reflections), from the integrals of exp(x (cos t - 1)) and
+    cos(t) exp(x (cos t - 1)) over [0, pi], or the asymptotic series for large arguments.
+    """
+    x = np.asarray(x_, dtype=float)
+    t = np.linspace(0, np.pi, 129)
+    values = 1 - 1 / (2 * np.maximum(x, 1)) - 1 / (8 * np.maximum(x, 1)**2)
+    small = x <= 500
+    integrand = np.exp(x[small, None] * (np.cos(t) - 1))
+    values[small] = np.trapz(integrand * np.cos(t), t, axis=1) / np.trapz(integrand, t, axis=1)
+    return values
+
+def sigmaa_coefficients(f_obs_, f_model_, s2_, epsilon_, centric_, n_bins_=None):
+    """
+    Calculates the weights of 2mFo-DFc map coefficients in resolution bins: sigmaA is the value (0.01 to 0.99) that
+    maximizes the likelihood of the normalized observed amplitudes given the model ones (Rice distributions, Read 1986);
+    D = sigmaA sqrt(<Fobs^2> / <Fmodel^2>) and the figure of merit m = I1(X) / I0(X) (acentric) or tanh(X / 2)
+    (centric), X = 2 sigmaA Eo Ec / (1 - sigmaA^2).
+
+    Returns:
+        tuple: m of each reflection, D of each reflection, and sigmaA of each bin.
+    """
+
+    n_bins = n_bins_ or int(np.clip(len(f_obs_) // 1000, 6, 30))
+    edges = np.quantile(s2_, np.linspace(0, 1, n_bins + 1))
+    bins = np.clip(np.searchsorted(edges, s2_, side='right') - 1, 0, n_bins - 1)
+    amplitude = np.abs(f_model_)
+    sigma_grid = np.linspace(0.01, 0.99, 99)[:, None]
+    m, D, sigmaa = np.zeros(len(f_obs_)), np.zeros(len(f_obs_)), np.zeros(n_bins)
+    for i in range(n_bins):
+        select = np.flatnonzero(bins == i)
+        scale_obs = np.mean(f_obs_[select]**2 / epsilon_[select])
+        scale_model = np.mean(amplitude[select]**2 / epsilon_[select])
+        e_obs = f_obs_[select] / np.sqrt(epsilon_[select] * scale_obs)
+        e_model = amplitude[select] / np.sqrt(epsilon_[select] * scale_model)
+        is_centric = centric_[select]
+        variance = 1 - sigma_grid**2
+        x = 2 * sigma_grid * e_obs * e_model / variance
+        log_likelihood = np.where(is_centric,
+                                  0.5 * np.log(2 / (np.pi * variance)) - (e_obs**2 + sigma_grid**2 * e_model**2) / (2 * variance) + x / 2 + np.log1p(np.exp(-x)) - np.log(2),
+                                  np.log(2 * np.maximum(e_obs, 1e-12) / variance) - (e_obs**2 + sigma_grid**2 * e_model**2) / variance + log_i0(x))
+        sigmaa[i] = sigma_grid[np.argmax(log_likelihood.sum(axis=1)), 0]
+        x = 2 * sigmaa[i] * e_obs * e_model / (1 - sigmaa[i]**2)
+        m[select] = np.where(is_centric, np.tanh(x / 2), bessel_ratio(x))
+        D[select] = sigmaa[i] * np.sqrt(scale_obs / scale_model)
+    return m, D, sigmaa
+
+def synthesize_map(hkl_, coefficients_, cell_, symmetry_, grid_):
+    """
+    Calculates a map from complex map coefficients of the unique reflections, rho(x) = 1/V sum over h of F(h) exp(-2 pi i h.x),
+    by expanding them to all symmetry mates and Friedel mates (F(h R) = F(h) exp(-2 pi i h.t)) and one inverse FFT.
+
+    Args:
+        hkl_ (numpy.ndarray): (n, 3) Miller indices.
+        coefficients_ (numpy.ndarray): Complex map coefficients.
+        cell_ (numpy.ndarray): Unit cell.
+        symmetry_ (list): (rotation, translation) of each symmetry operator.
+        grid_ (numpy.ndarray): Number of grid points along a, b, and c (see fft_grid).
+
+    Returns:
+        DensityMap: The map of the whole unit cell.
+    """
+
+    grid = np.asarray(grid_, dtype=int)
+    volume = abs(np.linalg.det(orthogonalization_matrix(cell_)))
+    half = np.zeros((grid[0], grid[1], grid[2] // 2 + 1), dtype=complex)
+    for rotation, translation in symmetry_:
+        image = hkl_ @ np.rint(rotation).astype(np.int64)
+        values = coefficients_ * np.exp(-2j * np.pi * (hkl_ @ translation))
+        for sign in (1, -1):
+            index, mate_values = sign * image, (values if sign == 1 else np.conj(values))
+            keep = index[:, 2] >= 0
+            index = index[keep] % grid
+            # the inverse FFT of conj(F) gives the sum of F(h) exp(-2 pi i h.x) of a real map
+            half[index[:, 0], index[:, 1], index[:, 2]] = np.conj(mate_values[keep])
+    data = np.fft.irfftn(half, s=tuple(grid)) * (grid.prod() / volume)
+    return DensityMap(data.astype(np.float32), cell_, grid, np.zeros(3, dtype=int), symmetry_=symmetry_)
+
+def missing_reflections(hkl_, cell_, symmetry_, d_min_):
+    """
+    Returns the unique reflections up to a resolution that are not in hkl_ (and not systematically absent), e.g., to fill
+    a map with the model amplitudes of unmeasured reflections.
+    """
+
+    # |h| is at most a / d along each axis
+    limits = np.floor(np.asarray(cell_[:3], dtype=float) / d_min_).astype(int)
+    candidates = np.array(np.meshgrid(*[np.arange(-l, l + 1) for l in limits], indexing='ij')).reshape(3, -1).T
+    candidates = candidates[(d_spacing(cell_, candidates) >= d_min_) & candidates.any(axis=1)]
+    span = 2 * limits.max() + 1
+
+    def canonical(hkl):
+        # the largest code of the symmetry mates and Friedel mates of each reflection
+        codes = []
+        for rotation, translation in symmetry_:
+            image = hkl @ np.rint(rotation).astype(np.int64)
+            for sign in (1, -1):
+                codes.append((((sign * image) + limits.max()) * np.array([span**2, span, 1])).sum(axis=1))
+        return np.max(codes, axis=0)
+
+    candidate_codes = canonical(candidates)
+    unique_codes, first = np.unique(candidate_codes, return_index=True)
+    missing = ~np.isin(unique_codes, canonical(hkl_))
+    candidates = candidates[first[missing]]
+    return candidates[~reflection_symmetry(candidates, symmetry_)[2]]
+
+def find_columns(mtz_, map_columns_=None):
+    """
+    Returns the labels of the map coefficients to use (amplitude and phase): the given ones, or the first pair of
+    map_coefficient_columns in the file; None if there are none (the map is then phased by the model).
+
+    Outputs:
+        Raises a ValueError if the given columns are not in the file.
+    """
+    if map_columns_:
+        missing = [label for label in map_columns_ if label not in mtz_.columns]
+        if missing:
+            raise ValueError('The MTZ file has no column ' + ', '.join(missing) + ' (columns: ' + ', '.join(mtz_.columns) + ').')
+        return tuple(map_columns_)
+    return next(((f, phi) for f, phi in map_coefficient_columns if f in mtz_.columns and phi in mtz_.columns), None)
+
+def amplitude_column(mtz_, mtz_file_):
+    """
+    Returns the label of the observed amplitudes to phase with the model: the first amplitude column (type F) that is
+    not a map coefficient.
+
+    Outputs:
+        Raises a ValueError if the file has no such column (e.g., only intensities).
+    """
+    labels = [label for label in mtz_.labels('F') if not any(label == f for f, phi in map_coefficient_columns)]
+    if not labels:
+        raise ValueError('The MTZ file ' + mtz_file_ + ' has no map coefficients and no amplitudes (type F) to phase with the model; '
+                         'give a CCP4 map (-ccp4) or convert the intensities to amplitudes first.')
+    return labels[0]
+
+def check_map_inputs(mtz_file_, map_columns_=None):
+    """
+    Checks that a map can be calculated from an MTZ file (see calculate_map) without calculating it, e.g., in the
+    validation-only mode.
+
+    Outputs:
+        Raises a ValueError if the file cannot be read or has neither map coefficients nor amplitudes.
+
+    Returns:
+        str: How the map would be calculated.
+    """
+    mtz = read_mtz(mtz_file_)
+    columns = find_columns(mtz, map_columns_)
+    if columns is not None:
+        return 'the map will be calculated from the map coefficients ' + '/'.join(columns) + ' of ' + mtz_file_
+    return 'the 2mFo-DFc map will be calculated from the amplitudes ' + amplitude_column(mtz, mtz_file_) + ' of ' + mtz_file_ + ', phased by the model'
+
+def calculate_map(mtz_file_, structure_=None, map_columns_=None, fill_missing_=True):
+    """
+    Calculates the 2mFo-DFc map of a structure from its MTZ file, on the grid phenix.maps uses (a step of a third of the
+    resolution). Map coefficients of the file are used if it has them (see find_columns); otherwise the map is phased by
+    the model: the observed amplitudes (the first amplitude column, e.g., FP) are scaled against the structure factors of
+    the model with a flat bulk solvent (see model_structure_factors and scale_model), weighted by sigmaA (see
+    sigmaa_coefficients), and combined with the model phases as 2mFo - DFc (mFo for centric reflections). Unmeasured
+    reflections are filled with DFc (fill_missing_).
+
+    Args:
+        mtz_file_ (str): Path to the MTZ file.
+        structure_ (Structure): The structure (needed unless the file has map coefficients).
+        map_columns_ (list): Labels of the amplitude and phase of the map coefficients (default: found in the file).
+        fill_missing_ (bool): Fill unmeasured reflections with DFc in model-phased maps (default: True).
+
+    Outputs:
+        Raises a ValueError if the file has neither map coefficients nor amplitudes.
+
+    Returns:
+        tuple: The map (DensityMap of the whole unit cell) and a description of its calculation (dict).
+    """
+
+    mtz = read_mtz(mtz_file_)
+    hkl = mtz.hkl()
+    columns = find_columns(mtz, map_columns_)
+    if columns is not None:
+        amplitude, phase = mtz.columns[columns[0]], mtz.columns[columns[1]]
+        measured = ~(np.isnan(amplitude) | np.isnan(phase))
+        hkl, coefficients = hkl[measured], amplitude[measured] * np.exp(1j * np.radians(phase[measured]))
+        d_min = float(mtz.d_spacing()[measured].min())
+        info = {'coefficients': '/'.join(columns)}
+    else:
+        amplitude_label = amplitude_column(mtz, mtz_file_)
+        if structure_ is None:
+            raise ValueError('A structure is needed to phase the map of ' + mtz_file_ + '.')
+        f_obs = mtz.columns[amplitude_label]
+        measured = ~np.isnan(f_obs) & (f_obs > 0) & hkl.any(axis=1)
+        hkl, f_obs = hkl[measured], f_obs[measured]
+        d = d_spacing(mtz.cell, hkl)
+        d_min = float(d.min())
+        epsilon, centric, absent = reflection_symmetry(hkl, mtz.symmetry)
+        hkl, f_obs, d, epsilon, centric = hkl[~absent], f_obs[~absent], d[~absent], epsilon[~absent], centric[~absent]
+
+        fill = missing_reflections(hkl, mtz.cell, mtz.symmetry, d_min) if fill_missing_ else np.zeros((0, 3), dtype=np.int64)
+        all_hkl = np.concatenate([hkl, fill])
+        f_calc, f_mask = model_structure_factors(structure_, mtz.cell, mtz.symmetry, all_hkl, d_min)
+        s2 = 1 / d_spacing(mtz.cell, all_hkl)**2
+        n = len(hkl)
+        f_model, scale = scale_model(f_obs, f_calc[:n], f_mask[:n], s2[:n])
+        f_model = np.concatenate([f_model, scale['k'] * np.exp(-scale['B'] * s2[n:] / 4) * (f_calc[n:] + scale['k_sol'] * np.exp(-scale['B_sol'] * s2[n:] / 4) * f_mask[n:])])
+        m, D, sigmaa = sigmaa_coefficients(f_obs, f_model[:n], s2[:n], epsilon, centric)
+        phases = np.exp(1j * np.angle(f_model))
+        amplitudes = np.where(centric, m * f_obs, 2 * m * f_obs - D * np.abs(f_model[:n]))
+        if len(fill):
+            # D of the unmeasured reflections from the bin of the closest measured resolution
+            fill_D = D[np.argsort(s2[:n])][np.clip(np.searchsorted(np.sort(s2[:n]), s2[n:]), 0, n - 1)]
+            amplitudes = np.concatenate([amplitudes, fill_D * np.abs(f_model[n:])])
+        hkl, coefficients = all_hkl, amplitudes * phases
+        info = dict(scale, coefficients='2mFo-DFc', f_obs=amplitude_label, n_filled=int(len(fill)), sigmaa=[round(float(x), 3) for x in sigmaa])
+
+    grid = fft_grid(mtz.cell, d_min, mtz.symmetry)
+    density_map = synthesize_map(hkl, coefficients, mtz.cell, mtz.symmetry, grid)
+    info.update({'d_min': round(d_min, 3), 'grid': [int(x) for x in grid], 'n_reflections': int(len(hkl)), 'space_group': mtz.space_group[1],
+                 'space_group_number': mtz.space_group[0]})
+    return density_map, info
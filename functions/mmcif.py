@@ -0,0 +1,251 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import re
+import numpy as np
+
+# mmCIF _atom_site items of each structure column (the first item found in the file is used)
+atom_site_items = {
+    'record_name': ['group_PDB'],
+    'atom_number': ['id'],
+    'atom_name': ['auth_atom_id', 'label_atom_id'],
+    'alt_loc': ['label_alt_id'],
+    'residue_name': ['auth_comp_id', 'label_comp_id'],
+    'chain_id': ['auth_asym_id', 'label_asym_id'],
+    'residue_number': ['auth_seq_id', 'label_seq_id'],
+    'insertion': ['pdbx_PDB_ins_code'],
+    'x_coord': ['Cartn_x'],
+    'y_coord': ['Cartn_y'],
+    'z_coord': ['Cartn_z'],
+    'occupancy': ['occupancy'],
+    'b_factor': ['B_iso_or_equiv'],
+    'segment_id': [],
+    'element_symbol': ['type_symbol'],
+    'charge': ['pdbx_formal_charge']
+}
+
+atom_site_formats = {
+    'atom_number': '%d',
+    'residue_number': '%d',
+    'x_coord': '%.3f',
+    'y_coord': '%.3f',
+    'z_coord': '%.3f',
+    'occupancy': '%.2f',
+    'b_factor': '%.2f'
+}
+
+# values of a CIF line: quoted strings (closed by a quote followed by a space) or bare words
+cif_token = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""")
+
+class AtomSite:
+    """
+    The _atom_site loop of an mmCIF file, with the text of the file before and after the loop.
+    Values are kept as strings, so the loop is written back as it was read except for the changed items.
+
+    Attributes:
+        items (list): Names of the _atom_site items (without the '_atom_site.' prefix), in file order.
+        values (dict): Values of each item (numpy.ndarray of str, one per atom).
+        header_lines (list): Lines of the file before the loop (data block name, cell, symmetry, entities, ...).
+        footer_lines (list): Lines of the file after the loop.
+    """
+
+    def __init__(self, items_, values_, header_lines_, footer_lines_):
+        self.items = items_
+        self.values = values_
+        self.header_lines = header_lines_
+        self.footer_lines = footer_lines_
+
+    def __len__(self):
+        return len(self.values[self.items[0]]) if self.items else 0
+
+    def item_of(self, column_):
+        """
+        Returns the _atom_site item holding a structure column (see atom_site_items), or None if the file has none.
+        """
+        return next((item for item in atom_site_items[column_] if item in self.values), None)
+
+    def column(self, column_, type_):
+        """
+        Returns the values of a structure column, with the mmCIF null values ('.' and '?') as blanks.
+
+        Args:
+            column_ (str): Column name (see atom_site_items).
+            type_ (type): Type of the column (str, int, or float).
+
+        Returns:
+            numpy.ndarray: Values of the column (blank numbers are 0 for int and NaN for float columns).
+        """
+
+        item = self.item_of(column_)
+        text = self.values[item] if item is not None else np.full(len(self), '')
+        text = np.where(np.isin(text, ['.', '?']), '', text)
+        if column_ == 'element_symbol':
+            text = np.char.upper(text)
+        if type_ == str:
+            return text.astype(str)
+        return np.where(text == '', '0' if type_ == int else 'nan', text).astype(type_)
+
+    def cell(self):
+        """
+        Returns the unit cell and space group of the file (_cell and _symmetry or _space_group items).
+
+        Returns:
+            tuple: Cell a, b, c, alpha, beta, gamma (list of float, None if missing) and space group (str).
+        """
+
+        items = {}
+        for line in self.header_lines + self.footer_lines:
+            tokens = tokenize(line)
+            if len(tokens) == 2 and tokens[0].startswith('_'):
+                items[tokens[0]] = tokens[1]
+        try:
+            cell = [float(items['_cell.' + name]) for name in ['length_a', 'length_b', 'length_c', 'angle_alpha', 'angle_beta', 'angle_gamma']]
+        except (KeyError, ValueError):
+            cell = None
+        space_group = items.get('_symmetry.space_group_name_H-M', items.get('_space_group.name_H-M_alt', 'P 1'))
+        return cell, space_group
+
+def tokenize(line_):
+    """
+    Splits a line of a CIF file into values (quotes are removed).
+    """
+    if "'" not in line_ and '"' not in line_:
+        return line_.split()
+    return [next(group for group in match.groups() if group is not None) for match in cif_token.finditer(line_)]
+
+def quote(values_):
+    """
+    Quotes the values that need it in a CIF file (values with spaces, values starting with a reserved character, and blanks).
+
+    Args:
+        values_ (numpy.ndarray): Values (str).
+
+    Returns:
+        numpy.ndarray: Values as written in the file.
+    """
+
+    values_ = np.ascontiguousarray(values_, dtype=str).reshape(-1)
+    # the characters of the values as codes (one row per value), which is much faster than the np.char functions
+    codes = values_.view(np.uint32).reshape(len(values_), values_.itemsize // 4)
+    needs_quotes = (codes == ord(' ')).any(axis=1) | np.isin(codes[:, 0], [ord(c) for c in '_\'"#$;[]'])
+    out = np.where(values_ == '', '?', values_).astype(object)
+    for i in np.flatnonzero(needs_quotes):
+        out[i] = ("'%s'" if "'" not in values_[i] else '"%s"') % values_[i]
+    return out.astype(str)
+
+def read_mmcif_atom_site(cif_file_, all_models_=False):
+    """
+    Reads the _atom_site loop of an mmCIF file line by line, keeping the first model only.
+
+    Args:
+        cif_file_ (str): Path to the mmCIF file.
+        all_models_ (bool): Keep the atoms of all models (see structure.read_models) (default: False).
+
+    Outputs:
+        Raises a ValueError if the file has no _atom_site loop or a row with a wrong number of values.
+
+    Returns:
+        AtomSite: The atoms and the other text of the file.
+    """
+
+    header_lines, footer_lines, items, rows = [], [], [], []
+    state = 'header'
+    pending_loop = False
+    row = []
+    with open(cif_file_, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            stripped = line.strip()
+            if state == 'header':
+                if stripped == 'loop_':
+                    pending_loop = True
+                elif pending_loop and stripped.startswith('_atom_site.'):
+                    state = 'items'
+                    items.append(stripped.split()[0][len('_atom_site.'):])
+                else:
+                    if pending_loop:
+                        header_lines.append('loop_')
+                        pending_loop = False
+                    header_lines.append(line)
+            elif state == 'items':
+                if stripped.startswith('_atom_site.'):
+                    items.append(stripped.split()[0][len('_atom_site.'):])
+                else:
+                    state = 'rows'
+            if state == 'rows':
+                if stripped.startswith(('loop_', 'data_', '_')) or (stripped == '#' and not row):
+                    state = 'footer'
+                elif stripped and not stripped.startswith('#'):
+                    row += tokenize(stripped)
+                    if len(row) >= len(items):
+                        if len(row) > len(items):
+                            raise ValueError('Invalid _atom_site row in ' + cif_file_ + ': ' + stripped)
+                        rows.append(row)
+                        row = []
+            if state == 'footer':
+                footer_lines.append(line)
+    if not items or not rows:
+        raise ValueError(cif_file_ + ' has no _atom_site loop.')
+
+    values = dict(zip(items, (np.array(column, dtype=str) for column in zip(*rows))))
+    atom_site = AtomSite(items, values, header_lines, footer_lines)
+    if 'pdbx_PDB_model_num' in values and not all_models_:
+        first_model = values['pdbx_PDB_model_num'] == values['pdbx_PDB_model_num'][0]
+        atom_site.values = dict((item, value[first_model]) for item, value in values.items())
+    return atom_site
+
+def write_mmcif_atom_site(path_, atom_site_, index_, columns_=None, others_=True):
+    """
+    Writes atoms of an _atom_site loop to an mmCIF file, optionally with new values for some columns.
+
+    Args:
+        path_ (str): Path of the output mmCIF file.
+        atom_site_ (AtomSite): The atoms and text of the input file.
+        index_ (numpy.ndarray): Indices of the atoms to write.
+        columns_ (dict): New values for columns of some of the written atoms, mapping a column name
+            (see atom_site_items) to a tuple of (atom indices, values) (default: None).
+        others_ (bool): Also write the other text of the input file (cell, symmetry, entities, ...) (default: True).
+
+    Outputs:
+        Saves the mmCIF file.
+
+    Returns:
+        None
+    """
+
+    values = dict((item, atom_site_.values[item].astype(object)) for item in atom_site_.items)
+    for name, (atom_index, new_values) in (columns_ or {}).items():
+        item = atom_site_.item_of(name)
+        if item is None:
+            continue
+        text = np.char.mod(atom_site_formats.get(name, '%s'), np.asarray(new_values)).astype(str)
+        if name == 'alt_loc':
+            text = np.where(text == '', '.', text)
+        values[item][atom_index] = text
+
+    with open(path_, 'w') as f:
+        if others_:
+            f.write(''.join(line + '\n' for line in atom_site_.header_lines))
+        else:
+            f.write(next((line for line in atom_site_.header_lines if line.startswith('data_')), 'data_coldbrew') + '\n#\n')
+        f.write('loop_\n' + ''.join('_atom_site.' + item + '\n' for item in atom_site_.items))
+        columns = [quote(values[item][index_].astype(str)) for item in atom_site_.items]
+        f.write(''.join(' '.join(row) + '\n' for row in zip(*columns)))
+        if others_:
+            f.write(''.join(line + '\n' for line in atom_site_.footer_lines))
+        else:
+            f.write('#\n')
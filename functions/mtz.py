@@ -0,0 +1,136 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import numpy as np
+from functions.ccp4 import orthogonalization_matrix, parse_symmetry_operator
+
+# header records are 80 characters; the reflections start after the first 80 bytes
+record_bytes = 80
+reflection_offset = 80
+
+class MtzData:
+    """
+    Merged reflections of an MTZ file.
+
+    Attributes:
+        columns (dict): Values of each column by label (numpy.ndarray of float; missing values are NaN).
+        column_types (dict): MTZ type of each column by label (H: index, F: amplitude, Q: standard deviation, P: phase
+            in degrees, J: intensity, W: weight, I: integer, ...).
+        cell (numpy.ndarray): Unit cell a, b, c (Angstrom), alpha, beta, gamma (degrees).
+        symmetry (list): (rotation, translation) of each symmetry operator in fractional coordinates.
+        space_group (tuple): Number and name of the space group.
+        title (str): Title of the file.
+    """
+
+    def __init__(self, columns_, column_types_, cell_, symmetry_, space_group_, title_=''):
+        self.columns = columns_
+        self.column_types = column_types_
+        self.cell = np.asarray(cell_, dtype=float)
+        self.symmetry = symmetry_
+        self.space_group = space_group_
+        self.title = title_
+
+    def hkl(self):
+        """
+        Returns the (n, 3) Miller indices of the reflections.
+        """
+        return np.column_stack([self.columns[label] for label in ['H', 'K', 'L']]).astype(np.int64)
+
+    def d_spacing(self):
+        """
+        Returns the resolution (d-spacing, Angstrom) of each reflection.
+        """
+        reciprocal = np.linalg.inv(orthogonalization_matrix(self.cell))
+        s = self.hkl() @ reciprocal
+        return 1 / np.sqrt(np.maximum((s**2).sum(axis=1), 1e-12))
+
+    def labels(self, column_type_):
+        """
+        Returns the labels of the columns of a type, in file order.
+        """
+        return [label for label, column_type in self.column_types.items() if column_type == column_type_]
+
+def read_mtz(mtz_file_):
+    """
+    Reads a merged MTZ file: the reflection table, the cell, and the symmetry operators from the header.
+    The byte order (machine stamp) and the missing value (VALM) are taken from the file.
+
+    Args:
+        mtz_file_ (str): Path to the MTZ file.
+
+    Outputs:
+        Raises a ValueError if the file is not an MTZ file, is truncated, or holds unmerged reflections (batches).
+
+    Returns:
+        MtzData: The reflections.
+    """
+
+    with open(mtz_file_, 'rb') as f:
+        data = f.read()
+    if len(data) < reflection_offset or data[:4] != b'MTZ ':
+        raise ValueError(mtz_file_ + ' is not an MTZ file.')
+    # the high nibble of the first byte of the machine stamp is the real number format (1: big-endian IEEE, 4: little-endian IEEE)
+    byte_order = '>' if data[8] >> 4 == 1 else '<'
+    header_start = (int(np.frombuffer(data[4:8], dtype=byte_order + 'i4')[0]) - 1) * 4
+    if not reflection_offset <= header_start < len(data):
+        raise ValueError('The MTZ file ' + mtz_file_ + ' is truncated.')
+
+    records = []
+    for i in range(header_start, len(data) - record_bytes + 1, record_bytes):
+        record = data[i: i + record_bytes].decode('ascii', errors='replace').rstrip()
+        if record.startswith('END'):
+            break
+        records.append(record)
+
+    n_columns, n_reflections, n_batches = 0, 0, 0
+    labels, column_types, operators = [], {}, []
+    cell, space_group, title, missing = None, (1, 'P 1'), '', np.nan
+    for record in records:
+        key, _, value = record.partition(' ')
+        fields = value.split()
+        if key == 'NCOL':
+            n_columns, n_reflections, n_batches = int(fields[0]), int(fields[1]), int(fields[2])
+        elif key == 'CELL':
+            cell = [float(x) for x in fields[:6]]
+        elif key == 'SYMINF':
+            # SYMINF <number of operators> <number of primitive operators> <lattice> <space group number> '<name>' <point group>
+            name = value.split("'")[1] if value.count("'") >= 2 else fields[4]
+            space_group = (int(fields[3]), name)
+        elif key == 'SYMM':
+            operators.append(parse_symmetry_operator(value))
+        elif key == 'VALM':
+            missing = np.nan if fields[0].upper() == 'NAN' else float(fields[0])
+        elif key == 'COLUMN':
+            labels.append(fields[0])
+            column_types[fields[0]] = fields[1]
+        elif key == 'TITLE':
+            title = value.strip()
+
+    if n_batches:
+        raise ValueError('The MTZ file ' + mtz_file_ + ' holds unmerged reflections (' + str(n_batches) + ' batches); merge them first.')
+    if cell is None or len(labels) != n_columns or not all(label in labels for label in ['H', 'K', 'L']):
+        raise ValueError('The header of the MTZ file ' + mtz_file_ + ' has no cell or no H, K, L columns.')
+    if reflection_offset + n_columns * n_reflections * 4 > header_start:
+        raise ValueError('The MTZ file ' + mtz_file_ + ' is truncated.')
+
+    table = np.frombuffer(data, dtype=byte_order + 'f4', count=n_columns * n_reflections, offset=reflection_offset).reshape(n_reflections, n_columns).astype(float)
+    if not np.isnan(missing):
+        table[table == missing] = np.nan
+    columns = dict((label, table[:, i]) for i, label in enumerate(labels))
+    if not operators:
+        operators = [(np.eye(3), np.zeros(3))]
+    return MtzData(columns, column_types, cell, operators, space_group, title)
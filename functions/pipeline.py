@@ -0,0 +1,178 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import json
+from functions.structure import read_structure
+from functions.cache import run_cached_stage
+from functions.validation import check_map_coverage, check_pdb_format_limits
+from functions.configuration import get_backends, uses_external_programs, uses_native_density, do_setup, setup_files
+from functions.execution import run_calculations
+from functions.data_parsing import parse_raw_datafiles
+from functions.data_analysis import calculate_CB_prob
+from functions.instrumentation import RunReport, instrument, file_fingerprint
+
+def run_pipeline(pdb_file_, pdb_id_, mtz_file_, ccp4_file_, outdir_, n_workers_=None, workdir_=None, write_parsed_=False, cache_=None, backends_=None, resolution_=None, openmetrics_=False, previous_=None, site_=None, dataset_=None,
+                 scratch_=None, keep_intermediates_=None, map_columns_=None):
+    """
+    Runs the full ColdBrew pipeline for one structure.
+    - Calculates the 2mFo-DFc map from the MTZ file if no CCP4 map is given.
+    - Sets up the files needed for calculations.
+    - Runs calculations on the input data.
+    - Parses raw output files into per-water features.
+    - Computes final results and saves them.
+    Each stage and external command is recorded in a run report (see instrumentation.RunReport), saved as
+    <ID>_run_report.json even if the run fails.
+
+    Args:
+        pdb_file_ (str): Path to the input PDB or mmCIF file.
+        pdb_id_ (str): Identifier for the structure, used for output naming.
+        mtz_file_ (str): Path to the MTZ file containing reflection data.
+        ccp4_file_ (str): Path to the CCP4 file containing the electron density map (None to calculate the 2mFo-DFc map
+            from the MTZ file, saved as <ID>_2mFo-DFc.ccp4; see maps.calculate_map).
+        outdir_ (str): Directory where results will be saved.
+        n_workers_ (int): Maximum number of calculations run at the same time (default: number of CPUs, up to 4).
+        workdir_ (str): Working directory for external programs that write into the current directory (default: a private directory in the output directory).
+        write_parsed_ (bool): Also save the parsed data of each metric as PDB files in 'parsed_data_files' (default: False).
+        cache_ (StageCache): Cache of stage outputs, so a rerun skips the stages that already ran with the same inputs (default: None).
+        backends_ (dict): Backend of each feature, e.g., {'SASA': 'native'} (see configuration.get_backends; default: external programs).
+        resolution_ (float): Resolution of the map for the native RSCC and EDIA backends (default: estimated from the grid of the map).
+        openmetrics_ (bool): Also save the run report as OpenMetrics text in <ID>_run_report.prom (default: False).
+        previous_ (str): Output directory of a previous run of an earlier version of the structure (e.g., the previous
+            refinement cycle); only the waters whose environment changed are recalculated (see incremental.rescore_incrementally).
+        site_ (dict): Site to score, with the keys 'ligand' (residue names), 'residues' (e.g., ['A:45']), 'center'
+            (x, y, z), and 'radius' (see site.select_site; default: None, all waters). Only the waters near the site are
+            scored, and the calculations run on the site structure (<ID>_site.pdb: the site waters and their environment).
+        dataset_ (str): Directory of a Parquet dataset to add the results to (see dataset.write_structure_results; default: None).
+        scratch_ (str): Directory for the scratch workspace of the run (see workspace.Workspace; default: None, all files
+            are written to the output directory, unless keep_intermediates_ is given).
+        keep_intermediates_ (str): With a workspace, when to keep the intermediate files, as <ID>_intermediates.tar.gz:
+            'none', 'failure', or 'all' (default: None, 'failure' if scratch_ is given).
+        map_columns_ (list): Labels of the amplitude and phase of the map coefficients in the MTZ file, used if ccp4_file_
+            is None (default: None, found in the file, or the map is phased by the model).
+
+    Outputs:
+        Saves the setup, raw, and result files (and optionally the parsed data files) and the run report in the output directory.
+        With a workspace, only the results, the run report, and the archive of the intermediate files (if kept) are saved there.
+
+    Returns:
+        pandas.DataFrame: The results as saved in <ID>_ColdBrew_results.csv.
+    """
+
+    # external programs may run in another directory, so use absolute paths
+    pdb_file_ = os.path.abspath(pdb_file_)
+    mtz_file_ = os.path.abspath(mtz_file_)
+    ccp4_file_ = os.path.abspath(ccp4_file_) if ccp4_file_ is not None else None
+    outdir_ = os.path.abspath(outdir_)
+
+    # write everything to a scratch workspace and publish only the final outputs
+    workspace = None
+    if scratch_ is not None or keep_intermediates_ is not None:
+        from functions.workspace import Workspace
+        workspace = Workspace(outdir_, pdb_id_, scratch_, keep_intermediates_ or 'failure')
+        outdir_ = workspace.path
+        if workdir_ is None:
+            workdir_ = workspace.workdir
+
+    input_files = {'pdb_file': pdb_file_, 'mtz_file': mtz_file_, 'ccp4_file': ccp4_file_}
+    report = RunReport(pdb_id_, dict(input_files, backends=get_backends(backends_), resolution=resolution_, n_workers=n_workers_,
+                                     input_files=dict((name, file_fingerprint(path)) for name, path in input_files.items())))
+    if workspace is not None:
+        report.info['workspace'] = {'path': workspace.path, 'keep_intermediates': workspace.keep}
+    status, error = 'failed', ''
+    try:
+        if previous_ is not None and site_ is not None:
+            raise ValueError('A site cannot be rescored incrementally; give either a previous run or a site.')
+
+        # read the structure once and setup files for calculation
+        with instrument(report, 'read_structure') as record:
+            structure = read_structure(pdb_file_)
+            report.info['n_atoms'] = record['n_atoms'] = len(structure)
+            report.info['n_waters'] = record['n_waters'] = len(structure.water_index())
+
+        # calculate the 2mFo-DFc map from the MTZ file (phased by the whole structure) if no map is given
+        if ccp4_file_ is None:
+            from functions.maps import calculate_map
+            from functions.ccp4 import write_ccp4_map
+            ccp4_file_ = outdir_ + '/' + pdb_id_ + '_2mFo-DFc.ccp4'
+            map_info_file = outdir_ + '/' + pdb_id_ + '_2mFo-DFc.json'
+            def calc_map():
+                print('calculating the 2mFo-DFc map from ' + mtz_file_ + '...')
+                density_map, info = calculate_map(mtz_file_, structure, map_columns_)
+                write_ccp4_map(density_map, ccp4_file_, info['space_group_number'])
+                with open(map_info_file, 'w') as f:
+                    json.dump(info, f, indent=1)
+            with instrument(report, 'calculate_map') as record:
+                record['cached'] = run_cached_stage(cache_, 'calculate_map', calc_map, [pdb_file_, mtz_file_], {'map': ccp4_file_, 'info': map_info_file},
+                                                    extra_=list(map_columns_ or []))
+            with open(map_info_file, 'r') as f:
+                report.info['map'] = json.load(f)
+            # the map depends on the model, so an incremental rerun recalculates the density features of every water
+            report.info['ccp4_file'] = ccp4_file_
+            report.info['input_files']['ccp4_file'] = file_fingerprint(ccp4_file_)
+
+        # score the waters of a site: run the calculations on the site waters and their environment only
+        full_structure, site_waters = structure, None
+        if site_ is not None:
+            from functions.site import site_radius, select_site, write_site_structure, site_results
+            with instrument(report, 'select_site') as record:
+                site_waters, shell_index = select_site(structure, site_.get('ligand'), site_.get('residues'), site_.get('center'), site_.get('radius') or site_radius)
+                pdb_file_ = outdir_ + '/' + pdb_id_ + '_site' + structure.file_extension
+                structure = write_site_structure(full_structure, pdb_file_, shell_index)
+                record.update({'n_site_waters': len(site_waters), 'n_site_atoms': len(shell_index)})
+            report.info['site'] = dict(site_, n_site_waters=len(site_waters), n_site_atoms=len(shell_index), site_file=pdb_file_)
+            print('scoring ' + str(len(site_waters)) + ' waters of the site (' + str(len(shell_index)) + ' of ' + str(len(full_structure)) + ' atoms)...')
+
+        with instrument(report, 'check_inputs'):
+            check_pdb_format_limits(structure, pdb_id_, backends_)
+            # the map is only read here if a native backend reads it anyway (the external programs read the file themselves)
+            if uses_native_density(backends_):
+                check_map_coverage(structure, ccp4_file_, resolution_, backends_)
+        with instrument(report, 'setup') as record:
+            # the renumbered PDB files are only written for external programs, so the setup files depend on the backends
+            record['cached'] = run_cached_stage(cache_, 'setup', lambda: do_setup(structure, pdb_id_, outdir_, backends_), [pdb_file_], setup_files(structure, pdb_id_, outdir_, backends_),
+                                                extra_=['external=' + str(uses_external_programs(backends_))])
+
+        if previous_ is not None:
+            # recalculate the waters that changed since the previous run
+            from functions.incremental import rescore_incrementally
+            if write_parsed_:
+                print('the parsed data files are not written when rescoring incrementally...')
+            df_out = rescore_incrementally(structure, pdb_id_, pdb_file_, mtz_file_, ccp4_file_, outdir_, previous_, n_workers_=n_workers_, workdir_=workdir_, cache_=cache_,
+                                           backends_=backends_, resolution_=resolution_, report_=report)
+        else:
+            # run calculations
+            run_calculations(pdb_file_, pdb_id_, mtz_file_, ccp4_file_, outdir_, n_workers_, workdir_, cache_, backends_, report)
+
+            # parse raw datafiles into per-water features
+            df_out = parse_raw_datafiles(structure, pdb_id_, outdir_, write_parsed_, backends_, ccp4_file_, resolution_, report, n_workers_)
+
+        if site_waters is not None:
+            df_out = site_results(full_structure, structure, shell_index, site_waters, df_out)
+
+        # calculate CB prob and save results
+        df_results = calculate_CB_prob(full_structure, pdb_id_, outdir_, df_out, report, None if site_waters is None else full_structure.water_index()[site_waters],
+                                       dataset_, get_backends(backends_))
+        status = 'done'
+    except Exception as e:
+        error = type(e).__name__ + ': ' + str(e)
+        raise
+    finally:
+        report.save(outdir_ + '/' + pdb_id_ + '_run_report.json', status, error, outdir_ + '/' + pdb_id_ + '_run_report.prom' if openmetrics_ else None)
+        if workspace is not None:
+            workspace.publish(status != 'done')
+    return df_results
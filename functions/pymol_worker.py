@@ -0,0 +1,186 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Long-lived PyMOL processes that add hydrogens to one structure after the other (scripts/add_hydrogens.py -worker),
+# so PyMOL starts once per process instead of once per structure. Each process (e.g., each process of a batch) keeps
+# its own idle workers; configuration.add_hydrogens falls back to running PyMOL once per structure if no worker starts.
+
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+import subprocess
+from functions.configuration import add_hydrogens_script
+from functions.instrumentation import progress
+
+# seconds to wait for a worker to start (PyMOL to load and run the script)
+worker_start_timeout = 60
+# seconds to wait for the result of one job; a worker that takes longer is killed and PyMOL is run once for the structure
+worker_job_timeout = 600
+# printed by the worker when it is ready, and before the result of each job
+ready_marker = 'COLDBREW_READY'
+result_marker = 'COLDBREW_RESULT '
+
+# idle workers of this process; after a fork, the child starts its own workers (see get_pool)
+worker_pool = {'pid': None, 'idle': [], 'available': True}
+worker_pool_lock = threading.Lock()
+
+class PymolWorker:
+    """
+    One PyMOL process running scripts/add_hydrogens.py -worker. Jobs are sent as JSON lines on its stdin; a reader
+    thread collects its output, so a worker that stops or never starts is noticed instead of blocking.
+
+    Outputs:
+        Raises a RuntimeError if PyMOL does not start the worker within worker_start_timeout seconds.
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen('exec $PYMOL_EXE -cq ' + add_hydrogens_script + ' -- -worker', shell=True, text=True, bufsize=1,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.lines = queue.Queue()
+        threading.Thread(target=self.read_output, daemon=True).start()
+        output = []
+        try:
+            while True:
+                line = self.lines.get(timeout=worker_start_timeout)
+                if line is None or line.strip() == ready_marker:
+                    break
+                output.append(line)
+        except queue.Empty:
+            line = None
+        if line is None:
+            self.close()
+            raise RuntimeError('the PyMOL worker did not start' + (': ' + ''.join(output[-5:]).strip() if output else ''))
+
+    def read_output(self):
+        for line in self.process.stdout:
+            self.lines.put(line)
+        self.lines.put(None)
+
+    def add_hydrogens(self, pdb_id_, outdir_, timeout_=worker_job_timeout):
+        """
+        Adds hydrogens to <outdir>/<ID>_renumber.pdb (see scripts/add_hydrogens.py).
+
+        Outputs:
+            Raises a RuntimeError if the worker stops during the job, or kills the worker and raises a RuntimeError if
+            the job does not finish within timeout_ seconds (e.g., PyMOL hangs on the structure).
+
+        Returns:
+            tuple: The result of the job (keys ok, error, cpu_seconds, max_rss_mb, read_bytes, and write_bytes) and the output of PyMOL.
+        """
+        self.process.stdin.write(json.dumps({'id': pdb_id_, 'outdir': outdir_}) + '\n')
+        self.process.stdin.flush()
+        output = []
+        deadline = time.monotonic() + timeout_
+        while True:
+            try:
+                line = self.lines.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                self.process.kill()
+                raise RuntimeError('the PyMOL worker did not finish ' + pdb_id_ + ' within ' + str(timeout_) + ' seconds')
+            if line is None:
+                raise RuntimeError('the PyMOL worker stopped: ' + ''.join(output[-5:]).strip())
+            if line.startswith(result_marker):
+                return json.loads(line[len(result_marker):]), ''.join(output)
+            output.append(line)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+
+def get_pool():
+    """
+    Returns the worker pool of this process. A forked process does not use the workers of its parent, whose pipes it shares.
+    """
+    if worker_pool['pid'] != os.getpid():
+        worker_pool.update(pid=os.getpid(), idle=[], available=True)
+    return worker_pool
+
+def close_workers():
+    """
+    Stops the idle workers of this process (at exit).
+    """
+    with worker_pool_lock:
+        workers, get_pool()['idle'] = get_pool()['idle'], []
+    for worker in workers:
+        worker.close()
+
+atexit.register(close_workers)
+
+def add_hydrogens_with_worker(pdb_id_, outdir_, log_file_, report_=None):
+    """
+    Adds hydrogens to the renumbered structure with an idle worker of this process (a new one if none is idle).
+    Structures run at the same time in one process get different workers, and a worker deletes every object after each
+    job, so jobs do not see each other's structures.
+
+    Args:
+        pdb_id_ (str): Identifier for the PDB file, used for output naming.
+        outdir_ (str): Directory where the renumbered PDB file is stored and the output file will be saved.
+        log_file_ (str): Path of the log file of the job (the output of PyMOL).
+        report_ (RunReport): Report of the run, which records the job in the H_add stage (default: None).
+
+    Returns:
+        bool: True if a worker added the hydrogens; False if no worker could be used or the job failed, so the caller
+        runs PyMOL once for the structure.
+    """
+
+    with worker_pool_lock:
+        pool = get_pool()
+        if not pool['available']:
+            return False
+        worker = pool['idle'].pop() if pool['idle'] else None
+    if worker is None:
+        try:
+            worker = PymolWorker()
+        except Exception as e:
+            # PyMOL cannot run the worker (e.g., an older script or a wrapper that does not pass the arguments on)
+            with worker_pool_lock:
+                get_pool()['available'] = False
+            progress('running PyMOL once per structure (' + str(e) + ')...')
+            return False
+
+    start = time.perf_counter()
+    try:
+        result, output = worker.add_hydrogens(pdb_id_, os.path.abspath(outdir_))
+    except Exception as e:
+        worker.close()
+        progress('the PyMOL worker failed (' + str(e) + '), running PyMOL for ' + pdb_id_ + '...')
+        return False
+    with worker_pool_lock:
+        get_pool()['idle'].append(worker)
+
+    with open(log_file_, 'w') as f:
+        f.write(output)
+    if report_ is not None:
+        report_.add_command('H_add', {
+            'command': 'PyMOL worker ' + str(worker.process.pid) + ': add_hydrogens ' + pdb_id_ + ' ' + outdir_,
+            'returncode': 0 if result['ok'] else 1,
+            'seconds': round(time.perf_counter() - start, 4),
+            'cpu_seconds': result['cpu_seconds'],
+            'max_rss_mb': result['max_rss_mb'],
+            'read_bytes': result['read_bytes'],
+            'write_bytes': result['write_bytes']
+        })
+    if not result['ok']:
+        progress('the PyMOL worker failed for ' + pdb_id_ + ' (' + result['error'] + '), running PyMOL for it...')
+    return result['ok']
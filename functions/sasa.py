@@ -0,0 +1,169 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functions.spatial import CellList
+
+probe_radius = 1.40
+
+# van der Waals radii used by naccess (Chothia, 1976)
+backbone_radii = {'N': 1.65, 'CA': 1.87, 'C': 1.76, 'O': 1.40, 'OXT': 1.40}
+# side-chain carbons with a radius of 1.76 (aromatic, carbonyl, and guanidinium carbons); other side-chain carbons are 1.87
+sp2_side_chain_carbons = {
+    'ARG': ['CZ'],
+    'ASN': ['CG'],
+    'ASP': ['CG'],
+    'GLN': ['CD'],
+    'GLU': ['CD'],
+    'HIS': ['CG', 'CD2', 'CE1'],
+    'PHE': ['CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ'],
+    'TRP': ['CG', 'CD1', 'CD2', 'CE2', 'CE3', 'CZ2', 'CZ3', 'CH2'],
+    'TYR': ['CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ']
+}
+element_radii = {'C': 1.87, 'N': 1.65, 'O': 1.40, 'S': 1.85, 'SE': 1.80, 'P': 1.90}
+default_radius = 1.80
+
+def atom_radii(structure_, index_):
+    """
+    Assigns naccess van der Waals radii to atoms.
+
+    Args:
+        structure_ (Structure): The structure.
+        index_ (numpy.ndarray): Indices of the atoms.
+
+    Returns:
+        numpy.ndarray: Radius of each atom in Angstrom.
+    """
+
+    atom_names = structure_.column('atom_name')[index_]
+    residue_names = structure_.column('residue_name')[index_]
+    elements = structure_.column('element_symbol')[index_]
+    radii = np.array([element_radii.get(element, default_radius) for element in elements])
+
+    is_protein = structure_.column('record_name')[index_] == 'ATOM'
+    for name, radius in backbone_radii.items():
+        radii[is_protein & (atom_names == name)] = radius
+    radii[is_protein & (residue_names == 'LYS') & (atom_names == 'NZ')] = 1.50
+    for residue_name, carbons in sp2_side_chain_carbons.items():
+        radii[is_protein & (residue_names == residue_name) & np.isin(atom_names, carbons)] = 1.76
+    return radii
+
+def sphere_points(n_points_):
+    """
+    Returns points evenly spread on the unit sphere (golden spiral).
+
+    Args:
+        n_points_ (int): Number of points.
+
+    Returns:
+        numpy.ndarray: (n_points, 3) array of unit vectors.
+    """
+
+    k = np.arange(n_points_) + 0.5
+    z = 1 - 2 * k / n_points_
+    r = np.sqrt(1 - z**2)
+    phi = np.pi * (3 - np.sqrt(5)) * k
+    return np.column_stack([r * np.cos(phi), r * np.sin(phi), z])
+
+def get_SASA_environment(structure_):
+    """
+    Selects the atoms that occlude the surface of the waters, as naccess does for the renumbered structure run with -w:
+    protein atoms (first alternate location only, no hydrogens) and all water oxygens. Other HETATM records are left out.
+
+    Args:
+        structure_ (Structure): The structure.
+
+    Returns:
+        numpy.ndarray: Indices of the environment atoms.
+    """
+
+    is_protein = structure_.column('record_name') == 'ATOM'
+    is_first_alt_loc = np.isin(structure_.column('alt_loc'), ['', 'A'])
+    is_hydrogen = np.isin(structure_.column('element_symbol'), ['H', 'D'])
+    index_protein = np.flatnonzero(is_protein & is_first_alt_loc & ~is_hydrogen)
+    return np.union1d(index_protein, structure_.water_index())
+
+def calculate_water_SASA(structure_, n_points_=960, n_workers_=1, chunk_size_=64, waters_=None):
+    """
+    Calculates the solvent-accessible surface area of every water oxygen with the Shrake-Rupley method.
+    Only the waters are scored: test points are placed on the expanded sphere of each water oxygen and checked
+    against the neighboring atoms found with a cell list, in vectorized chunks of waters.
+
+    Args:
+        structure_ (Structure): The structure.
+        n_points_ (int): Number of test points per water (default: 960).
+        n_workers_ (int): Number of threads used for the chunks of waters (default: 1).
+        chunk_size_ (int): Number of waters per chunk (default: 64).
+        waters_ (numpy.ndarray): Positions (in the order of structure_.water_index()) of the waters to score; all
+            waters still occlude (default: None, all waters).
+
+    Returns:
+        numpy.ndarray: SASA of each water (in the order of structure_.water_index(), or of waters_) in square Angstrom.
+    """
+
+    wat_index = structure_.water_index()
+    env_index = get_SASA_environment(structure_)
+    env_xyz = structure_.coords(env_index)
+    env_radii = atom_radii(structure_, env_index) + probe_radius
+    if waters_ is not None:
+        wat_index = wat_index[waters_]
+    wat_xyz = structure_.coords(wat_index)
+    wat_radius = element_radii['O'] + probe_radius
+    # position of each water in the environment (to skip the water itself)
+    wat_env_pos = np.searchsorted(env_index, wat_index)
+
+    cell_list = CellList(env_xyz, wat_radius + env_radii.max())
+    unit_points = sphere_points(n_points_)
+
+    def calc_chunk(start):
+        stop = min(start + chunk_size_, len(wat_index))
+        pair_wat, pair_env, dist = cell_list.query_pairs(wat_xyz[start:stop], wat_radius + env_radii.max())
+        keep = (dist < wat_radius + env_radii[pair_env]) & (pair_env != wat_env_pos[start:stop][pair_wat])
+        pair_wat, pair_env = pair_wat[keep], pair_env[keep]
+
+        # test points of each water (w + R*u) are buried if closer to a neighbor (e) than its expanded radius:
+        # |w + R*u - e|^2 = |w - e|^2 + R^2 + 2*R*u.(w - e)
+        buried = np.zeros((stop - start, n_points_), dtype=bool)
+        if len(pair_wat):
+            diff = wat_xyz[start:stop][pair_wat] - env_xyz[pair_env]
+            d2 = (diff**2).sum(axis=1)[:, None] + wat_radius**2 + 2 * wat_radius * (diff @ unit_points.T)
+            buried_by_pair = d2 < (env_radii[pair_env]**2)[:, None]
+            wats_with_pairs, first_pair = np.unique(pair_wat, return_index=True)
+            buried[wats_with_pairs] = np.logical_or.reduceat(buried_by_pair, first_pair, axis=0)
+        return (1 - buried.mean(axis=1)) * 4 * np.pi * wat_radius**2
+
+    starts = range(0, len(wat_index), chunk_size_)
+    if n_workers_ > 1:
+        with ThreadPoolExecutor(max_workers=n_workers_) as executor:
+            chunks = list(executor.map(calc_chunk, starts))
+    else:
+        chunks = [calc_chunk(start) for start in starts]
+    return np.concatenate(chunks) if chunks else np.zeros(0)
+
+def round_like_naccess(values_):
+    """
+    Rounds SASA values the way they are read from the naccess .asa file, where the value ('%8.3f') is read from the
+    6-character occupancy columns of the PDB format (i.e., truncated to one decimal for values below 1000).
+
+    Args:
+        values_ (iterable): SASA values.
+
+    Returns:
+        list: The values as read from an .asa file.
+    """
+    return [float(('%8.3f' % value)[:6]) for value in values_]
@@ -0,0 +1,116 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def default_n_workers():
+    """
+    Returns the default number of workers used to run independent stages.
+
+    Args:
+        None
+
+    Returns:
+        int: Number of available CPUs, capped at 4 (the number of external programs run per structure).
+    """
+    return max(1, min(4, os.cpu_count() or 1))
+
+def check_stage_graph(stages_):
+    """
+    Checks that every dependency in a stage graph is defined and that the graph has no cycles.
+
+    Args:
+        stages_ (dict): A dictionary mapping stage names to (function, list of dependency names) tuples.
+
+    Outputs:
+        Raises a ValueError if a dependency is unknown or if the stages depend on each other in a cycle.
+
+    Returns:
+        list: The stage names in an order where each stage comes after its dependencies.
+    """
+
+    for name, (func, deps) in stages_.items():
+        for dep in deps:
+            if dep not in stages_:
+                raise ValueError('Stage ' + name + ' depends on unknown stage ' + dep + '.')
+
+    order = []
+    remaining = dict( (name, set(deps)) for name, (func, deps) in stages_.items() )
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError('Stages ' + ', '.join(sorted(remaining)) + ' have cyclic dependencies.')
+        for name in ready:
+            order.append(name)
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return order
+
+def run_stage_graph(stages_, n_workers_=None):
+    """
+    Runs a set of stages as a dependency graph on a bounded pool of worker threads.
+    A stage is launched as soon as all of its dependencies have finished, so independent stages
+    (e.g., the external programs for each metric) run at the same time.
+
+    Args:
+        stages_ (dict): A dictionary mapping stage names to (function, list of dependency names) tuples.
+            Each function is called without arguments.
+        n_workers_ (int): Maximum number of stages run at the same time (default: default_n_workers()).
+
+    Outputs:
+        Raises the first error of a failed stage after the stages that are already running have finished.
+        Stages that have not been started yet are skipped.
+
+    Returns:
+        dict: A dictionary mapping stage names to the values returned by their functions.
+    """
+
+    check_stage_graph(stages_)
+    if n_workers_ is None:
+        n_workers_ = default_n_workers()
+
+    results = {}
+    pending = dict( (name, set(deps)) for name, (func, deps) in stages_.items() )
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max(1, n_workers_)) as executor:
+        while pending or running:
+            # launch every stage whose dependencies are done
+            if error is None:
+                for name in [name for name, deps in pending.items() if deps.issubset(results)]:
+                    # run the stage in a copy of the caller's context (e.g., silenced progress messages)
+                    running[executor.submit(contextvars.copy_context().run, stages_[name][0])] = name
+                    del pending[name]
+            if not running:
+                break
+
+            # wait for the next stage to finish
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    if error is None:
+                        error = future.exception()
+                else:
+                    results[name] = future.result()
+
+    if error is not None:
+        raise error
+    return results
@@ -0,0 +1,298 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import time
+import queue
+import socket
+import threading
+import socketserver
+import http.server
+import numpy as np
+import pandas as pd
+from concurrent.futures import Future, ProcessPoolExecutor
+from functions.data_analysis import load_model, predict_CB_prob, feature_cols
+from functions.batch import run_manifest_entry
+
+class MicroBatcher:
+    """
+    Collects the feature batches of concurrent requests and scores them with one call of the model.
+    A thread takes the first waiting batch, waits up to max_wait seconds for more (up to max_rows waters in total),
+    and then scores them together. The model scores each water independently, so the results are the same as
+    scoring each batch alone.
+
+    Attributes:
+        max_rows (int): Maximum number of waters scored in one call.
+        max_wait (float): Time (seconds) to wait for more batches after the first one.
+    """
+
+    def __init__(self, max_rows_=65536, max_wait_=0.005):
+        self.max_rows = max_rows_
+        self.max_wait = max_wait_
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, df_features_):
+        """
+        Queues the features of a batch of waters.
+
+        Args:
+            df_features_ (pd.DataFrame): Features of the waters (see data_analysis.feature_cols).
+
+        Returns:
+            concurrent.futures.Future: The ColdBrew probabilities of the waters (numpy.ndarray).
+        """
+
+        future = Future()
+        self._queue.put((df_features_, future))
+        return future
+
+    def close(self):
+        """
+        Stops the thread after the queued batches are scored.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            n_rows = len(item[0].index)
+            deadline = time.monotonic() + self.max_wait
+            stop = False
+            while n_rows < self.max_rows:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+                n_rows += len(item[0].index)
+
+            try:
+                probabilities = predict_CB_prob(pd.concat([df for df, future in batch], ignore_index=True))
+                splits = np.cumsum([len(df.index) for df, future in batch])[:-1]
+                for (df, future), result in zip(batch, np.split(probabilities, splits)):
+                    future.set_result(result)
+            except Exception as e:
+                for df, future in batch:
+                    future.set_exception(e)
+            if stop:
+                return
+
+class LocalHTTPServer(http.server.ThreadingHTTPServer):
+    """
+    HTTP server on a TCP port (one thread per connection), with a backlog for many concurrent clients.
+    """
+
+    request_queue_size = 128
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    HTTP server on a Unix socket (one thread per connection).
+    """
+
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+    request_queue_size = 128
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+class ColdBrewRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Requests of the scoring service (JSON in and out):
+    - GET /health: status of the service.
+    - POST /predict: {"features": [{"RSCC": ..., "B_norm": ..., "SASA": ..., "HB": ..., "EDIA": ...}, ...]}
+      returns {"probabilities": [...]} (micro-batched with the other requests).
+    - POST /score: {"id": ..., "pdb": ..., "mtz": ..., "ccp4": ... (optional), "map_columns": [...] (optional), "outdir": ... (optional),
+      "backends": {...} (optional)} runs the whole pipeline for the structure and returns the summary of the run with the
+      per-water results. Without "ccp4", the map is calculated from the MTZ file. The ID must be a file name, and
+      "outdir" a directory inside the output directory of the service (relative to it), or the request fails with 400.
+    """
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format_, *args_):
+        print(self.address_string() + ' ' + format_ % args_)
+
+    def send_json(self, status_, body_):
+        data = json.dumps(body_).encode()
+        self.send_response(status_)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_json(404, {'error': 'Unknown path ' + self.path + '.'})
+        self.send_json(200, {'status': 'ok', 'features': feature_cols, 'jobs_running': self.server.service.jobs_running})
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path == '/predict':
+                response = self.server.service.predict(request)
+            elif self.path == '/score':
+                response = self.server.service.score(request)
+            else:
+                return self.send_json(404, {'error': 'Unknown path ' + self.path + '.'})
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {'error': type(e).__name__ + ': ' + str(e)})
+        except Exception as e:
+            return self.send_json(500, {'error': type(e).__name__ + ': ' + str(e)})
+        self.send_json(200, response)
+
+class ScoringService:
+    """
+    Long-lived ColdBrew scoring service. The model is loaded once; feature batches are scored in this process by a
+    MicroBatcher, and whole-structure jobs run on a pool of processes that stay alive between jobs (with their imports
+    and model loaded).
+
+    Attributes:
+        outdir (str): Default output directory of structure jobs (results are saved in <outdir>/<ID>).
+        backends (dict): Default backend of each feature for structure jobs (see configuration.get_backends).
+        jobs_running (int): Number of structure jobs running.
+    """
+
+    def __init__(self, outdir_, n_procs_=1, n_workers_=None, cache_=None, backends_=None, max_rows_=65536, max_wait_=0.005):
+        self.outdir = os.path.abspath(outdir_)
+        self.backends = backends_
+        self.jobs_running = 0
+        self._n_workers = n_workers_
+        self._cache = cache_
+        self._lock = threading.Lock()
+        load_model()
+        self._batcher = MicroBatcher(max_rows_, max_wait_)
+        self._pool = ProcessPoolExecutor(max_workers=max(1, n_procs_))
+
+    def predict(self, request_):
+        """
+        Scores a batch of waters from their features.
+
+        Args:
+            request_ (dict): {"features": list of dicts with the features of each water}.
+
+        Outputs:
+            Raises a KeyError if a feature is missing and a ValueError if a value is not a number.
+
+        Returns:
+            dict: {"probabilities": ColdBrew probability of each water}.
+        """
+
+        df_features = pd.DataFrame(request_['features'], columns=feature_cols)
+        if df_features.isnull().values.any():
+            raise KeyError('Every water needs the features ' + ', '.join(feature_cols) + '.')
+        df_features = df_features.astype(float)
+        return {'probabilities': self._batcher.submit(df_features).result().tolist()}
+
+    def score(self, request_):
+        """
+        Runs the pipeline for one structure on the process pool (see batch.run_manifest_entry).
+
+        Args:
+            request_ (dict): {"id", "pdb", "mtz", and optionally "ccp4", "map_columns", "outdir", "backends", "write_parsed"}.
+
+        Outputs:
+            Raises a ValueError if the ID is not a plain file name, or the output directory is not inside the output
+            directory of the service (a relative one is taken relative to it).
+
+        Returns:
+            dict: Summary of the run (id, status, error, seconds, outdir) and the per-water results (if done).
+        """
+
+        entry = dict((key, str(request_[key])) for key in ['pdb', 'mtz'])
+        entry['ccp4'] = str(request_['ccp4']) if request_.get('ccp4') else None
+        entry['id'] = str(request_.get('id') or os.path.splitext(os.path.basename(entry['pdb']))[0])
+        # the ID names the result directory and files, so a client cannot write outside the output directory
+        if entry['id'] in ['', '.', '..'] or any(char in entry['id'] for char in ['/', '\\', '\0']):
+            raise ValueError('Invalid ID ' + repr(entry['id']) + ': the ID must be a file name without path separators.')
+        outdir = os.path.realpath(os.path.join(self.outdir, str(request_.get('outdir', self.outdir))))
+        if os.path.commonpath([outdir, os.path.realpath(self.outdir)]) != os.path.realpath(self.outdir):
+            raise ValueError('Invalid outdir ' + repr(request_['outdir']) + ': results are written inside ' + self.outdir + '.')
+        os.makedirs(outdir, exist_ok=True)
+        backends = dict(self.backends or {}, **request_.get('backends', {}))
+
+        with self._lock:
+            self.jobs_running += 1
+        try:
+            summary = self._pool.submit(run_manifest_entry, entry, outdir, n_workers_=self._n_workers, write_parsed_=bool(request_.get('write_parsed', False)), cache_=self._cache,
+                                       backends_=backends, map_columns_=request_.get('map_columns')).result()
+        finally:
+            with self._lock:
+                self.jobs_running -= 1
+        summary['outdir'] = os.path.join(outdir, entry['id'])
+        if summary['status'] == 'done':
+            df_results = pd.read_csv(os.path.join(summary['outdir'], entry['id'] + '_ColdBrew_results.csv'), index_col=0)
+            summary['results'] = df_results.to_dict('records')
+        return summary
+
+    def close(self):
+        """
+        Stops the micro-batcher and the process pool.
+        """
+        self._batcher.close()
+        self._pool.shutdown()
+
+def serve(outdir_, host_='127.0.0.1', port_=8765, socket_file_=None, n_procs_=1, n_workers_=None, cache_=None, backends_=None):
+    """
+    Runs the ColdBrew scoring service until it is interrupted.
+
+    Args:
+        outdir_ (str): Default output directory of structure jobs.
+        host_ (str): Host of the HTTP server (default: 127.0.0.1, local requests only).
+        port_ (int): Port of the HTTP server (default: 8765).
+        socket_file_ (str): Path of a Unix socket to serve on instead of a port (default: None).
+        n_procs_ (int): Number of structure jobs run at the same time (default: 1).
+        n_workers_ (int): Maximum number of calculations run at the same time for each structure.
+        cache_ (StageCache): Cache of stage outputs shared by all jobs (default: None).
+        backends_ (dict): Default backend of each feature (see configuration.get_backends; default: external programs).
+
+    Returns:
+        None
+    """
+
+    service = ScoringService(outdir_, n_procs_, n_workers_, cache_, backends_)
+    if socket_file_ is not None:
+        if os.path.exists(socket_file_):
+            os.remove(socket_file_)
+        server = UnixHTTPServer(socket_file_, ColdBrewRequestHandler)
+        print('serving ColdBrew on ' + socket_file_ + '...')
+    else:
+        server = LocalHTTPServer((host_, port_), ColdBrewRequestHandler)
+        print('serving ColdBrew on http://' + host_ + ':' + str(server.server_port) + '...')
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if socket_file_ is not None and os.path.exists(socket_file_):
+            os.remove(socket_file_)
@@ -0,0 +1,156 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import re
+import numpy as np
+from functions.spatial import CellList
+from functions.structure import Structure, read_structure, get_water_frame
+from functions.configuration import environment_cutoff
+from functions.data_parsing import read_in_B_norm
+
+# waters within this distance of the site (ligand atoms, residue atoms, or center) are scored (Angstrom)
+site_radius = 6.0
+
+def parse_residue(residue_):
+    """
+    Parses a residue of a site, 'A:45' (chain A, residue 45), 'A:45B' (with insertion code B), or '45' (any chain).
+
+    Returns:
+        tuple: Chain (None for any chain), residue number, and insertion code (None for any).
+    """
+    match = re.fullmatch(r'(?:(\S+):)?(-?\d+)([A-Za-z]?)', residue_.strip())
+    if match is None:
+        raise ValueError('Cannot read the residue ' + residue_ + ' (expected CHAIN:NUMBER, e.g., A:45).')
+    return match.group(1), int(match.group(2)), match.group(3) or None
+
+def residue_groups(structure_):
+    """
+    Returns the residue of each atom as a number, counting the residues in file order (a residue is a run of atoms with
+    the same chain, residue number, insertion code, and residue name).
+    """
+    keys = [structure_.column(name) for name in ['chain_id', 'residue_number', 'insertion', 'residue_name']]
+    new_residue = np.zeros(len(structure_), dtype=bool)
+    new_residue[:1] = True
+    for key in keys:
+        new_residue[1:] |= key[1:] != key[:-1]
+    return np.cumsum(new_residue) - 1
+
+def select_site(structure_, ligand_=None, residues_=None, center_=None, radius_=site_radius, cutoff_=environment_cutoff):
+    """
+    Selects the waters of a site and the atoms around them that their features depend on.
+    The site is given by ligands (residue names), residues, and/or a center; its waters are the waters within radius_
+    of any atom of the ligands or residues, or of the center. The environment is every residue with an atom within
+    cutoff_ of a site water (whole residues, so that hydrogens are placed as in the whole structure).
+
+    Args:
+        structure_ (Structure): The structure.
+        ligand_ (list): Residue names of the ligands (default: None).
+        residues_ (list): Residues, e.g., ['A:45', 'A:46'] (see parse_residue; default: None).
+        center_ (list): x, y, and z coordinates of the center (default: None).
+        radius_ (float): Distance of the site waters from the site (Angstrom; default: site_radius).
+        cutoff_ (float): Distance of the environment from the site waters (Angstrom; default: configuration.environment_cutoff).
+
+    Outputs:
+        Raises a ValueError if no site is given, if a ligand or residue is not in the structure, or if the site has no waters.
+
+    Returns:
+        tuple: Positions of the site waters in structure_.water_index() (so their renumbered water IDs are the
+        positions + 1), and the indices of the atoms of the site structure (the site waters and their environment) in file order.
+    """
+
+    if not ligand_ and not residues_ and center_ is None:
+        raise ValueError('No site given: give a ligand, residues, or a center.')
+
+    # points of the site
+    site_mask = np.zeros(len(structure_), dtype=bool)
+    for ligand in ligand_ or []:
+        ligand_mask = structure_.column('residue_name') == ligand
+        if not ligand_mask.any():
+            raise ValueError('The ligand ' + ligand + ' is not in the structure.')
+        site_mask |= ligand_mask
+    for residue in residues_ or []:
+        chain, number, insertion = parse_residue(residue)
+        residue_mask = structure_.column('residue_number') == number
+        if chain is not None:
+            residue_mask &= structure_.column('chain_id') == chain
+        if insertion is not None:
+            residue_mask &= structure_.column('insertion') == insertion
+        if not residue_mask.any():
+            raise ValueError('The residue ' + residue + ' is not in the structure.')
+        site_mask |= residue_mask
+    site_xyz = structure_.coords(np.flatnonzero(site_mask))
+    if center_ is not None:
+        site_xyz = np.vstack([site_xyz, np.asarray(center_, dtype=float).reshape(1, 3)])
+
+    # waters near the site
+    wat_index = structure_.water_index()
+    site_waters = np.flatnonzero(CellList(site_xyz, radius_).count_within(structure_.coords(wat_index), radius_) > 0)
+    if len(site_waters) == 0:
+        raise ValueError('No waters within ' + str(radius_) + ' A of the site.')
+
+    # whole residues near the site waters
+    near = CellList(structure_.coords(wat_index[site_waters]), cutoff_).count_within(structure_.coords(), cutoff_) > 0
+    groups = residue_groups(structure_)
+    shell_index = np.flatnonzero(np.isin(groups, np.unique(groups[near])))
+
+    return site_waters, shell_index
+
+def write_site_structure(structure_, site_file_, shell_index_):
+    """
+    Writes the atoms of a site (see select_site) with the header of the structure (e.g., CRYST1), so the external
+    programs run on the site alone. CONECT records are left out, as they may name atoms outside the site.
+
+    Args:
+        structure_ (Structure): The structure.
+        site_file_ (str): Path of the site structure (PDB, or mmCIF for mmCIF input).
+        shell_index_ (numpy.ndarray): Indices of the atoms of the site.
+
+    Returns:
+        Structure: The site structure, read back from the file.
+    """
+
+    other_lines = [(idx, text) for idx, text in structure_.other_lines if not text.startswith(b'CONECT')]
+    Structure(structure_._lines, structure_.line_idx, other_lines, structure_.atom_site).write(site_file_, shell_index_)
+    return read_structure(site_file_)
+
+def site_results(structure_, site_structure_, shell_index_, site_waters_, df_site_):
+    """
+    Takes the features of the site waters from the features of the site structure (see data_parsing.parse_raw_datafiles)
+    and gives them the renumbered water IDs of the whole structure. B_norm is normalized by the B-factors of all
+    protein atoms, so it is recalculated from the whole structure.
+
+    Args:
+        structure_ (Structure): The whole structure.
+        site_structure_ (Structure): The site structure (see write_site_structure).
+        shell_index_ (numpy.ndarray): Indices of the atoms of the site structure in the whole structure.
+        site_waters_ (numpy.ndarray): Positions of the site waters in structure_.water_index().
+        df_site_ (pandas.DataFrame): Features of the waters of the site structure.
+
+    Returns:
+        pandas.DataFrame: Features of the site waters, in the order of the whole structure.
+    """
+
+    # the waters of the site structure are the waters of the whole structure in the site, in the same order
+    wat_index = structure_.water_index()
+    site_wat_index = shell_index_[site_structure_.water_index()]
+    local_waters = np.searchsorted(site_wat_index, wat_index[site_waters_])
+    assert np.array_equal(site_wat_index[local_waters], wat_index[site_waters_])
+
+    df_out = df_site_.iloc[local_waters].reset_index(drop=True)
+    df_out['wat_ID'] = site_waters_ + 1
+    df_out['B_norm'] = read_in_B_norm(structure_, get_water_frame(structure_)).values[site_waters_]
+    return df_out
@@ -0,0 +1,117 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import numpy as np
+
+class CellList:
+    """
+    Cell-list spatial index of atom coordinates for fixed-cutoff neighbor searches.
+    Atoms are binned into cubic cells with the size of the cutoff, so all neighbors of a point are in the 27 cells around it.
+
+    Attributes:
+        xyz (numpy.ndarray): (n, 3) coordinates of the indexed atoms.
+        cell_size (float): Edge length of the cells (the largest cutoff that can be searched).
+    """
+
+    def __init__(self, xyz_, cell_size_):
+        self.xyz = np.asarray(xyz_, dtype=float).reshape(-1, 3)
+        self.cell_size = float(cell_size_)
+        self._origin = self.xyz.min(axis=0) if len(self.xyz) else np.zeros(3)
+        keys = self._cell_keys(self._cells(self.xyz))
+        self._order = np.argsort(keys, kind='stable')
+        self._keys, self._starts, counts = np.unique(keys[self._order], return_index=True, return_counts=True)
+        self._ends = self._starts + counts
+
+    def _cells(self, xyz_):
+        return np.floor((xyz_ - self._origin) / self.cell_size).astype(np.int64)
+
+    @staticmethod
+    def _cell_keys(cells_):
+        # cells can be negative for query points outside the indexed box
+        cells = cells_ + (1 << 20)
+        return (cells[:, 0] << 42) | (cells[:, 1] << 21) | cells[:, 2]
+
+    def query_pairs(self, query_xyz_, cutoff_, sort_=True):
+        """
+        Finds all (query point, atom) pairs closer than a cutoff.
+
+        Args:
+            query_xyz_ (numpy.ndarray): (m, 3) coordinates of the query points.
+            cutoff_ (float): Distance cutoff (at most the cell size).
+            sort_ (bool): Sort the pairs by query index and atom index (default: True).
+
+        Outputs:
+            Raises a ValueError if the cutoff is larger than the cell size.
+
+        Returns:
+            tuple: (query indices, atom indices, distances) as arrays, sorted by query index if sort_ is True.
+        """
+
+        if cutoff_ > self.cell_size:
+            raise ValueError('Cutoff ' + str(cutoff_) + ' is larger than the cell size ' + str(self.cell_size) + '.')
+        query_xyz_ = np.asarray(query_xyz_, dtype=float).reshape(-1, 3)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0))
+        if len(query_xyz_) == 0 or len(self.xyz) == 0:
+            return empty
+
+        query_cells = self._cells(query_xyz_)
+        list_query = []
+        list_atom = []
+        for offset in np.array(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1])).T.reshape(-1, 3):
+            keys = self._cell_keys(query_cells + offset)
+            pos = np.searchsorted(self._keys, keys)
+            pos_clip = np.minimum(pos, len(self._keys) - 1)
+            found = self._keys[pos_clip] == keys
+            query_idx = np.flatnonzero(found)
+            starts = self._starts[pos_clip[found]]
+            counts = self._ends[pos_clip[found]] - starts
+
+            # expand each (query, cell) match into one pair per atom of the cell
+            n_pairs = counts.sum()
+            if n_pairs == 0:
+                continue
+            pair_query = np.repeat(query_idx, counts)
+            pair_rank = np.arange(n_pairs) - np.repeat(np.cumsum(counts) - counts, counts)
+            list_query.append(pair_query)
+            list_atom.append(self._order[np.repeat(starts, counts) + pair_rank])
+
+        if not list_query:
+            return empty
+        pair_query = np.concatenate(list_query)
+        pair_atom = np.concatenate(list_atom)
+        dist = np.linalg.norm(query_xyz_[pair_query] - self.xyz[pair_atom], axis=1)
+        keep = dist < cutoff_
+        pair_query, pair_atom, dist = pair_query[keep], pair_atom[keep], dist[keep]
+        if not sort_:
+            return pair_query, pair_atom, dist
+        order = np.lexsort((pair_atom, pair_query))
+        return pair_query[order], pair_atom[order], dist[order]
+
+    def count_within(self, query_xyz_, cutoff_):
+        """
+        Counts the atoms closer than a cutoff to each query point.
+
+        Args:
+            query_xyz_ (numpy.ndarray): (m, 3) coordinates of the query points.
+            cutoff_ (float): Distance cutoff (at most the cell size).
+
+        Returns:
+            numpy.ndarray: Number of atoms within the cutoff of each query point.
+        """
+
+        pair_query, pair_atom, dist = self.query_pairs(query_xyz_, cutoff_, sort_=False)
+        return np.bincount(pair_query, minlength=len(np.asarray(query_xyz_).reshape(-1, 3)))
@@ -0,0 +1,293 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import io
+import csv
+import gzip
+import time
+import sqlite3
+
+# columns of the results CSV (see data_analysis.calculate_CB_prob), in file order
+result_columns = ['wat_ID', 'insertion', 'wat_ID_renumbered', 'chain', 'RSCC', 'B_norm', 'SASA', 'EDIA', 'HB', 'ColdBrew_probability']
+# names accepted for each column when ingesting (lower case); the files of one structure may have no ID column
+column_aliases = {
+    'pdb_id': ['pdb_id', 'pdb', 'pdbid', 'pdb_code', 'entry', 'entry_id'],
+    'wat_ID': ['wat_id', 'water_id', 'residue_number', 'resnum'],
+    'insertion': ['insertion', 'insertion_code', 'icode', 'ins_code'],
+    'wat_ID_renumbered': ['wat_id_renumbered'],
+    'chain': ['chain', 'chain_id'],
+    'RSCC': ['rscc'],
+    'B_norm': ['b_norm', 'bnorm'],
+    'SASA': ['sasa'],
+    'EDIA': ['edia'],
+    'HB': ['hb'],
+    'ColdBrew_probability': ['coldbrew_probability', 'coldbrew_prob', 'cb_prob', 'probability']
+}
+results_suffix = '_ColdBrew_results.csv'
+
+store_schema = '''
+CREATE TABLE IF NOT EXISTS entries (
+    pdb_id TEXT PRIMARY KEY,
+    n_waters INTEGER NOT NULL,
+    source TEXT,
+    added REAL
+);
+CREATE TABLE IF NOT EXISTS waters (
+    pdb_id TEXT NOT NULL,
+    wat_ID_renumbered INTEGER NOT NULL,
+    wat_ID INTEGER,
+    insertion TEXT,
+    chain TEXT,
+    RSCC REAL,
+    B_norm REAL,
+    SASA REAL,
+    EDIA REAL,
+    HB REAL,
+    ColdBrew_probability REAL,
+    PRIMARY KEY (pdb_id, wat_ID_renumbered)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS waters_chain ON waters (pdb_id, chain, wat_ID);
+'''
+
+def normalize_pdb_id(pdb_id_):
+    """
+    Returns the key of a structure in the store (PDB IDs are not case-sensitive).
+    """
+    return str(pdb_id_).strip().upper()
+
+def open_text(path_):
+    """
+    Opens a text file for reading, decompressing .gz files.
+    """
+    if path_.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path_, 'rb'), newline='')
+    return open(path_, 'r', newline='')
+
+def find_result_files(paths_):
+    """
+    Lists the results files to ingest: the given files, and the results CSV files (<ID>_ColdBrew_results.csv) in the
+    given directories and their subdirectories (e.g., the output directory of a batch).
+
+    Args:
+        paths_ (list): Paths of files or directories.
+
+    Returns:
+        list: Paths of the files, sorted within each directory.
+    """
+
+    files = []
+    for path in paths_:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in sorted(os.walk(path)):
+                dirnames.sort()
+                files += [os.path.join(dirpath, name) for name in sorted(filenames) if name.endswith(results_suffix)]
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise FileNotFoundError(path)
+    return files
+
+class ResultStore:
+    """
+    Local SQLite store of ColdBrew results, keyed by PDB ID (and by chain and water ID within a structure), e.g., the
+    precomputed probabilities of the PDB or the results of earlier runs. A structure is stored as a whole: ingesting it
+    again replaces its waters.
+
+    Attributes:
+        db_file (str): Path of the SQLite database.
+    """
+
+    def __init__(self, db_file_):
+        self.db_file = db_file_
+        self._connection = sqlite3.connect(db_file_, timeout=60)
+        # one transaction per structure; WAL keeps the many small commits of an ingest fast and lets lookups read meanwhile
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(store_schema)
+        # stores created before the insertion code was kept
+        if 'insertion' not in [row[1] for row in self._connection.execute('PRAGMA table_info(waters)')]:
+            self._connection.execute('ALTER TABLE waters ADD COLUMN insertion TEXT')
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args_):
+        self.close()
+
+    def has_entry(self, pdb_id_):
+        """
+        Checks whether the results of a structure are in the store.
+        """
+        return self._connection.execute('SELECT 1 FROM entries WHERE pdb_id = ?', (normalize_pdb_id(pdb_id_),)).fetchone() is not None
+
+    def entries(self):
+        """
+        Returns the stored structures as a list of (PDB ID, number of waters, source file).
+        """
+        return self._connection.execute('SELECT pdb_id, n_waters, source FROM entries ORDER BY pdb_id').fetchall()
+
+    def query(self, pdb_id_, chain_=None, wat_ID_=None):
+        """
+        Returns the stored waters of a structure.
+
+        Args:
+            pdb_id_ (str): PDB ID of the structure.
+            chain_ (str): Only the waters of this chain (default: all chains).
+            wat_ID_ (int): Only the water with this residue number (default: all waters).
+
+        Returns:
+            list: One dictionary per water with the columns of the results CSV (see result_columns), in renumbered order.
+        """
+
+        sql = 'SELECT ' + ', '.join(result_columns) + ' FROM waters WHERE pdb_id = ?'
+        params = [normalize_pdb_id(pdb_id_)]
+        if chain_ is not None:
+            sql += ' AND chain = ?'
+            params.append(chain_)
+        if wat_ID_ is not None:
+            sql += ' AND wat_ID = ?'
+            params.append(int(wat_ID_))
+        rows = self._connection.execute(sql + ' ORDER BY wat_ID_renumbered', params).fetchall()
+        return [dict(zip(result_columns, row)) for row in rows]
+
+    def write_results_csv(self, pdb_id_, results_file_):
+        """
+        Writes the stored waters of a structure as a results CSV (the format of data_analysis.calculate_CB_prob).
+
+        Args:
+            pdb_id_ (str): PDB ID of the structure.
+            results_file_ (str): Path of the CSV file.
+
+        Returns:
+            int: Number of waters written.
+        """
+
+        rows = self.query(pdb_id_)
+        with open(results_file_, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow([''] + result_columns)
+            for i, row in enumerate(rows):
+                writer.writerow([i] + ['' if row[column] is None else format_value(row[column]) for column in result_columns])
+        return len(rows)
+
+    def add_rows(self, pdb_id_, rows_, source_=None, replace_=True):
+        """
+        Stores waters of one structure.
+
+        Args:
+            pdb_id_ (str): PDB ID of the structure.
+            rows_ (list): One dictionary per water with the columns of result_columns (missing columns are stored as NULL;
+                without wat_ID_renumbered, the waters are numbered in the order given, after the stored waters).
+            source_ (str): File the results come from (default: None).
+            replace_ (bool): Replace the stored waters of the structure; otherwise add to them (default: True).
+
+        Returns:
+            int: Number of waters stored.
+        """
+
+        key = normalize_pdb_id(pdb_id_)
+        with self._connection:
+            if replace_:
+                self._connection.execute('DELETE FROM waters WHERE pdb_id = ?', (key,))
+            n_stored = self._connection.execute('SELECT COUNT(*) FROM waters WHERE pdb_id = ?', (key,)).fetchone()[0]
+            values = []
+            for i, row in enumerate(rows_):
+                row = dict(row)
+                if row.get('wat_ID_renumbered') in (None, ''):
+                    row['wat_ID_renumbered'] = n_stored + i + 1
+                values.append([key] + [parse_value(column, row.get(column)) for column in result_columns])
+            self._connection.executemany('INSERT INTO waters (pdb_id, ' + ', '.join(result_columns) + ') VALUES (' + ', '.join(['?'] * (len(result_columns) + 1)) + ')', values)
+            self._connection.execute('INSERT OR REPLACE INTO entries (pdb_id, n_waters, source, added) VALUES (?, ?, ?, ?)', (key, n_stored + len(values), source_, time.time()))
+        return len(values)
+
+    def ingest_file(self, results_file_, pdb_id_=None):
+        """
+        Stores the results of a CSV/TSV file (optionally gzipped): a results CSV of one structure (<ID>_ColdBrew_results.csv,
+        the ID is taken from the file name), or a table of many structures with a PDB ID column (e.g., the precomputed
+        probabilities of the PDB). The file is read row by row, so tables larger than memory can be ingested.
+
+        Args:
+            results_file_ (str): Path of the file.
+            pdb_id_ (str): PDB ID of the waters of a file without a PDB ID column (default: from the file name).
+
+        Outputs:
+            Raises a ValueError if the file has no water ID, chain, or ColdBrew probability column, or neither a PDB ID
+            column nor a PDB ID.
+
+        Returns:
+            dict: Number of waters stored for each PDB ID.
+        """
+
+        with open_text(results_file_) as f:
+            first_line = f.readline()
+            reader = csv.reader(f, delimiter='\t' if '\t' in first_line else ',')
+            header = next(csv.reader([first_line], delimiter='\t' if '\t' in first_line else ','))
+            positions = {}
+            for column, aliases in column_aliases.items():
+                matches = [i for i, name in enumerate(header) if name.strip().lower() in aliases]
+                if matches:
+                    positions[column] = matches[0]
+            missing = [column for column in ['wat_ID', 'chain', 'ColdBrew_probability'] if column not in positions]
+            if missing:
+                raise ValueError(results_file_ + ' has no ' + ', '.join(missing) + ' column.')
+            if 'pdb_id' not in positions and pdb_id_ is None:
+                name = os.path.basename(results_file_)
+                if not name.endswith(results_suffix):
+                    raise ValueError(results_file_ + ' has no PDB ID column; name it <ID>' + results_suffix + ' or give the PDB ID.')
+                pdb_id_ = name[:-len(results_suffix)]
+
+            counts = {}
+            current_id, rows = None, []
+            for line in reader:
+                if not line:
+                    continue
+                row = dict((column, line[i]) for column, i in positions.items())
+                row_id = row.pop('pdb_id', pdb_id_)
+                # the waters of a structure are stored together (a structure split over the file is added to, not replaced)
+                if row_id != current_id or len(rows) >= 100000:
+                    if rows:
+                        counts[current_id] = counts.get(current_id, 0) + self.add_rows(current_id, rows, results_file_, current_id not in counts)
+                    current_id, rows = row_id, []
+                rows.append(row)
+            if rows:
+                counts[current_id] = counts.get(current_id, 0) + self.add_rows(current_id, rows, results_file_, current_id not in counts)
+        return counts
+
+def parse_value(column_, value_):
+    """
+    Converts a value of a results file to the type of its column (missing values, 'M', and 'nan' are None).
+    """
+    if column_ == 'insertion':
+        # a letter, so 'M' is an insertion code rather than a missing value
+        return str(value_).strip() or None if value_ is not None else None
+    if value_ is None or str(value_).strip() in ('', 'M', 'nan', 'NaN'):
+        return None
+    if column_ == 'chain':
+        return str(value_).strip()
+    if column_ in ('wat_ID', 'wat_ID_renumbered'):
+        return int(float(value_))
+    return float(value_)
+
+def format_value(value_):
+    """
+    Formats a stored value as pandas writes it in the results CSV (repr of floats, e.g., 1.0 and 0.6107681321551758).
+    """
+    return repr(value_) if isinstance(value_, float) else str(value_)
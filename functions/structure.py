@@ -0,0 +1,496 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import numpy as np
+from functions.mmcif import read_mmcif_atom_site, write_mmcif_atom_site
+
+# column name: (first character, last character + 1, type) of the fixed-width ATOM/HETATM records
+pdb_columns = {
+    'record_name': (0, 6, str),
+    'atom_number': (6, 11, int),
+    'atom_name': (12, 16, str),
+    'alt_loc': (16, 17, str),
+    'residue_name': (17, 20, str),
+    'chain_id': (21, 22, str),
+    'residue_number': (22, 26, int),
+    'insertion': (26, 27, str),
+    'x_coord': (30, 38, float),
+    'y_coord': (38, 46, float),
+    'z_coord': (46, 54, float),
+    'occupancy': (54, 60, float),
+    'b_factor': (60, 66, float),
+    'segment_id': (72, 76, str),
+    'element_symbol': (76, 78, str),
+    'charge': (78, 80, str)
+}
+
+# format used to write each column that can be changed
+pdb_column_formats = {
+    'atom_number': '%5d',
+    'alt_loc': '%1s',
+    'chain_id': '%1s',
+    'residue_number': '%4d',
+    'x_coord': '%8.3f',
+    'y_coord': '%8.3f',
+    'z_coord': '%8.3f',
+    'occupancy': '%6.2f',
+    'b_factor': '%6.2f'
+}
+
+line_width = 80
+
+# integer columns written in the hybrid-36 encoding when a value does not fit (atom serials above 99999, residue numbers above 9999)
+hybrid36_columns = ['atom_number', 'residue_number']
+hybrid36_digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+mmcif_extensions = ('.cif', '.mmcif')
+
+class Structure:
+    """
+    Atoms of a PDB file held as one fixed-width character array (one row of 80 characters per ATOM/HETATM record).
+    Columns are parsed into NumPy arrays with vectorized slicing the first time they are used and then kept,
+    so a structure is read once per run and shared by setup, parsing, and scoring.
+    Subsets (e.g., the waters) are index arrays into the same array rather than copies of the atoms.
+    A structure read from an mmCIF file keeps its _atom_site loop instead; its columns are parsed from the loop
+    (without the PDB limits on the width of the columns) and PDB records are only made when a PDB file is written.
+
+    Attributes:
+        lines (numpy.ndarray): ATOM/HETATM records as an (n_atoms, 80) array of characters (uint8).
+        line_idx (numpy.ndarray): Line number of each ATOM/HETATM record in the input file.
+        other_lines (list): Other records (header, TER, CONECT, END, ...) as (line number, text) tuples.
+            ANISOU records are not kept.
+        atom_site (AtomSite): The _atom_site loop of an mmCIF file (None for a PDB file).
+    """
+
+    def __init__(self, lines_, line_idx_, other_lines_, atom_site_=None):
+        self._lines = lines_
+        self.line_idx = line_idx_
+        self.other_lines = other_lines_
+        self.atom_site = atom_site_
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.line_idx)
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = format_pdb_records(self)
+        return self._lines
+
+    @property
+    def file_extension(self):
+        """
+        Extension of the structure files written for this structure ('.cif' for mmCIF input, else '.pdb').
+        """
+        return '.cif' if self.atom_site is not None else '.pdb'
+
+    def column(self, name_):
+        """
+        Returns the values of one column of the ATOM/HETATM records (parsed on first use).
+
+        Args:
+            name_ (str): Column name (see pdb_columns), e.g., 'residue_name' or 'b_factor'.
+
+        Returns:
+            numpy.ndarray: Values of the column for all atoms (strings are stripped of spaces).
+        """
+
+        if name_ not in self._columns:
+            start, end, col_type = pdb_columns[name_]
+            if self.atom_site is not None:
+                self._columns[name_] = self.atom_site.column(name_, col_type)
+            else:
+                self._columns[name_] = parse_fixed_width(self.lines[:, start:end], col_type)
+        return self._columns[name_]
+
+    def coords(self, index_=None):
+        """
+        Returns the coordinates of the atoms.
+
+        Args:
+            index_ (numpy.ndarray): Indices of the atoms (default: all atoms).
+
+        Returns:
+            numpy.ndarray: (n, 3) array of x, y, and z coordinates.
+        """
+
+        xyz = np.column_stack([self.column('x_coord'), self.column('y_coord'), self.column('z_coord')])
+        return xyz if index_ is None else xyz[index_]
+
+    def select(self, record_=None, residue_name_=None, element_=None, exclude_residue_name_=None):
+        """
+        Selects atoms by record name, residue name, and element.
+
+        Args:
+            record_ (str): Record name ('ATOM' or 'HETATM'; default: any).
+            residue_name_ (str): Residue name (default: any).
+            element_ (str): Element symbol (default: any).
+            exclude_residue_name_ (str): Residue name to leave out (default: None).
+
+        Returns:
+            numpy.ndarray: Indices of the selected atoms in file order.
+        """
+
+        mask = np.ones(len(self), dtype=bool)
+        if record_ is not None:
+            mask &= self.column('record_name') == record_
+        if residue_name_ is not None:
+            mask &= self.column('residue_name') == residue_name_
+        if element_ is not None:
+            mask &= self.column('element_symbol') == element_
+        if exclude_residue_name_ is not None:
+            mask &= self.column('residue_name') != exclude_residue_name_
+        return np.flatnonzero(mask)
+
+    def protein_index(self):
+        """
+        Returns the indices of the protein atoms (ATOM records).
+        """
+        return self.select(record_='ATOM')
+
+    def water_index(self):
+        """
+        Returns the indices of the water oxygens (HOH HETATM records with element O), in file order.
+        The renumbered water ID of water i (0-based) in this order is i + 1.
+        """
+        return self.select(record_='HETATM', residue_name_='HOH', element_='O')
+
+    def write(self, path_, index_=None, columns_=None, others_=True):
+        """
+        Writes atoms to a PDB or mmCIF file (by the extension of the path; see write_pdb for the arguments).
+        mmCIF files can only be written for structures read from mmCIF files.
+        """
+
+        if path_.endswith(mmcif_extensions):
+            if self.atom_site is None:
+                raise ValueError('Cannot write ' + path_ + ': mmCIF files are only written for structures read from mmCIF files.')
+            write_mmcif_atom_site(path_, self.atom_site, np.arange(len(self)) if index_ is None else index_, columns_, others_)
+        else:
+            self.write_pdb(path_, index_, columns_, others_)
+
+    def write_pdb(self, path_, index_=None, columns_=None, others_=True):
+        """
+        Writes atoms to a PDB file, optionally with new values for some columns.
+        Records are written in the order of the input file; each line is padded to 80 characters.
+
+        Args:
+            path_ (str): Path of the output PDB file.
+            index_ (numpy.ndarray): Indices of the atoms to write (default: all atoms).
+            columns_ (dict): New values for columns of some of the written atoms, mapping a column name
+                (see pdb_column_formats) to a tuple of (atom indices, values) (default: None).
+            others_ (bool): Also write the other records (header, TER, CONECT, END, ...) (default: True).
+
+        Outputs:
+            Saves the PDB file.
+
+        Returns:
+            None
+        """
+
+        if index_ is None:
+            index_ = np.arange(len(self))
+        lines = self.lines[index_]
+        if columns_:
+            row_of_atom = np.full(len(self), -1)
+            row_of_atom[index_] = np.arange(len(index_))
+            for name, (atom_index, values) in columns_.items():
+                start, end, col_type = pdb_columns[name]
+                lines[row_of_atom[atom_index], start:end] = format_fixed_width(values, pdb_column_formats[name], end - start, name)
+
+        atom_text = lines.view('S' + str(line_width)).ravel()
+        if others_ and self.other_lines:
+            other_idx = np.array([idx for idx, text in self.other_lines])
+            other_text = np.array([text.rstrip().ljust(line_width) for idx, text in self.other_lines])
+            order = np.argsort(np.concatenate([self.line_idx[index_], other_idx]), kind='stable')
+            out_text = np.concatenate([atom_text, other_text])[order]
+        else:
+            out_text = atom_text
+
+        with open(path_, 'wb') as f:
+            f.write(b'\n'.join(out_text.tolist()))
+            f.write(b'\n')
+
+def parse_fixed_width(chars_, type_):
+    """
+    Parses one fixed-width column of PDB records.
+
+    Args:
+        chars_ (numpy.ndarray): (n, width) array of characters (uint8) of the column.
+        type_ (type): Type of the column (str, int, or float).
+
+    Returns:
+        numpy.ndarray: Parsed values (strings are stripped; blank numbers are 0 for int and NaN for float columns).
+    """
+
+    text = np.ascontiguousarray(chars_).view('S' + str(chars_.shape[1])).ravel()
+    text = np.char.strip(text)
+    if type_ == str:
+        return text.astype(str)
+    blank = text == b''
+    if blank.any():
+        text = np.where(blank, b'0' if type_ == int else b'nan', text)
+    if type_ == int:
+        # atom serials and residue numbers beyond the width of the column are hybrid-36 encoded
+        is_hybrid36 = np.char.isalpha(np.char.ljust(text, 1).astype('S1'))
+        if is_hybrid36.any():
+            values = np.zeros(len(text), dtype=int)
+            values[~is_hybrid36] = text[~is_hybrid36].astype(int)
+            values[is_hybrid36] = [decode_hybrid36(value.decode(), chars_.shape[1]) for value in text[is_hybrid36]]
+            return values
+    return text.astype(type_)
+
+def encode_hybrid36(value_, width_):
+    """
+    Encodes an integer in the hybrid-36 format of PDB files: decimal while it fits in the column, then base 36 with
+    upper-case letters (A000 follows 9999), then base 36 with lower-case letters.
+
+    Args:
+        value_ (int): The value.
+        width_ (int): Width of the column.
+
+    Outputs:
+        Raises a ValueError if the value does not fit in hybrid-36 either.
+
+    Returns:
+        str: The encoded value.
+    """
+
+    value = int(value_)
+    if -10**(width_ - 1) < value < 10**width_:
+        return str(value)
+    value -= 10**width_
+    block = 26 * 36**(width_ - 1)
+    for letters in (str.upper, str.lower):
+        if 0 <= value < block:
+            value += 10 * 36**(width_ - 1)
+            digits = ''
+            while value:
+                value, digit = divmod(value, 36)
+                digits = hybrid36_digits[digit] + digits
+            return letters(digits)
+        value -= block
+    raise ValueError('Value ' + str(value_) + ' does not fit in a ' + str(width_) + '-character hybrid-36 column.')
+
+def decode_hybrid36(text_, width_):
+    """
+    Decodes a hybrid-36 encoded integer of a PDB column (see encode_hybrid36).
+    """
+
+    if text_[0].isupper():
+        return int(text_, 36) - 10 * 36**(width_ - 1) + 10**width_
+    return int(text_, 36) - 10 * 36**(width_ - 1) + 10**width_ + 26 * 36**(width_ - 1)
+
+def format_fixed_width(values_, format_, width_, name_='column'):
+    """
+    Formats values into a fixed-width column of PDB records.
+
+    Args:
+        values_ (iterable): Values to format.
+        format_ (str): printf-style format (e.g., '%6.2f').
+        width_ (int): Width of the column.
+        name_ (str): Name of the column (used in error messages).
+
+    Outputs:
+        Raises a ValueError if a formatted value does not fit in the column.
+
+    Returns:
+        numpy.ndarray: (n, width) array of characters (uint8).
+    """
+
+    text = np.char.mod(format_, np.asarray(values_)).astype('S')
+    if text.dtype.itemsize > width_ and name_ in hybrid36_columns:
+        too_wide = np.char.str_len(text) > width_
+        text = text.astype(object)
+        text[too_wide] = [encode_hybrid36(value, width_).rjust(width_).encode() for value in np.asarray(values_)[too_wide]]
+        text = text.astype('S')
+    if text.dtype.itemsize > width_:
+        too_wide = text[np.char.str_len(text) > width_]
+        if len(too_wide):
+            raise ValueError('Value ' + too_wide[0].decode() + ' does not fit in the ' + str(width_) + '-character PDB ' + name_ + ' column.')
+    text = text.astype('S' + str(width_))
+    chars = text.view(np.uint8).reshape(len(text), width_).copy()
+    chars[chars == 0] = ord(' ')
+    return chars
+
+def format_pdb_records(structure_):
+    """
+    Makes the ATOM/HETATM records of a structure read from an mmCIF file (atom names are aligned as in PDB files,
+    atom serials and residue numbers are hybrid-36 encoded if needed).
+
+    Args:
+        structure_ (Structure): The structure.
+
+    Outputs:
+        Raises a ValueError if a value does not fit in its PDB column (e.g., a chain ID longer than one character).
+
+    Returns:
+        numpy.ndarray: (n_atoms, 80) array of characters (uint8).
+    """
+
+    lines = np.full((len(structure_), line_width), ord(' '), dtype=np.uint8)
+    names = structure_.column('atom_name')
+    elements = structure_.column('element_symbol')
+    # atom names of fewer than 4 characters with a one-letter element start in the second column
+    names = np.where((np.char.str_len(names) < 4) & (np.char.str_len(elements) == 1), np.char.add(' ', names), names)
+    charges = structure_.column('charge')
+    charges = np.array([charge.lstrip('+-') + ('-' if charge.startswith('-') else '+') if charge not in ('', '0') else '' for charge in charges])
+    formats = dict((name, pdb_column_formats.get(name, '%s')) for name in pdb_columns)
+    formats.update({'record_name': '%-6s', 'atom_name': '%-4s', 'residue_name': '%3s', 'insertion': '%1s', 'segment_id': '%-4s', 'element_symbol': '%2s', 'charge': '%2s'})
+    for name, (start, end, col_type) in pdb_columns.items():
+        values = names if name == 'atom_name' else charges if name == 'charge' else structure_.column(name)
+        lines[:, start:end] = format_fixed_width(values, formats[name], end - start, name)
+    return lines
+
+def read_mmcif(cif_file_):
+    """
+    Reads an mmCIF file into a Structure (first model only).
+
+    Args:
+        cif_file_ (str): Path to the mmCIF file.
+
+    Returns:
+        Structure: The atoms of the file, with a CRYST1 record made from its cell and space group (for PDB files written from it).
+    """
+
+    return mmcif_structure(read_mmcif_atom_site(cif_file_))
+
+def mmcif_structure(atom_site_):
+    """
+    Returns the Structure of an _atom_site loop (see read_mmcif).
+    """
+    cell, space_group = atom_site_.cell()
+    other_lines = []
+    if cell is not None:
+        other_lines.append((-1, ('CRYST1%9.3f%9.3f%9.3f%7.2f%7.2f%7.2f %-11s%4d' % (*cell, space_group, 1)).encode()))
+    return Structure(None, np.arange(len(atom_site_)), other_lines, atom_site_)
+
+def read_structure(pdb_file_):
+    """
+    Reads a PDB file (or an mmCIF file, by its extension '.cif' or '.mmcif') into a Structure.
+
+    Args:
+        pdb_file_ (str): Path to the PDB or mmCIF file.
+
+    Returns:
+        Structure: The ATOM/HETATM records and the other records of the file.
+    """
+
+    if pdb_file_.endswith(mmcif_extensions):
+        return read_mmcif(pdb_file_)
+
+    with open(pdb_file_, 'rb') as f:
+        file_lines = f.read().splitlines()
+
+    atom_lines = []
+    atom_line_idx = []
+    other_lines = []
+    for i, line in enumerate(file_lines):
+        if line.startswith((b'ATOM  ', b'HETATM')):
+            atom_lines.append(line)
+            atom_line_idx.append(i)
+        elif line.startswith(b'ANISOU') or not line.strip():
+            continue
+        else:
+            other_lines.append((i, line))
+
+    lines = np.array(atom_lines, dtype='S' + str(line_width)).view(np.uint8).reshape(len(atom_lines), line_width).copy()
+    lines[lines == 0] = ord(' ')
+    return Structure(lines, np.array(atom_line_idx, dtype=int), other_lines)
+
+def read_models(pdb_file_):
+    """
+    Reads every model of a PDB file (MODEL/ENDMDL records) or an mmCIF file (_atom_site.pdbx_PDB_model_num), e.g., an
+    ensemble, alternate refinements, or the snapshots of a simulation. The file is read once.
+
+    Args:
+        pdb_file_ (str): Path to the PDB or mmCIF file.
+
+    Returns:
+        list: (model number, Structure) of each model, in file order. Each Structure has the records of its model and
+        the records outside the models (header, END, ...), so it can be written as a file of its own. A file without
+        models gives one model, numbered 1.
+    """
+
+    if pdb_file_.endswith(mmcif_extensions):
+        from functions.mmcif import AtomSite
+        atom_site = read_mmcif_atom_site(pdb_file_, all_models_=True)
+        if 'pdbx_PDB_model_num' not in atom_site.values:
+            return [(1, mmcif_structure(atom_site))]
+        model_nums = atom_site.values['pdbx_PDB_model_num']
+        models = []
+        for model in dict.fromkeys(model_nums.tolist()):
+            in_model = model_nums == model
+            values = dict((item, value[in_model]) for item, value in atom_site.values.items())
+            models.append((int(model), mmcif_structure(AtomSite(atom_site.items, values, atom_site.header_lines, atom_site.footer_lines))))
+        return models
+
+    structure = read_structure(pdb_file_)
+    model_lines = [(idx, text) for idx, text in structure.other_lines if text.startswith(b'MODEL')]
+    if not model_lines:
+        return [(1, structure)]
+    end_lines = [idx for idx, text in structure.other_lines if text.startswith(b'ENDMDL')]
+    # each model runs to the next MODEL record, the last one to the last ENDMDL record
+    last_end = max(end_lines) if end_lines and max(end_lines) > model_lines[-1][0] else np.inf
+    bounds = [idx for idx, text in model_lines] + [last_end]
+    models = []
+    for i, (start_idx, text) in enumerate(model_lines):
+        end_idx = bounds[i + 1]
+        in_model = (structure.line_idx > start_idx) & (structure.line_idx < end_idx)
+        other_lines = [(idx, line) for idx, line in structure.other_lines if not line.startswith((b'MODEL', b'ENDMDL')) and
+                       (idx < bounds[0] or idx > bounds[-1] or start_idx < idx < end_idx)]
+        model = int(text[5:].split()[0]) if text[5:].split() else i + 1
+        models.append((model, Structure(structure.lines[in_model], structure.line_idx[in_model], other_lines)))
+    return models
+
+def load_structure(structure_):
+    """
+    Returns the given Structure, or reads it if a path is given.
+
+    Args:
+        structure_ (Structure or str): A Structure or the path to a PDB file.
+
+    Returns:
+        Structure: The structure.
+    """
+
+    if isinstance(structure_, Structure):
+        return structure_
+    return read_structure(structure_)
+
+def get_water_frame(structure_):
+    """
+    Returns the water oxygens of a structure as a DataFrame, with the renumbered water IDs.
+
+    Args:
+        structure_ (Structure): The structure.
+
+    Returns:
+        pandas.DataFrame: One row per water with the columns residue_number (renumbered water ID, 1 to N),
+        original_residue_number, chain_id, insertion, and b_factor.
+    """
+
+    import pandas as pd
+
+    wat_index = structure_.water_index()
+    return pd.DataFrame({
+        'residue_number': np.arange(1, len(wat_index) + 1),
+        'original_residue_number': structure_.column('residue_number')[wat_index],
+        'chain_id': structure_.column('chain_id')[wat_index],
+        'insertion': structure_.column('insertion')[wat_index],
+        'b_factor': structure_.column('b_factor')[wat_index]
+    })
@@ -16,14 +16,16 @@
 
 
 import os
+import sys
+from functions.configuration import uses_external_programs, uses_native_density
 
-def check_env_variables():
+def check_env_variables(required_vars_=None):
     """
     Checks that all required environment variables are set.
     If any environment variable is missing, it prints an error message and exits the program.
 
     Args:
-        None
+        required_vars_ (list): Names of the required environment variables (default: the variables of all external programs).
 
     Outputs:
         Prints error messages if environment variables are missing.
@@ -34,12 +36,36 @@ def check_env_variables():
     
     print('checking environment variables...')
     required_vars = ['PYMOL_EXE', 'PHENIX_BIN', 'NACCESS_EXE', 'HBPLUS_EXE', 'EDIASCORER_EXE', 'EDIASCORER_LICENSE']
+    if required_vars_ is not None:
+        required_vars = required_vars_
     for var in required_vars:
         if not os.getenv(var):
             print(f'Error: Required environment variable {var} is not set. See github page for instructions.')
             sys.exit(1)
     print('environment variables found...')
 
+# command-line flag of each path argument, for the messages of missing arguments
+argument_flags = {'pdb_file': '-pdb', 'mtz_file': '-mtz', 'ccp4_file': '-ccp4', 'outdir': '-o'}
+
+def check_required_arguments(args_, names_):
+    """
+    Checks that the given arguments were provided.
+
+    Args:
+        args_ (Namespace): The command-line arguments.
+        names_ (list): Names of the required arguments (keys of argument_flags).
+
+    Outputs:
+        Raises a ValueError naming the flags of the missing arguments.
+
+    Returns:
+        None
+    """
+
+    missing = [argument_flags[name] for name in names_ if getattr(args_, name, None) is None]
+    if missing:
+        raise ValueError('Missing required arguments: ' + ', '.join(missing) + '.')
+
 def check_argument_files(args_):
     """
     Checks the validity of the file paths and extensions provided in the arguments.
@@ -48,31 +74,33 @@ def check_argument_files(args_):
     Args:
         args_ (Namespace): An object containing the command-line arguments, which include:
             - pdb_file (str): Path to the PDB file.
-            - ccp4_file (str): Path to the CCP4 file.
+            - ccp4_file (str): Path to the CCP4 file (None if the map is calculated from the MTZ file).
             - mtz_file (str): Path to the MTZ file.
             - outdir (str): Path to the output directory.
 
     Outputs:
-        Raises appropriate errors if any file or directory is invalid or if file extensions are incorrect.
+        Raises appropriate errors if an argument is missing, any file or directory is invalid, or file extensions are incorrect.
     
     Returns:
         None
     """
     
+    check_required_arguments(args_, ['pdb_file', 'mtz_file', 'outdir'])
     files_and_dirs = {
         args_.pdb_file: FileNotFoundError,
-        args_.ccp4_file: FileNotFoundError,
         args_.mtz_file: FileNotFoundError,
         args_.outdir: NotADirectoryError
     }
+    if args_.ccp4_file is not None:
+        files_and_dirs[args_.ccp4_file] = FileNotFoundError
 
     for path, error in files_and_dirs.items():
         if not os.path.isfile(path) if error == FileNotFoundError else not os.path.isdir(path):
             raise error(path)
 
-    if not args_.pdb_file.endswith('.pdb'):
-        raise ValueError('Invalid file extension for ' + args_.pdb_file + '. Expected a ".pdb" file.')
-    if not args_.ccp4_file.endswith('.ccp4'):
+    if not args_.pdb_file.endswith(('.pdb', '.cif', '.mmcif')):
+        raise ValueError('Invalid file extension for ' + args_.pdb_file + '. Expected a ".pdb", ".cif", or ".mmcif" file.')
+    if args_.ccp4_file is not None and not args_.ccp4_file.endswith('.ccp4'):
         raise ValueError('Invalid file extension for ' + args_.ccp4_file + '. Expected a ".ccp4" file.')
     if not args_.mtz_file.endswith('.mtz'):
         raise ValueError('Invalid file extension for ' + args_.mtz_file + '. Expected a ".mtz" file.')
@@ -115,3 +143,120 @@ def check_raw_datafiles(pdb_id__, outdir__, dict_file_suffixes_):
     for metric_name, suffix in dict_file_suffixes_.items():
         raw_datafile = outdir__ + '/raw_data_files/' + pdb_id__ + suffix
         check_file_exists(raw_datafile, metric_name)
+
+def check_map_coverage(structure_, ccp4_file_, resolution_=None, backends_=None):
+    """
+    Checks, before any calculation, that the CCP4 map covers every water (including its symmetry mates in the map).
+    The EDIA (and the ColdBrew probability) of waters not covered by the map is -1.
+
+    Args:
+        structure_ (Structure): The structure.
+        ccp4_file_ (str): Path to the CCP4 map.
+        resolution_ (float): Resolution of the map (default: estimated from the grid of the map).
+        backends_ (dict): Backend of each feature (see configuration.get_backends; default: external programs).
+
+    Outputs:
+        Prints a warning with the waters not covered by the map. If the file cannot be read as a CCP4 map, raises a
+        ValueError when a native density backend reads it; otherwise only the external programs read the map (and may
+        support more of the format, e.g., other data modes), so a warning is printed instead.
+
+    Returns:
+        numpy.ndarray: True for the covered waters (in the order of the waters in the structure), or None if the map
+            could not be read.
+    """
+
+    from functions.ccp4 import load_ccp4_map
+    from functions.density import water_map_coverage
+
+    print('checking map coverage...')
+    try:
+        density_map = load_ccp4_map(ccp4_file_)
+    except ValueError as e:
+        if uses_native_density(backends_):
+            raise
+        print('Warning: the map coverage is not checked: ' + str(e))
+        return None
+    covered = water_map_coverage(structure_, density_map, resolution_)
+    if not covered.all():
+        wat_index = structure_.water_index()[~covered]
+        waters = [chain + str(number) for chain, number in zip(structure_.column('chain_id')[wat_index], structure_.column('residue_number')[wat_index])]
+        print('Warning: the map ' + ccp4_file_ + ' does not cover ' + str(len(waters)) + ' of ' + str(len(covered)) + ' waters (' + ', '.join(waters) +
+              '). Their EDIA and ColdBrew probability may be -1. To score them, provide a map covering the whole model (e.g., the unit cell).')
+    print('map covers ' + str(int(covered.sum())) + ' of ' + str(len(covered)) + ' waters...')
+    return covered
+
+def check_pdb_format_limits(structure_, pdb_id_, backends_=None):
+    """
+    Checks that the renumbered structure can be written as the PDB files read by the external programs: at most
+    9999 waters (4-character residue number column), 99999 atoms (5-character atom serial column), one-character
+    chain IDs, and three-character residue names. The native backends have none of these limits.
+
+    Args:
+        structure_ (Structure): The structure.
+        pdb_id_ (str): Identifier of the structure.
+        backends_ (dict): Backend of each feature (see configuration.get_backends; default: external programs).
+
+    Outputs:
+        Raises a ValueError naming the limit if an external program is used and the structure exceeds it.
+
+    Returns:
+        None
+    """
+
+    if not uses_external_programs(backends_):
+        return
+    import numpy as np
+
+    problems = []
+    n_waters = len(structure_.water_index())
+    if n_waters > 9999:
+        problems.append(str(n_waters) + ' waters (the renumbered water IDs go up to 9999)')
+    if len(structure_) > 99999:
+        problems.append(str(len(structure_)) + ' atoms (atom serials go up to 99999)')
+    long_chains = np.unique(structure_.column('chain_id')[np.char.str_len(structure_.column('chain_id')) > 1])
+    if len(long_chains):
+        problems.append('chain IDs longer than one character (' + ', '.join(long_chains[:5]) + ')')
+    long_names = np.unique(structure_.column('residue_name')[np.char.str_len(structure_.column('residue_name')) > 3])
+    if len(long_names):
+        problems.append('residue names longer than three characters (' + ', '.join(long_names[:5]) + ')')
+    if problems:
+        raise ValueError(pdb_id_ + ' has ' + ' and '.join(problems) + ', which do not fit in the PDB files read by the external programs. '
+                         'Use the native backends (-rscc_backend native -sasa_backend native -edia_backend native -hb_backend native) for this structure.')
+
+def validate_inputs(pdb_file_, pdb_id_, ccp4_file_, backends_=None, resolution_=None, mtz_file_=None, map_columns_=None):
+    """
+    Runs the checks of the pipeline on the input structure and map without running any calculation (validation-only
+    mode): the PDB format limits of the external programs and the coverage of the waters by the map.
+    Only the structure and map modules are loaded (not pandas or the model).
+
+    Args:
+        pdb_file_ (str): Path to the input PDB or mmCIF file.
+        pdb_id_ (str): Identifier of the structure.
+        ccp4_file_ (str): Path to the CCP4 map (None if the map is calculated from the MTZ file).
+        backends_ (dict): Backend of each feature (see configuration.get_backends; default: external programs).
+        resolution_ (float): Resolution of the map (default: estimated from the grid of the map).
+        mtz_file_ (str): Path to the MTZ file, checked if ccp4_file_ is None (default: None).
+        map_columns_ (list): Labels of the map coefficients in the MTZ file (default: None, found in the file).
+
+    Outputs:
+        Raises a ValueError if the structure does not fit the PDB files of the external programs, the map is not a CCP4 map
+        read by a native density backend, or no map can be calculated from the MTZ file, and prints a warning if the map
+        does not cover every water (see check_map_coverage).
+
+    Returns:
+        numpy.ndarray: True for the covered waters (in the order of the waters in the structure), or None if the map
+            could not be read.
+    """
+
+    from functions.structure import read_structure
+
+    print('reading ' + pdb_file_ + '...')
+    structure = read_structure(pdb_file_)
+    check_pdb_format_limits(structure, pdb_id_, backends_)
+    if ccp4_file_ is None:
+        # a map of the whole unit cell is calculated from the MTZ file, so it covers every water
+        import numpy as np
+        from functions.maps import check_map_inputs
+        print(check_map_inputs(mtz_file_, map_columns_) + '...')
+        return np.ones(len(structure.water_index()), dtype=bool)
+    return check_map_coverage(structure, ccp4_file_, resolution_, backends_)
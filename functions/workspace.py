@@ -0,0 +1,103 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Scratch workspace of a run: the setup, raw, and parsed files are written to a local directory (e.g., on tmpfs or a
+# local disk), and only the final outputs are moved to the output directory (often on a shared, network file system).
+# The other files are kept, or not, as one compressed archive per structure.
+
+import os
+import shutil
+import tarfile
+import tempfile
+
+# when the intermediate files are kept: never, only if the run fails, or always
+retention_policies = ['none', 'failure', 'all']
+# final outputs moved to the output directory ({0} is the ID)
+published_files = ['{0}_ColdBrew_results.csv', '{0}_ColdBrew_probability.pdb', '{0}_ColdBrew_probability.cif',
+                   '{0}_run_report.json', '{0}_run_report.prom']
+# archive of the intermediate files in the output directory
+archive_suffix = '_intermediates.tar.gz'
+
+class Workspace:
+    """
+    Scratch directory of one run (see run_pipeline). The pipeline writes all its files to the workspace; publish moves
+    the final outputs (see published_files) to the output directory, packs the intermediate files into
+    <ID>_intermediates.tar.gz if the retention policy keeps them, and removes the workspace. A run thus leaves 2 to 4
+    files in the output directory instead of about 25.
+
+    Args:
+        outdir_ (str): Output directory of the run.
+        pdb_id_ (str): Identifier of the structure.
+        scratch_dir_ (str): Directory in which the workspace is created (default: the temporary directory of the system, see tempfile.gettempdir).
+        keep_ (str): Retention policy of the intermediate files (see retention_policies; default: 'failure').
+    """
+
+    def __init__(self, outdir_, pdb_id_, scratch_dir_=None, keep_='failure'):
+        if keep_ not in retention_policies:
+            raise ValueError('Unknown retention policy ' + str(keep_) + ' (choose from ' + ', '.join(retention_policies) + ').')
+        self.outdir = os.path.abspath(outdir_)
+        self.pdb_id = pdb_id_
+        self.keep = keep_
+        if scratch_dir_ is not None:
+            os.makedirs(scratch_dir_, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix='coldbrew_' + pdb_id_ + '_', dir=scratch_dir_)
+        # working directory of the external programs that write into the current directory
+        self.workdir = os.path.join(self.path, 'workdir')
+        os.makedirs(self.workdir)
+
+    def publish(self, failed_=False):
+        """
+        Moves the final outputs to the output directory and keeps the intermediate files according to the retention
+        policy. Files are copied under temporary names and renamed, so the output directory never has partial files.
+
+        Args:
+            failed_ (bool): The run failed (default: False).
+
+        Returns:
+            list: Paths of the files saved in the output directory.
+        """
+
+        os.makedirs(self.outdir, exist_ok=True)
+        saved = []
+        for name in published_files:
+            name = name.format(self.pdb_id)
+            if os.path.isfile(os.path.join(self.path, name)):
+                saved.append(self.move(os.path.join(self.path, name), name))
+
+        archive = self.pdb_id + archive_suffix
+        if self.keep == 'all' or (self.keep == 'failure' and failed_):
+            temp_file = os.path.join(self.path, archive)
+            with tarfile.open(temp_file, 'w:gz') as tar:
+                for name in sorted(os.listdir(self.path)):
+                    if name != archive:
+                        tar.add(os.path.join(self.path, name), arcname=os.path.join(self.pdb_id, name))
+            saved.append(self.move(temp_file, archive))
+            print('saved the intermediate files in ' + saved[-1] + '...')
+        elif os.path.isfile(os.path.join(self.outdir, archive)):
+            # the archive of an earlier run is not from this run
+            os.remove(os.path.join(self.outdir, archive))
+        shutil.rmtree(self.path, ignore_errors=True)
+        return saved
+
+    def move(self, path_, name_):
+        """
+        Moves a file of the workspace to the output directory as name_ and returns its new path.
+        """
+        temp_file = os.path.join(self.outdir, '.' + name_ + '.tmp')
+        shutil.move(path_, temp_file)
+        os.replace(temp_file, os.path.join(self.outdir, name_))
+        return os.path.join(self.outdir, name_)
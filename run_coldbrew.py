@@ -16,17 +16,16 @@
 
 
 import os
+import sys
 import argparse
-import joblib
-import pandas as pd
-from biopandas.pdb import PandasPdb
-import warnings
-warnings.filterwarnings("ignore", module="biopandas.pdb")
-from functions.validation import *
-from functions.configuration import *
-from functions.execution import *
-from functions.data_parsing import *
-from functions.data_analysis import *
+# only light modules are imported here (the help, argument checks, and validation-only mode do not load pandas or the model);
+# the modules of each mode are imported when it runs
+from functions.validation import check_env_variables, check_required_arguments, check_argument_files, check_file_exists, validate_inputs
+from functions.configuration import feature_backends, get_backends, required_env_variables, get_pdb_id
+from functions.cache import StageCache
+from functions.store import ResultStore
+from functions.workspace import retention_policies
+from functions.job_queue import default_lease_seconds, default_max_attempts
 
 
 def cmd_lineparser():
@@ -34,21 +33,86 @@ def cmd_lineparser():
     Parses command-line arguments for the script.
 
     Arguments:
-    -pdb   : Path to the PDB file (default: 'NA').
-    -ccp4  : Path to the CCP4 map file (default: 'NA').
+    -pdb   : Path to the PDB or mmCIF file (default: 'NA').
+    -ccp4  : Path to the CCP4 map file (default: None, the 2mFo-DFc map is calculated from the MTZ file).
     -mtz   : Path to the MTZ file (default: 'NA').
     -o     : Output directory (default: current directory).
+    -nproc : Maximum number of calculations run in parallel (default: number of CPUs, up to 4).
+    -manifest : CSV/TSV file of structures (id, pdb, mtz, ccp4) to run in batch mode (default: None).
+    -npool : Number of structures run at the same time in batch mode (default: 1).
+    -write_parsed : Also save the parsed per-water metrics as PDB files (default: off).
+    -cache_dir : Directory of the cache of stage outputs (default: None, no cache).
+    -cache_size : Maximum size of the cache in GB (default: 10).
+    -sasa_backend : Program used to calculate SASA, 'naccess' or 'native' (default: naccess).
+    -hb_backend : Program used to count hydrogen bonds, 'hbplus' or 'native' (default: hbplus).
+    -rscc_backend : Program used to calculate RSCC, 'phenix' or 'native' (default: phenix).
+    -edia_backend : Program used to calculate EDIA, 'ediascorer' or 'native' (default: ediascorer).
+    -resolution : Resolution of the map for the native RSCC and EDIA backends (default: estimated from the map grid; single structure mode).
+    -serve : Run the scoring service instead of a single structure (default: off).
+    -host  : Host of the scoring service (default: 127.0.0.1).
+    -port  : Port of the scoring service (default: 8765).
+    -socket : Unix socket of the scoring service, used instead of the port (default: None).
+    -validate : Only check the environment variables, input files, and map coverage, then exit (default: off).
+    -store : SQLite store of results; a structure already in it is not run again, and new results are added (default: None).
+    -openmetrics : Also save the run report of each structure as OpenMetrics text (default: off).
+    -previous : Output directory of a previous run of an earlier version of the structure; only waters whose environment changed are recalculated (default: None).
+    -site_ligand : Residue names of ligands; only the waters near them are scored (default: None).
+    -site_residues : Residues (e.g., A:45); only the waters near them are scored (default: None).
+    -site_center : x, y, z of a point; only the waters near it are scored (default: None).
+    -site_radius : Distance of the scored waters from the site in Angstrom (default: 6).
+    -dataset : Directory of a Parquet dataset of results; the results of each structure are added to it (default: None).
+    -ensemble : Score every model of the structure file, -npool models at a time (default: off).
+    -scratch : Directory for the scratch workspace of each run; only the final outputs are saved in the output directory (default: None).
+    -keep_intermediates : When to keep the intermediate files of a workspace: none, failure, or all (default: failure with -scratch).
+    -map_columns : Labels of the amplitude and phase of the map coefficients in the MTZ file, used without -ccp4 (default: found in the file).
+    -queue : SQLite work queue of structure jobs shared by several nodes; with -manifest, its structures are added first (default: None).
+    -lease_seconds : Queue mode: time a lease lasts without a heartbeat, after which the job is queued again (default: 120).
+    -max_attempts : Queue mode: attempts of a job before it fails for good (default: 3).
 
     Returns:
         argparse.Namespace: Parsed arguments with attributes 
-        `pdb_file`, `ccp4_file`, `mtz_file`, and `outdir`.
+        `pdb_file`, `ccp4_file`, `mtz_file`, `outdir`, `nproc`, `manifest`, `npool`, `write_parsed`, `cache_dir`, `cache_size`, `sasa_backend`, `hb_backend`,
+        `rscc_backend`, `edia_backend`, `resolution`, `serve`, `host`, `port`, `socket`, `validate`, `store`, `openmetrics`, `previous`,
+        `site_ligand`, `site_residues`, `site_center`, `site_radius`, `ensemble`, `dataset`, `scratch`, `keep_intermediates`, `map_columns`,
+        `queue`, `lease_seconds`, and `max_attempts`.
     """
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('-pdb', dest='pdb_file', type=str, action='store', help='Path to the input PDB file (cryo crystal structure containing water molecules).')
-    parser.add_argument('-ccp4', dest='ccp4_file', type=str, action='store', help='Path to the CCP4 map file.')
+    parser.add_argument('-pdb', dest='pdb_file', type=str, action='store', help='Path to the input PDB or mmCIF file (.pdb, .cif, or .mmcif; cryo crystal structure containing water molecules).')
+    parser.add_argument('-ccp4', dest='ccp4_file', type=str, action='store', help='Path to the CCP4 map file (2mFo-DFc). Without it, the 2mFo-DFc map is calculated from the MTZ file (its map coefficients, or its amplitudes phased by the model) and saved as <ID>_2mFo-DFc.ccp4.')
     parser.add_argument('-mtz', dest='mtz_file', type=str, action='store', help='Path to the MTZ file containing structure factor data.')
     parser.add_argument('-o', dest='outdir',type=str, action='store', help='Path to the output directory where results will be saved. (full path preferred)')
+    parser.add_argument('-nproc', dest='nproc', type=int, action='store', default=None, help='Maximum number of external calculations run in parallel (default: number of CPUs, up to 4).')
+    parser.add_argument('-manifest', '--manifest', dest='manifest', type=str, action='store', default=None, help='Batch mode: CSV/TSV file with the columns id, pdb, mtz, ccp4 (one structure per line). Results are saved in <outdir>/<id>.')
+    parser.add_argument('-npool', dest='npool', type=int, action='store', default=1, help='Batch mode: number of structures run at the same time (default: 1).')
+    parser.add_argument('-write_parsed', dest='write_parsed', action='store_true', help='Also save the parsed per-water metrics as PDB files in <outdir>/parsed_data_files (for debugging).')
+    parser.add_argument('-cache_dir', dest='cache_dir', type=str, action='store', default=None, help='Directory of a cache of stage outputs. Reruns (e.g., after a failed program) skip every stage that already ran with the same input files and programs.')
+    parser.add_argument('-cache_size', dest='cache_size', type=float, action='store', default=10, help='Maximum size of the cache in GB; least recently used results are removed (default: 10).')
+    parser.add_argument('-sasa_backend', dest='sasa_backend', type=str, action='store', default=feature_backends['SASA'][0], choices=feature_backends['SASA'], help='Program used to calculate the SASA of waters: naccess, or the built-in Shrake-Rupley engine (native, does not need naccess) (default: naccess).')
+    parser.add_argument('-hb_backend', dest='hb_backend', type=str, action='store', default=feature_backends['HB'][0], choices=feature_backends['HB'], help='Program used to count the hydrogen bonds of waters: PyMOL and HBPLUS (hbplus), or the built-in counter (native, does not need PyMOL or HBPLUS) (default: hbplus).')
+    parser.add_argument('-rscc_backend', dest='rscc_backend', type=str, action='store', default=feature_backends['RSCC'][0], choices=feature_backends['RSCC'], help='Program used to calculate the RSCC of waters: phenix.real_space_correlation (phenix), or the built-in density backend, which samples the CCP4 map around the waters (native) (default: phenix).')
+    parser.add_argument('-edia_backend', dest='edia_backend', type=str, action='store', default=feature_backends['EDIA'][0], choices=feature_backends['EDIA'], help='Program used to calculate the EDIA of waters: ediascorer, or the built-in density backend (native) (default: ediascorer).')
+    parser.add_argument('-resolution', dest='resolution', type=float, action='store', default=None, help='Resolution of the map (Angstrom) for the native RSCC and EDIA backends (default: estimated from the map grid).')
+    parser.add_argument('-serve', dest='serve', action='store_true', help='Run the scoring service, which keeps the model loaded and scores feature batches (POST /predict) and structures (POST /score) until it is interrupted. Structures are run -npool at a time, with results in <outdir>/<id>.')
+    parser.add_argument('-host', dest='host', type=str, action='store', default='127.0.0.1', help='Scoring service: host to listen on (default: 127.0.0.1, local requests only).')
+    parser.add_argument('-port', dest='port', type=int, action='store', default=8765, help='Scoring service: port to listen on (default: 8765).')
+    parser.add_argument('-socket', dest='socket', type=str, action='store', default=None, help='Scoring service: path of a Unix socket to listen on instead of the port.')
+    parser.add_argument('-store', dest='store', type=str, action='store', default=None, help='SQLite store of results (see scripts/coldbrew_store.py). If the structure (by ID) is in the store, its results are written to <outdir>/<ID>_ColdBrew_results.csv without running anything; otherwise the results of the run are added to the store.')
+    parser.add_argument('-openmetrics', dest='openmetrics', action='store_true', help='Also save the run report (<ID>_run_report.json: time, CPU, memory, and I/O of each stage and external program) as OpenMetrics text in <ID>_run_report.prom.')
+    parser.add_argument('-previous', dest='previous', type=str, action='store', default=None, help='Output directory of a previous run of an earlier version of the structure (e.g., the previous refinement cycle). Waters are matched to the previous waters by position and chain, and only the waters within 8 A of an added, deleted, or changed atom are recalculated; the other waters keep their previous features.')
+    parser.add_argument('-site_ligand', '--site_ligand', dest='site_ligand', type=str, nargs='+', default=None, help='Score only the waters within -site_radius of these ligands (residue names, e.g., LIG). The calculations run on the site waters and the residues within 8 A of them.')
+    parser.add_argument('-site_residues', '--site_residues', dest='site_residues', type=str, nargs='+', default=None, help='Score only the waters within -site_radius of these residues (CHAIN:NUMBER, e.g., A:45 A:46; NUMBER for any chain).')
+    parser.add_argument('-site_center', '--site_center', dest='site_center', type=float, nargs=3, default=None, metavar=('X', 'Y', 'Z'), help='Score only the waters within -site_radius of this point.')
+    parser.add_argument('-site_radius', '--site_radius', dest='site_radius', type=float, action='store', default=None, help='Distance of the scored waters from the site (Angstrom; default: 6).')
+    parser.add_argument('-dataset', '--dataset', dest='dataset', type=str, action='store', default=None, help='Directory of a Parquet dataset of results (needs pyarrow; created if missing). The results of each structure (features, probability, IDs, model version, backends, and run time) are added to it, replacing earlier results of the structure; see scripts/coldbrew_dataset.py to query it.')
+    parser.add_argument('-scratch', '--scratch', dest='scratch', type=str, action='store', default=None, help='Directory for the scratch workspace of each run, e.g., a local disk or tmpfs (/dev/shm). The setup, raw, and parsed files are written there, and only the results, the probability structure, and the run report are saved in the output directory.')
+    parser.add_argument('-keep_intermediates', '--keep_intermediates', dest='keep_intermediates', type=str, action='store', default=None, choices=retention_policies, help='Run in a scratch workspace (in -scratch, or the temporary directory of the system) and keep its intermediate files as <ID>_intermediates.tar.gz in the output directory: never (none), if the run fails (failure), or always (all) (default: failure with -scratch).')
+    parser.add_argument('-ensemble', '--ensemble', dest='ensemble', action='store_true', help='Score every model of the structure file (MODEL records, or the model numbers of an mmCIF file), e.g., an ensemble or the snapshots of a simulation, -npool models at a time. Results of each model are saved in <outdir>/<ID>_model_<N>, and the probabilities of each water across the models in <ID>_ensemble_summary.csv.')
+    parser.add_argument('-queue', '--queue', dest='queue', type=str, action='store', default=None, help='Queue mode: SQLite work queue of structure jobs, e.g., on shared storage (created if missing; see scripts/coldbrew_queue.py). -npool workers lease jobs, renew their leases while they run, and record the status of each stage and the error of failed jobs; the jobs of a stopped worker (e.g., a failed node) are queued again when their lease expires. Run the same command on several nodes with the same queue and output directory. With -manifest, its structures are added to the queue first (IDs already in the queue are kept).')
+    parser.add_argument('-lease_seconds', '--lease_seconds', dest='lease_seconds', type=float, action='store', default=default_lease_seconds, help='Queue mode: time a lease lasts without a heartbeat, after which the job is queued again (default: 120).')
+    parser.add_argument('-max_attempts', '--max_attempts', dest='max_attempts', type=int, action='store', default=default_max_attempts, help='Queue mode: attempts of a job (failed runs and expired leases) before it fails for good (default: 3).')
+    parser.add_argument('-map_columns', '--map_columns', dest='map_columns', type=str, nargs=2, default=None, metavar=('F', 'PHI'), help='Labels of the amplitude and phase of the map coefficients in the MTZ file, used without -ccp4 (default: 2FOFCWT/PH2FOFCWT or FWT/PHWT if in the file; otherwise the map is phased by the model).')
+    parser.add_argument('-validate', dest='validate', action='store_true', help='Only check the environment variables, the input files (of every structure in batch mode), the PDB format limits, and the map coverage, then exit without running any calculation.')
 
     return parser.parse_args()
 
@@ -57,37 +121,135 @@ def main():
     Main execution function for the pipeline.
     - Parses command-line arguments.
     - Performs initial checks on the environment and input files.
-    - Sets up the files needed for calculations.
-    - Runs calculations on the input data.
-    - Parses and processes raw output files.
-    - Computes final results and saves them.
+    - Runs the pipeline (setup, calculations, parsing, and results) for the input structure,
+      or for every structure of the manifest in batch mode.
     """
 
     # parse command-line arguments
     args = cmd_lineparser()
 
-    # validate environment variables, check files, and assign arguments as global variables
-    check_env_variables()
+    # cache of stage outputs
+    cache = None
+    if args.cache_dir is not None:
+        cache = StageCache(args.cache_dir, int(args.cache_size * 1024**3))
+
+    # backend of each feature
+    backends = get_backends({'RSCC': args.rscc_backend, 'SASA': args.sasa_backend, 'EDIA': args.edia_backend, 'HB': args.hb_backend})
+
+    # the dataset needs pyarrow; check before running anything
+    if args.dataset is not None:
+        from functions.dataset import import_pyarrow
+        import_pyarrow()
+
+    # scoring service: keep the model loaded and score requests until interrupted
+    if args.serve:
+        from functions.server import serve
+        check_env_variables(required_env_variables(backends))
+        if not os.path.isdir(args.outdir):
+            raise NotADirectoryError(args.outdir)
+        serve(args.outdir, args.host, args.port, args.socket, args.npool, args.nproc, cache, backends)
+        return
+
+    # queue mode: lease the jobs of a queue shared with the workers of other nodes
+    if args.queue is not None and not args.validate:
+        from functions.job_queue import JobQueue, run_queue
+        check_env_variables(required_env_variables(backends))
+        if not os.path.isdir(args.outdir):
+            raise NotADirectoryError(args.outdir)
+        if args.manifest is not None:
+            from functions.batch import read_manifest
+            check_file_exists(args.manifest, 'manifest')
+            with JobQueue(args.queue) as queue:
+                n_added = queue.add_jobs(read_manifest(args.manifest))
+            print('added ' + str(n_added) + ' jobs to ' + args.queue + '...')
+        counts = run_queue(args.queue, args.outdir, n_procs_=args.npool, n_workers_=args.nproc, write_parsed_=args.write_parsed, cache_=cache, backends_=backends,
+                           openmetrics_=args.openmetrics, dataset_=args.dataset, scratch_=args.scratch, keep_intermediates_=args.keep_intermediates,
+                           map_columns_=args.map_columns, lease_seconds_=args.lease_seconds, max_attempts_=args.max_attempts)
+        if counts['failed']:
+            sys.exit(1)
+        return
+
+    # batch mode: run every structure of the manifest on a process pool
+    if args.manifest is not None:
+        from functions.batch import read_manifest, run_manifest
+        check_env_variables(required_env_variables(backends))
+        check_file_exists(args.manifest, 'manifest')
+        if not os.path.isdir(args.outdir):
+            raise NotADirectoryError(args.outdir)
+        if args.validate:
+            failed = []
+            for entry in read_manifest(args.manifest):
+                try:
+                    check_argument_files(argparse.Namespace(pdb_file=entry['pdb'], ccp4_file=entry['ccp4'], mtz_file=entry['mtz'], outdir=args.outdir))
+                    validate_inputs(entry['pdb'], entry['id'], entry['ccp4'], backends_=backends, mtz_file_=entry['mtz'], map_columns_=args.map_columns)
+                except Exception as e:
+                    print(entry['id'] + ': ' + type(e).__name__ + ': ' + str(e))
+                    failed.append(entry['id'])
+            print(('inputs of ' + ', '.join(failed) + ' are not valid') if failed else 'inputs are valid')
+            if failed:
+                sys.exit(1)
+            return
+        summaries = run_manifest(args.manifest, args.outdir, n_procs_=args.npool, n_workers_=args.nproc, write_parsed_=args.write_parsed, cache_=cache, backends_=backends,
+                                 openmetrics_=args.openmetrics, dataset_=args.dataset, scratch_=args.scratch, keep_intermediates_=args.keep_intermediates, map_columns_=args.map_columns)
+        if any(summary['status'] == 'failed' for summary in summaries):
+            sys.exit(1)
+        return
+
+    # site to score (default: all waters)
+    site = None
+    if args.site_ligand or args.site_residues or args.site_center is not None:
+        site = {'ligand': args.site_ligand, 'residues': args.site_residues, 'center': args.site_center, 'radius': args.site_radius}
+    if site is not None and args.store is not None:
+        print('the store holds the results of whole structures, so it is not used for a site...')
+        args.store = None
+
+    # ensemble: score every model of the structure file on a process pool
+    if args.ensemble and not args.validate:
+        check_env_variables(required_env_variables(backends))
+        check_argument_files(args)
+        if args.store is not None or args.previous is not None:
+            print('-store and -previous are not used for an ensemble...')
+        pdb_id = get_pdb_id(args.pdb_file)
+        print('using ' + pdb_id + ' as the ID...')
+        from functions.ensemble import run_ensemble
+        summaries = run_ensemble(args.pdb_file, pdb_id, args.mtz_file, args.ccp4_file, args.outdir, n_procs_=args.npool, n_workers_=args.nproc, write_parsed_=args.write_parsed,
+                                 cache_=cache, backends_=backends, openmetrics_=args.openmetrics, resolution_=args.resolution, site_=site, dataset_=args.dataset,
+                                 scratch_=args.scratch, keep_intermediates_=args.keep_intermediates, map_columns_=args.map_columns)
+        if any(summary['status'] == 'failed' for summary in summaries):
+            sys.exit(1)
+        return
+
+    # stored results: known structures are not run again (only the ID and the output directory are needed)
+    if args.store is not None and not args.validate:
+        check_required_arguments(args, ['pdb_file', 'outdir'])
+        if not os.path.isdir(args.outdir):
+            raise NotADirectoryError(args.outdir)
+        pdb_id = get_pdb_id(args.pdb_file)
+        with ResultStore(args.store) as store:
+            if store.has_entry(pdb_id):
+                n_waters = store.write_results_csv(pdb_id, os.path.join(args.outdir, pdb_id + '_ColdBrew_results.csv'))
+                print('found ' + pdb_id + ' in ' + args.store + ', saved the results of ' + str(n_waters) + ' waters...')
+                return
+
+    # validate environment variables and check files
+    check_env_variables(required_env_variables(backends))
     check_argument_files(args)
-    for arg_name, value in vars(args).items():
-        globals()[arg_name] = value
 
-    # get ID to use for output and setup files for calculation
-    pdb_id = pdb_file[pdb_file.rfind('/') + 1: -4]
+    # get ID to use for output and run the pipeline
+    pdb_id = get_pdb_id(args.pdb_file)
     print('using ' + pdb_id + ' as the ID...')
-    do_setup(pdb_file, pdb_id, outdir)
-
-    # run calculations
-    run_calculations(pdb_file, pdb_id, mtz_file, ccp4_file, outdir)
-
-    # parse raw datafiles
-    parse_raw_datafiles(pdb_file, pdb_id, outdir)
-
-    # read in parsed data    
-    df_out = read_in_parsed_data(pdb_id, outdir)
-
-    # calculate CB prob and save results
-    calculate_CB_prob(pdb_file, pdb_id, outdir, df_out)
+    if args.validate:
+        validate_inputs(args.pdb_file, pdb_id, args.ccp4_file, backends_=backends, resolution_=args.resolution, mtz_file_=args.mtz_file, map_columns_=args.map_columns)
+        print('inputs are valid')
+        return
+    from functions.pipeline import run_pipeline
+    run_pipeline(args.pdb_file, pdb_id, args.mtz_file, args.ccp4_file, args.outdir, n_workers_=args.nproc, write_parsed_=args.write_parsed, cache_=cache, backends_=backends,
+                 resolution_=args.resolution, openmetrics_=args.openmetrics, previous_=args.previous, site_=site, dataset_=args.dataset, scratch_=args.scratch,
+                 keep_intermediates_=args.keep_intermediates, map_columns_=args.map_columns)
+    if args.store is not None:
+        with ResultStore(args.store) as store:
+            store.ingest_file(os.path.join(args.outdir, pdb_id + '_ColdBrew_results.csv'), pdb_id)
+        print('added the results to ' + args.store + '...')
 
 if __name__ == "__main__":
     main()
@@ -16,7 +16,11 @@
 
 
 from pymol import cmd
+import sys
+import json
+import time
 import argparse
+import resource
 
 #arg parse functions
 
@@ -27,6 +31,8 @@ def cmd_lineparser():
                         action='store', help='')
     parser.add_argument('-o', dest='outdir', default='.', type=str,
 			action='store', help='')
+    parser.add_argument('-worker', dest='worker', action='store_true',
+                        help='Stay running and add hydrogens to each structure sent on stdin (see functions/pymol_worker.py).')
 
     return parser.parse_args()
 
@@ -36,11 +42,35 @@ def add_hydrogens(pdb_id, outdir):
     cmd.do('h_add')
     cmd.save( outdir + '/' + pdb_id + '_renumber_pymolH.pdb' )
 
+def serve_jobs():
+    # one job per line on stdin ({"id": ..., "outdir": ...}); each result is printed as one line after the marker, other
+    # output of PyMOL is sent back as the log of the job
+    print('COLDBREW_READY', flush=True)
+    for line in sys.stdin:
+        job = json.loads(line)
+        start, usage = time.process_time(), resource.getrusage(resource.RUSAGE_SELF)
+        result = {'ok': True, 'error': ''}
+        try:
+            # jobs do not see each other's objects
+            cmd.delete('all')
+            add_hydrogens(job['id'], job['outdir'])
+        except Exception as e:
+            result = {'ok': False, 'error': type(e).__name__ + ': ' + str(e)}
+        finally:
+            cmd.delete('all')
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        result.update({'cpu_seconds': round(time.process_time() - start, 4), 'max_rss_mb': round(end_usage.ru_maxrss / 1024, 2),
+                       'read_bytes': (end_usage.ru_inblock - usage.ru_inblock) * 512, 'write_bytes': (end_usage.ru_oublock - usage.ru_oublock) * 512})
+        print('COLDBREW_RESULT ' + json.dumps(result), flush=True)
+
 def main():
 
     args = cmd_lineparser()
 
-    add_hydrogens(args.pdb_id, args.outdir)
+    if args.worker:
+        serve_jobs()
+    else:
+        add_hydrogens(args.pdb_id, args.outdir)
     
 if __name__ == "pymol":   
     main()
@@ -0,0 +1,76 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Adds existing results CSV files (e.g., the output directories of earlier batches) to a Parquet dataset of results,
+# and queries it by ID and probability range (see functions/dataset.py; needs pyarrow).
+# usage: python scripts/coldbrew_dataset.py -dataset /path/to/dataset -ingest /path/to/batch_outdir
+#        python scripts/coldbrew_dataset.py -dataset /path/to/dataset -compact
+#        python scripts/coldbrew_dataset.py -dataset /path/to/dataset -query 6GPW 1ABC [-min_prob 0.8] [-max_prob 1] [-o waters.csv]
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from functions.store import find_result_files, results_suffix
+from functions.dataset import import_pyarrow, write_structure_results, read_results, compact_dataset
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-dataset', dest='dataset', type=str, required=True, help='Directory of the Parquet dataset (created if missing).')
+    parser.add_argument('-ingest', dest='ingest', type=str, nargs='+', default=None, help='Results CSV files (<ID>_ColdBrew_results.csv) or directories to add to the dataset.')
+    parser.add_argument('-model_version', dest='model_version', type=str, default=None, help='Ingest: version of the model that made the ingested results (default: not recorded).')
+    parser.add_argument('-compact', dest='compact', action='store_true', help='Merge the files of each partition into one file (do not add to the dataset meanwhile).')
+    parser.add_argument('-query', dest='query', type=str, nargs='*', default=None, help='IDs of the structures to print (no IDs: all structures).')
+    parser.add_argument('-min_prob', dest='min_prob', type=float, default=None, help='Query: only the waters with at least this ColdBrew probability.')
+    parser.add_argument('-max_prob', dest='max_prob', type=float, default=None, help='Query: only the waters with at most this ColdBrew probability.')
+    parser.add_argument('-o', dest='out_file', type=str, default=None, help='Query: save the waters as CSV (or Parquet for a .parquet path) instead of printing them.')
+    args = parser.parse_args()
+
+    import_pyarrow()
+    import pandas as pd
+
+    if args.ingest is not None:
+        start = time.time()
+        files = [path for path in find_result_files(args.ingest) if os.path.basename(path).endswith(results_suffix)]
+        n_waters = 0
+        for i, results_file in enumerate(files):
+            pdb_id = os.path.basename(results_file)[:-len(results_suffix)]
+            df_results = pd.read_csv(results_file, index_col=0)
+            # results files keep their modification time as the time of the run
+            write_structure_results(args.dataset, pdb_id, df_results, args.model_version, None, os.path.getmtime(results_file))
+            n_waters += len(df_results.index)
+            print(str(i + 1) + '/' + str(len(files)) + ' ' + results_file + ': ' + str(len(df_results.index)) + ' waters')
+        print('ingested ' + str(len(files)) + ' structures (' + str(n_waters) + ' waters) in ' + '%.1f' % (time.time() - start) + ' s')
+
+    if args.compact:
+        start = time.time()
+        n_before, n_after = compact_dataset(args.dataset)
+        print('compacted ' + str(n_before) + ' files into ' + str(n_after) + ' in ' + '%.1f' % (time.time() - start) + ' s')
+
+    if args.query is not None:
+        df = read_results(args.dataset, args.query, args.min_prob, args.max_prob)
+        if args.out_file is None:
+            df.to_csv(sys.stdout, index=False)
+        elif args.out_file.endswith('.parquet'):
+            df.to_parquet(args.out_file, index=False)
+        else:
+            df.to_csv(args.out_file, index=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Adds structure jobs to a work queue (see functions/job_queue.py) and reports its status; the jobs are run by
+# python run_coldbrew.py -queue jobs.sqlite -o /path/to/outdir -npool 8 on each node.
+# usage: python scripts/coldbrew_queue.py -queue jobs.sqlite -add manifest.csv
+#        python scripts/coldbrew_queue.py -queue jobs.sqlite -status [-job 6GPW]
+#        python scripts/coldbrew_queue.py -queue jobs.sqlite -requeue_failed
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from functions.batch import read_manifest
+from functions.job_queue import JobQueue, default_max_attempts
+
+def format_age(seconds_):
+    return '-' if seconds_ is None else '%.0f s ago' % (time.time() - seconds_)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-queue', dest='queue', type=str, required=True, help='Path to the SQLite work queue (created if missing).')
+    parser.add_argument('-add', dest='add', type=str, default=None, help='Manifest (CSV/TSV with the columns id, pdb, mtz, ccp4) of the structures to add to the queue.')
+    parser.add_argument('-requeue', dest='requeue', action='store_true', help='With -add: queue the structures already in the queue again (e.g., with new files).')
+    parser.add_argument('-requeue_failed', dest='requeue_failed', action='store_true', help='Queue the failed jobs again, with no attempts.')
+    parser.add_argument('-status', dest='status', action='store_true', help='Print the number of jobs of each status, the running jobs, and the failed jobs with their error.')
+    parser.add_argument('-job', dest='job', type=str, default=None, help='Print the attempts and the stages of each attempt of this job.')
+    parser.add_argument('-max_attempts', dest='max_attempts', type=int, default=default_max_attempts, help='Attempts of a job before it fails for good (default: 3).')
+    args = parser.parse_args()
+
+    with JobQueue(args.queue, max_attempts_=args.max_attempts) as queue:
+        if args.add is not None:
+            n_added = queue.add_jobs(read_manifest(args.add), args.requeue)
+            print('added ' + str(n_added) + ' jobs to ' + args.queue)
+
+        if args.requeue_failed:
+            print('queued ' + str(queue.requeue_failed()) + ' failed jobs again')
+
+        if args.status:
+            counts = queue.counts()
+            print(', '.join(str(n) + ' ' + status for status, n in counts.items()))
+            for job in queue.jobs('running'):
+                print('running\t' + job['id'] + '\tattempt ' + str(job['attempts']) + '\t' + str(job['worker']) + '\theartbeat ' + format_age(job['heartbeat']))
+            for job in queue.jobs('failed'):
+                print('failed\t' + job['id'] + '\tattempts ' + str(job['attempts']) + '\t' + (job['failed_stage'] or '-') + '\t' + str(job['error']))
+
+        if args.job is not None:
+            attempts = queue.attempts(args.job)
+            if not attempts:
+                print(args.job + ' is not in the queue or has not run.')
+                sys.exit(1)
+            for attempt in attempts:
+                print('attempt ' + str(attempt['attempt']) + '\t' + str(attempt['worker']) + '\t' + str(attempt['status']) + ('\t' + attempt['error'] if attempt['error'] else ''))
+                for stage, status, seconds, cached in queue.stages(attempt['lease']):
+                    print('\t' + stage + '\t' + str(status) + '\t' + ('-' if seconds is None else '%.2f s' % seconds) + ('\tcached' if cached else ''))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Ingests ColdBrew results (the precomputed probabilities of the PDB, results CSV files, or batch output directories)
+# into a local store, and queries it.
+# usage: python scripts/coldbrew_store.py -store coldbrew.sqlite -ingest /path/to/dump.csv.gz /path/to/batch_outdir
+#        python scripts/coldbrew_store.py -store coldbrew.sqlite -query 6GPW [-chain A] [-wat 401]
+
+import os
+import sys
+import csv
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from functions.store import ResultStore, find_result_files, result_columns, format_value
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-store', dest='store', type=str, required=True, help='Path to the SQLite store (created if missing).')
+    parser.add_argument('-ingest', dest='ingest', type=str, nargs='+', default=None, help='Results files (CSV/TSV, optionally gzipped) or directories to ingest.')
+    parser.add_argument('-id', dest='pdb_id', type=str, default=None, help='PDB ID of an ingested file without a PDB ID column (default: from the file name <ID>_ColdBrew_results.csv).')
+    parser.add_argument('-query', dest='query', type=str, default=None, help='PDB ID of the structure to print.')
+    parser.add_argument('-chain', dest='chain', type=str, default=None, help='Query: only the waters of this chain.')
+    parser.add_argument('-wat', dest='wat_ID', type=int, default=None, help='Query: only the water with this residue number.')
+    parser.add_argument('-list', dest='list', action='store_true', help='Print the stored structures.')
+    args = parser.parse_args()
+
+    with ResultStore(args.store) as store:
+        if args.ingest is not None:
+            start = time.time()
+            files = find_result_files(args.ingest)
+            n_structures, n_waters = 0, 0
+            for i, results_file in enumerate(files):
+                try:
+                    counts = store.ingest_file(results_file, args.pdb_id)
+                except ValueError as e:
+                    # other CSV files of the directories (e.g., batch_summary.csv)
+                    print('skipping ' + results_file + ': ' + str(e))
+                    continue
+                n_structures += len(counts)
+                n_waters += sum(counts.values())
+                print(str(i + 1) + '/' + str(len(files)) + ' ' + results_file + ': ' + str(len(counts)) + ' structures, ' + str(sum(counts.values())) + ' waters')
+            print('ingested ' + str(n_structures) + ' structures (' + str(n_waters) + ' waters) in ' + '%.1f' % (time.time() - start) + ' s')
+
+        if args.list:
+            for pdb_id, n_waters, source in store.entries():
+                print(pdb_id + '\t' + str(n_waters) + '\t' + str(source))
+
+        if args.query is not None:
+            rows = store.query(args.query, args.chain, args.wat_ID)
+            if not store.has_entry(args.query):
+                print(args.query + ' is not in the store.')
+                sys.exit(1)
+            writer = csv.writer(sys.stdout, lineterminator='\n')
+            writer.writerow(result_columns)
+            for row in rows:
+                writer.writerow(['' if row[column] is None else format_value(row[column]) for column in result_columns])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Compares the features of the native backends with the results of the external programs (parity and calibration report).
+# usage: python scripts/compare_backends.py -pdb demo/6GPW.pdb -results demo/out_6GPW/6GPW_ColdBrew_results.csv \
+#            -hb2 demo/out_6GPW/raw_data_files/6GPW_renumber_pymolH.hb2 -hydrogens demo/out_6GPW/6GPW_renumber_pymolH.pdb \
+#            -ccp4 /path/to/6GPW_2mFo-DFc_map.ccp4
+# parity check of the native hydrogen-bond counter (exits with 1 if it regresses): python scripts/compare_backends.py -check
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from functions.structure import read_structure, get_water_frame
+from functions.data_parsing import calc_SASA_native, calc_HB_native, read_in_HB, calc_RSCC_native, calc_EDIA_native
+from functions.ccp4 import read_ccp4_map
+from functions.hbonds import count_water_HB
+
+# -check: the demo structure, its HBPLUS output and hydrogenated structure, and the waters allowed to differ from HBPLUS
+# when the water hydrogens added by PyMOL are given (2 side-chain counts of 6GPW)
+demo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'demo')
+check_files = {
+    'pdb_file': os.path.join(demo_dir, '6GPW.pdb'),
+    'results_file': os.path.join(demo_dir, 'out_6GPW', '6GPW_ColdBrew_results.csv'),
+    'hb2_file': os.path.join(demo_dir, 'out_6GPW', 'raw_data_files', '6GPW_renumber_pymolH.hb2'),
+    'hydrogens_file': os.path.join(demo_dir, 'out_6GPW', '6GPW_renumber_pymolH.pdb')
+}
+max_HB_mismatches = 2
+
+def compare_feature(feature_, native_, reference_):
+    """
+    Prints the agreement of the native values of a feature with the reference values, and the linear fit of the
+    reference values on the native values (calibration).
+
+    Args:
+        feature_ (str): Name of the feature.
+        native_ (numpy.ndarray): Values of the native backend.
+        reference_ (numpy.ndarray): Values of the external program.
+
+    Returns:
+        None
+    """
+
+    native_ = np.asarray(native_, dtype=float)
+    reference_ = np.asarray(reference_, dtype=float)
+    diff = np.abs(native_ - reference_)
+    slope, intercept = np.polyfit(native_, reference_, 1)
+    print(feature_ + ': n=' + str(len(diff)) + ', mean abs diff=' + '%.3f' % diff.mean() + ', max abs diff=' + '%.3f' % diff.max() +
+          ', identical=' + str(int((diff == 0).sum())) + ', r=' + '%.5f' % np.corrcoef(native_, reference_)[0, 1] +
+          ', mean=' + '%.3f' % native_.mean() + ' (reference ' + '%.3f' % reference_.mean() + ')' +
+          ', fit: reference = ' + '%.3f' % slope + ' * native + ' + '%.3f' % intercept)
+
+def check_HB_parity(structure_, df_wat_, hb2_file_, hydrogens_file_, max_mismatches_=max_HB_mismatches):
+    """
+    Checks that the native hydrogen-bond counter classifies the partners of the waters as HBPLUS does: with the water
+    hydrogens HBPLUS used, the main-chain (HB_M) and side-chain (HB_S) counts of at most max_mismatches_ waters may differ.
+
+    Returns:
+        bool: True if the check passes.
+    """
+
+    df_HB_ref = read_in_HB(df_wat_, hb2_file_)
+    n_HB_M, n_HB_S = count_water_HB(structure_, read_water_hydrogens(hydrogens_file_, len(df_wat_.index)))
+    mismatched = (n_HB_M != df_HB_ref['HB_M'].values) | (n_HB_S != df_HB_ref['HB_S'].values)
+    passed = mismatched.sum() <= max_mismatches_
+    print('HB parity with HBPLUS (water hydrogens of ' + os.path.basename(hydrogens_file_) + '): ' + str(int((~mismatched).sum())) + ' of ' +
+          str(len(mismatched)) + ' waters match (at most ' + str(max_mismatches_) + ' may differ): ' + ('passed' if passed else 'FAILED'))
+    if mismatched.any():
+        print('differing waters (renumbered ID: native HB_M/HB_S, HBPLUS HB_M/HB_S): ' + ', '.join(
+            str(ID) + ': ' + str(n_HB_M[i]) + '/' + str(n_HB_S[i]) + ', ' + str(int(df_HB_ref['HB_M'].values[i])) + '/' + str(int(df_HB_ref['HB_S'].values[i]))
+            for i, ID in zip(np.flatnonzero(mismatched), df_wat_['residue_number'].values[mismatched])))
+    return passed
+
+def read_water_hydrogens(hydrogens_file_, n_waters_):
+    """
+    Reads the water hydrogens of a hydrogenated renumbered structure (e.g., <ID>_renumber_pymolH.pdb).
+
+    Args:
+        hydrogens_file_ (str): Path to the hydrogenated PDB file.
+        n_waters_ (int): Number of waters.
+
+    Returns:
+        numpy.ndarray: (n_waters, 2, 3) array of hydrogen coordinates (NaN for missing hydrogens).
+    """
+
+    structure_H = read_structure(hydrogens_file_)
+    H_index = structure_H.select(record_='HETATM', residue_name_='HOH', element_='H')
+    water_hydrogens = np.full((n_waters_, 2, 3), np.nan)
+    n_added = np.zeros(n_waters_, dtype=int)
+    for wat_ID, xyz in zip(structure_H.column('residue_number')[H_index], structure_H.coords(H_index)):
+        if n_added[wat_ID - 1] < 2:
+            water_hydrogens[wat_ID - 1, n_added[wat_ID - 1]] = xyz
+            n_added[wat_ID - 1] += 1
+    return water_hydrogens
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-check', dest='check', action='store_true', help='Check the parity of the native hydrogen-bond counter with HBPLUS on the 6GPW demo (or the given files) and exit with 1 if it regresses.')
+    parser.add_argument('-max_mismatches', dest='max_mismatches', type=int, default=max_HB_mismatches, help='With -check: waters whose counts may differ from HBPLUS (default: 2, those of the demo).')
+    parser.add_argument('-pdb', dest='pdb_file', type=str, default=None, help='Path to the input PDB file.')
+    parser.add_argument('-results', dest='results_file', type=str, default=None, help='ColdBrew results CSV of the same structure calculated with the external programs.')
+    parser.add_argument('-hb2', dest='hb2_file', type=str, default=None, help='HBPLUS output of the same structure (<ID>_renumber_pymolH.hb2) to compare the main- and side-chain counts.')
+    parser.add_argument('-hydrogens', dest='hydrogens_file', type=str, default=None, help='Hydrogenated structure used by HBPLUS (<ID>_renumber_pymolH.pdb). The hydrogen bonds are also counted with its water hydrogens, which checks the criteria independently of the orientation of the waters.')
+    parser.add_argument('-ccp4', dest='ccp4_file', type=str, default=None, help='CCP4 map (2mFo-DFc) of the structure to compare the native RSCC and EDIA.')
+    parser.add_argument('-resolution', dest='resolution', type=float, default=None, help='Resolution of the map for the native RSCC and EDIA (default: estimated from the map grid).')
+    args = parser.parse_args()
+
+    if args.check:
+        for name, path in check_files.items():
+            if getattr(args, name) is None:
+                setattr(args, name, path)
+        structure = read_structure(args.pdb_file)
+        if not check_HB_parity(structure, get_water_frame(structure), args.hb2_file, args.hydrogens_file, args.max_mismatches):
+            sys.exit(1)
+        return
+    if args.pdb_file is None or args.results_file is None:
+        parser.error('-pdb and -results are required (except with -check)')
+
+    structure = read_structure(args.pdb_file)
+    df_wat = get_water_frame(structure)
+    df_ref = pd.read_csv(args.results_file)
+    if len(df_ref.index) != len(df_wat.index):
+        raise ValueError('The results file has ' + str(len(df_ref.index)) + ' waters, the structure has ' + str(len(df_wat.index)) + '.')
+    df_ref = df_ref.set_index('wat_ID_renumbered').loc[df_wat['residue_number']]
+
+    compare_feature('SASA', calc_SASA_native(structure, df_wat).values, df_ref['SASA'].values)
+    df_HB = calc_HB_native(structure, df_wat)
+    compare_feature('HB', (df_HB['HB_M'] + df_HB['HB_S']).values, df_ref['HB'].values)
+
+    if args.ccp4_file is not None:
+        density_map = read_ccp4_map(args.ccp4_file)
+        RSCC = calc_RSCC_native(structure, df_wat, density_map, args.resolution).values
+        EDIA = calc_EDIA_native(structure, df_wat, density_map, args.resolution).values
+        # waters not covered by the map (-1) are left out
+        covered = (RSCC != -1) & (EDIA != -1) & (df_ref['EDIA'].values != -1)
+        print('waters not covered by the map: ' + str(int(((RSCC == -1) | (EDIA == -1)).sum())) + ' (native), ' + str(int((df_ref['EDIA'].values == -1).sum())) + ' (reference EDIA)')
+        compare_feature('RSCC', RSCC[covered], df_ref['RSCC'].values[covered])
+        compare_feature('EDIA', EDIA[covered], df_ref['EDIA'].values[covered])
+
+    if args.hb2_file is not None:
+        df_HB_ref = read_in_HB(df_wat, args.hb2_file)
+        compare_feature('HB_M', df_HB['HB_M'].values, df_HB_ref['HB_M'].values)
+        compare_feature('HB_S', df_HB['HB_S'].values, df_HB_ref['HB_S'].values)
+        if args.hydrogens_file is not None:
+            n_HB_M, n_HB_S = count_water_HB(structure, read_water_hydrogens(args.hydrogens_file, len(df_wat.index)))
+            compare_feature('HB_M (water hydrogens of ' + os.path.basename(args.hydrogens_file) + ')', n_HB_M, df_HB_ref['HB_M'].values)
+            compare_feature('HB_S (water hydrogens of ' + os.path.basename(args.hydrogens_file) + ')', n_HB_S, df_HB_ref['HB_S'].values)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#    ColdBrew
+#    Copyright (C) 2024 Justin Seffernick and Marcus Fischer, St. Jude Children's Research Hospital
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Compiles the scikit-learn model (model/model.joblib) into NumPy arrays (model/model_forest.npz), the model used by
+# ColdBrew, and checks that both give the same probabilities.
+# usage: python scripts/export_model.py [-model model/model.joblib] [-out model/model_forest.npz] [-check results.csv ...]
+
+import os
+import sys
+import argparse
+import joblib
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from functions.forest import compile_forest, save_forest, load_forest
+from functions.data_analysis import feature_cols
+
+def main():
+    model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-model', dest='model_file', type=str, default=os.path.join(model_dir, 'model.joblib'), help='Path to the scikit-learn model.')
+    parser.add_argument('-out', dest='forest_file', type=str, default=os.path.join(model_dir, 'model_forest.npz'), help='Path of the compiled model.')
+    parser.add_argument('-check', dest='check_files', type=str, nargs='*', default=[], help='ColdBrew results CSV files whose features are also scored by both models.')
+    args = parser.parse_args()
+
+    model = joblib.load(args.model_file)
+    save_forest(compile_forest(model), args.forest_file)
+    forest = load_forest(args.forest_file)
+    print('saved ' + args.forest_file + ' (' + str(len(forest.roots)) + ' trees, ' + str(len(forest.feature)) + ' nodes)')
+
+    # random features around the ranges of the model, the thresholds themselves, and the features of results files
+    rng = np.random.default_rng(0)
+    checks = [pd.DataFrame(rng.uniform([-1, -3, 0, 0, -1], [1, 5, 100, 6, 2], (100000, len(feature_cols))), columns=feature_cols)]
+    is_split = forest.feature >= 0
+    thresholds = np.tile(np.median(checks[0].values, axis=0), (int(is_split.sum()), 1))
+    thresholds[np.arange(len(thresholds)), forest.feature[is_split]] = forest.threshold[is_split]
+    checks.append(pd.DataFrame(thresholds, columns=feature_cols))
+    checks += [pd.read_csv(check_file)[feature_cols] for check_file in args.check_files]
+    for df_features in checks:
+        if not np.array_equal(model.predict_proba(df_features), forest.predict_proba(df_features)):
+            raise ValueError('The compiled model does not give the same probabilities as ' + args.model_file + '.')
+    print('the compiled model gives the same probabilities on ' + str(sum(len(df.index) for df in checks)) + ' samples')
+
+if __name__ == "__main__":
+    main()